@@ -0,0 +1,66 @@
+from bisect import bisect_right, insort
+from collections import deque
+from typing import Deque, List
+
+
+class OutputLengthEstimator:
+    """Online estimate of the number of tokens the requests generate.
+
+    Keeps the output lengths of the last window finished requests, sorted,
+    and estimates the output length of a request as the given quantile of
+    the lengths of the requests that generated more tokens than it has so
+    far. A request that outlives its estimate is estimated again, from the
+    longer requests only.
+
+    A deployment serves a single model with a single prompt format, so one
+    estimator is learned per deployment.
+
+    Args:
+        quantile (float): Quantile of the output lengths to estimate. The
+            higher, the fewer requests generate more tokens than estimated.
+        window (int): Number of finished requests to learn from.
+        min_samples (int): Until this many requests finished, the estimate
+            is max_new_tokens.
+    """
+
+    def __init__(
+        self, quantile: float = 0.9, window: int = 1000, min_samples: int = 100
+    ):
+        if not 0 < quantile <= 1:
+            raise ValueError(f"quantile must be in (0, 1], got {quantile}")
+        self.quantile = quantile
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Deque[int] = deque()
+        self._sorted_samples: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def observe(self, num_tokens: int):
+        """Record the output length of a finished request."""
+        self._samples.append(num_tokens)
+        insort(self._sorted_samples, num_tokens)
+        if len(self._samples) > self.window:
+            oldest = self._samples.popleft()
+            del self._sorted_samples[bisect_right(self._sorted_samples, oldest) - 1]
+
+    def estimate(self, num_generated: int, max_new_tokens: int) -> int:
+        """Estimate the output length of a request.
+
+        Args:
+            num_generated (int): Tokens the request generated so far.
+            max_new_tokens (int): Max tokens the request can generate.
+
+        Returns:
+            The estimated number of tokens, between num_generated + 1 and
+            max_new_tokens.
+        """
+        if len(self._samples) < self.min_samples:
+            return max_new_tokens
+        start = bisect_right(self._sorted_samples, num_generated)
+        num_longer = len(self._sorted_samples) - start
+        if not num_longer:
+            return max_new_tokens
+        index = start + min(num_longer - 1, int(self.quantile * num_longer))
+        return min(max_new_tokens, self._sorted_samples[index])
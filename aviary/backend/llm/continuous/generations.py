@@ -0,0 +1,126 @@
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from text_generation_server.models.types import Generation
+
+
+class GeneratedText(NamedTuple):
+    text: str
+    generated_tokens: int
+    # 0 is length, otherwise EOS or a stop sequence.
+    finish_reason: int
+
+
+class TokenGeneration(NamedTuple):
+    """The token generated for a request by a step, with the fields of the
+    TGI Generation the scheduler uses."""
+
+    request_id: int
+    token_id: int
+    token_logprob: float
+    token_text: str
+    token_is_special: bool
+    # Set once the request finished.
+    generated_text: Optional[GeneratedText]
+
+
+@dataclass
+class GenerationColumns:
+    """The generations of a step, stored as one array per field, so that
+    they are serialized as a few buffers instead of a tree of objects per
+    request.
+
+    The text of each token is an index into texts, which holds each
+    distinct text once. The generated texts of the finished requests are
+    in finished_texts, in the order of the requests. The prefill tokens are
+    dropped, the scheduler doesn't use them.
+    """
+
+    request_ids: np.ndarray
+    token_ids: np.ndarray
+    token_logprobs: np.ndarray
+    token_is_special: np.ndarray
+    token_text_indices: np.ndarray
+    texts: List[str]
+    # -1 while the request is unfinished.
+    finish_reasons: np.ndarray
+    generated_tokens: np.ndarray
+    finished_texts: List[str]
+
+    @classmethod
+    def from_generations(
+        cls, generations: Sequence["Generation"]
+    ) -> "GenerationColumns":
+        text_indices: Dict[str, int] = {}
+        finish_reasons = np.full(len(generations), -1, dtype=np.int8)
+        generated_tokens = np.zeros(len(generations), dtype=np.int32)
+        finished_texts = []
+        for i, generation in enumerate(generations):
+            text_indices.setdefault(generation.token_text, len(text_indices))
+            generated_text = generation.generated_text
+            if generated_text is not None:
+                finish_reasons[i] = generated_text.finish_reason
+                generated_tokens[i] = generated_text.generated_tokens
+                finished_texts.append(generated_text.text)
+        return cls(
+            request_ids=np.fromiter(
+                (g.request_id for g in generations), np.int64, len(generations)
+            ),
+            token_ids=np.fromiter(
+                (g.token_id for g in generations), np.int64, len(generations)
+            ),
+            token_logprobs=np.fromiter(
+                (g.token_logprob for g in generations), np.float32, len(generations)
+            ),
+            token_is_special=np.fromiter(
+                (g.token_is_special for g in generations), np.bool_, len(generations)
+            ),
+            token_text_indices=np.fromiter(
+                (text_indices[g.token_text] for g in generations),
+                np.int32,
+                len(generations),
+            ),
+            texts=list(text_indices),
+            finish_reasons=finish_reasons,
+            generated_tokens=generated_tokens,
+            finished_texts=finished_texts,
+        )
+
+    def __len__(self) -> int:
+        return len(self.request_ids)
+
+    def to_generations(self) -> List[TokenGeneration]:
+        texts = self.texts
+        finished_texts = iter(self.finished_texts)
+        return [
+            TokenGeneration(
+                request_id,
+                token_id,
+                token_logprob,
+                texts[text_index],
+                token_is_special,
+                None
+                if finish_reason < 0
+                else GeneratedText(next(finished_texts), num_tokens, finish_reason),
+            )
+            for (
+                request_id,
+                token_id,
+                token_logprob,
+                token_is_special,
+                text_index,
+                finish_reason,
+                num_tokens,
+            ) in zip(
+                self.request_ids.tolist(),
+                self.token_ids.tolist(),
+                self.token_logprobs.tolist(),
+                self.token_is_special.tolist(),
+                self.token_text_indices.tolist(),
+                self.finish_reasons.tolist(),
+                self.generated_tokens.tolist(),
+            )
+        ]
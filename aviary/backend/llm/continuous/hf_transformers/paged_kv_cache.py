@@ -0,0 +1,432 @@
+import contextlib
+import functools
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+
+
+class KVCacheFullError(RuntimeError):
+    """Raised when a paged KV cache has no free block left. Its message
+    says "out of memory", so that the step fails like an OOM and the
+    scheduler preempts requests."""
+
+
+class BlockManager:
+    """Hands out the fixed size blocks of a paged KV cache to sequences.
+
+    A sequence owns a block table, the blocks holding its tokens in order,
+    so its memory follows the tokens it has rather than the longest
+    sequence of its batch, and giving a sequence back frees its blocks right
+    away. Blocks are reference counted, so that sequences can share them:
+
+    - The full blocks of prompts are shared by the sequences whose prompts
+      start with the same tokens, like a common system prompt. A block is
+      identified by its tokens and by the block before it, which is itself
+      shared, so two blocks match only if the whole prefix does.
+    - fork gives a sequence a copy of the block table of another one.
+      Writing into a shared block copies it first, see append_slot.
+
+    Args:
+        num_blocks (int): Number of blocks of the cache.
+        block_size (int): Number of tokens per block.
+    """
+
+    def __init__(self, num_blocks: int, block_size: int):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        # Popped from the end, so that the lowest blocks go first.
+        self._free_blocks = list(range(num_blocks - 1, -1, -1))
+        self._ref_counts = [0] * num_blocks
+        # Full prompt blocks, by the block before them and their tokens.
+        self._full_blocks: Dict[Tuple[int, Tuple[int, ...]], int] = {}
+        self._block_keys: Dict[int, Tuple[int, Tuple[int, ...]]] = {}
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self._free_blocks)
+
+    @property
+    def num_used_blocks(self) -> int:
+        return self.num_blocks - len(self._free_blocks)
+
+    def num_blocks_for(self, num_tokens: int) -> int:
+        return -(-num_tokens // self.block_size)
+
+    def ref_count(self, block: int) -> int:
+        return self._ref_counts[block]
+
+    def _take(self) -> int:
+        if not self._free_blocks:
+            raise KVCacheFullError(
+                f"The paged KV cache is out of memory, all of its "
+                f"{self.num_blocks} blocks are used."
+            )
+        block = self._free_blocks.pop()
+        self._ref_counts[block] = 1
+        return block
+
+    def allocate(self, token_ids: Sequence[int]) -> List[int]:
+        """The block table of a new sequence of tokens, sharing its full
+        blocks with the sequences that start the same way."""
+        self.check_free(self.num_new_blocks(token_ids))
+        block_table = []
+        previous = -1
+        for start in range(0, len(token_ids), self.block_size):
+            tokens = tuple(token_ids[start : start + self.block_size])
+            if len(tokens) < self.block_size:
+                block_table.append(self._take())
+                break
+            key = (previous, tokens)
+            block = self._full_blocks.get(key)
+            if block is None:
+                block = self._take()
+                self._full_blocks[key] = block
+                self._block_keys[block] = key
+            else:
+                self._ref_counts[block] += 1
+            block_table.append(block)
+            previous = block
+        return block_table
+
+    def num_new_blocks(self, token_ids: Sequence[int]) -> int:
+        """How many free blocks allocate(token_ids) takes."""
+        num_new_blocks = 0
+        previous = -1
+        for start in range(0, len(token_ids), self.block_size):
+            tokens = tuple(token_ids[start : start + self.block_size])
+            block = None
+            if len(tokens) == self.block_size:
+                block = self._full_blocks.get((previous, tokens))
+            if block is None:
+                # The blocks after a new one are new too.
+                return num_new_blocks + self.num_blocks_for(len(token_ids) - start)
+            previous = block
+        return num_new_blocks
+
+    def check_free(self, num_blocks: int):
+        """Raise KVCacheFullError if fewer than num_blocks blocks are free."""
+        if num_blocks > self.num_free_blocks:
+            raise KVCacheFullError(
+                f"The paged KV cache is out of memory, {num_blocks} blocks are "
+                f"needed but only {self.num_free_blocks} are free."
+            )
+
+    def num_blocks_to_append(self, block_table: List[int], position: int) -> int:
+        """How many free blocks append_slot(block_table, position) takes."""
+        if position // self.block_size == len(block_table):
+            return 1
+        return int(self._ref_counts[block_table[-1]] > 1)
+
+    def append_slot(
+        self, block_table: List[int], position: int
+    ) -> Tuple[int, Optional[Tuple[int, int]]]:
+        """Make room in a block table for the token at position, the one
+        after its last token.
+
+        A new block is taken when the last one is full. If the last one is
+        shared, it is replaced by a copy, which the caller has to make.
+        Appending at the same position again, like after a failed step,
+        takes nothing more.
+
+        Returns:
+            The slot of the token, block * block_size + offset, and the
+            source and destination blocks to copy, if any.
+        """
+        offset = position % self.block_size
+        copy = None
+        if position // self.block_size == len(block_table):
+            block_table.append(self._take())
+        elif self._ref_counts[block_table[-1]] > 1:
+            source = block_table[-1]
+            block_table[-1] = self._take()
+            self._ref_counts[source] -= 1
+            copy = (source, block_table[-1])
+        return block_table[-1] * self.block_size + offset, copy
+
+    def fork(self, block_table: List[int]) -> List[int]:
+        """A block table sharing all the blocks of another one."""
+        for block in block_table:
+            self._ref_counts[block] += 1
+        return list(block_table)
+
+    def free(self, block_table: List[int]):
+        """Give back the blocks of a sequence."""
+        for block in block_table:
+            self._ref_counts[block] -= 1
+            if self._ref_counts[block] == 0:
+                key = self._block_keys.pop(block, None)
+                if key is not None:
+                    del self._full_blocks[key]
+                self._free_blocks.append(block)
+        block_table.clear()
+
+
+class PagedKVCache:
+    """The keys and values of a paged KV cache, a tensor per layer with a
+    row per slot, [num_blocks * block_size, heads, head_dim], so that a
+    slot is found by its index alone.
+
+    Args:
+        num_blocks (int): Number of blocks.
+        block_size (int): Number of tokens per block.
+        num_layers (int): Number of layers of the model.
+        num_heads (int): Number of key and value heads.
+        head_dim (int): Size of a head.
+        dtype (torch.dtype): Type of the keys and values.
+        device (torch.device): Where to keep them.
+    """
+
+    def __init__(
+        self,
+        num_blocks: int,
+        block_size: int,
+        num_layers: int,
+        num_heads: int,
+        head_dim: int,
+        dtype: torch.dtype,
+        device: torch.device,
+    ):
+        self.block_manager = BlockManager(num_blocks, block_size)
+        self.block_size = block_size
+        shape = (num_blocks * block_size, num_heads, head_dim)
+        self.key_cache = [
+            torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)
+        ]
+        self.value_cache = [
+            torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)
+        ]
+
+    @property
+    def num_bytes(self) -> int:
+        return sum(
+            tensor.numel() * tensor.element_size()
+            for tensor in self.key_cache + self.value_cache
+        )
+
+    def write(
+        self,
+        slots: torch.Tensor,
+        past_key_values: Sequence[Tuple[torch.Tensor, torch.Tensor]],
+        rows: torch.Tensor,
+        columns: torch.Tensor,
+    ):
+        """Copy keys and values of a padded KV cache into slots.
+
+        Args:
+            slots (torch.Tensor): Slot of each token to copy.
+            past_key_values: The padded KV cache, [batch, heads, tokens,
+                head_dim] per layer.
+            rows (torch.Tensor): Row of each token to copy.
+            columns (torch.Tensor): Column of each token to copy.
+        """
+        for key_cache, value_cache, (keys, values) in zip(
+            self.key_cache, self.value_cache, past_key_values
+        ):
+            key_cache[slots] = keys[rows, :, columns]
+            value_cache[slots] = values[rows, :, columns]
+
+    def copy_blocks(self, copies: List[Tuple[int, int]]):
+        """Copy blocks, given by their source and destination."""
+        if not copies:
+            return
+        block_size = self.block_size
+        offsets = torch.arange(block_size, device=self.key_cache[0].device)
+        sources = torch.tensor([s for s, _ in copies], device=offsets.device)
+        destinations = torch.tensor([d for _, d in copies], device=offsets.device)
+        sources = (sources[:, None] * block_size + offsets).view(-1)
+        destinations = (destinations[:, None] * block_size + offsets).view(-1)
+        for cache in self.key_cache + self.value_cache:
+            cache[destinations] = cache[sources]
+
+    def block_table_tensor(self, block_tables: List[List[int]]) -> torch.Tensor:
+        """Block tables, [batch, max_blocks], padded with block 0."""
+        num_blocks = max(1, max(len(block_table) for block_table in block_tables))
+        return torch.tensor(
+            [table + [0] * (num_blocks - len(table)) for table in block_tables],
+            dtype=torch.long,
+            device=self.key_cache[0].device,
+        )
+
+    def slot_table(
+        self, block_tables: List[List[int]], context_lens: List[int], width: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """The slots of the tokens of sequences, right aligned in width
+        columns, like a left padded batch.
+
+        Returns:
+            The slots, [batch, width], and which of them hold a token.
+        """
+        device = self.key_cache[0].device
+        tables = self.block_table_tensor(block_tables)
+        lens = torch.tensor(context_lens, dtype=torch.long, device=device)
+        # Position of the token of each column in its sequence.
+        positions = torch.arange(width, device=device) - (width - lens)[:, None]
+        valid = positions >= 0
+        positions = positions.clamp(min=0)
+        blocks = torch.gather(tables, 1, positions // self.block_size)
+        slots = blocks * self.block_size + positions % self.block_size
+        return slots.masked_fill(~valid, 0), valid
+
+    def gather(self, slots: torch.Tensor) -> Tuple[Tuple[torch.Tensor, ...], ...]:
+        """The padded KV cache, [batch, heads, tokens, head_dim] per layer,
+        of the slots given by slot_table. The padding is garbage, it has to
+        be masked out."""
+        return tuple(
+            (
+                key_cache[slots].transpose(1, 2),
+                value_cache[slots].transpose(1, 2),
+            )
+            for key_cache, value_cache in zip(self.key_cache, self.value_cache)
+        )
+
+
+def paged_attention(
+    query: torch.Tensor,
+    key_cache: torch.Tensor,
+    value_cache: torch.Tensor,
+    block_tables: torch.Tensor,
+    context_lens: torch.Tensor,
+    block_size: int,
+    scale: Optional[float] = None,
+) -> torch.Tensor:
+    """Attention of the last tokens of sequences over their KV cache, read
+    through their block tables, with scaled_dot_product_attention.
+
+    The queries are the last query_len tokens of each sequence, which are
+    already in the cache, and each attends to the tokens up to itself.
+
+    Args:
+        query (torch.Tensor): [batch, heads, query_len, head_dim].
+        key_cache (torch.Tensor): Keys of a layer of a PagedKVCache,
+            [slots, kv_heads, head_dim]. With fewer heads than the query,
+            each is shared by a group of query heads.
+        value_cache (torch.Tensor): Values, like key_cache.
+        block_tables (torch.Tensor): Blocks of each sequence, [batch,
+            max_blocks], padded with any block.
+        context_lens (torch.Tensor): Number of tokens of each sequence,
+            [batch].
+        block_size (int): Number of tokens per block.
+        scale (Optional[float]): Scale of the attention scores, 1 /
+            sqrt(head_dim) by default.
+
+    Returns:
+        The attention output, [batch, heads, query_len, head_dim].
+    """
+    batch_size, num_heads, query_len, _ = query.shape
+    width = block_tables.shape[1] * block_size
+    offsets = torch.arange(block_size, device=block_tables.device)
+    slots = (block_tables[:, :, None] * block_size + offsets).view(batch_size, width)
+    keys = key_cache[slots].transpose(1, 2)
+    values = value_cache[slots].transpose(1, 2)
+    if keys.shape[1] != num_heads:
+        keys = keys.repeat_interleave(num_heads // keys.shape[1], dim=1)
+        values = values.repeat_interleave(num_heads // values.shape[1], dim=1)
+    # Query i of a sequence is its token context_len - query_len + i.
+    columns = torch.arange(width, device=query.device)
+    last_columns = (
+        context_lens[:, None] - query_len + torch.arange(query_len, device=query.device)
+    )
+    mask = columns[None, None, :] <= last_columns[:, :, None]
+    return F.scaled_dot_product_attention(
+        query, keys, values, attn_mask=mask[:, None], scale=scale
+    )
+
+
+class PagedAttentionInputs(NamedTuple):
+    """Where the new tokens of the sequences of a decode step go in a
+    PagedKVCache, and what they attend to."""
+
+    # Slot of each new token, [batch * query_len], sequence by sequence.
+    slots: torch.Tensor
+    # Blocks of each sequence, [batch, max_blocks], see block_table_tensor.
+    block_tables: torch.Tensor
+    # Number of tokens of each sequence, the new ones included, [batch].
+    context_lens: torch.Tensor
+
+
+class PagedAttention:
+    """Makes the attention layers of a GPT-2 model read their past from a
+    PagedKVCache, through the block tables of the sequences, instead of
+    taking a padded past.
+
+    Within decode, each attention layer writes the keys and values of the
+    new tokens into their slots, and runs paged_attention over the blocks
+    of the sequences. The model then returns no KV cache. Outside of it, the
+    layers run as usual, like for prefills.
+
+    Args:
+        model (PreTrainedModel): A GPT-2 model, see supports.
+        kv_cache (PagedKVCache): Its KV cache.
+    """
+
+    def __init__(self, model, kv_cache: PagedKVCache):
+        self.kv_cache = kv_cache
+        self.inputs: Optional[PagedAttentionInputs] = None
+        for layer, module in enumerate(_gpt2_attention_layers(model)):
+            module.forward = self._paged_forward(module, layer)
+
+    @staticmethod
+    def supports(model) -> bool:
+        """Whether the attention layers of a model can be paged: those of
+        GPT-2 models, unless they upcast and reorder their attention."""
+        layers = _gpt2_attention_layers(model)
+        return bool(layers) and not any(
+            module.is_cross_attention or module.reorder_and_upcast_attn
+            for module in layers
+        )
+
+    @contextlib.contextmanager
+    def decode(self, inputs: PagedAttentionInputs) -> Iterator[None]:
+        """Run the model on the new tokens given by inputs within."""
+        self.inputs = inputs
+        try:
+            yield
+        finally:
+            self.inputs = None
+
+    def _paged_forward(self, module, layer: int):
+        forward = module.forward
+
+        @functools.wraps(forward)
+        def paged_forward(hidden_states: torch.Tensor, *args, **kwargs):
+            inputs = self.inputs
+            if inputs is None:
+                return forward(hidden_states, *args, **kwargs)
+            num_heads, head_dim = module.num_heads, module.head_dim
+            query, key, value = (
+                module._split_heads(tensor, num_heads, head_dim)
+                for tensor in module.c_attn(hidden_states).split(
+                    module.split_size, dim=2
+                )
+            )
+            key_cache = self.kv_cache.key_cache[layer]
+            value_cache = self.kv_cache.value_cache[layer]
+            key_cache[inputs.slots] = key.transpose(1, 2).reshape(
+                -1, num_heads, head_dim
+            )
+            value_cache[inputs.slots] = value.transpose(1, 2).reshape(
+                -1, num_heads, head_dim
+            )
+            scale = head_dim**-0.5 if module.scale_attn_weights else 1.0
+            if module.scale_attn_by_inverse_layer_idx:
+                scale /= module.layer_idx + 1
+            output = paged_attention(
+                query,
+                key_cache,
+                value_cache,
+                inputs.block_tables,
+                inputs.context_lens,
+                self.kv_cache.block_size,
+                scale,
+            )
+            output = module._merge_heads(output, num_heads, head_dim)
+            return module.resid_dropout(module.c_proj(output)), None
+
+        return paged_forward
+
+
+def _gpt2_attention_layers(model) -> List[torch.nn.Module]:
+    from transformers.models.gpt2.modeling_gpt2 import GPT2Attention
+
+    return [module for module in model.modules() if isinstance(module, GPT2Attention)]
@@ -0,0 +1,738 @@
+import contextlib
+import copy
+import dataclasses
+import inspect
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers import (
+    LogitsProcessorList,
+    PreTrainedModel,
+    PreTrainedTokenizer,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+    TypicalLogitsWarper,
+)
+
+from aviary.backend.logger import get_logger
+
+from ..generations import GeneratedText, TokenGeneration
+from ..metrics import WorkerMetrics
+from ..prefix_cache import has_split_kv_cache
+from ..worker import AbstractInferenceWorker, StepFailedError, is_oom
+from .paged_kv_cache import PagedAttention, PagedAttentionInputs, PagedKVCache
+
+logger = get_logger(__name__)
+
+# The finish reasons of TGI.
+FINISH_REASON_LENGTH = 0
+FINISH_REASON_EOS_TOKEN = 1
+FINISH_REASON_STOP_SEQUENCE = 2
+
+
+@dataclass
+class TransformersRequest:
+    """A request of a TransformersInferenceWorker, with the parameters of a
+    TGI request.
+
+    Sampling is used if do_sample is set or any of temperature, top_k, top_p
+    and typical_p changes the distribution, like TGI does.
+    """
+
+    id: int
+    inputs: str
+    # Keep at most this many tokens of the prompt, the last ones.
+    truncate: int
+    max_new_tokens: int = 256
+    temperature: float = 1.0
+    repetition_penalty: float = 1.0
+    top_k: int = 0
+    top_p: float = 1.0
+    typical_p: float = 1.0
+    do_sample: bool = False
+    seed: int = 0
+    stop_sequences: List[str] = field(default_factory=list)
+    ignore_eos_token: bool = False
+
+
+class _Sequence:
+    """The tokens generated so far for a request, and how to pick the next
+    one."""
+
+    def __init__(
+        self,
+        request: TransformersRequest,
+        token_ids: List[int],
+        device: torch.device,
+    ):
+        self.request = request
+        self.token_ids = token_ids
+        self.num_input_tokens = len(token_ids)
+        # Where the text of the next token starts, see
+        # TransformersInferenceWorker._decode_token.
+        self.prefix_offset = max(len(token_ids) - 5, 0)
+        self.read_offset = len(token_ids)
+        # The end of the output, long enough to end with any stop sequence.
+        self.output_tail = ""
+        self.finished = False
+        # The blocks of the paged KV cache holding the first
+        # num_cached_tokens tokens, if the worker pages it.
+        self.block_table: List[int] = []
+        self.num_cached_tokens = 0
+
+        self.processors = LogitsProcessorList()
+        if request.repetition_penalty not in (None, 1.0):
+            self.processors.append(
+                RepetitionPenaltyLogitsProcessor(request.repetition_penalty)
+            )
+        num_processors = len(self.processors)
+        if request.temperature not in (None, 1.0) and request.temperature > 0:
+            self.processors.append(TemperatureLogitsWarper(request.temperature))
+        if request.top_k:
+            self.processors.append(TopKLogitsWarper(request.top_k))
+        if request.top_p is not None and request.top_p < 1.0:
+            self.processors.append(TopPLogitsWarper(request.top_p))
+        if request.typical_p is not None and request.typical_p < 1.0:
+            self.processors.append(TypicalLogitsWarper(request.typical_p))
+        self.generator = None
+        if request.do_sample or len(self.processors) > num_processors:
+            self.generator = torch.Generator(device).manual_seed(request.seed)
+
+    @property
+    def num_generated_tokens(self) -> int:
+        return len(self.token_ids) - self.num_input_tokens
+
+
+@dataclass
+class _Batch:
+    """A batch of requests, left padded to the longest."""
+
+    batch_id: int
+    sequences: List[_Sequence]
+    # Next input tokens, [batch, columns].
+    input_ids: torch.Tensor
+    # The past and the next input tokens, [batch, past + columns].
+    attention_mask: torch.Tensor
+    # Positions of the next input tokens, [batch, columns].
+    position_ids: torch.Tensor
+    # Per layer, a key and a value tensor, [batch, heads, past, head_dim].
+    # None if the worker pages the KV cache.
+    past_key_values: Optional[Tuple[Tuple[torch.Tensor, torch.Tensor], ...]] = None
+
+    def __len__(self) -> int:
+        return len(self.sequences)
+
+    @property
+    def past_length(self) -> int:
+        return self.attention_mask.shape[1] - self.input_ids.shape[1]
+
+    @property
+    def request_ids(self) -> List[int]:
+        return [
+            sequence.request.id for sequence in self.sequences if not sequence.finished
+        ]
+
+
+def _kv_cache_bytes(batch: _Batch) -> int:
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for layer in batch.past_key_values
+        for tensor in layer
+    )
+
+
+class TransformersInferenceWorker(AbstractInferenceWorker):
+    """Runs the batches of a Hugging Face causal LM, without TGI, so that
+    continuous batching works with any model transformers can load, on CPU
+    too.
+
+    Batches are padded: the prompts of a new batch are left padded to the
+    longest one and prefilled at once, and each decode step appends a column
+    to the KV cache of every row. Concatenating batches left pads them to
+    the longest past, filtering one drops the columns that only its removed
+    requests used. Both copy the KV cache, like TGI's padded batches.
+    Requests finish like TGI requests, and their rows stay in the batch
+    until they are filtered out.
+
+    With a kv_cache_block_size, the KV cache is paged instead: it is kept in
+    a PagedKVCache, sized by warmup for the max_batch_total_tokens of the
+    scheduler, and each sequence holds the blocks of its tokens, so filtering
+    and concatenating batches copy no KV cache, a finished request frees its
+    blocks when it is filtered out, and prompts starting with the same full
+    blocks share them. The attention layers of GPT-2 models read the past
+    of a decode step from the blocks, through the block tables of its
+    sequences, see PagedAttention. The other models of transformers take a
+    padded past, so a decode step gathers it from the blocks of the batch,
+    copying it, and writes the KV cache of the new tokens back. Running out
+    of blocks fails the step like an OOM, and the scheduler preempts
+    requests.
+
+    Only models whose KV cache is a key and value tensor per layer,
+    [batch, heads, tokens, head_dim], are supported, which is most of them.
+
+    Args:
+        model (PreTrainedModel): The model, on its device.
+        tokenizer (PreTrainedTokenizer): Its tokenizer.
+        metrics (Optional[WorkerMetrics]): Metrics to export the batch
+            operations to.
+        kv_cache_block_size (int): Page the KV cache in blocks of this many
+            tokens, see above. 0 to keep it in the batches.
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizer,
+        metrics: Optional[WorkerMetrics] = None,
+        kv_cache_block_size: int = 0,
+    ):
+        self.model = model.eval()
+        # The scheduler counts the tokens of the prompts with the tokenizer
+        # from another thread, and a fast tokenizer can't be used by two
+        # threads at once.
+        self.tokenizer = copy.deepcopy(tokenizer)
+        self.device = model.device
+        self._metrics = metrics
+        self._batches: Dict[int, _Batch] = dict()
+        self._all_special_ids = set(tokenizer.all_special_ids)
+        self._pad_token_id = (
+            tokenizer.pad_token_id
+            if tokenizer.pad_token_id is not None
+            else tokenizer.eos_token_id or 0
+        )
+        # Models like BLOOM don't take position ids, and place the tokens
+        # from the attention mask.
+        self._use_position_ids = (
+            "position_ids" in inspect.signature(model.forward).parameters
+        )
+        self._kv_cache_block_size = kv_cache_block_size
+        # Sized by warmup, and allocated once the shape of the KV cache of
+        # the model is known.
+        self._num_kv_cache_blocks: Optional[int] = None
+        self._kv_cache: Optional[PagedKVCache] = None
+        # Set with the paged KV cache, if the model supports it.
+        self._paged_attention: Optional[PagedAttention] = None
+
+    @torch.inference_mode()
+    def process_new_batch(
+        self, requests: List[TransformersRequest], batch_id: int
+    ) -> Tuple[List[TokenGeneration], Optional[int]]:
+        try:
+            batch = self._create_batch(requests, batch_id)
+            generations, batch = self._step(batch)
+        except Exception as e:
+            logger.error(f"process_new_batch error happened: {repr(e)}")
+            raise StepFailedError(repr(e), oom=is_oom(e)) from e
+        if batch is None:
+            return generations, None
+        self._batches[batch.batch_id] = batch
+        return generations, batch.batch_id
+
+    @torch.inference_mode()
+    def generate_next_token(
+        self, batch_ids: List[int]
+    ) -> Tuple[List[TokenGeneration], Optional[int]]:
+        if len(batch_ids) == 0:
+            raise ValueError("Must provide at least one batch")
+        batches = []
+        for batch_id in batch_ids:
+            if batch_id is None:
+                continue
+            batch = self._batches.pop(batch_id, None)
+            if batch is None:
+                raise ValueError(f"Batch ID {batch_id} not found in cache.")
+            batches.append(batch)
+        if len(batches) == 0:
+            return [], None
+
+        try:
+            if len(batches) > 1:
+                batch = self._concatenate(batches)
+            else:
+                batch = batches[0]
+            generations, batch = self._step(batch)
+        except Exception as e:
+            logger.error(f"generate_next_token error happened: {repr(e)}")
+            # A step only changes its batch once it went through, and a
+            # concatenation copies the batches, so they are intact.
+            for batch in batches:
+                self._batches[batch.batch_id] = batch
+            raise StepFailedError(
+                repr(e),
+                oom=is_oom(e),
+                request_ids_by_batch={
+                    batch.batch_id: batch.request_ids for batch in batches
+                },
+            ) from e
+        if batch is None:
+            return generations, None
+        self._batches[batch.batch_id] = batch
+        return generations, batch.batch_id
+
+    @torch.inference_mode()
+    def filter_requests(
+        self, batch_id: int, request_ids: List[int], compact: bool = False
+    ) -> Optional[int]:
+        # Filters always free the requests filtered out.
+        if batch_id is None:
+            return None
+        batch = self._batches.pop(batch_id)
+        batch = self._filter(batch, request_ids)
+        if batch is None:
+            return None
+        self._batches[batch.batch_id] = batch
+        return batch.batch_id
+
+    @torch.inference_mode()
+    def warmup(
+        self,
+        requests: List[TransformersRequest],
+        batch_id: int,
+        max_total_tokens: int,
+    ) -> Optional[int]:
+        """Prefill the requests, to check that the model and the largest
+        batch work. The batch is dropped.
+
+        The paged KV cache, if any, gets room for max_total_tokens tokens.
+        """
+        if self._kv_cache_block_size and self._kv_cache is None:
+            self._num_kv_cache_blocks = -(
+                -max_total_tokens // self._kv_cache_block_size
+            )
+        batch = self._create_batch(requests, batch_id)
+        _, batch = self._step(batch)
+        if batch is not None:
+            self._release(batch.sequences)
+        return True
+
+    def _create_batch(
+        self, requests: List[TransformersRequest], batch_id: int
+    ) -> _Batch:
+        prompts = []
+        for request in requests:
+            token_ids = self.tokenizer(request.inputs)["input_ids"]
+            if request.truncate > 0:
+                token_ids = token_ids[-request.truncate :]
+            prompts.append(token_ids)
+        width = max(len(token_ids) for token_ids in prompts)
+        input_ids = torch.full(
+            (len(prompts), width), self._pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros(len(prompts), width, dtype=torch.long)
+        for i, token_ids in enumerate(prompts):
+            input_ids[i, width - len(token_ids) :] = torch.tensor(token_ids)
+            attention_mask[i, width - len(token_ids) :] = 1
+        position_ids = attention_mask.cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask == 0, 1)
+        return _Batch(
+            batch_id=batch_id,
+            sequences=[
+                _Sequence(request, token_ids, self.device)
+                for request, token_ids in zip(requests, prompts)
+            ],
+            input_ids=input_ids.to(self.device),
+            attention_mask=attention_mask.to(self.device),
+            position_ids=position_ids.to(self.device),
+        )
+
+    def _step(self, batch: _Batch) -> Tuple[List[TokenGeneration], Optional[_Batch]]:
+        """Run the model on the next input tokens of a batch and generate a
+        token for each of its unfinished requests.
+
+        The batch is only updated once the tokens are picked, so that it can
+        be used again if anything fails before.
+
+        Returns:
+            The generations, and the batch, or None if all of its requests
+            finished.
+        """
+        prefill = batch.past_length == 0
+        paged = self._paged_attention is not None and not prefill
+        past_key_values = batch.past_key_values
+        attention_mask = batch.attention_mask
+        decode = contextlib.nullcontext()
+        if self._kv_cache is not None:
+            self._reserve_blocks(batch, prefill)
+            if paged:
+                # The attention layers take the past from the blocks.
+                decode = self._paged_attention.decode(self._append_slots(batch))
+                attention_mask = None
+            elif not prefill:
+                past_key_values = self._gather(batch)
+        kwargs = {}
+        if self._use_position_ids:
+            kwargs["position_ids"] = batch.position_ids
+        with decode:
+            outputs = self.model(
+                input_ids=batch.input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                use_cache=not paged,
+                **kwargs,
+            )
+        if not paged:
+            past_key_values = tuple(tuple(layer) for layer in outputs.past_key_values)
+        if prefill and not has_split_kv_cache(
+            dataclasses.replace(batch, past_key_values=past_key_values)
+        ):
+            raise ValueError(
+                f"{type(self.model).__name__} is not supported, its KV cache "
+                "isn't a key and a value tensor per layer, [batch, heads, "
+                "tokens, head_dim]."
+            )
+        if self._kv_cache_block_size and self._kv_cache is None:
+            self._create_kv_cache(batch, past_key_values)
+        token_ids, logprobs = self._choose_tokens(batch, outputs.logits[:, -1])
+
+        generations = []
+        for sequence, token_id, logprob in zip(batch.sequences, token_ids, logprobs):
+            if not sequence.finished:
+                generations.append(self._add_token(sequence, token_id, logprob))
+        if all(sequence.finished for sequence in batch.sequences):
+            self._release(batch.sequences)
+            return generations, None
+
+        if paged:
+            for sequence in batch.sequences:
+                sequence.num_cached_tokens += 1
+            self._report_kv_cache()
+        elif self._kv_cache_block_size:
+            self._cache_kv(batch, past_key_values, prefill)
+        else:
+            batch.past_key_values = past_key_values
+        batch.input_ids = torch.tensor(token_ids, device=self.device).view(-1, 1)
+        batch.attention_mask = torch.cat(
+            [batch.attention_mask, batch.attention_mask.new_ones(len(batch), 1)],
+            dim=1,
+        )
+        batch.position_ids = batch.position_ids[:, -1:] + 1
+        return generations, batch
+
+    def _reserve_blocks(self, batch: _Batch, prefill: bool):
+        """Check that the paged KV cache has room for the KV cache of the
+        next input tokens of a batch, before running the model on them."""
+        block_manager = self._kv_cache.block_manager
+        if prefill:
+            # The full blocks that the prompts of the batch share are
+            # counted once per prompt.
+            num_blocks = sum(
+                block_manager.num_new_blocks(sequence.token_ids)
+                for sequence in batch.sequences
+            )
+        else:
+            num_blocks = sum(
+                block_manager.num_blocks_to_append(
+                    sequence.block_table, sequence.num_cached_tokens
+                )
+                for sequence in batch.sequences
+            )
+        block_manager.check_free(num_blocks)
+
+    def _create_kv_cache(
+        self, batch: _Batch, past_key_values: Tuple[Tuple[torch.Tensor, ...], ...]
+    ):
+        """Allocate the paged KV cache, like the KV cache of the model, and
+        check that it has room for the batch it was just run on."""
+        if self._num_kv_cache_blocks is None:
+            raise RuntimeError(
+                "The paged KV cache is sized by warmup, which has to run first."
+            )
+        keys = past_key_values[0][0]
+        self._kv_cache = PagedKVCache(
+            self._num_kv_cache_blocks,
+            self._kv_cache_block_size,
+            num_layers=len(past_key_values),
+            num_heads=keys.shape[1],
+            head_dim=keys.shape[3],
+            dtype=keys.dtype,
+            device=keys.device,
+        )
+        if PagedAttention.supports(self.model):
+            self._paged_attention = PagedAttention(self.model, self._kv_cache)
+        else:
+            logger.warning(
+                f"The attention of {type(self.model).__name__} can't read the "
+                "paged KV cache, each decode step gathers a padded past from it."
+            )
+        self._reserve_blocks(batch, prefill=True)
+
+    def _append_slots(self, batch: _Batch) -> PagedAttentionInputs:
+        """Make room in the paged KV cache for the next input token of each
+        sequence of a decoding batch."""
+        block_manager = self._kv_cache.block_manager
+        slots, copies = [], []
+        for sequence in batch.sequences:
+            slot, copy = block_manager.append_slot(
+                sequence.block_table, sequence.num_cached_tokens
+            )
+            if copy is not None:
+                copies.append(copy)
+            slots.append(slot)
+        self._kv_cache.copy_blocks(copies)
+        return PagedAttentionInputs(
+            slots=torch.tensor(slots, device=self.device),
+            block_tables=self._kv_cache.block_table_tensor(
+                [sequence.block_table for sequence in batch.sequences]
+            ),
+            context_lens=torch.tensor(
+                [sequence.num_cached_tokens + 1 for sequence in batch.sequences],
+                device=self.device,
+            ),
+        )
+
+    def _gather(self, batch: _Batch) -> Tuple[Tuple[torch.Tensor, ...], ...]:
+        """The past of a batch, left padded, from the paged KV cache."""
+        slots, _ = self._kv_cache.slot_table(
+            [sequence.block_table for sequence in batch.sequences],
+            [sequence.num_cached_tokens for sequence in batch.sequences],
+            batch.past_length,
+        )
+        return self._kv_cache.gather(slots)
+
+    def _cache_kv(
+        self,
+        batch: _Batch,
+        past_key_values: Tuple[Tuple[torch.Tensor, ...], ...],
+        prefill: bool,
+    ):
+        """Copy the KV cache of the input tokens a batch was just run on,
+        the right columns of past_key_values, into the paged KV cache."""
+        block_manager = self._kv_cache.block_manager
+        width = past_key_values[0][0].shape[2]
+        slots, rows, columns, copies = [], [], [], []
+        for i, sequence in enumerate(batch.sequences):
+            if prefill:
+                num_tokens = sequence.num_input_tokens
+                sequence.block_table = block_manager.allocate(
+                    sequence.token_ids[:num_tokens]
+                )
+                # Only the blocks taken for this prompt are written, the
+                # shared ones already hold the same tokens.
+                for position in range(num_tokens):
+                    block = sequence.block_table[position // block_manager.block_size]
+                    if block_manager.ref_count(block) == 1:
+                        slots.append(
+                            block * block_manager.block_size
+                            + position % block_manager.block_size
+                        )
+                        rows.append(i)
+                        columns.append(width - num_tokens + position)
+            else:
+                slot, copy = block_manager.append_slot(
+                    sequence.block_table, sequence.num_cached_tokens
+                )
+                if copy is not None:
+                    copies.append(copy)
+                slots.append(slot)
+                rows.append(i)
+                columns.append(width - 1)
+                num_tokens = sequence.num_cached_tokens + 1
+            sequence.num_cached_tokens = num_tokens
+        self._kv_cache.copy_blocks(copies)
+        self._kv_cache.write(
+            torch.tensor(slots, device=self.device),
+            past_key_values,
+            torch.tensor(rows, device=self.device),
+            torch.tensor(columns, device=self.device),
+        )
+        self._report_kv_cache()
+
+    def _release(self, sequences: List[_Sequence]):
+        """Give back the blocks of the paged KV cache held by sequences."""
+        if self._kv_cache is None:
+            return
+        for sequence in sequences:
+            self._kv_cache.block_manager.free(sequence.block_table)
+        self._report_kv_cache()
+
+    def _report_kv_cache(self):
+        if self._metrics:
+            self._metrics.kv_cache_used_blocks.set(
+                self._kv_cache.block_manager.num_used_blocks
+            )
+
+    def _choose_tokens(
+        self, batch: _Batch, logits: torch.Tensor
+    ) -> Tuple[List[int], List[float]]:
+        """The next token of each row, and its logprob."""
+        logits = logits.float()
+        # Greedy rows without processors all at once.
+        logprobs = torch.log_softmax(logits, dim=-1)
+        next_token_ids = logits.argmax(dim=-1)
+        for i, sequence in enumerate(batch.sequences):
+            if sequence.finished or not (sequence.processors or sequence.generator):
+                continue
+            scores = logits[i : i + 1]
+            if sequence.processors:
+                scores = sequence.processors(
+                    torch.tensor([sequence.token_ids], device=self.device), scores
+                )
+            logprobs[i] = torch.log_softmax(scores, dim=-1)[0]
+            if sequence.generator is not None:
+                next_token_ids[i] = torch.multinomial(
+                    logprobs[i].exp(), 1, generator=sequence.generator
+                )[0]
+            else:
+                next_token_ids[i] = scores.argmax(dim=-1)[0]
+        token_logprobs = logprobs.gather(1, next_token_ids.view(-1, 1)).view(-1)
+        return next_token_ids.tolist(), token_logprobs.tolist()
+
+    def _add_token(
+        self, sequence: _Sequence, token_id: int, logprob: float
+    ) -> TokenGeneration:
+        """Append a token to a sequence, and check whether it finished, the
+        way TGI's StoppingCriteria do."""
+        sequence.token_ids.append(token_id)
+        token_text = self._decode_token(sequence)
+        request = sequence.request
+        finish_reason = None
+        if sequence.num_generated_tokens >= request.max_new_tokens:
+            finish_reason = FINISH_REASON_LENGTH
+        elif not request.ignore_eos_token and token_id == self.tokenizer.eos_token_id:
+            finish_reason = FINISH_REASON_EOS_TOKEN
+        elif request.stop_sequences:
+            tail_length = max(len(stop) for stop in request.stop_sequences)
+            sequence.output_tail = (sequence.output_tail + token_text)[-tail_length:]
+            if any(
+                sequence.output_tail.endswith(stop) for stop in request.stop_sequences
+            ):
+                finish_reason = FINISH_REASON_STOP_SEQUENCE
+
+        generated_text = None
+        if finish_reason is not None:
+            sequence.finished = True
+            generated_text = GeneratedText(
+                self.tokenizer.decode(
+                    sequence.token_ids[sequence.num_input_tokens :],
+                    skip_special_tokens=True,
+                    clean_up_tokenization_spaces=False,
+                ),
+                sequence.num_generated_tokens,
+                finish_reason,
+            )
+        return TokenGeneration(
+            request.id,
+            token_id,
+            logprob,
+            token_text,
+            token_id in self._all_special_ids,
+            generated_text,
+        )
+
+    def _decode_token(self, sequence: _Sequence) -> str:
+        """The text the last token of a sequence adds, like TGI's
+        Model.decode_token: the tokens from prefix_offset are decoded with
+        and without it, so that tokenizers which merge spaces or bytes into
+        the next token get it right. Nothing is returned while the text
+        ends with an incomplete character."""
+        token_ids = sequence.token_ids
+        prefix_text = self.tokenizer.decode(
+            token_ids[sequence.prefix_offset : sequence.read_offset],
+            skip_special_tokens=False,
+        )
+        new_text = self.tokenizer.decode(
+            token_ids[sequence.prefix_offset :], skip_special_tokens=False
+        )
+        if len(new_text) > len(prefix_text) and not new_text.endswith("�"):
+            sequence.prefix_offset = sequence.read_offset
+            sequence.read_offset = len(token_ids)
+            return new_text[len(prefix_text) :]
+        return ""
+
+    def _filter(self, batch: _Batch, request_ids: List[int]) -> Optional[_Batch]:
+        """The rows of a batch of the given requests, without the columns
+        that only the other rows used."""
+        kept = set(request_ids)
+        indices = [
+            i
+            for i, sequence in enumerate(batch.sequences)
+            if sequence.request.id in kept
+        ]
+        if len(indices) == len(batch):
+            return batch
+        self._release(
+            [
+                sequence
+                for sequence in batch.sequences
+                if sequence.request.id not in kept
+            ]
+        )
+        if not indices:
+            return None
+        index = torch.tensor(indices, device=self.device)
+        attention_mask = batch.attention_mask[index]
+        # The rows are left padded, so the longest row left starts at the
+        # first column any of them uses.
+        start = attention_mask.shape[1] - int(attention_mask.sum(dim=1).max())
+        filtered = _Batch(
+            batch_id=batch.batch_id,
+            sequences=[batch.sequences[i] for i in indices],
+            input_ids=batch.input_ids[index],
+            attention_mask=attention_mask[:, start:],
+            position_ids=batch.position_ids[index],
+        )
+        if batch.past_key_values is None:
+            return filtered
+        filtered.past_key_values = tuple(
+            (keys[index, :, start:], values[index, :, start:])
+            for keys, values in batch.past_key_values
+        )
+        if self._metrics:
+            self._metrics.batch_filters.inc()
+            self._metrics.inc(
+                self._metrics.kv_cache_bytes_copied, _kv_cache_bytes(filtered)
+            )
+        return filtered
+
+    def _concatenate(self, batches: List[_Batch]) -> _Batch:
+        """Merge decoding batches into the first one, left padding their
+        past to the longest."""
+        past_length = max(batch.past_length for batch in batches)
+        num_rows = sum(len(batch) for batch in batches)
+        first = batches[0]
+        attention_mask = first.attention_mask.new_zeros(num_rows, past_length + 1)
+        start = 0
+        for batch in batches:
+            end = start + len(batch)
+            attention_mask[
+                start:end, past_length - batch.past_length :
+            ] = batch.attention_mask
+            start = end
+        concatenated = _Batch(
+            batch_id=first.batch_id,
+            sequences=[sequence for batch in batches for sequence in batch.sequences],
+            input_ids=torch.cat([batch.input_ids for batch in batches]),
+            attention_mask=attention_mask,
+            position_ids=torch.cat([batch.position_ids for batch in batches]),
+        )
+        if first.past_key_values is None:
+            return concatenated
+
+        concatenated.past_key_values = tuple(
+            (
+                keys.new_zeros(num_rows, keys.shape[1], past_length, keys.shape[3]),
+                values.new_zeros(
+                    num_rows, values.shape[1], past_length, values.shape[3]
+                ),
+            )
+            for keys, values in first.past_key_values
+        )
+        start = 0
+        for batch in batches:
+            end = start + len(batch)
+            offset = past_length - batch.past_length
+            for (keys, values), (batch_keys, batch_values) in zip(
+                concatenated.past_key_values, batch.past_key_values
+            ):
+                keys[start:end, :, offset:] = batch_keys
+                values[start:end, :, offset:] = batch_values
+            start = end
+        if self._metrics:
+            self._metrics.batch_concatenations.inc()
+            self._metrics.inc(
+                self._metrics.kv_cache_bytes_copied, _kv_cache_bytes(concatenated)
+            )
+        return concatenated
@@ -0,0 +1,160 @@
+from array import array
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from aviary.backend.llm.continuous.queue import InferenceRequest
+
+
+class BatchLengths(NamedTuple):
+    """Aggregated lengths of a batch of requests, as used to compute the
+    tokens the batch needs in the worst case."""
+
+    num_requests: int = 0
+    # Longest input, including the tokens generated so far.
+    max_input_length: int = 0
+    # Inputs, including the tokens generated so far, summed over the requests.
+    total_input_length: int = 0
+    # Tokens left to generate, summed over the requests.
+    total_gen_length: int = 0
+
+    @classmethod
+    def of(
+        cls,
+        requests: Iterable[InferenceRequest],
+        gen_length: Optional[Callable[[InferenceRequest], int]] = None,
+    ) -> "BatchLengths":
+        lengths = cls()
+        for request in requests:
+            lengths = lengths.add(request, gen_length and gen_length(request))
+        return lengths
+
+    def add(
+        self, request: InferenceRequest, gen_length: Optional[int] = None
+    ) -> "BatchLengths":
+        """Return the lengths of the batch with one more request.
+
+        Args:
+            request (InferenceRequest): The request to add.
+            gen_length (Optional[int]): Tokens to count for what the request
+                has left to generate. Defaults to request.gen_length.
+        """
+        input_length = request.input_length
+        return BatchLengths(
+            self.num_requests + 1,
+            max(self.max_input_length, input_length),
+            self.total_input_length + input_length,
+            self.total_gen_length
+            + (request.gen_length if gen_length is None else gen_length),
+        )
+
+
+class InFlightTable:
+    """The requests admitted into the running batch, by id.
+
+    Lengths are stored in flat columns indexed by slot, slots being reused
+    as requests leave, and the batch aggregates are updated as tokens are
+    generated, so that matching a generation to its request and budgeting
+    a new request don't have to walk the batch.
+
+    The lengths are counted from the generations, special tokens included,
+    starting from the input_length and gen_length of the request when it
+    was admitted.
+
+    Args:
+        gen_length (Optional[Callable[[InferenceRequest], int]]): Tokens to
+            count for what a request has left to generate, instead of its
+            gen_length. Called when the request is added, and again when it
+            generates more tokens than that.
+    """
+
+    def __init__(self, gen_length: Optional[Callable[[InferenceRequest], int]] = None):
+        self._gen_length = gen_length
+        self._slots: Dict[int, int] = {}
+        self._requests: List[Optional[InferenceRequest]] = []
+        self._free_slots: List[int] = []
+        self._input_lengths = array("q")
+        self._gen_lengths = array("q")
+        self._total_input_length = 0
+        self._total_gen_length = 0
+        # None when the longest request left and the max must be recomputed.
+        self._max_input_length: Optional[int] = 0
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, request_id: int) -> bool:
+        return request_id in self._slots
+
+    def get(self, request_id: int) -> Optional[InferenceRequest]:
+        slot = self._slots.get(request_id)
+        return None if slot is None else self._requests[slot]
+
+    def add(self, requests: Iterable[InferenceRequest]):
+        for request in requests:
+            if request.id in self._slots:
+                raise ValueError(f"Request {request.id} is already in flight")
+            input_length = request.input_length
+            gen_length = (
+                self._gen_length(request) if self._gen_length else request.gen_length
+            )
+            if self._free_slots:
+                slot = self._free_slots.pop()
+                self._requests[slot] = request
+                self._input_lengths[slot] = input_length
+                self._gen_lengths[slot] = gen_length
+            else:
+                slot = len(self._requests)
+                self._requests.append(request)
+                self._input_lengths.append(input_length)
+                self._gen_lengths.append(gen_length)
+            self._slots[request.id] = slot
+            self._total_input_length += input_length
+            self._total_gen_length += gen_length
+            if self._max_input_length is not None:
+                self._max_input_length = max(self._max_input_length, input_length)
+
+    def remove(self, request_id: int) -> Optional[InferenceRequest]:
+        slot = self._slots.pop(request_id, None)
+        if slot is None:
+            return None
+        request = self._requests[slot]
+        self._total_input_length -= self._input_lengths[slot]
+        self._total_gen_length -= self._gen_lengths[slot]
+        if self._input_lengths[slot] == self._max_input_length:
+            self._max_input_length = None
+        self._requests[slot] = None
+        self._input_lengths[slot] = 0
+        self._gen_lengths[slot] = 0
+        self._free_slots.append(slot)
+        return request
+
+    def token_generated(self, request_id: int) -> InferenceRequest:
+        """Account for a token generated for a request, and return it."""
+        slot = self._slots[request_id]
+        input_length = self._input_lengths[slot] + 1
+        self._input_lengths[slot] = input_length
+        self._total_input_length += 1
+        if self._gen_lengths[slot] > 0:
+            self._gen_lengths[slot] -= 1
+            self._total_gen_length -= 1
+        elif self._gen_length:
+            # The request outlived its estimate. The token being generated
+            # isn't in its output stream yet.
+            gen_length = max(0, self._gen_length(self._requests[slot]) - 1)
+            self._gen_lengths[slot] = gen_length
+            self._total_gen_length += gen_length
+        if self._max_input_length is not None and input_length > (
+            self._max_input_length
+        ):
+            self._max_input_length = input_length
+        return self._requests[slot]
+
+    def lengths(self) -> BatchLengths:
+        if self._max_input_length is None:
+            # Free slots are zeroed, so they don't count.
+            self._max_input_length = max(self._input_lengths, default=0)
+        return BatchLengths(
+            len(self._slots),
+            self._max_input_length,
+            self._total_input_length,
+            self._total_gen_length,
+        )
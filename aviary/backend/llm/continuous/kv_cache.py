@@ -0,0 +1,139 @@
+import math
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Literal, Optional
+
+from aviary.backend.llm.continuous.inflight import BatchLengths
+
+
+class BudgetCalculator(ABC):
+    """Computes the tokens of KV cache a batch needs once all its requests
+    generated the tokens reserved for them, to compare against
+    max_batch_total_tokens."""
+
+    @abstractmethod
+    def num_tokens(self, lengths: BatchLengths) -> int:
+        raise NotImplementedError
+
+
+class PaddedBudgetCalculator(BudgetCalculator):
+    """The inputs of the batch are padded to the longest one, like in the
+    CausalLM models of TGI.
+
+    Args:
+        masked_fraction (float): Fraction of the rows of the batch that can
+            be held by requests that left it, until the worker compacts it.
+            The budget of the requests left is scaled up to cover them.
+        reserved_tokens (int): Tokens of KV cache held outside of the
+            batch, by a prefix cache.
+        speculative_tokens (int): Most draft tokens per request and decode
+            step. Every row takes the columns of the longest draft of a
+            step, and those of the rejected drafts stay in the batch as
+            masked out holes, until they take more than masked_fraction of
+            its columns. The budget covers both.
+    """
+
+    def __init__(
+        self,
+        masked_fraction: float = 0,
+        reserved_tokens: int = 0,
+        speculative_tokens: int = 0,
+    ):
+        self.masked_fraction = masked_fraction
+        self.reserved_tokens = reserved_tokens
+        self.speculative_tokens = speculative_tokens
+
+    def num_tokens(self, lengths: BatchLengths) -> int:
+        num_tokens = (
+            lengths.max_input_length * lengths.num_requests
+            + lengths.total_gen_length
+            + lengths.num_requests * self.speculative_tokens
+        )
+        # Masked rows, and masked columns if speculating.
+        num_masked_dims = 2 if self.speculative_tokens else 1
+        return (
+            math.ceil(num_tokens / (1 - self.masked_fraction) ** num_masked_dims)
+            + self.reserved_tokens
+        )
+
+
+class PagedBudgetCalculator(BudgetCalculator):
+    """Each request only takes its own tokens, in blocks of block_size
+    tokens, like in the FlashCausalLM models of TGI.
+
+    A request takes its input and the tokens left to generate, whose sum
+    doesn't change as it generates tokens. Up to a block per request is
+    lost to fragmentation.
+
+    Args:
+        block_size (int): Number of tokens per block of KV cache.
+    """
+
+    def __init__(self, block_size: int = 16):
+        self.block_size = block_size
+
+    def num_tokens(self, lengths: BatchLengths) -> int:
+        return (
+            lengths.total_input_length
+            + lengths.total_gen_length
+            + lengths.num_requests * (self.block_size - 1)
+        )
+
+
+class SlidingWindowBudgetCalculator(PagedBudgetCalculator):
+    """Same as PagedBudgetCalculator, but a request never takes more than
+    sliding_window tokens.
+
+    Only the batch totals are tracked, so a batch takes at most
+    sliding_window tokens per request, even if some of its requests are
+    shorter than that.
+
+    Args:
+        sliding_window (int): Number of tokens the attention looks back.
+        block_size (int): Number of tokens per block of KV cache.
+    """
+
+    def __init__(self, sliding_window: int, block_size: int = 16):
+        super().__init__(block_size)
+        self.sliding_window = sliding_window
+
+    def num_tokens(self, lengths: BatchLengths) -> int:
+        return min(
+            super().num_tokens(lengths),
+            lengths.num_requests * (self.sliding_window + self.block_size - 1),
+        )
+
+
+@dataclass
+class KVCacheLayout:
+    """How an inference worker lays out the KV cache of a batch.
+
+    Args:
+        kind: "padded" if the inputs of a batch are padded to the longest
+            one, "paged" if each request has its own blocks.
+        block_size: Number of tokens per block, for "paged".
+        sliding_window: If set, the attention only looks back this many
+            tokens and no more are cached per request, for "paged".
+        masked_fraction: Fraction of the rows of a batch that requests
+            filtered out of it can still hold, for "padded".
+        reserved_tokens: Tokens of KV cache held outside of the batches,
+            by a prefix cache, for "padded".
+        speculative_tokens: Most draft tokens per request and decode step,
+            for "padded".
+    """
+
+    kind: Literal["padded", "paged"] = "padded"
+    block_size: int = 1
+    sliding_window: Optional[int] = None
+    masked_fraction: float = 0
+    reserved_tokens: int = 0
+    speculative_tokens: int = 0
+
+    def budget_calculator(self) -> BudgetCalculator:
+        if self.kind == "padded":
+            return PaddedBudgetCalculator(
+                self.masked_fraction, self.reserved_tokens, self.speculative_tokens
+            )
+        if self.sliding_window:
+            return SlidingWindowBudgetCalculator(self.sliding_window, self.block_size)
+        return PagedBudgetCalculator(self.block_size)
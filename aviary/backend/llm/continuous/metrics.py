@@ -0,0 +1,289 @@
+from ray import serve
+from ray.util import metrics
+
+# Boundaries (in seconds) of the latency histograms.
+STEP_LATENCY_BOUNDARIES_S = [
+    0.005,
+    0.01,
+    0.02,
+    0.03,
+    0.05,
+    0.075,
+    0.1,
+    0.15,
+    0.2,
+    0.3,
+    0.5,
+    1,
+    2,
+    5,
+]
+REQUEST_LATENCY_BOUNDARIES_S = [
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2,
+    5,
+    10,
+    20,
+    30,
+    60,
+    120,
+]
+
+
+def _get_replica_tag() -> str:
+    try:
+        return serve.get_replica_context().replica_tag
+    except Exception:
+        return ""
+
+
+class SchedulerMetrics:
+    """Metrics of a continuous batching scheduler.
+
+    They are exported through Ray's metrics agent, which serves them to
+    Prometheus on every node. Each metric is tagged with the model id and the
+    Serve replica, so that replicas can be told apart.
+
+    Args:
+        model_id (str): Id of the model served by the scheduler.
+    """
+
+    def __init__(self, model_id: str):
+        tags = {"model_id": model_id, "replica": _get_replica_tag()}
+        tag_keys = tuple(tags)
+
+        self.queue_size = metrics.Gauge(
+            "aviary_continuous_queue_size",
+            description="Number of requests waiting to be scheduled.",
+            tag_keys=tag_keys,
+        )
+        self.running_requests = metrics.Gauge(
+            "aviary_continuous_running_requests",
+            description="Number of requests in the running batch.",
+            tag_keys=tag_keys,
+        )
+        self.tokens_in_flight = metrics.Gauge(
+            "aviary_continuous_tokens_in_flight",
+            description=(
+                "Input and max new tokens of the requests in the running batch."
+            ),
+            tag_keys=tag_keys,
+        )
+        self.max_batch_total_tokens = metrics.Gauge(
+            "aviary_continuous_max_batch_total_tokens",
+            description="Max number of tokens in flight.",
+            tag_keys=tag_keys,
+        )
+        self.tokens_per_s = metrics.Gauge(
+            "aviary_continuous_tokens_per_s",
+            description="Input and generated tokens processed per second.",
+            tag_keys=tag_keys,
+        )
+        self.prefill_latency_s = metrics.Histogram(
+            "aviary_continuous_prefill_latency_s",
+            description="Latency of a prefill step.",
+            boundaries=STEP_LATENCY_BOUNDARIES_S,
+            tag_keys=tag_keys,
+        )
+        self.decode_latency_s = metrics.Histogram(
+            "aviary_continuous_decode_latency_s",
+            description="Latency of a decode step.",
+            boundaries=STEP_LATENCY_BOUNDARIES_S,
+            tag_keys=tag_keys,
+        )
+        self.time_to_first_token_s = metrics.Histogram(
+            "aviary_continuous_time_to_first_token_s",
+            description="Time from a request being queued to its first token.",
+            boundaries=REQUEST_LATENCY_BOUNDARIES_S,
+            tag_keys=tag_keys,
+        )
+        self.inter_token_latency_s = metrics.Histogram(
+            "aviary_continuous_inter_token_latency_s",
+            description="Mean time between two tokens of a request.",
+            boundaries=STEP_LATENCY_BOUNDARIES_S,
+            tag_keys=tag_keys,
+        )
+        self.input_tokens = metrics.Counter(
+            "aviary_continuous_input_tokens",
+            description="Number of prefilled tokens.",
+            tag_keys=tag_keys,
+        )
+        self.generated_tokens = metrics.Counter(
+            "aviary_continuous_generated_tokens",
+            description="Number of generated tokens.",
+            tag_keys=tag_keys,
+        )
+        self.finished_requests = metrics.Counter(
+            "aviary_continuous_finished_requests",
+            description="Number of requests that finished generating.",
+            tag_keys=tag_keys,
+        )
+        self.cancelled_requests = metrics.Counter(
+            "aviary_continuous_cancelled_requests",
+            description="Number of requests cancelled before finishing.",
+            tag_keys=tag_keys,
+        )
+        self.failed_requests = metrics.Counter(
+            "aviary_continuous_failed_requests",
+            description="Number of requests ended by an error of the inference worker.",
+            tag_keys=tag_keys,
+        )
+        self.ooms = metrics.Counter(
+            "aviary_continuous_ooms",
+            description="Number of OOMs hit by the inference worker.",
+            tag_keys=tag_keys,
+        )
+        self.preemptions = metrics.Counter(
+            "aviary_continuous_preemptions",
+            description="Number of requests preempted and put back in the queue.",
+            tag_keys=tag_keys,
+        )
+        self.shed_requests = metrics.Counter(
+            "aviary_continuous_shed_requests",
+            description=(
+                "Number of requests rejected because their estimated queue wait "
+                "was too long."
+            ),
+            tag_keys=tag_keys,
+        )
+
+        for metric in (
+            self.queue_size,
+            self.running_requests,
+            self.tokens_in_flight,
+            self.max_batch_total_tokens,
+            self.tokens_per_s,
+            self.prefill_latency_s,
+            self.decode_latency_s,
+            self.time_to_first_token_s,
+            self.inter_token_latency_s,
+            self.input_tokens,
+            self.generated_tokens,
+            self.finished_requests,
+            self.cancelled_requests,
+            self.failed_requests,
+            self.ooms,
+            self.preemptions,
+            self.shed_requests,
+        ):
+            metric.set_default_tags(tags)
+
+    @staticmethod
+    def inc(counter: metrics.Counter, value: float = 1) -> None:
+        # Ray counters only accept positive increments.
+        if value > 0:
+            counter.inc(value)
+
+
+class WorkerMetrics:
+    """Metrics of the batch operations of an inference worker.
+
+    Exported the same way as SchedulerMetrics, from every worker of the
+    group, so that the copies made by each shard can be told apart.
+
+    Args:
+        model_id (str): Id of the model served by the worker.
+        rank (int): Rank of the worker in its group.
+    """
+
+    def __init__(self, model_id: str, rank: int = 0):
+        tags = {"model_id": model_id, "rank": str(rank)}
+        tag_keys = tuple(tags)
+
+        self.batch_filters = metrics.Counter(
+            "aviary_continuous_batch_filters",
+            description="Number of batches filtered, copying their KV cache.",
+            tag_keys=tag_keys,
+        )
+        self.lazy_batch_filters = metrics.Counter(
+            "aviary_continuous_lazy_batch_filters",
+            description=(
+                "Number of batch filters done by masking the filtered out "
+                "requests, without copying anything."
+            ),
+            tag_keys=tag_keys,
+        )
+        self.batch_concatenations = metrics.Counter(
+            "aviary_continuous_batch_concatenations",
+            description="Number of batches concatenated, copying their KV cache.",
+            tag_keys=tag_keys,
+        )
+        self.in_place_batch_concatenations = metrics.Counter(
+            "aviary_continuous_in_place_batch_concatenations",
+            description=(
+                "Number of batches merged into the masked rows of another, "
+                "copying only their own KV cache."
+            ),
+            tag_keys=tag_keys,
+        )
+        self.kv_cache_bytes_copied = metrics.Counter(
+            "aviary_continuous_kv_cache_bytes_copied",
+            description="Bytes of KV cache copied by batch filters and concatenations.",
+            tag_keys=tag_keys,
+        )
+        self.masked_requests = metrics.Gauge(
+            "aviary_continuous_masked_requests",
+            description=(
+                "Number of requests filtered out of the batch but still taking "
+                "a row of it until it is compacted."
+            ),
+            tag_keys=tag_keys,
+        )
+        self.prefix_cache_lookups = metrics.Counter(
+            "aviary_continuous_prefix_cache_lookups",
+            description="Number of prompts looked up in the prefix cache.",
+            tag_keys=tag_keys,
+        )
+        self.prefix_cache_hits = metrics.Counter(
+            "aviary_continuous_prefix_cache_hits",
+            description="Number of prompts prefilled from a cached prefix.",
+            tag_keys=tag_keys,
+        )
+        self.prefix_cache_saved_tokens = metrics.Counter(
+            "aviary_continuous_prefix_cache_saved_tokens",
+            description="Number of prompt tokens taken from the prefix cache.",
+            tag_keys=tag_keys,
+        )
+        self.prefix_cache_bytes = metrics.Gauge(
+            "aviary_continuous_prefix_cache_bytes",
+            description="Bytes of KV cache held by the prefix cache.",
+            tag_keys=tag_keys,
+        )
+        self.speculative_draft_tokens = metrics.Counter(
+            "aviary_continuous_speculative_draft_tokens",
+            description="Number of draft tokens checked by speculative steps.",
+            tag_keys=tag_keys,
+        )
+        self.speculative_accepted_tokens = metrics.Counter(
+            "aviary_continuous_speculative_accepted_tokens",
+            description="Number of draft tokens kept by speculative steps.",
+            tag_keys=tag_keys,
+        )
+        self.kv_cache_used_blocks = metrics.Gauge(
+            "aviary_continuous_kv_cache_used_blocks",
+            description="Number of blocks of the paged KV cache held by requests.",
+            tag_keys=tag_keys,
+        )
+
+        for metric in (
+            self.batch_filters,
+            self.lazy_batch_filters,
+            self.batch_concatenations,
+            self.in_place_batch_concatenations,
+            self.kv_cache_bytes_copied,
+            self.masked_requests,
+            self.prefix_cache_lookups,
+            self.prefix_cache_hits,
+            self.prefix_cache_saved_tokens,
+            self.prefix_cache_bytes,
+            self.speculative_draft_tokens,
+            self.speculative_accepted_tokens,
+            self.kv_cache_used_blocks,
+        ):
+            metric.set_default_tags(tags)
+
+    inc = staticmethod(SchedulerMetrics.inc)
@@ -0,0 +1,120 @@
+from typing import TYPE_CHECKING, List
+
+import torch
+
+from .prefix_cache import has_split_kv_cache
+
+if TYPE_CHECKING:
+    from text_generation_server.models.causal_lm import CausalLMBatch
+
+# Per row fields of a CausalLMBatch, in the order of its rows.
+ROW_FIELDS = (
+    "requests",
+    "all_input_ids",
+    "input_lengths",
+    "prefix_offsets",
+    "read_offsets",
+    "next_token_choosers",
+    "stopping_criterias",
+)
+
+
+def _past_width(batch: "CausalLMBatch") -> int:
+    return batch.past_key_values[0][1].shape[-2]
+
+
+def can_merge_in_place(
+    batch: "CausalLMBatch", other: "CausalLMBatch", num_free_rows: int
+) -> bool:
+    """Whether merge_in_place can put the rows of other into num_free_rows
+    rows of batch.
+
+    The KV cache of other has to fit in the columns of batch, and both
+    have to be decoding, with a key and value tensor per layer and a
+    NextTokenChooser per row.
+    """
+    return (
+        len(other) <= num_free_rows
+        and all(
+            has_split_kv_cache(b)
+            and hasattr(b, "next_token_choosers")
+            and b.input_ids.shape[1] == b.position_ids.shape[1] == 1
+            and b.max_input_length == _past_width(b) + 1
+            for b in (batch, other)
+        )
+        and batch.keys_head_dim_last == other.keys_head_dim_last
+        and len(batch.past_key_values) == len(other.past_key_values)
+        and other.max_input_length <= batch.max_input_length
+    )
+
+
+def merge_in_place(batch: "CausalLMBatch", other: "CausalLMBatch", rows: List[int]):
+    """Overwrite rows of batch with the rows of other, in order, the way
+    concatenating them would have added them.
+
+    The KV cache of other is copied into the columns of the rows on the
+    right, and the columns on its left are masked out as padding. Only the
+    KV cache of other is copied, the rest of batch stays where it is.
+    Check can_merge_in_place first.
+
+    Args:
+        batch (CausalLMBatch): Batch to merge into, whose requests in rows
+            are dropped.
+        other (CausalLMBatch): Batch to merge, left unusable.
+        rows (List[int]): Rows of batch to overwrite, one per row of other.
+    """
+    device = batch.input_ids.device
+    index = torch.tensor(rows, device=device)
+    # The attention mask may have to grow for the tokens other has left to
+    # generate. Allocate that first, so that a failure leaves batch as it
+    # was.
+    attention_mask = batch.attention_mask
+    extra_columns = other.padding_right_offset - batch.padding_right_offset
+    if extra_columns > 0:
+        attention_mask = torch.cat(
+            [attention_mask, attention_mask.new_zeros(len(batch), extra_columns)],
+            dim=1,
+        )
+
+    key_seq_dim = 2 if batch.keys_head_dim_last else 3
+    width = _past_width(batch)
+    other_width = _past_width(other)
+    # Other is unusable from here on, and so is batch if this fails.
+    past_key_values, other.past_key_values = other.past_key_values, None
+    for (keys, values), (other_keys, other_values) in zip(
+        batch.past_key_values, past_key_values
+    ):
+        for tensor, other_tensor, seq_dim in (
+            (keys, other_keys, key_seq_dim),
+            (values, other_values, 2),
+        ):
+            tensor.narrow(seq_dim, 0, width - other_width).index_fill_(0, index, 0)
+            tensor.narrow(seq_dim, width - other_width, other_width).index_copy_(
+                0, index, other_tensor
+            )
+
+    if extra_columns > 0:
+        batch.attention_mask = attention_mask
+        batch.padding_right_offset = other.padding_right_offset
+    # The columns of the inputs end where those of the tokens to generate
+    # start.
+    end = attention_mask.shape[1] - batch.padding_right_offset
+    other_end = other.attention_mask.shape[1] - other.padding_right_offset
+    attention_mask.index_fill_(0, index, 0)
+    attention_mask.narrow(
+        1, end - other.max_input_length, other.max_input_length
+    ).index_copy_(
+        0,
+        index,
+        other.attention_mask[:, other_end - other.max_input_length : other_end].to(
+            attention_mask.dtype
+        ),
+    )
+    batch.input_ids.index_copy_(0, index, other.input_ids)
+    batch.position_ids.index_copy_(0, index, other.position_ids)
+
+    for other_row, row in enumerate(rows):
+        del batch.requests_idx_mapping[batch.requests[row].id]
+        batch.requests_idx_mapping[other.requests[other_row].id] = row
+        for field in ROW_FIELDS:
+            getattr(batch, field)[row] = getattr(other, field)[other_row]
@@ -1,9 +1,20 @@
-import asyncio
+import heapq
+import time
 from abc import ABC, abstractmethod
-from collections import namedtuple
-from typing import List
+from collections import deque, namedtuple
+from dataclasses import dataclass
+from typing import Deque, Dict, Iterable, List, Optional
 
-from aviary.backend.llm.continuous.queue import InferenceRequest, RequestQueue
+from aviary.backend.llm.continuous.estimator import OutputLengthEstimator
+from aviary.backend.llm.continuous.inflight import BatchLengths
+from aviary.backend.llm.continuous.kv_cache import (
+    BudgetCalculator,
+    PaddedBudgetCalculator,
+)
+from aviary.backend.llm.continuous.queue import (
+    InferenceRequest,
+    PriorityRequestQueue,
+)
 
 
 class RequestSelectionPolicy(ABC):
@@ -11,8 +22,9 @@ class RequestSelectionPolicy(ABC):
     def select_new_requests(
         self,
         in_process_requests: List[InferenceRequest],
-        queue: RequestQueue,
+        queue: PriorityRequestQueue,
         has_oom: bool = False,
+        in_process_lengths: Optional[BatchLengths] = None,
     ) -> List[InferenceRequest]:
         raise NotImplementedError
 
@@ -21,13 +33,56 @@ class RequestSelectionPolicy(ABC):
         # noqa
         pass
 
+    def request_preempted(self, preempted_request: InferenceRequest):  # noqa: B027
+        pass
+
+    def reserved_gen_length(self, request: InferenceRequest) -> int:
+        """Tokens to reserve in the budget for what a request has left to
+        generate."""
+        return request.gen_length
+
     # TODO: we might also interested in other events, such as when a request is
     # finished, or when a token is generated.
 
 
+# fifo: admit in arrival order, stop at the first request that doesn't fit.
+# sjf: shortest job first within the look-ahead window.
+# best_fit: largest request that still fits first within the look-ahead window.
+SELECTION_MODES = ("fifo", "sjf", "best_fit")
+
+# The token budget is multiplied by this after each OOM.
+OOM_PENALTY = 0.8
+
 Quota = namedtuple("Quota", ["min_num_requests", "token_budget"])
 
 
+@dataclass
+class AdmissionStats:
+    """Counters of the admission decisions taken by a selection policy.
+
+    A round is a single call to select_new_requests. A deferred round is one
+    where requests were waiting in the queue, but none were admitted (so
+    no batch concatenation happened)."""
+
+    num_rounds: int = 0
+    num_admissions: int = 0
+    num_admitted_requests: int = 0
+    # Admissions that happened because max_waiting_tokens was reached.
+    num_forced_admissions: int = 0
+    # Rounds deferred because not enough requests were waiting
+    # compared to the running ones (waiting_served_ratio).
+    num_deferred_by_ratio: int = 0
+    # Rounds deferred because the head of the queue did not fit in
+    # the token budget.
+    num_deferred_by_budget: int = 0
+    # Queued requests overtaken by a later request (sjf/best_fit only).
+    num_bypassed_requests: int = 0
+
+    @property
+    def num_deferred(self) -> int:
+        return self.num_deferred_by_ratio + self.num_deferred_by_budget
+
+
 class QuotaBasedRequestSelectionPolicy(RequestSelectionPolicy):
     def __init__(
         self,
@@ -35,86 +90,421 @@ class QuotaBasedRequestSelectionPolicy(RequestSelectionPolicy):
         max_batch_prefill_tokens: int = 4096,
         waiting_served_ratio: float = 1.2,
         max_waiting_tokens: int = 20,
+        selection_mode: str = "fifo",
+        selection_lookahead: int = 32,
+        max_queue_wait_s: float = 10.0,
+        output_length_estimator: Optional[OutputLengthEstimator] = None,
+        budget_calculator: Optional[BudgetCalculator] = None,
     ):
+        if selection_mode not in SELECTION_MODES:
+            raise ValueError(
+                f"selection_mode must be one of {SELECTION_MODES}, got '{selection_mode}'"
+            )
         self.max_batch_total_tokens = max_batch_total_tokens
         self.max_batch_prefill_tokens = max_batch_prefill_tokens
         self.waiting_served_ratio = waiting_served_ratio
         self.max_waiting_tokens = max_waiting_tokens
+        self.selection_mode = selection_mode
+        self.selection_lookahead = selection_lookahead
+        self.max_queue_wait_s = max_queue_wait_s
+        # If set, requests only reserve the tokens they are estimated to
+        # generate instead of max_new_tokens. A batch that generates more
+        # than that OOMs, and its last requests are preempted.
+        self.output_length_estimator = output_length_estimator
+        # How the tokens of a batch are counted against the budget, depends
+        # on the KV cache layout of the model.
+        self.budget_calculator = budget_calculator or PaddedBudgetCalculator()
+        # Number of decode steps since the last admission.
         self.waiting_tokens = 0
+        self.stats = AdmissionStats()
         self.oom_penalty = 1.0
         self.oomed_requests = set()
 
     def request_finished(self, finished_request: InferenceRequest):
+        if self.output_length_estimator is not None and not finished_request.cancelled:
+            self.output_length_estimator.observe(
+                finished_request.output_stream.num_tokens()
+            )
         if finished_request.id in self.oomed_requests:
             self.oomed_requests.remove(finished_request.id)
         if len(self.oomed_requests) == 0:
             self.oom_penalty = 1
 
-    def _calculate_budget(
-        self,
-        in_process: List[InferenceRequest],
-        selected: List[InferenceRequest],
-        candidate: InferenceRequest,
-    ):
-        max_input_length = candidate.input_length
-        gen_length = candidate.gen_length
-        for r in in_process:
-            max_input_length = max(max_input_length, r.input_length)
-            gen_length += r.gen_length
-        for r in selected:
-            max_input_length = max(max_input_length, r.input_length)
-            gen_length += r.gen_length
-        return gen_length + max_input_length * (len(selected) + 1 + len(in_process))
+    def reserved_gen_length(self, request: InferenceRequest) -> int:
+        if self.output_length_estimator is None:
+            return request.gen_length
+        num_generated = request.output_stream.num_tokens()
+        estimate = self.output_length_estimator.estimate(
+            num_generated, request.request.max_new_tokens
+        )
+        return min(request.gen_length, max(0, estimate - num_generated))
+
+    def _calculate_budget(self, batch_lengths: BatchLengths) -> int:
+        """Tokens needed by a batch with the given lengths, once all its
+        requests generated the tokens reserved for them."""
+        return self.budget_calculator.num_tokens(batch_lengths)
 
     def select_new_requests(
-        self, in_process_requests: List[InferenceRequest], queue: asyncio.Queue
+        self,
+        in_process_requests: List[InferenceRequest],
+        queue: PriorityRequestQueue,
+        has_oom: bool = False,
+        in_process_lengths: Optional[BatchLengths] = None,
     ) -> List[InferenceRequest]:
+        """Select the queued requests to add to the running batch, and take
+        them out of the queue.
+
+        Args:
+            in_process_requests (List[InferenceRequest]): The running batch.
+            queue (PriorityRequestQueue): The queued requests.
+            has_oom (bool): Whether the last step ran out of memory.
+            in_process_lengths (Optional[BatchLengths]): Lengths of the
+                running batch, if they are tracked by the caller. Computed
+                from in_process_requests otherwise.
+        """
+        self.stats.num_rounds += 1
+        if queue.empty():
+            self._no_admission(in_process_requests)
+            return []
+
+        forced = bool(in_process_requests) and (
+            self.waiting_tokens >= self.max_waiting_tokens
+        )
         min_num_requests, token_budget = self.calculate_quota(
-            in_process_requests, has_oom=False
+            in_process_requests, has_oom=has_oom
         )
 
         if min_num_requests and queue.qsize() < min_num_requests:
+            self.stats.num_deferred_by_ratio += 1
+            self._no_admission(in_process_requests)
             return []
 
+        # Walk the candidates without popping, so that nothing is taken out
+        # of the queue unless the whole selection is admitted.
         hypothetical_results = []
-        while len(hypothetical_results) < queue.qsize():
-            request: InferenceRequest = queue._queue[0]
+        prefill_tokens = 0
+        if in_process_lengths is None:
+            in_process_lengths = BatchLengths.of(
+                in_process_requests, self.reserved_gen_length
+            )
+        batch_lengths = in_process_lengths
+        for request in self._get_candidates(queue):
+            request: InferenceRequest
+            new_batch_lengths = batch_lengths.add(
+                request, self.reserved_gen_length(request)
+            )
             if (
-                request.request_input_length > self.max_batch_prefill_tokens
-                or request.total_tokens >= token_budget
+                prefill_tokens + request.prefill_length <= self.max_batch_prefill_tokens
+                and self._calculate_budget(new_batch_lengths) <= token_budget
             ):
+                hypothetical_results.append(request)
+                prefill_tokens += request.prefill_length
+                batch_lengths = new_batch_lengths
+            elif self.selection_mode == "fifo" or self._is_starving(request):
+                # Nothing may overtake a request that has waited for too long,
+                # so that the budget eventually drains enough to fit it.
                 break
-            hypothetical_results.append(request)
-            token_budget -= request.total_tokens
 
-        results = []
         if min_num_requests and len(hypothetical_results) < min_num_requests:
-            results = []
-        else:
-            results = []
-            for _ in hypothetical_results:
-                results.append(queue.get_nowait())
+            self.stats.num_deferred_by_ratio += 1
+            self._no_admission(in_process_requests)
+            return []
+
+        if not hypothetical_results:
+            self.stats.num_deferred_by_budget += 1
+            self._no_admission(in_process_requests)
+            return []
 
+        results = self._take_from_queue(queue, hypothetical_results)
+        self.waiting_tokens = 0
+        self.stats.num_admissions += 1
+        self.stats.num_admitted_requests += len(results)
+        if forced:
+            self.stats.num_forced_admissions += 1
         return results
 
+    def _is_starving(self, request: InferenceRequest) -> bool:
+        return (
+            time.monotonic_ns() - request.submit_time_ns >= self.max_queue_wait_s * 1e9
+        )
+
+    def _get_candidates(
+        self, queue: PriorityRequestQueue
+    ) -> Iterable[InferenceRequest]:
+        """Return the queued requests to consider, in the order to try them."""
+        if self.selection_mode == "fifo":
+            # Lazy, the selection stops at the first request that doesn't fit.
+            return iter(queue)
+
+        window = queue.peek(self.selection_lookahead)
+        starving = [r for r in window if self._is_starving(r)]
+        rest = [r for r in window if not self._is_starving(r)]
+        rest.sort(
+            key=lambda r: r.total_tokens, reverse=self.selection_mode == "best_fit"
+        )
+        return starving + rest
+
+    def _take_from_queue(
+        self, queue: PriorityRequestQueue, requests: List[InferenceRequest]
+    ) -> List[InferenceRequest]:
+        # Fast path - the selection is the head of the queue.
+        if all(r is q for r, q in zip(requests, queue)):
+            return [queue.get_nowait() for _ in requests]
+
+        selected = {r.id for r in requests}
+        num_left = len(requests)
+        for i, r in enumerate(queue):
+            if r.id in selected:
+                num_left -= 1
+                if not num_left:
+                    self.stats.num_bypassed_requests += i + 1 - len(requests)
+                    break
+        for r in requests:
+            queue.remove(r.id)
+        return requests
+
+    def _no_admission(self, in_process_requests: List[InferenceRequest]):
+        """Record a round that did not admit anything.
+
+        Every round with running requests is followed by exactly one decode
+        step, so this is where the decode steps since the last admission
+        are counted."""
+        if in_process_requests:
+            self.waiting_tokens += 1
+        else:
+            self.waiting_tokens = 0
+
     def calculate_quota(
         self, in_process_requests: List[InferenceRequest], has_oom: bool = False
     ) -> Quota:
+        if has_oom:
+            # Shrink the budget until the requests running when the OOM
+            # happened have finished.
+            self.oom_penalty *= OOM_PENALTY
+            self.oomed_requests.update(r.id for r in in_process_requests)
+        token_budget = int(self.max_batch_total_tokens * self.oom_penalty)
         if not in_process_requests:
-            return Quota(
-                min_num_requests=None,
-                token_budget=int(self.max_batch_total_tokens * self.oom_penalty),
-            )
+            return Quota(min_num_requests=None, token_budget=token_budget)
 
         batch_size = len(in_process_requests)
 
-        # calculate minmal_new_requests to be served
+        # Same as the TGI router: once the running batch has done
+        # max_waiting_tokens decode steps without an admission, admit whatever
+        # fits. Otherwise only interrupt the running batch if enough requests
+        # are waiting compared to the ones already being served.
         if self.waiting_tokens >= self.max_waiting_tokens:
-            pass
+            min_num_requests = None
         else:
-            int(batch_size * self.waiting_served_ratio)
+            min_num_requests = int(batch_size * self.waiting_served_ratio) or None
+
+        return Quota(min_num_requests=min_num_requests, token_budget=token_budget)
+
+
+@dataclass
+class _TenantState:
+    virtual_time: float = 0
+    # Requests admitted that haven't finished yet.
+    num_running: int = 0
+    # Token bucket of the rate limit. Can go negative, as a request is
+    # admitted as soon as the bucket isn't empty.
+    tokens: float = 0
+    refill_time_s: float = 0
+
+
+class FairShareRequestSelectionPolicy(QuotaBasedRequestSelectionPolicy):
+    """Quota based policy that shares the token budget between tenants.
+
+    Implements start-time fair queueing over tokens. Each tenant has a
+    virtual time, advanced by the tokens of each request it gets admitted
+    (prefill tokens + max new tokens) divided by its weight. The tokens a
+    request doesn't generate are refunded when it finishes or is preempted.
+    The queued requests are tried in increasing order of their tenant's
+    virtual time, so that under contention each tenant gets a share of the
+    tokens proportional to its weight. A tenant that was idle restarts from
+    the virtual time of the last admission instead of making up for the
+    share it didn't use, and tenants with nothing queued don't hold any
+    budget back, so the policy is work-conserving.
+
+    Tenants can also be capped to a number of tokens per second. A tenant
+    over its cap isn't admitted until it's back under it, even if the
+    budget is unused.
+
+    Args:
+        tenant_weights (Dict[str, float]): Weight of each tenant. Tenants
+            that aren't listed have a weight of default_tenant_weight.
+        default_tenant_weight (float): Weight of the unlisted tenants.
+        tenant_max_tokens_per_s (Dict[str, float]): Max tokens per second
+            admitted for each tenant. Tenants that aren't listed are
+            unlimited.
+        rate_limit_burst_s (float): A capped tenant can save up to this many
+            seconds worth of tokens while idle.
+        **kwargs: Arguments of QuotaBasedRequestSelectionPolicy.
+    """
+
+    def __init__(
+        self,
+        tenant_weights: Optional[Dict[str, float]] = None,
+        default_tenant_weight: float = 1.0,
+        tenant_max_tokens_per_s: Optional[Dict[str, float]] = None,
+        rate_limit_burst_s: float = 1.0,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.tenant_weights = tenant_weights or {}
+        self.default_tenant_weight = default_tenant_weight
+        self.tenant_max_tokens_per_s = tenant_max_tokens_per_s or {}
+        self.rate_limit_burst_s = rate_limit_burst_s
+        for tenant, weight in self.tenant_weights.items():
+            if weight <= 0:
+                raise ValueError(
+                    f"The weight of tenant '{tenant}' must be > 0, got {weight}"
+                )
+        # Start tag of the last admitted request.
+        self.virtual_time = 0.0
+        # Only the tenants with running requests, or with some state that
+        # differs from that of a new tenant, are kept.
+        self._tenants: Dict[str, _TenantState] = {}
+
+    def _weight(self, tenant: str) -> float:
+        return self.tenant_weights.get(tenant, self.default_tenant_weight)
+
+    @staticmethod
+    def _cost(request: InferenceRequest) -> int:
+        return request.prefill_length + request.gen_length
+
+    def _get_tenant(self, tenant: str) -> _TenantState:
+        state = self._tenants.get(tenant)
+        if state is None:
+            rate = self.tenant_max_tokens_per_s.get(tenant)
+            state = self._tenants[tenant] = _TenantState(
+                virtual_time=self.virtual_time,
+                tokens=rate * self.rate_limit_burst_s if rate else 0,
+                refill_time_s=time.monotonic(),
+            )
+        return state
+
+    def _start_time(self, tenant: str) -> float:
+        state = self._tenants.get(tenant)
+        if state is None:
+            return self.virtual_time
+        return max(state.virtual_time, self.virtual_time)
 
-        return Quota(
-            min_num_requests=None,
-            token_budget=int(self.max_batch_total_tokens * self.oom_penalty),
+    def _get_tokens_left(self, tenant: str, now_s: float) -> float:
+        """Return the tokens left in the rate limit bucket of a tenant."""
+        rate = self.tenant_max_tokens_per_s.get(tenant)
+        if rate is None:
+            return float("inf")
+        state = self._tenants.get(tenant)
+        if state is None:
+            return rate * self.rate_limit_burst_s
+        state.tokens = min(
+            rate * self.rate_limit_burst_s,
+            state.tokens + (now_s - state.refill_time_s) * rate,
         )
+        state.refill_time_s = now_s
+        return state.tokens
+
+    def _get_candidates(
+        self, queue: PriorityRequestQueue
+    ) -> Iterable[InferenceRequest]:
+        """Interleave the queued requests of the tenants in the order the
+        fair queueing would admit them."""
+        now_s = time.monotonic()
+        tokens_left: Dict[str, float] = {}
+        starving = []
+        by_tenant: Dict[str, Deque[InferenceRequest]] = {}
+        # The look-ahead applies to each tenant, so that a tenant with many
+        # queued requests can't crowd the others out of the candidates.
+        for tenant in queue.tenants():
+            tokens_left[tenant] = self._get_tokens_left(tenant, now_s)
+            if tokens_left[tenant] <= 0:
+                continue
+            for request in queue.peek(self.selection_lookahead, tenant):
+                if self._is_starving(request):
+                    starving.append(request)
+                else:
+                    by_tenant.setdefault(tenant, deque()).append(request)
+        starving.sort(key=lambda r: r.submit_time_ns)
+        for request in starving:
+            tokens_left[request.tenant] -= self._cost(request)
+
+        heap = []
+        for tenant, requests in by_tenant.items():
+            if self.selection_mode != "fifo":
+                by_tenant[tenant] = requests = deque(
+                    sorted(
+                        requests,
+                        key=lambda r: r.total_tokens,
+                        reverse=self.selection_mode == "best_fit",
+                    )
+                )
+            heap.append((self._start_time(tenant), tenant))
+        heapq.heapify(heap)
+
+        candidates = starving
+        while heap:
+            start_time, tenant = heapq.heappop(heap)
+            if tokens_left[tenant] <= 0:
+                continue
+            request = by_tenant[tenant].popleft()
+            candidates.append(request)
+            tokens_left[tenant] -= self._cost(request)
+            if by_tenant[tenant]:
+                heapq.heappush(
+                    heap,
+                    (start_time + self._cost(request) / self._weight(tenant), tenant),
+                )
+        return candidates
+
+    def _take_from_queue(
+        self, queue: PriorityRequestQueue, requests: List[InferenceRequest]
+    ) -> List[InferenceRequest]:
+        # The candidates don't follow the queue order, don't count bypasses.
+        for r in requests:
+            queue.remove(r.id)
+        return requests
+
+    def select_new_requests(
+        self,
+        in_process_requests: List[InferenceRequest],
+        queue: PriorityRequestQueue,
+        has_oom: bool = False,
+        in_process_lengths: Optional[BatchLengths] = None,
+    ) -> List[InferenceRequest]:
+        results = super().select_new_requests(
+            in_process_requests, queue, has_oom, in_process_lengths
+        )
+        for request in results:
+            state = self._get_tenant(request.tenant)
+            start_time = self._start_time(request.tenant)
+            cost = self._cost(request)
+            self.virtual_time = max(self.virtual_time, start_time)
+            state.virtual_time = start_time + cost / self._weight(request.tenant)
+            state.num_running += 1
+            state.tokens -= cost
+        return results
+
+    def _refund(self, request: InferenceRequest):
+        """Refund the tokens a request left without generating."""
+        state = self._tenants.get(request.tenant)
+        if state is None:
+            return
+        state.virtual_time -= request.gen_length / self._weight(request.tenant)
+        state.num_running -= 1
+        rate = self.tenant_max_tokens_per_s.get(request.tenant)
+        if rate:
+            state.tokens += request.gen_length
+        if (
+            state.num_running <= 0
+            and state.virtual_time <= self.virtual_time
+            and (not rate or state.tokens >= rate * self.rate_limit_burst_s)
+        ):
+            del self._tenants[request.tenant]
+
+    def request_finished(self, finished_request: InferenceRequest):
+        super().request_finished(finished_request)
+        self._refund(finished_request)
+
+    def request_preempted(self, preempted_request: InferenceRequest):
+        super().request_preempted(preempted_request)
+        self._refund(preempted_request)
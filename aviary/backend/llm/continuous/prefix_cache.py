@@ -0,0 +1,422 @@
+import functools
+import heapq
+import itertools
+from typing import TYPE_CHECKING, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import torch
+
+if TYPE_CHECKING:
+    from text_generation_server.models.causal_lm import CausalLMBatch
+
+
+def _common_length(a, b, start: int) -> int:
+    """Length of the common prefix of a and b[start:]."""
+    n = min(len(a), len(b) - start)
+    for i in range(n):
+        if a[i] != b[start + i]:
+            return i
+    return n
+
+
+class KVSegment:
+    """The KV cache of a run of tokens of a single sequence.
+
+    Args:
+        layers (List[Tuple[torch.Tensor, torch.Tensor]]): Keys and values
+            of each layer, [1, heads, tokens, head_dim].
+        key_seq_dim (int): Dimension of the tokens in the keys, -1 if they
+            are stored as [1, heads, head_dim, tokens].
+    """
+
+    __slots__ = ("layers", "key_seq_dim")
+
+    def __init__(
+        self, layers: List[Tuple[torch.Tensor, torch.Tensor]], key_seq_dim: int = -2
+    ):
+        self.layers = layers
+        self.key_seq_dim = key_seq_dim
+
+    @classmethod
+    def gather(
+        cls,
+        past_key_values: List[Tuple[torch.Tensor, torch.Tensor]],
+        row: int,
+        columns: torch.Tensor,
+        key_seq_dim: int = -2,
+    ) -> "KVSegment":
+        """Copy the given columns of a row of the KV cache of a batch."""
+        return cls(
+            [
+                (
+                    keys[row : row + 1].index_select(key_seq_dim, columns),
+                    values[row : row + 1].index_select(-2, columns),
+                )
+                for keys, values in past_key_values
+            ],
+            key_seq_dim,
+        )
+
+    @property
+    def num_tokens(self) -> int:
+        return self.layers[0][1].shape[-2]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            tensor.numel() * tensor.element_size()
+            for layer in self.layers
+            for tensor in layer
+        )
+
+    def split(self, at: int) -> Tuple["KVSegment", "KVSegment"]:
+        """Split into the first at tokens and the rest. Both are copies, so
+        that either can be freed on its own."""
+        n = self.num_tokens - at
+        return tuple(
+            KVSegment(
+                [
+                    (
+                        keys.narrow(self.key_seq_dim, start, length).clone(),
+                        values.narrow(-2, start, length).clone(),
+                    )
+                    for keys, values in self.layers
+                ],
+                self.key_seq_dim,
+            )
+            for start, length in ((0, at), (at, n))
+        )
+
+    @staticmethod
+    def concat(
+        segments: List["KVSegment"], num_tokens: int
+    ) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """The keys and values of the first num_tokens tokens of segments
+        laid end to end, for each layer."""
+        key_seq_dim = segments[0].key_seq_dim
+        layers = []
+        for i in range(len(segments[0].layers)):
+            keys = torch.cat([s.layers[i][0] for s in segments], dim=key_seq_dim)
+            values = torch.cat([s.layers[i][1] for s in segments], dim=-2)
+            layers.append(
+                (
+                    keys.narrow(key_seq_dim, 0, num_tokens),
+                    values.narrow(-2, 0, num_tokens),
+                )
+            )
+        return layers
+
+
+class _Node:
+    __slots__ = ("tokens", "value", "parent", "children", "last_access")
+
+    def __init__(
+        self,
+        tokens: Tuple[int, ...],
+        value: Optional[KVSegment],
+        parent: Optional["_Node"],
+    ):
+        # Tokens of the edge from the parent, and their KV cache.
+        self.tokens = tokens
+        self.value = value
+        self.parent = parent
+        # By first token of their edge.
+        self.children: Dict[int, "_Node"] = {}
+        self.last_access = 0
+
+
+class RadixPrefixCache:
+    """KV cache of prompts, in a radix tree over their token ids.
+
+    Each node holds the KV cache of the tokens of the edge leading to it,
+    so a prefix shared by many prompts, like their prompt_format, is stored
+    once. A prompt can use a cached path that it only follows partway
+    through an edge, since the KV cache of a token only depends on the
+    tokens before it.
+
+    Leaves are evicted, least recently used first, once the cache holds
+    more than max_bytes. Time is counted in calls rather than read from a
+    clock, so that the shards of a model, which see the same calls, always
+    agree on what is cached.
+
+    Args:
+        max_bytes (int): Max size of the cached KV cache.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._root = _Node((), None, None)
+        self._clock = 0
+
+    def match(self, token_ids: List[int]) -> Tuple[int, List[KVSegment]]:
+        """Find the longest cached prefix of token_ids.
+
+        Returns:
+            The length of the prefix, and the KV cache of the nodes along
+            it. The last one may cover more tokens than the prefix.
+        """
+        self._clock += 1
+        node = self._root
+        length = 0
+        values = []
+        while length < len(token_ids):
+            child = node.children.get(token_ids[length])
+            if child is None:
+                break
+            matched = _common_length(child.tokens, token_ids, length)
+            child.last_access = self._clock
+            values.append(child.value)
+            length += matched
+            if matched < len(child.tokens):
+                break
+            node = child
+        return length, values
+
+    def insert(
+        self, token_ids: List[int], load: Callable[[int, int], KVSegment]
+    ) -> int:
+        """Cache the KV cache of token_ids.
+
+        Args:
+            token_ids (List[int]): Tokens of the prompt.
+            load (Callable[[int, int], KVSegment]): Returns the KV cache of
+                token_ids[start:end]. Only called for the tokens that aren't
+                cached yet.
+
+        Returns:
+            The number of tokens added.
+        """
+        self._clock += 1
+        node = self._root
+        length = 0
+        added = 0
+        while length < len(token_ids):
+            child = node.children.get(token_ids[length])
+            if child is None:
+                child = _Node(
+                    tuple(token_ids[length:]),
+                    load(length, len(token_ids)),
+                    node,
+                )
+                node.children[child.tokens[0]] = child
+                self.num_bytes += child.value.nbytes
+                added = len(child.tokens)
+                length = len(token_ids)
+            else:
+                matched = _common_length(child.tokens, token_ids, length)
+                if matched < len(child.tokens):
+                    child = self._split(child, matched)
+                length += matched
+            child.last_access = self._clock
+            node = child
+        self._evict()
+        return added
+
+    def clear(self):
+        self._root.children.clear()
+        self.num_bytes = 0
+
+    def _split(self, node: _Node, at: int) -> _Node:
+        """Split the edge to node at, and return the new node in between."""
+        self.num_bytes -= node.value.nbytes
+        head, node.value = node.value.split(at)
+        middle = _Node(node.tokens[:at], head, node.parent)
+        middle.last_access = node.last_access
+        node.parent.children[middle.tokens[0]] = middle
+        node.tokens = node.tokens[at:]
+        node.parent = middle
+        middle.children[node.tokens[0]] = node
+        self.num_bytes += head.nbytes + node.value.nbytes
+        return middle
+
+    def _evict(self):
+        if self.num_bytes <= self.max_bytes:
+            return
+        counter = itertools.count()
+        leaves = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            if not node.children and node is not self._root:
+                leaves.append((node.last_access, next(counter), node))
+        heapq.heapify(leaves)
+        while self.num_bytes > self.max_bytes and leaves:
+            _, _, node = heapq.heappop(leaves)
+            parent = node.parent
+            del parent.children[node.tokens[0]]
+            self.num_bytes -= node.value.nbytes
+            if not parent.children and parent is not self._root:
+                heapq.heappush(leaves, (parent.last_access, next(counter), parent))
+
+
+class PrefixReuse(NamedTuple):
+    """What PrefixKVCache.prepare did to a batch."""
+
+    # Tokens of the prompt of each row.
+    prompts: List[List[int]]
+    # Tokens taken from the cache for every row, 0 if none.
+    prefix_length: int
+
+
+class PrefixKVCache:
+    """Reuses the KV cache of the prompts of earlier prefills in the prefill
+    of a padded TGI batch.
+
+    The rows of a batch share a past, so only the prefix common to all of
+    their prompts that is cached is reused. The prefill then only runs
+    on the rest of the prompts, which are left padded to the same length
+    after the prefix: the padding is masked, and the position ids skip it,
+    which keeps the outputs exact for models taking position ids. Models
+    without, like the ALiBi ones, see the distance to the prefix through
+    the padding, so their batches only reuse a prefix when no row is
+    padded. After the prefill, the prompts of all the rows are cached.
+
+    The cached KV cache takes GPU memory on top of the batches: max_bytes
+    has to fit in what max_batch_total_tokens leaves free.
+
+    Args:
+        max_bytes (int): Max size of the cached KV cache.
+        min_prefix_tokens (int): Don't reuse shorter prefixes, which save
+            less than the gather costs.
+    """
+
+    def __init__(self, max_bytes: int, min_prefix_tokens: int = 16):
+        self.tree = RadixPrefixCache(max_bytes)
+        self.min_prefix_tokens = min_prefix_tokens
+        self._key_seq_dim: Optional[int] = None
+        self._supported = True
+        # Rows looked up, rows that reused a prefix, and the prompt tokens
+        # they didn't prefill, since the cache was created.
+        self.num_lookups = 0
+        self.num_hits = 0
+        self.num_saved_tokens = 0
+
+    def prepare(
+        self, batch: "CausalLMBatch", use_position_ids: bool
+    ) -> Optional[PrefixReuse]:
+        """Take the cached prefix of the prompts of a batch about to be
+        prefilled out of its inputs, and give it as their past.
+
+        Returns:
+            What was reused, to pass to update once the batch is
+            prefilled, or None if the batch can't be cached.
+        """
+        if not self._supported:
+            return None
+        input_lengths = batch.input_lengths
+        rows = batch.input_ids.tolist()
+        prompts = [row[len(row) - n :] for row, n in zip(rows, input_lengths)]
+        reuse = PrefixReuse(prompts, 0)
+        self.num_lookups += len(prompts)
+        if self._key_seq_dim is None:
+            # Nothing is cached before the first batch is.
+            return reuse
+        if not use_position_ids and len(set(input_lengths)) > 1:
+            return reuse
+
+        matches = [self.tree.match(prompt) for prompt in prompts]
+        prefix_length = min(
+            min(input_lengths) - 1,
+            *(length for length, _ in matches),
+            *(_common_length(prompts[0], prompt, 0) for prompt in prompts[1:]),
+        )
+        if prefix_length < self.min_prefix_tokens:
+            return reuse
+
+        _reuse_prefix(
+            batch, KVSegment.concat(matches[0][1], prefix_length), prefix_length
+        )
+        # TGI computes the logprobs of the prompt from the logits of all of
+        # its tokens, which the prefill no longer has.
+        for request in batch.requests:
+            request.prefill_logprobs = False
+        self.num_hits += len(prompts)
+        self.num_saved_tokens += prefix_length * len(prompts)
+        return PrefixReuse(prompts, prefix_length)
+
+    def update(self, batch: "CausalLMBatch", reuse: PrefixReuse):
+        """Cache the prompts of a batch that was just prefilled."""
+        past_key_values = batch.past_key_values
+        if self._key_seq_dim is None:
+            self._supported = has_split_kv_cache(batch)
+            if not self._supported:
+                return
+            self._key_seq_dim = -2 if batch.keys_head_dim_last else -1
+        width = past_key_values[0][1].shape[-2]
+        for row, prompt in enumerate(reuse.prompts):
+            self.tree.insert(
+                prompt,
+                functools.partial(
+                    self._load,
+                    past_key_values,
+                    row,
+                    width - len(prompt),
+                    reuse.prefix_length,
+                ),
+            )
+
+    def _load(
+        self,
+        past_key_values: List[Tuple[torch.Tensor, torch.Tensor]],
+        row: int,
+        offset: int,
+        prefix_length: int,
+        start: int,
+        end: int,
+    ) -> KVSegment:
+        """Copy the KV cache of tokens start to end of the prompt of a row.
+        The prefix shared by the batch is in its first columns, and the
+        rest of the prompt in the last ones, offset by the padding."""
+        columns = torch.arange(start, end, device=past_key_values[0][1].device)
+        columns[columns >= prefix_length] += offset
+        return KVSegment.gather(past_key_values, row, columns, self._key_seq_dim)
+
+
+def has_split_kv_cache(batch: "CausalLMBatch") -> bool:
+    """Whether the KV cache of a batch is a key and value tensor per layer,
+    [batch, heads, tokens, head_dim], which is what most padded models
+    use. BLOOM merges the heads into the batch, and GPT BigCode the keys
+    and values."""
+    past_key_values = batch.past_key_values
+    return bool(past_key_values) and all(
+        len(layer) == 2
+        and all(tensor.dim() == 4 and tensor.shape[0] == len(batch) for tensor in layer)
+        for layer in past_key_values
+    )
+
+
+def _reuse_prefix(
+    batch: "CausalLMBatch",
+    prefix: List[Tuple[torch.Tensor, torch.Tensor]],
+    prefix_length: int,
+):
+    """Turn the first prefix_length tokens of every prompt of a batch into
+    its past, given their KV cache.
+
+    The columns of the batch stay where they were, the prefix first and
+    then the rest of each prompt, left padded to the longest.
+    """
+    width = batch.max_input_length
+    num_rows = len(batch.input_lengths)
+    suffix_lengths = torch.tensor(batch.input_lengths, device=batch.input_ids.device)
+    suffix_lengths -= prefix_length
+
+    columns = torch.arange(width, device=batch.input_ids.device)
+    mask = (columns < prefix_length) | (columns >= width - suffix_lengths[:, None])
+    batch.attention_mask[:, :width] = mask
+    position_ids = mask.long().cumsum(-1) - 1
+    position_ids.masked_fill_(~mask, 1)
+
+    batch.input_ids = batch.input_ids[:, prefix_length:]
+    batch.position_ids = position_ids[:, prefix_length:]
+    batch.past_key_values = [
+        (
+            keys.expand(num_rows, *keys.shape[1:]),
+            values.expand(num_rows, *values.shape[1:]),
+        )
+        for keys, values in prefix
+    ]
+    # The filters of TGI keep the last input_length columns of each row.
+    # Counting the padding keeps the prefix in the row.
+    batch.input_lengths = [width] * num_rows
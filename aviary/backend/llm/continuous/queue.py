@@ -1,8 +1,11 @@
+import asyncio
+import heapq
+import itertools
 import time
 from collections import deque
 from dataclasses import dataclass
 from threading import Condition, RLock
-from typing import Optional, Union
+from typing import Dict, Iterator, List, Optional, Union
 
 import ray
 
@@ -18,6 +21,22 @@ class InferenceRequest:
     output_stream: TokenStream
     submit_time_ns: int
     request_input_length: Union[int, ray.ObjectRef]
+    # Number of generated tokens that were folded into the prompt
+    # when the request was last preempted.
+    num_resumed_tokens: int = 0
+    resumed_text: str = ""
+    cancelled: bool = False
+    # Monotonic time at which the first token was generated, 0 until then.
+    first_token_time_ns: int = 0
+    # Lower value = higher priority (see QueuePriority).
+    priority: int = 0
+    # Monotonic time by which the request should be scheduled, if any.
+    deadline_ns: Optional[int] = None
+    # Who sent the request, for fair share scheduling.
+    tenant: str = ""
+    # Times the request was split off a step that failed because of one of
+    # its requests.
+    num_failed_steps: int = 0
 
     @property
     def request_input_length(self) -> int:
@@ -34,15 +53,60 @@ class InferenceRequest:
         self._request_input_length = v
 
     @classmethod
-    def from_request(cls, request: Request, request_input_length: int):
+    def from_request(
+        cls,
+        request: Request,
+        request_input_length: int,
+        priority: int = 0,
+        deadline_s: Optional[float] = None,
+        tenant: str = "",
+        output_stream: Optional[TokenStream] = None,
+    ):
+        submit_time_ns = time.monotonic_ns()
         return cls(
             id=request.id,
             request=request,
             request_input_length=request_input_length,
-            output_stream=TokenStream(request.id),
-            submit_time_ns=int(time.time()),
+            output_stream=output_stream or TokenStream(request.id),
+            submit_time_ns=submit_time_ns,
+            priority=priority,
+            deadline_ns=(
+                submit_time_ns + int(deadline_s * 1e9)
+                if deadline_s is not None
+                else None
+            ),
+            tenant=tenant,
+        )
+
+    def preempt(self) -> None:
+        """Prepare the request to be resubmitted after being preempted.
+
+        The tokens generated so far are kept in the output stream. When the
+        request is processed again, they are appended to the prompt, so that
+        the generation resumes where it stopped instead of starting over."""
+        self.num_resumed_tokens = self.output_stream.num_tokens()
+        self.resumed_text = self.output_stream.generated_text()
+
+    @property
+    def generation_request(self) -> Request:
+        """The request to send to the inference worker."""
+        if not self.num_resumed_tokens:
+            return self.request
+        return Request(
+            id=self.request.id,
+            inputs=self.request.inputs + self.resumed_text,
+            truncate=self.request.truncate + self.num_resumed_tokens,
+            max_new_tokens=max(
+                1, self.request.max_new_tokens - self.num_resumed_tokens
+            ),
+            params=self.request.params,
         )
 
+    @property
+    def prefill_length(self) -> int:
+        """Number of tokens to prefill when the request is processed."""
+        return self.request_input_length + self.num_resumed_tokens
+
     @property
     def total_tokens(self) -> int:
         return self.request_input_length + self.request.max_new_tokens
@@ -103,3 +167,182 @@ class RequestQueue:
     def __len__(self) -> int:
         with self._lock:
             return len(self._queue)
+
+
+class PriorityRequestQueue:
+    """Queue of the requests waiting to be scheduled.
+
+    Requests are served earliest deadline first. A request without an
+    explicit deadline is due priority * priority_aging_s after it was queued,
+    so that interactive requests (priority 0) are served in arrival order and
+    ahead of bulk ones, while a bulk request can only be overtaken by requests
+    queued less than priority_aging_s after it, and never starves. Requests
+    put back with put_front (e.g. preempted ones) go ahead of everything else.
+
+    The requests are kept in a binary heap, indexed by request id, and in a
+    heap per tenant. Adding and popping a request is O(log n), removing one
+    is O(1) (the heap entries are dropped lazily), and the first k requests,
+    overall or of a tenant, can be looked at in O(k log k) without popping
+    anything.
+
+    Supports the subset of the asyncio.Queue interface used by the scheduler.
+
+    Args:
+        priority_aging_s (float): Delay added to the deadline of a request
+            for each priority level below 0.
+    """
+
+    def __init__(self, priority_aging_s: float = 30.0):
+        self.priority_aging_ns = int(priority_aging_s * 1e9)
+        # Entries are [sort key, request, tokens]. An entry is shared by the
+        # heap and the heap of its tenant. The request of a removed entry is
+        # set to None, and the entry is discarded when it reaches the top of
+        # a heap.
+        self._heap: List[list] = []
+        self._tenant_heaps: Dict[str, List[list]] = {}
+        self._entries: Dict[int, list] = {}
+        self._tenant_sizes: Dict[str, int] = {}
+        # Tokens reserved by the queued requests (prefill + new tokens), by
+        # priority.
+        self._tokens_by_priority: Dict[int, int] = {}
+        self._counter = itertools.count()
+        self._front_counter = itertools.count()
+
+    def deadline_ns(self, request: InferenceRequest) -> int:
+        deadline_ns = request.submit_time_ns + request.priority * self.priority_aging_ns
+        if request.deadline_ns is not None:
+            deadline_ns = min(deadline_ns, request.deadline_ns)
+        return deadline_ns
+
+    def put_nowait(self, request: InferenceRequest) -> None:
+        self._push(
+            (1, self.deadline_ns(request), request.priority, next(self._counter)),
+            request,
+        )
+
+    def put_front(self, request: InferenceRequest) -> None:
+        """Put a request ahead of all the queued ones, including the ones
+        previously put in front."""
+        self._push((0, -next(self._front_counter)), request)
+
+    def _push(self, key: tuple, request: InferenceRequest) -> None:
+        if request.id in self._entries:
+            raise ValueError(f"Request {request.id} is already queued")
+        tokens = self._reserved_tokens(request)
+        entry = [key, request, tokens]
+        self._entries[request.id] = entry
+        self._tokens_by_priority[request.priority] = (
+            self._tokens_by_priority.get(request.priority, 0) + tokens
+        )
+        heapq.heappush(self._heap, entry)
+        heapq.heappush(self._tenant_heaps.setdefault(request.tenant, []), entry)
+        self._tenant_sizes[request.tenant] = (
+            self._tenant_sizes.get(request.tenant, 0) + 1
+        )
+
+    @staticmethod
+    def _reserved_tokens(request: InferenceRequest) -> int:
+        input_length = request._request_input_length
+        if isinstance(input_length, ray.ObjectRef):
+            # Don't block on the tokenization, assume the longest prompt.
+            input_length = request.request.truncate
+        return input_length + request.num_resumed_tokens + request.gen_length
+
+    def get_nowait(self) -> InferenceRequest:
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            request = entry[1]
+            if request is not None:
+                self._discard(entry)
+                return request
+        raise asyncio.QueueEmpty
+
+    def remove(self, request_id: int) -> Optional[InferenceRequest]:
+        """Remove a request from the queue.
+
+        Returns:
+            The removed request, or None if it wasn't queued.
+        """
+        entry = self._entries.get(request_id)
+        if entry is None:
+            return None
+        request = entry[1]
+        self._discard(entry)
+        return request
+
+    def _discard(self, entry: list) -> None:
+        request = entry[1]
+        entry[1] = None
+        del self._entries[request.id]
+        self._tokens_by_priority[request.priority] -= entry[2]
+        self._tenant_sizes[request.tenant] -= 1
+        if not self._tenant_sizes[request.tenant]:
+            del self._tenant_sizes[request.tenant]
+            del self._tenant_heaps[request.tenant]
+        else:
+            # Entries popped from the main heap are usually at the top of the
+            # tenant heap, discard them there.
+            tenant_heap = self._tenant_heaps[request.tenant]
+            while tenant_heap[0][1] is None:
+                heapq.heappop(tenant_heap)
+        if len(self._heap) > 2 * len(self._entries) + 32:
+            # Too many removed entries, rebuild the heaps without them.
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
+            self._tenant_heaps = {}
+            for entry in self._heap:
+                self._tenant_heaps.setdefault(entry[1].tenant, []).append(entry)
+            for heap in self._tenant_heaps.values():
+                heapq.heapify(heap)
+
+    def peek(self, n: int, tenant: Optional[str] = None) -> List[InferenceRequest]:
+        """Return the first n requests (of a tenant, if set), in the order
+        they would be popped."""
+        if tenant is None:
+            return list(itertools.islice(self, n))
+        return list(itertools.islice(self._iter(self._tenant_heaps.get(tenant, [])), n))
+
+    def num_tokens(self, max_priority: Optional[int] = None) -> int:
+        """Return the tokens reserved by the queued requests (of priority
+        max_priority or higher, if set)."""
+        return sum(
+            tokens
+            for priority, tokens in self._tokens_by_priority.items()
+            if max_priority is None or priority <= max_priority
+        )
+
+    def tenants(self) -> List[str]:
+        """Return the tenants with queued requests."""
+        return list(self._tenant_sizes)
+
+    def __iter__(self) -> Iterator[InferenceRequest]:
+        """Iterate over the requests in the order they would be popped.
+
+        The queue must not be modified during the iteration."""
+        return self._iter(self._heap)
+
+    @staticmethod
+    def _iter(heap: List[list]) -> Iterator[InferenceRequest]:
+        # The heap is walked lazily, so that looking at the first k requests
+        # costs O(k log k) regardless of the size of the queue.
+        frontier = [(heap[0][0], 0)] if heap else []
+        while frontier:
+            _, i = heapq.heappop(frontier)
+            request = heap[i][1]
+            if request is not None:
+                yield request
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child][0], child))
+
+    def __contains__(self, request_id: int) -> bool:
+        return request_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def qsize(self) -> int:
+        return len(self._entries)
+
+    def empty(self) -> bool:
+        return not self._entries
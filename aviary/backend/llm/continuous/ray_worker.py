@@ -0,0 +1,172 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, List, Optional, Tuple
+
+import ray
+import torch
+
+from .generations import GenerationColumns, TokenGeneration
+from .worker import AsyncInferenceWorker
+
+if TYPE_CHECKING:
+    from .types import Request
+
+logger = logging.getLogger(__name__)
+
+
+def _decode_generations(
+    ret: List[Tuple[Optional[GenerationColumns], Optional[int]]]
+) -> Tuple[Optional[List[TokenGeneration]], Optional[int]]:
+    """Decode the generations returned by rank 0. The other ranks computed
+    the same ones and only acknowledge the step."""
+    generations, batch_id = ret[0]
+    if generations is None:
+        return None, batch_id
+    return generations.to_generations(), batch_id
+
+
+def _decode_steps(
+    ret: List[Tuple[Optional[List[GenerationColumns]], Optional[int]]]
+) -> Tuple[Optional[List[List[TokenGeneration]]], Optional[int]]:
+    """Decode the generations of each step returned by rank 0."""
+    steps, batch_id = ret[0]
+    if steps is None:
+        return None, batch_id
+    return [generations.to_generations() for generations in steps], batch_id
+
+
+# TODO: Add error handling.
+# We need to catch the exception and propagate it to the user.
+class RayInferenceWorker(AsyncInferenceWorker):
+    """Drives the ranks of a model, one prediction worker each.
+
+    The requests of a new batch are put in the object store once and sent
+    to every rank by reference. Only rank 0 returns the generations, as
+    GenerationColumns, which are decoded here.
+    """
+
+    def __init__(self, worker_group: List[ray.ObjectRef]):
+        self.worker_group = worker_group
+
+    def _put(self, requests: List["Request"]) -> Any:
+        """The requests of a new batch as sent to the ranks."""
+        return ray.put(requests) if self.worker_group else requests
+
+    def _submit(self, method: str, *args) -> List[ray.ObjectRef]:
+        return [getattr(worker, method).remote(*args) for worker in self.worker_group]
+
+    def _call(self, method: str, *args) -> List[Any]:
+        """Run a method on every rank, and return what each rank returned."""
+        return ray.get(self._submit(method, *args))
+
+    async def _call_async(self, method: str, *args) -> List[Any]:
+        ret = await asyncio.gather(*self._submit(method, *args))
+        logger.debug(f"{method} returns {ret}")
+        return ret
+
+    def process_new_batch(
+        self, requests: List["Request"], batch_id: int
+    ) -> Tuple[List[TokenGeneration], int]:
+        return _decode_generations(
+            self._call("process_new_batch", self._put(requests), batch_id)
+        )
+
+    def generate_next_token(
+        self, batch_ids: List[int]
+    ) -> Tuple[List[TokenGeneration], Optional[int]]:
+        return _decode_generations(self._call("generate_next_token", batch_ids))
+
+    def filter_requests(
+        self, batch_id: int, request_ids: List[int], compact: bool = False
+    ) -> Optional[int]:
+        return self._call("filter_requests", batch_id, request_ids, compact)[0]
+
+    def generate_next_tokens(
+        self, batch_ids: List[int], max_steps: int
+    ) -> Tuple[Optional[List[List[TokenGeneration]]], Optional[int]]:
+        return _decode_steps(self._call("generate_next_tokens", batch_ids, max_steps))
+
+    def prefill_chunk(
+        self, requests: Optional[List["Request"]], batch_id: int, max_tokens: int
+    ) -> int:
+        if requests is not None:
+            requests = self._put(requests)
+        return self._call("prefill_chunk", requests, batch_id, max_tokens)[0]
+
+    async def process_new_batch_async(
+        self, requests: List["Request"], batch_id: int
+    ) -> Tuple[List[TokenGeneration], int]:
+        return _decode_generations(
+            await self._call_async("process_new_batch", self._put(requests), batch_id)
+        )
+
+    async def generate_next_token_async(
+        self, batch_ids: List[int]
+    ) -> Tuple[List[TokenGeneration], Optional[int]]:
+        return _decode_generations(
+            await self._call_async("generate_next_token", batch_ids)
+        )
+
+    async def filter_requests_async(
+        self, batch_id: int, request_ids: List[int], compact: bool = False
+    ) -> Optional[int]:
+        return (
+            await self._call_async("filter_requests", batch_id, request_ids, compact)
+        )[0]
+
+    async def generate_next_tokens_async(
+        self, batch_ids: List[int], max_steps: int
+    ) -> Tuple[Optional[List[List[TokenGeneration]]], Optional[int]]:
+        return _decode_steps(
+            await self._call_async("generate_next_tokens", batch_ids, max_steps)
+        )
+
+    async def prefill_chunk_async(
+        self, requests: Optional[List["Request"]], batch_id: int, max_tokens: int
+    ) -> int:
+        if requests is not None:
+            requests = self._put(requests)
+        return (
+            await self._call_async("prefill_chunk", requests, batch_id, max_tokens)
+        )[0]
+
+
+class LocalInferenceWorker(RayInferenceWorker):
+    """Drives the ranks of a model from the rank 0 prediction worker.
+
+    Rank 0 runs each step in a thread of its own, in inference mode, while
+    the other ranks are called through Ray as usual, so the generations of
+    rank 0 are never serialized.
+
+    Args:
+        local_worker: The rank 0 prediction worker.
+        worker_group (List[ray.ObjectRef]): The other ranks.
+    """
+
+    def __init__(self, local_worker: Any, worker_group: List[ray.ObjectRef]):
+        super().__init__(worker_group)
+        self.local_worker = local_worker
+        # A single thread, the steps of rank 0 must run one after the other.
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="rank-0")
+
+    def _call_local(self, method: str, *args) -> Any:
+        # The requests of a new batch are put in the object store for the
+        # other ranks.
+        args = [ray.get(arg) if isinstance(arg, ray.ObjectRef) else arg for arg in args]
+        # Inference mode is thread local, and the steps run in the thread of
+        # the executor, not the one the worker was created in.
+        with torch.inference_mode():
+            return getattr(self.local_worker, method)(*args)
+
+    def _call(self, method: str, *args) -> List[Any]:
+        refs = self._submit(method, *args)
+        return [self._call_local(method, *args)] + (ray.get(refs) if refs else [])
+
+    async def _call_async(self, method: str, *args) -> List[Any]:
+        refs = self._submit(method, *args)
+        ret = await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(self._call_local, method, *args)
+        )
+        return [ret] + list(await asyncio.gather(*refs))
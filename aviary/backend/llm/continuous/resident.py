@@ -0,0 +1,390 @@
+import asyncio
+import logging
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Type,
+)
+
+import ray
+
+from aviary.backend.llm.continuous.scheduler import InferenceScheduler, Tokenizer
+from aviary.backend.llm.continuous.tokenstream import TokenStream
+
+logger = logging.getLogger(__name__)
+
+
+class StreamChunk(NamedTuple):
+    """The tokens generated for a request since the last pull."""
+
+    text: str
+    num_tokens: int
+    num_input_tokens: Optional[int] = None
+    # Set once the stream of the request ended, after text.
+    ended: bool = False
+    error: Optional[Exception] = None
+
+
+class SchedulerUpdate(NamedTuple):
+    """What a pull from a ResidentScheduler returns."""
+
+    chunks: Dict[int, StreamChunk]
+    # Estimated queue wait, by priority.
+    queue_wait_s: Dict[int, float]
+
+
+class ThreadTokenizer(Tokenizer):
+    """Counts the tokens of prompts in a thread, so that the event loop
+    of the scheduler doesn't block on tokenization.
+
+    Args:
+        get_input_length: Counts the tokens of a prompt, truncated to
+            max_length.
+    """
+
+    def __init__(self, get_input_length: Callable[[str, int], int]):
+        self._get_input_length = get_input_length
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="tokenizer")
+
+    def get_input_length(self, input_text: str, max_length: int) -> int:
+        return self._get_input_length(input_text, max_length)
+
+    async def get_input_length_async(self, input_text: str, max_length: int) -> int:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._get_input_length, input_text, max_length
+        )
+
+
+class Outbox:
+    """The tokens generated for each request since the last pull, filled
+    from the event loop of the scheduler and emptied from another thread."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        # Texts, number of tokens, number of input tokens, whether the stream
+        # ended and its error, by request id.
+        self._pending: Dict[int, list] = {}
+
+    def push(
+        self,
+        request_id: int,
+        text: str,
+        num_tokens: int,
+        num_input_tokens: Optional[int],
+        ended: bool = False,
+        error: Optional[Exception] = None,
+    ):
+        with self._condition:
+            pending = self._pending.get(request_id)
+            if pending is None:
+                self._pending[request_id] = [
+                    [text],
+                    num_tokens,
+                    num_input_tokens,
+                    ended,
+                    error,
+                ]
+                if len(self._pending) == 1:
+                    self._condition.notify_all()
+            else:
+                pending[0].append(text)
+                pending[1] += num_tokens
+                pending[2:] = num_input_tokens, ended, error
+
+    def pull(self, timeout_s: float) -> Dict[int, StreamChunk]:
+        """Wait up to timeout_s for tokens, and return all of them."""
+        with self._condition:
+            if not self._pending:
+                self._condition.wait(timeout_s)
+            pending, self._pending = self._pending, {}
+        return {
+            request_id: StreamChunk("".join(texts), *rest)
+            for request_id, (texts, *rest) in pending.items()
+        }
+
+
+class OutboxTokenStream(TokenStream):
+    """Output stream of a request of a ResidentScheduler, which sends its
+    tokens to the outbox as they are put, instead of to a reader."""
+
+    def __init__(self, id: int, outbox: Outbox):
+        super().__init__(id)
+        self._outbox = outbox
+
+    def put(self, item, num_tokens: int = 1):
+        self._token_texts.append(item)
+        self._num_tokens += num_tokens
+        self._outbox.push(self.id, item, num_tokens, self.num_input_tokens)
+
+    def end(self, generated_text=None):
+        super().end(generated_text)
+        self._outbox.push(
+            self.id, "", 0, self.num_input_tokens, ended=True, error=self._error
+        )
+
+
+class ResidentScheduler:
+    """Runs a scheduler in the rank 0 prediction worker, next to the model,
+    instead of in the Serve replica.
+
+    The scheduler gets an event loop of its own, in a background thread,
+    so that the methods of the actor called by the replica never wait on a
+    step. Requests are submitted and cancelled from the threads of the
+    actor. The tokens of all the requests go to a single outbox, which the
+    replica pulls from: one call returns whatever was generated for every
+    request since the previous one, so the tokens are coalesced by the
+    pulls rather than by the streams.
+
+    Args:
+        scheduler_cls (Type[InferenceScheduler]): Scheduler to run.
+        **scheduler_kwargs: Passed to the scheduler, which is created in
+            its event loop.
+    """
+
+    def __init__(self, scheduler_cls: Type[InferenceScheduler], **scheduler_kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="resident-scheduler", daemon=True
+        )
+        self._thread.start()
+        self._outbox = Outbox()
+
+        async def create() -> InferenceScheduler:
+            return scheduler_cls(
+                output_stream_factory=lambda request_id: OutboxTokenStream(
+                    request_id, self._outbox
+                ),
+                **scheduler_kwargs,
+            )
+
+        self._scheduler = self._run(create())
+
+    def _run(self, coroutine: Awaitable) -> Any:
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def stop(self):
+        self._scheduler.stop()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def submit_request(
+        self,
+        input_text: str,
+        params: Dict[str, Any],
+        max_new_tokens: int = 256,
+        max_length: int = 1024,
+        priority: int = 0,
+        deadline_s: Optional[float] = None,
+        tenant: str = "",
+    ) -> int:
+        """Queue a request, see InferenceScheduler.process_request.
+
+        Returns:
+            The id of the request.
+        """
+        stream = self._run(
+            self._scheduler.process_request_async(
+                input_text,
+                params,
+                max_new_tokens=max_new_tokens,
+                max_length=max_length,
+                priority=priority,
+                deadline_s=deadline_s,
+                tenant=tenant,
+            )
+        )
+        return stream.id
+
+    def cancel_request(self, request_id: int):
+        self._loop.call_soon_threadsafe(self._scheduler.cancel_request, request_id)
+
+    def request_shed(self):
+        self._loop.call_soon_threadsafe(self._scheduler.request_shed)
+
+    def pull(self, timeout_s: float, priorities: List[int]) -> SchedulerUpdate:
+        """Wait up to timeout_s for tokens, and return all of them.
+
+        Args:
+            timeout_s (float): How long to wait for a token.
+            priorities (List[int]): Priorities to estimate the queue wait
+                of.
+        """
+        chunks = self._outbox.pull(timeout_s)
+        return SchedulerUpdate(chunks, self.estimate_queue_wait_s(priorities))
+
+    def estimate_queue_wait_s(self, priorities: List[int]) -> Dict[int, float]:
+        """The queue wait estimates of the scheduler, by priority."""
+
+        async def estimate_queue_wait_s() -> Dict[int, float]:
+            return {
+                priority: self._scheduler.estimate_queue_wait_s(priority)
+                for priority in priorities
+            }
+
+        return self._run(estimate_queue_wait_s())
+
+
+class ResidentSchedulerClient:
+    """Serve replica side of a ResidentScheduler, with the same interface
+    as a scheduler.
+
+    A single long-poll loop pulls the chunks of all the requests from the
+    prediction worker and puts them into the local streams, so the replica
+    makes one call per pull, however large the batch, and never takes part
+    in a step.
+
+    Args:
+        worker: Handle of the prediction worker running the scheduler.
+        poll_timeout_s (float): How long a pull waits for chunks.
+        stream_chunk_tokens (int): See TokenStream.chunk_tokens.
+        stream_chunk_interval_s (float): See TokenStream.chunk_interval_s.
+        max_stream_pending_tokens (Optional[int]): See
+            TokenStream.max_pending_tokens.
+    """
+
+    def __init__(
+        self,
+        worker: "ray.actor.ActorHandle",
+        poll_timeout_s: float = 1.0,
+        stream_chunk_tokens: int = 1,
+        stream_chunk_interval_s: float = 0,
+        max_stream_pending_tokens: Optional[int] = None,
+    ):
+        self._worker = worker
+        self._poll_timeout_s = poll_timeout_s
+        self._stream_chunk_tokens = stream_chunk_tokens
+        self._stream_chunk_interval_s = stream_chunk_interval_s
+        self._max_stream_pending_tokens = max_stream_pending_tokens
+        self._streams: Dict[int, TokenStream] = {}
+        # Chunks pulled while the request that they are for was being
+        # submitted, by request id.
+        self._early_chunks: Dict[int, List[StreamChunk]] = {}
+        self._num_submitting = 0
+        # Priorities whose queue wait estimate is pulled, and the estimates
+        # pulled so far.
+        self._priorities: Set[int] = set()
+        self._queue_wait_s: Dict[int, float] = {}
+        self._poll_task: Optional[asyncio.Task] = None
+
+    async def process_request_async(
+        self,
+        input_text: str,
+        params: Dict[str, Any],
+        max_new_tokens: int = 256,
+        max_length: int = 1024,
+        priority: int = 0,
+        deadline_s: Optional[float] = None,
+        tenant: str = "",
+    ) -> TokenStream:
+        """Queue a request in the prediction worker, see
+        InferenceScheduler.process_request."""
+        self._priorities.add(priority)
+        if self._poll_task is None or self._poll_task.done():
+            self._poll_task = asyncio.ensure_future(self._poll())
+        self._num_submitting += 1
+        try:
+            request_id = await self._worker.submit_request.remote(
+                input_text,
+                params,
+                max_new_tokens=max_new_tokens,
+                max_length=max_length,
+                priority=priority,
+                deadline_s=deadline_s,
+                tenant=tenant,
+            )
+        finally:
+            self._num_submitting -= 1
+        stream = TokenStream(
+            request_id,
+            chunk_tokens=self._stream_chunk_tokens,
+            chunk_interval_s=self._stream_chunk_interval_s,
+            max_pending_tokens=self._max_stream_pending_tokens,
+        )
+        self._streams[request_id] = stream
+        for chunk in self._early_chunks.pop(request_id, []):
+            self._dispatch(request_id, chunk)
+        if not self._num_submitting:
+            self._early_chunks.clear()
+        return stream
+
+    def cancel_request(self, request_id: int) -> bool:
+        stream = self._streams.pop(request_id, None)
+        if stream is None:
+            return False
+        stream.end("")
+        self._worker.cancel_request.remote(request_id)
+        return True
+
+    def estimate_queue_wait_s(self, priority: int = 0) -> float:
+        """The estimate of the prediction worker, as of the last pull.
+
+        It is infinite until the first estimate for priority arrives, which
+        is fetched right away, so that load shedding doesn't let everything
+        in before then."""
+        if priority not in self._priorities:
+            self._priorities.add(priority)
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                # The next pull brings it.
+                pass
+            else:
+                asyncio.ensure_future(self._fetch_queue_wait_s(priority))
+        return self._queue_wait_s.get(priority, math.inf)
+
+    def request_shed(self):
+        self._worker.request_shed.remote()
+
+    async def _fetch_queue_wait_s(self, priority: int):
+        try:
+            queue_wait_s = await self._worker.estimate_queue_wait_s.remote([priority])
+        except Exception as e:
+            logger.error(f"Failed to estimate the queue wait: {repr(e)}")
+            return
+        # A pull may have brought a newer one in the meantime.
+        self._queue_wait_s.setdefault(priority, queue_wait_s[priority])
+
+    async def _poll(self):
+        while True:
+            try:
+                update: SchedulerUpdate = await self._worker.pull.remote(
+                    self._poll_timeout_s, list(self._priorities)
+                )
+            except Exception as e:
+                logger.error(f"Failed to pull from the scheduler: {repr(e)}")
+                streams, self._streams = self._streams, {}
+                for stream in streams.values():
+                    stream.fail(e)
+                return
+            self._queue_wait_s.update(update.queue_wait_s)
+            for request_id, chunk in update.chunks.items():
+                if request_id in self._streams:
+                    self._dispatch(request_id, chunk)
+                elif self._num_submitting:
+                    self._early_chunks.setdefault(request_id, []).append(chunk)
+
+    def _dispatch(self, request_id: int, chunk: StreamChunk):
+        stream = self._streams.get(request_id)
+        if stream is None:
+            # Cancelled by an earlier chunk.
+            return
+        stream.num_input_tokens = chunk.num_input_tokens
+        if chunk.num_tokens:
+            stream.put(chunk.text, num_tokens=chunk.num_tokens)
+        if stream.overflowed() and chunk.error is None and not chunk.ended:
+            # The reader fell too far behind, stop generating for it.
+            self.cancel_request(request_id)
+        elif chunk.error is not None:
+            del self._streams[request_id]
+            stream.fail(chunk.error)
+        elif chunk.ended:
+            del self._streams[request_id]
+            stream.end()
@@ -1,27 +1,47 @@
 import asyncio
 import logging
+import math
 import sys
 import time
 import traceback
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 from threading import Lock
-from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import ray
 from ray._private.utils import run_background_task
 from transformers import AutoTokenizer
 
+from aviary.backend.llm.continuous.inflight import InFlightTable
+from aviary.backend.llm.continuous.metrics import SchedulerMetrics
 from aviary.backend.llm.continuous.policy import QuotaBasedRequestSelectionPolicy
-from aviary.backend.llm.continuous.queue import InferenceRequest
+from aviary.backend.llm.continuous.queue import (
+    InferenceRequest,
+    PriorityRequestQueue,
+)
 from aviary.backend.llm.continuous.tokenstream import TokenStream
 
 from .types import Request
+from .worker import StepFailedError
 
 if TYPE_CHECKING:
     from text_generation_server.models.types import (
         Generation,
     )
+    from transformers import PreTrainedTokenizerBase
 
     from .worker import AbstractInferenceWorker, AsyncInferenceWorker
 
@@ -55,6 +75,12 @@ class Tokenizer(ABC):
     def get_input_length(self, input_text: str, max_length: int) -> int:
         raise NotImplementedError("")
 
+    async def get_input_length_async(self, input_text: str, max_length: int) -> int:
+        input_length = self.get_input_length(input_text, max_length)
+        if isinstance(input_length, ray.ObjectRef):
+            input_length = await input_length
+        return input_length
+
 
 class NaiveTokenizer(Tokenizer):
     def get_input_length(self, input_text: str, max_length: int) -> int:
@@ -93,44 +119,273 @@ class RayTokenizer(Tokenizer):
         ].get_input_length.remote(input_text, max_length)
 
 
+class TokenizerWorker:
+    """Counts tokens of prompts. Meant to be run as a CPU-only Ray actor."""
+
+    def __init__(self, tokenizer: "PreTrainedTokenizerBase"):
+        self._tokenizer = tokenizer
+        if not getattr(tokenizer, "is_fast", False):
+            logger.warning(
+                f"Tokenizer {type(tokenizer).__name__} is not a fast tokenizer, "
+                "tokenization will be slow."
+            )
+
+    def get_input_lengths(self, input_texts: List[str], max_length: int) -> List[int]:
+        input_ids = self._tokenizer(
+            input_texts,
+            return_token_type_ids=False,
+            return_attention_mask=False,
+            truncation=True,
+            max_length=max_length,
+        )["input_ids"]
+        return [len(ids) for ids in input_ids]
+
+
+class RayTokenizerPool(Tokenizer):
+    """Tokenizer using a pool of CPU actors, keeping tokenization off the
+    GPU prediction workers.
+
+    Calls made in the same event loop iteration are sent to the actors as
+    batches, and token counts are kept in a LRU cache keyed by the prompt
+    and max length.
+
+    Args:
+        tokenizer: The tokenizer (or an ObjectRef to it) to use in the actors.
+        num_workers (int): Number of tokenizer actors.
+        num_cpus_per_worker (float): Number of CPUs per tokenizer actor.
+        max_batch_size (int): Max number of prompts in a single actor call.
+        cache_size (int): Max number of token counts to cache.
+    """
+
+    def __init__(
+        self,
+        tokenizer: Union["PreTrainedTokenizerBase", ray.ObjectRef],
+        num_workers: int = 1,
+        num_cpus_per_worker: float = 1,
+        max_batch_size: int = 64,
+        cache_size: int = 4096,
+    ):
+        remote_worker_cls = ray.remote(num_cpus=num_cpus_per_worker)(TokenizerWorker)
+        self._workers = [
+            remote_worker_cls.remote(tokenizer) for _ in range(num_workers)
+        ]
+        self._id = -1
+        self._max_batch_size = max_batch_size
+        self._cache_size = cache_size
+        # Keyed by the prompt itself, so that prompts whose hashes collide
+        # never share a token count.
+        self._cache: "OrderedDict[Tuple[str, int], int]" = OrderedDict()
+        self._in_flight: Dict[Tuple[str, int], asyncio.Future] = {}
+        self._pending: Dict[int, List[Tuple[str, int]]] = {}
+
+    def _next_worker(self):
+        self._id += 1
+        # Simple round robin
+        return self._workers[self._id % len(self._workers)]
+
+    def _get_cached(self, key: Tuple[str, int]) -> Optional[int]:
+        input_length = self._cache.get(key)
+        if input_length is not None:
+            self._cache.move_to_end(key)
+        return input_length
+
+    def _cache_input_length(self, key: Tuple[str, int], input_length: int):
+        self._cache[key] = input_length
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def get_input_length(self, input_text: str, max_length: int) -> int:
+        key = (input_text, max_length)
+        input_length = self._get_cached(key)
+        if input_length is None:
+            input_length = ray.get(
+                self._next_worker().get_input_lengths.remote([input_text], max_length)
+            )[0]
+            self._cache_input_length(key, input_length)
+        return input_length
+
+    async def get_input_length_async(self, input_text: str, max_length: int) -> int:
+        key = (input_text, max_length)
+        input_length = self._get_cached(key)
+        if input_length is not None:
+            return input_length
+
+        future = self._in_flight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._in_flight[key] = future
+            if not self._pending:
+                loop.call_soon(self._flush)
+            self._pending.setdefault(max_length, []).append(key)
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        pending, self._pending = self._pending, {}
+        for max_length, keys in pending.items():
+            for i in range(0, len(keys), self._max_batch_size):
+                batch = keys[i : i + self._max_batch_size]
+                ref = self._next_worker().get_input_lengths.remote(
+                    [text for text, _ in batch], max_length
+                )
+                asyncio.ensure_future(self._resolve(ref, batch))
+
+    async def _resolve(self, ref: ray.ObjectRef, keys: List[Tuple[str, int]]):
+        try:
+            input_lengths = await ref
+        except Exception as e:
+            for key in keys:
+                future = self._in_flight.pop(key)
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, input_length in zip(keys, input_lengths):
+            self._cache_input_length(key, input_length)
+            future = self._in_flight.pop(key)
+            if not future.done():
+                future.set_result(input_length)
+
+
 @dataclass
 class Stats:
     num_requests_processed: int = 0
     num_requests_failed: int = 0
+    num_requests_preempted: int = 0
+    num_requests_cancelled: int = 0
+    num_preempted_tokens_kept: int = 0
     num_requests_pending: int = 0
     num_active_requests: int = 0
     num_finished_requests: int = 0
     num_tokens_generated: int = 0
     num_input_tokens: int = 0
     num_iterations: int = 0
+    num_ooms: int = 0
+    num_requests_shed: int = 0
+    # Input and max new tokens of the active requests.
+    num_tokens_in_flight: int = 0
+    # Input and max new tokens of the requests that left the batch.
+    num_tokens_released: int = 0
+    tokens_per_s: float = 0.0
+    # Rate at which num_tokens_released grew over the last reports, and the
+    # highest it has been.
+    tokens_released_per_s: float = 0.0
+    max_tokens_released_per_s: float = 0.0
+    release_samples: Deque[Tuple[float, int]] = field(
+        default_factory=lambda: deque(maxlen=10), repr=False
+    )
     last_report_time: float = 0.0
+    last_report_num_tokens: int = 0
     start_time: float = 0.0
+    metrics: Optional[SchedulerMetrics] = field(default=None, repr=False)
 
     def report_stats(self):
         if time.time() - self.last_report_time < 1:
             return False
-        self.last_report_time = time.time()
-        # print(f"scheduler stats: {self}")
-        elapsed = self.last_report_time - self.start_time
-        (self.num_input_tokens + self.num_tokens_generated) / elapsed
-        # print(f"elapsed: {elapsed}, generated_tokens/s: {token_s}")
+        now = time.time()
+        num_tokens = self.num_input_tokens + self.num_tokens_generated
+        self.tokens_per_s = (num_tokens - self.last_report_num_tokens) / (
+            now - max(self.last_report_time, self.start_time)
+        )
+        self.last_report_time = now
+        self.last_report_num_tokens = num_tokens
+
+        self.release_samples.append((now, self.num_tokens_released))
+        first_time, first_num_tokens = self.release_samples[0]
+        if now > first_time:
+            self.tokens_released_per_s = (
+                self.num_tokens_released - first_num_tokens
+            ) / (now - first_time)
+            self.max_tokens_released_per_s = max(
+                self.max_tokens_released_per_s, self.tokens_released_per_s
+            )
         return True
 
+    def export_metrics(self):
+        if self.metrics is None:
+            return
+        self.metrics.queue_size.set(self.num_requests_pending)
+        self.metrics.running_requests.set(self.num_active_requests)
+        self.metrics.tokens_in_flight.set(self.num_tokens_in_flight)
+        self.metrics.tokens_per_s.set(self.tokens_per_s)
+
     def request_selected(self, requests: List[InferenceRequest]):
         self.num_active_requests += len(requests)
         self.num_requests_processed += len(requests)
-        self.num_input_tokens += sum([r.input_length for r in requests])
+        num_input_tokens = sum([r.input_length for r in requests])
+        self.num_input_tokens += num_input_tokens
+        self.num_tokens_in_flight += sum([r.total_tokens for r in requests])
+        if self.metrics:
+            self.metrics.inc(self.metrics.input_tokens, num_input_tokens)
+
+    def first_token_generated(self, request: InferenceRequest, now_ns: int):
+        if self.metrics:
+            self.metrics.time_to_first_token_s.observe(
+                (now_ns - request.submit_time_ns) / 1e9
+            )
 
-    def request_finished(self):
+    def request_finished(self, request: InferenceRequest, now_ns: int):
         self.num_active_requests -= 1
         self.num_finished_requests += 1
+        self.num_tokens_in_flight -= request.total_tokens
+        self.num_tokens_released += request.total_tokens
+        if self.metrics:
+            self.metrics.inc(self.metrics.finished_requests)
+            num_tokens = request.output_stream.num_tokens()
+            if num_tokens > 1:
+                self.metrics.inter_token_latency_s.observe(
+                    (now_ns - request.first_token_time_ns) / 1e9 / (num_tokens - 1)
+                )
 
-    def request_failed(self):
+    def request_failed(self, request: InferenceRequest):
         self.num_active_requests -= 1
         self.num_requests_failed += 1
+        self.num_tokens_in_flight -= request.total_tokens
+        self.num_tokens_released += request.total_tokens
+        if self.metrics:
+            self.metrics.inc(self.metrics.failed_requests)
+
+    def requests_cancelled(self, requests: List[InferenceRequest], running: bool):
+        if running:
+            self.num_active_requests -= len(requests)
+            num_tokens = sum([r.total_tokens for r in requests])
+            self.num_tokens_in_flight -= num_tokens
+            self.num_tokens_released += num_tokens
+        self.num_requests_cancelled += len(requests)
+        if self.metrics:
+            self.metrics.inc(self.metrics.cancelled_requests, len(requests))
+
+    def request_preempted(self, request: InferenceRequest):
+        self.num_active_requests -= 1
+        self.num_requests_preempted += 1
+        self.num_preempted_tokens_kept += request.num_resumed_tokens
+        self.num_tokens_in_flight -= request.total_tokens
+        self.num_tokens_released += request.total_tokens
+        if self.metrics:
+            self.metrics.inc(self.metrics.preemptions)
+
+    def request_shed(self):
+        self.num_requests_shed += 1
+        if self.metrics:
+            self.metrics.inc(self.metrics.shed_requests)
+
+    def oom_detected(self):
+        self.num_ooms += 1
+        if self.metrics:
+            self.metrics.inc(self.metrics.ooms)
 
     def token_generated(self, num):
         self.num_tokens_generated += num
+        if self.metrics:
+            self.metrics.inc(self.metrics.generated_tokens, num)
+
+    def prefill_step_finished(self, latency_s: float):
+        if self.metrics:
+            self.metrics.prefill_latency_s.observe(latency_s)
+
+    def decode_steps_finished(self, latency_s: float, num_steps: int = 1):
+        if self.metrics and num_steps:
+            self.metrics.decode_latency_s.observe(latency_s / num_steps)
 
     def iteration_finished(self):
         self.num_iterations += 1
@@ -149,19 +404,47 @@ class InferenceScheduler:
         tokenizer: Tokenizer,
         inference_worker_loader: Callable[[], "AbstractInferenceWorker"],
         request_selection_policy: QuotaBasedRequestSelectionPolicy,  # RequestSelectionPolicy,
-        request_queue: asyncio.Queue,
+        request_queue: PriorityRequestQueue,
         inline: bool = False,
+        max_decode_steps: int = 1,
+        metrics: Optional[SchedulerMetrics] = None,
+        stream_chunk_tokens: int = 1,
+        stream_chunk_interval_s: float = 0,
+        max_stream_pending_tokens: Optional[int] = None,
+        output_stream_factory: Optional[Callable[[int], TokenStream]] = None,
+        max_step_tokens: Optional[int] = None,
+        prior_tokens_released_per_s: Optional[float] = None,
     ):
         self._tokenizer = tokenizer
+        self._stream_chunk_tokens = stream_chunk_tokens
+        self._stream_chunk_interval_s = stream_chunk_interval_s
+        self._max_stream_pending_tokens = max_stream_pending_tokens
+        # Creates the output stream of a request from its id, instead of a
+        # TokenStream chunked as above.
+        self._output_stream_factory = output_stream_factory
+        self._max_decode_steps = max_decode_steps
+        # Token budget of a step while requests are running, which long
+        # prompts are prefilled in chunks of. See AsyncInferenceScheduler.
+        # None to prefill new requests in a single step.
+        self._max_step_tokens = max_step_tokens
+        # Throughput the queue wait is estimated with until one is measured.
+        self._prior_tokens_released_per_s = prior_tokens_released_per_s
         self._request_selection_policy = request_selection_policy
         self._inference_worker_loader = inference_worker_loader
         self._request_queue = request_queue
         self._queue_put_event = asyncio.Event()
         self._lock = Lock()
         self._stop = False
-        self._stats = Stats()
+        self._stats = Stats(metrics=metrics)
+        if metrics:
+            metrics.max_batch_total_tokens.set(
+                request_selection_policy.max_batch_total_tokens
+            )
         self._has_oom = False
-        self._cancelled_requests = set()
+        # Requests that are queued or running, by id.
+        self._requests: Dict[int, InferenceRequest] = {}
+        # Requests that are running.
+        self._in_flight = InFlightTable(request_selection_policy.reserved_gen_length)
         if not inline:
             self.scheduling_loop_task = run_background_task(self._run_scheduling_loop())
 
@@ -179,7 +462,27 @@ class InferenceScheduler:
         params: Dict[str, Any],
         max_new_tokens: int = 256,
         max_length: int = 1024,
+        priority: int = 0,
+        deadline_s: Optional[float] = None,
+        tenant: str = "",
     ) -> TokenStream:
+        """Queue a request for generation.
+
+        Args:
+            input_text (str): Prompt of the request.
+            params (Dict[str, Any]): Sampling parameters.
+            max_new_tokens (int): Max number of tokens to generate.
+            max_length (int): Max number of input tokens, the prompt is
+                truncated to this length.
+            priority (int): Priority of the request, lower value = higher
+                priority (see QueuePriority).
+            deadline_s (Optional[float]): If set, the request is scheduled
+                ahead of the ones due later than this many seconds from now.
+            tenant (str): Who sent the request, for fair share scheduling.
+
+        Returns:
+            The stream of generated tokens.
+        """
         request = Request(
             id=get_request_id(),
             inputs=input_text,
@@ -187,18 +490,133 @@ class InferenceScheduler:
             max_new_tokens=max_new_tokens,
             params=params,
         )
-        return self._add_request(request)
+        return self._add_request(request, priority, deadline_s, tenant)
+
+    async def process_request_async(
+        self,
+        input_text: str,
+        params: Dict[str, Any],
+        max_new_tokens: int = 256,
+        max_length: int = 1024,
+        priority: int = 0,
+        deadline_s: Optional[float] = None,
+        tenant: str = "",
+    ) -> TokenStream:
+        """Same as process_request, but the input length is resolved before
+        the request is put into the queue, so that the scheduling loop
+        never blocks on tokenization."""
+        request = Request(
+            id=get_request_id(),
+            inputs=input_text,
+            truncate=max_length,
+            max_new_tokens=max_new_tokens,
+            params=params,
+        )
+        return await self._add_request_async(request, priority, deadline_s, tenant)
 
     def cancel_request(self, request_id: int) -> bool:
-        self._cancelled_requests.add(request_id)
+        """Cancel a request.
+
+        The output stream of the request is ended right away. A queued request
+        will never be prefilled, and a running one is removed from the batch
+        in the next filter_requests call.
 
-    def _add_request(self, request: Request) -> TokenStream:
+        Returns:
+            False if the request is unknown or already finished, True otherwise.
+        """
+        request = self._requests.pop(request_id, None)
+        if request is None:
+            return False
+        request.cancelled = True
+        request.output_stream.end("")
+        if self._request_queue.remove(request_id) is not None:
+            self._stats.requests_cancelled([request], running=False)
+        logger.info(f"Request {request_id} cancelled")
+        return True
+
+    def estimate_queue_wait_s(self, priority: int = 0) -> float:
+        """Estimate how long a new request would wait in the queue.
+
+        That's the tokens reserved by the queued requests it can't overtake,
+        divided by the rate at which tokens were released by the requests
+        leaving the batch over the last few seconds.
+
+        No rate is measured before the first requests finish, or while none
+        leaves the batch. The estimate then uses the highest rate measured so
+        far, or else the prior rate, and is infinite if there is neither and
+        requests are queued, so that load shedding doesn't let everything in
+        when overload is the most likely.
+
+        Args:
+            priority (int): Priority of the new request.
+        """
+        num_tokens = self._request_queue.num_tokens(max_priority=priority)
+        if num_tokens == 0:
+            return 0.0
+        tokens_released_per_s = self._stats.tokens_released_per_s
+        if tokens_released_per_s <= 0:
+            tokens_released_per_s = (
+                self._stats.max_tokens_released_per_s
+                or self._prior_tokens_released_per_s
+            )
+        if not tokens_released_per_s:
+            return math.inf
+        return num_tokens / tokens_released_per_s
+
+    def request_shed(self):
+        """Record a request rejected before being queued."""
+        self._stats.request_shed()
+
+    def _new_output_stream(self, request_id: int) -> TokenStream:
+        if self._output_stream_factory:
+            return self._output_stream_factory(request_id)
+        return TokenStream(
+            request_id,
+            chunk_tokens=self._stream_chunk_tokens,
+            chunk_interval_s=self._stream_chunk_interval_s,
+            max_pending_tokens=self._max_stream_pending_tokens,
+        )
+
+    def _add_request(
+        self,
+        request: Request,
+        priority: int = 0,
+        deadline_s: Optional[float] = None,
+        tenant: str = "",
+    ) -> TokenStream:
         pending_request = InferenceRequest.from_request(
             request,
             request_input_length=self._tokenizer.get_input_length(
                 request.inputs, request.truncate
             ),
+            priority=priority,
+            deadline_s=deadline_s,
+            tenant=tenant,
+            output_stream=self._new_output_stream(request.id),
         )
+        self._requests[request.id] = pending_request
+        self._request_queue.put_nowait(pending_request)
+        self._queue_put_event.set()
+        return pending_request.output_stream
+
+    async def _add_request_async(
+        self,
+        request: Request,
+        priority: int = 0,
+        deadline_s: Optional[float] = None,
+        tenant: str = "",
+    ) -> TokenStream:
+        pending_request = InferenceRequest.from_request(
+            request,
+            request_input_length=await self._tokenizer.get_input_length_async(
+                request.inputs, request.truncate
+            ),
+            priority=priority,
+            deadline_s=deadline_s,
+            tenant=tenant,
+            output_stream=self._new_output_stream(request.id),
+        )
+        self._requests[request.id] = pending_request
         self._request_queue.put_nowait(pending_request)
         self._queue_put_event.set()
         return pending_request.output_stream
@@ -227,6 +645,9 @@ class InferenceScheduler:
             in_process_requests = []
             await asyncio.sleep(0.000001)
             while not self.is_stopped():
+                batch_id, in_process_requests = self._remove_cancelled_requests(
+                    batch_id, in_process_requests
+                )
                 # select new requests to process.
                 new_requests = await self._select_new_requests(in_process_requests)
                 new_batch_id, new_unfinished_requests = self._process_new_requests(
@@ -250,6 +671,8 @@ class InferenceScheduler:
     def _report_stats(self):
         if self._stats.report_stats():
             self._stats.set_num_requests_pending(self._request_queue.qsize())
+            self._stats.export_metrics()
+            logger.debug(f"admission stats: {self._request_selection_policy.stats}")
             self._inference_worker.report_stats()
 
     async def _select_new_requests(
@@ -269,23 +692,56 @@ class InferenceScheduler:
             self._queue_put_event.clear()
 
         requests = self._request_selection_policy.select_new_requests(
-            in_process_requests, self._request_queue
+            in_process_requests,
+            self._request_queue,
+            has_oom=self._has_oom,
+            in_process_lengths=self._in_flight.lengths(),
         )
         self._has_oom = False
+        self._in_flight.add(requests)
         self._stats.request_selected(requests)
         return requests
 
+    def _split_cancelled_requests(
+        self, requests: List[InferenceRequest]
+    ) -> Tuple[List[InferenceRequest], List[InferenceRequest]]:
+        cancelled = [r for r in requests if r.cancelled]
+        if not cancelled:
+            return requests, []
+        for request in cancelled:
+            self._in_flight.remove(request.id)
+            self._request_selection_policy.request_finished(request)
+        self._stats.requests_cancelled(cancelled, running=True)
+        return [r for r in requests if not r.cancelled], cancelled
+
+    def _remove_cancelled_requests(
+        self, batch_id: Optional[int], requests: List[InferenceRequest]
+    ) -> Tuple[Optional[int], List[InferenceRequest]]:
+        """Remove cancelled requests from the running batch, so that their
+        slots are freed before the next selection."""
+        requests, cancelled = self._split_cancelled_requests(requests)
+        if cancelled:
+            batch_id = self._inference_worker.filter_requests(
+                batch_id, [r.id for r in requests]
+            )
+        return batch_id, requests
+
     def _process_new_requests(
         self, requests: List[InferenceRequest]
     ) -> Tuple[int, List[InferenceRequest]]:
         if len(requests) == 0:
             return None, []
-        generations, batch_id = self._inference_worker.process_new_batch(
-            [r.request for r in requests], batch_id=get_batch_id()
-        )
+        start = time.monotonic()
+        try:
+            generations, batch_id = self._inference_worker.process_new_batch(
+                [r.generation_request for r in requests], batch_id=get_batch_id()
+            )
+        except StepFailedError as e:
+            return self._process_new_requests(self._recover_failed_prefill(e, requests))
+        self._stats.prefill_step_finished(time.monotonic() - start)
         requests, need_filter = self._process_generation_result(generations, requests)
 
-        if need_filter and batch_id:
+        if need_filter and batch_id is not None:
             batch_id = self._inference_worker.filter_requests(
                 batch_id, [r.id for r in requests]
             )
@@ -294,13 +750,22 @@ class InferenceScheduler:
     def _generate_next_token(
         self, batch_ids: List[int], requests: List[InferenceRequest]
     ) -> Tuple[Optional[int], List[InferenceRequest]]:
-        generations, batch_id = self._inference_worker.generate_next_token(
-            batch_ids,
-        )
+        num_steps = self._get_num_decode_steps()
+        if num_steps > 1:
+            return self._generate_next_tokens(batch_ids, requests, num_steps)
+
+        start = time.monotonic()
+        try:
+            generations, batch_id = self._inference_worker.generate_next_token(
+                batch_ids,
+            )
+        except StepFailedError as e:
+            return self._recover_failed_step(e, requests)
 
         # handle ooms
         if generations is None:
             return self._handle_ooms(batch_id, requests)
+        self._stats.decode_steps_finished(time.monotonic() - start)
 
         requests, need_filter = self._process_generation_result(generations, requests)
 
@@ -313,53 +778,127 @@ class InferenceScheduler:
             assert len(requests) == 0, "expect no requests left"
         return batch_id, requests
 
+    def _generate_next_tokens(
+        self, batch_ids: List[int], requests: List[InferenceRequest], num_steps: int
+    ) -> Tuple[Optional[int], List[InferenceRequest]]:
+        start = time.monotonic()
+        try:
+            steps, batch_id = self._inference_worker.generate_next_tokens(
+                batch_ids, num_steps
+            )
+        except StepFailedError as e:
+            return self._recover_failed_step(e, requests)
+
+        # handle ooms
+        if steps is None:
+            return self._handle_ooms(batch_id, requests)
+        self._stats.decode_steps_finished(time.monotonic() - start, len(steps))
+
+        # Finished requests were filtered out by the worker, but requests
+        # cancelled in the meantime are still in the batch.
+        unfinished_requests = self._process_decode_steps(steps, requests)
+        if batch_id is not None:
+            if any(r.cancelled for r in requests):
+                batch_id = self._inference_worker.filter_requests(
+                    batch_id, [r.id for r in unfinished_requests]
+                )
+        else:
+            assert len(unfinished_requests) == 0, "expect no requests left"
+        return batch_id, unfinished_requests
+
+    def _get_num_decode_steps(self) -> int:
+        """Number of tokens to generate per call to the inference worker.
+
+        Up to max_decode_steps when no request is waiting, so that decoding
+        isn't slowed down by a round-trip per token, and fewer as the queue
+        fills up, so that waiting requests are admitted quickly."""
+        return max(1, self._max_decode_steps // (1 + self._request_queue.qsize()))
+
+    def _process_decode_steps(
+        self, steps: List[List["Generation"]], requests: List[InferenceRequest]
+    ) -> List[InferenceRequest]:
+        """Process the generations of consecutive decode steps, returning
+        the unfinished requests."""
+        for generations in steps:
+            # Requests cancelled in a previous step have generations left.
+            requests, _ = self._process_generation_result(
+                [g for g in generations if g.request_id in self._in_flight], requests
+            )
+        return requests
+
     def _process_generation_result(
         self, generations: List["Generation"], requests: List[InferenceRequest]
     ) -> Tuple[List[InferenceRequest], bool]:
         some_request_finished = False
-        unfinished_requests = []
+        unfinished_requests: Dict[int, InferenceRequest] = {}
+        now_ns = time.monotonic_ns()
         self._stats.token_generated(len(generations))
-        assert len(generations) == len(
+        # A speculative step generates several tokens for some requests, in
+        # order, so there can be more generations than requests.
+        assert len(generations) >= len(
             requests
-        ), "expect same number of generations as requests"
+        ), "expect a generation for every request"
         # We do not have a guarantee that generations and requests are in the same order.
         # So we need to match them by request id.
-        requests = {r.id: r for r in requests}
         for generation in generations:
-            request = requests[generation.request_id]
+            if generation.request_id not in self._in_flight:
+                # Cancelled by an earlier token of the same step.
+                continue
+            request = self._in_flight.token_generated(generation.request_id)
+            if request.cancelled:
+                # The output stream was already ended by cancel_request.
+                some_request_finished = True
+                self._in_flight.remove(request.id)
+                self._stats.requests_cancelled([request], running=True)
+                self._request_selection_policy.request_finished(request)
+                unfinished_requests.pop(request.id, None)
+                continue
+            if not request.first_token_time_ns:
+                request.first_token_time_ns = now_ns
+                self._stats.first_token_generated(request, now_ns)
             # generation.generated_text.finish_reason == 0 is length, otherwise it's due to EOS/stop token
             if not generation.token_is_special and not (
                 generation.generated_text is not None
                 and generation.generated_text.finish_reason > 0
             ):
                 request.output_stream.put(generation.token_text)
-            if (
-                generation.generated_text is not None
-                or request.id in self._cancelled_requests
-            ):
-                if generation.generated_text is not None:
-                    text = generation.generated_text.text
-                else:
-                    text = ""
-                self._stats.request_finished()
+            if generation.generated_text is None and request.output_stream.overflowed():
+                # The reader fell too far behind, stop generating for it.
+                self.cancel_request(request.id)
+            if generation.generated_text is not None:
+                text = request.resumed_text + generation.generated_text.text
+                self._stats.request_finished(request, now_ns)
                 logger.info(
-                    f"Request {request.id} (cancelled: {request.id in self._cancelled_requests}) (generation.request_id {generation.request_id}) finished, response: {generation.generated_text}"
+                    f"Request {request.id} (generation.request_id {generation.request_id}) finished, response: {generation.generated_text}"
                 )
                 request.output_stream.end(text)
                 some_request_finished = True
+                self._in_flight.remove(request.id)
                 self._request_selection_policy.request_finished(request)
-                self._cancelled_requests.discard(request.id)
+                self._requests.pop(request.id, None)
+                unfinished_requests.pop(request.id, None)
             else:
-                unfinished_requests.append(request)
-        return unfinished_requests, some_request_finished
+                unfinished_requests[request.id] = request
+        return list(unfinished_requests.values()), some_request_finished
+
+    def _preempt_requests(self, requests: List[InferenceRequest]):
+        """Put preempted requests back at the head of the queue.
+
+        The requests keep their output streams and resume generating from
+        the tokens they have already generated."""
+        for request in reversed(requests):
+            request.preempt()
+            self._in_flight.remove(request.id)
+            self._request_selection_policy.request_preempted(request)
+            self._request_queue.put_front(request)
+            self._stats.request_preempted(request)
+        self._queue_put_event.set()
 
     def _handle_recoverable_ooms(self, batch_id, requests: List[InferenceRequest]):
         # pop last request to reduce memory overhead.
         assert requests
         failed_request = requests.pop()
-        # TODO confirm with Chen if this is ok
-        self._request_queue.put_nowait(failed_request)
-        self._stats.request_failed()
+        self._preempt_requests([failed_request])
         batch_id = self._inference_worker.filter_requests(
             batch_id, [r.id for r in requests]
         )
@@ -368,22 +907,138 @@ class InferenceScheduler:
 
     def _handle_ooms(self, batch_id, requests: List[InferenceRequest]):
         logger.warning("OOM detected, trying to recover...")
-        if batch_id:
+        self._stats.oom_detected()
+        if batch_id is not None:
             return self._handle_recoverable_ooms(batch_id, requests)
 
         # oom is not recoverable
         logger.error("OOM not recoverable!")
-        while requests:
-            failed_request = requests.pop()
-            # TODO confirm with Chen if this is ok
-            self._request_queue.put_nowait(failed_request)
-            self._stats.request_failed()
+        self._preempt_requests(requests)
         self._has_oom = True
         return None, []
 
+    def _fail_requests(self, requests: List[InferenceRequest], error: Exception):
+        """End the output streams of requests with an error."""
+        for request in requests:
+            logger.error(f"Request {request.id} failed: {error}")
+            self._in_flight.remove(request.id)
+            self._request_selection_policy.request_finished(request)
+            self._requests.pop(request.id, None)
+            self._stats.request_failed(request)
+            request.output_stream.fail(error)
+
+    def _step_failed(self, error: StepFailedError):
+        logger.warning(f"Step failed, trying to recover: {error}")
+        if error.oom:
+            self._stats.oom_detected()
+            self._has_oom = True
+
+    @staticmethod
+    def _bisect_failed_step(
+        requests: List[InferenceRequest],
+    ) -> List[InferenceRequest]:
+        """Split off half of the requests of a step that failed because of
+        one of them, and return the other half.
+
+        The requests split off the most often are kept, so that a request
+        failing every step it is in is isolated after a few steps, even if
+        it was split off first."""
+        suspects = sorted(requests, key=lambda r: -r.num_failed_steps)
+        for request in suspects[len(suspects) // 2 :]:
+            request.num_failed_steps += 1
+        kept_ids = {r.id for r in suspects[: len(suspects) // 2]}
+        return [r for r in requests if r.id in kept_ids]
+
+    def _recover_failed_prefill(
+        self, error: StepFailedError, requests: List[InferenceRequest]
+    ) -> List[InferenceRequest]:
+        """Handle a failed prefill of new requests.
+
+        A request failing alone is failed, unless it ran out of memory while
+        other requests are running, in which case it is preempted. Otherwise
+        half of the requests are preempted, the last ones on OOM.
+
+        Returns the requests to retry the prefill with."""
+        self._step_failed(error)
+        requests, _ = self._split_cancelled_requests(requests)
+        if len(requests) == 1 and not (error.oom and len(self._in_flight) > 1):
+            self._fail_requests(requests, error)
+            return []
+        if error.oom:
+            kept_requests = requests[: len(requests) // 2]
+        else:
+            kept_requests = self._bisect_failed_step(requests)
+        kept_ids = {r.id for r in kept_requests}
+        self._preempt_requests([r for r in requests if r.id not in kept_ids])
+        return kept_requests
+
+    def _plan_step_recovery(
+        self, error: StepFailedError, requests: List[InferenceRequest]
+    ) -> List[InferenceRequest]:
+        """Handle a failed decode step, whose batches the worker kept.
+
+        A request failing alone is failed. On OOM, the batches admitted last
+        are split off, or the last request if there is a single batch.
+        Otherwise half of the requests are split off. The requests split off
+        are preempted.
+
+        Returns the requests to retry the step with."""
+        self._step_failed(error)
+        requests, _ = self._split_cancelled_requests(requests)
+        if len(requests) == 1:
+            self._fail_requests(requests, error)
+            return []
+        if not error.oom:
+            kept_requests = self._bisect_failed_step(requests)
+        elif len(error.request_ids_by_batch) > 1:
+            first_request_ids = set(next(iter(error.request_ids_by_batch.values())))
+            kept_requests = [r for r in requests if r.id in first_request_ids]
+        else:
+            kept_requests = requests[:-1]
+        kept_ids = {r.id for r in kept_requests}
+        self._preempt_requests([r for r in requests if r.id not in kept_ids])
+        return kept_requests
+
+    def _recover_failed_step(
+        self, error: StepFailedError, requests: List[InferenceRequest]
+    ) -> Tuple[Optional[int], List[InferenceRequest]]:
+        requests = self._plan_step_recovery(error, requests)
+        kept_ids = {r.id for r in requests}
+        batch_ids = []
+        for batch_id, request_ids in error.request_ids_by_batch.items():
+            if not kept_ids.issuperset(request_ids):
+                # The memory of the requests split off on OOM has to be freed.
+                batch_id = self._inference_worker.filter_requests(
+                    batch_id,
+                    [i for i in request_ids if i in kept_ids],
+                    compact=error.oom,
+                )
+            batch_ids.append(batch_id)
+        if not requests:
+            return None, []
+        return self._generate_next_token(batch_ids, requests)
+
+
+class _ChunkedPrefill(NamedTuple):
+    """A new batch being prefilled in chunks."""
+
+    batch_id: int
+    requests: List[InferenceRequest]
+    # Whether the inference worker created the batch.
+    started: bool = False
+
 
 class AsyncInferenceScheduler(InferenceScheduler):
-    """Same as InferenceScheduler, but _run_scheduling_loop is fully async."""
+    """Same as InferenceScheduler, but _run_scheduling_loop is fully async.
+
+    With max_step_tokens set, new requests whose prefill would take more
+    than a step's budget while requests are running are prefilled in
+    chunks instead: every iteration prefills one chunk, of max_step_tokens
+    minus a token per running request, then runs the decode step of the
+    running batch, which only stalls for a chunk. No other request is
+    admitted until the batch is prefilled. It joins the running batch
+    once its last chunk is prefilled, with its first tokens generated.
+    """
 
     async def _run_scheduling_loop(self):
         """Schedule requests to be processed by the inference worker."""
@@ -407,13 +1062,29 @@ class AsyncInferenceScheduler(InferenceScheduler):
             # 3. goto step 1.
             batch_id = None
             in_process_requests = []
+            prefill: Optional[_ChunkedPrefill] = None
             while not self.is_stopped():
-                # select new requests to process.
-                new_requests = await self._select_new_requests(in_process_requests)
                 (
-                    new_batch_id,
-                    new_unfinished_requests,
-                ) = await self._process_new_requests(new_requests)
+                    batch_id,
+                    in_process_requests,
+                ) = await self._remove_cancelled_requests(batch_id, in_process_requests)
+                # select new requests to process, unless a batch is still
+                # being prefilled in chunks.
+                if prefill is None:
+                    new_requests = await self._select_new_requests(in_process_requests)
+                    if self._should_chunk_prefill(new_requests, in_process_requests):
+                        prefill = _ChunkedPrefill(get_batch_id(), new_requests)
+                if prefill is not None:
+                    (
+                        prefill,
+                        new_batch_id,
+                        new_unfinished_requests,
+                    ) = await self._prefill_chunk(prefill, in_process_requests)
+                else:
+                    (
+                        new_batch_id,
+                        new_unfinished_requests,
+                    ) = await self._process_new_requests(new_requests)
 
                 # combine new batch with existing batch to generate next token.
                 batch_id, in_process_requests = await self._generate_next_token(
@@ -428,17 +1099,107 @@ class AsyncInferenceScheduler(InferenceScheduler):
         finally:
             await asyncio.sleep(0.000001)
 
+    async def _remove_cancelled_requests(
+        self, batch_id: Optional[int], requests: List[InferenceRequest]
+    ) -> Tuple[Optional[int], List[InferenceRequest]]:
+        requests, cancelled = self._split_cancelled_requests(requests)
+        if cancelled:
+            batch_id = await self._inference_worker.filter_requests_async(
+                batch_id, [r.id for r in requests]
+            )
+        return batch_id, requests
+
+    async def _recover_failed_step(
+        self, error: StepFailedError, requests: List[InferenceRequest]
+    ) -> Tuple[Optional[int], List[InferenceRequest]]:
+        requests = self._plan_step_recovery(error, requests)
+        kept_ids = {r.id for r in requests}
+        batch_ids = []
+        for batch_id, request_ids in error.request_ids_by_batch.items():
+            if not kept_ids.issuperset(request_ids):
+                # The memory of the requests split off on OOM has to be freed.
+                batch_id = await self._inference_worker.filter_requests_async(
+                    batch_id,
+                    [i for i in request_ids if i in kept_ids],
+                    compact=error.oom,
+                )
+            batch_ids.append(batch_id)
+        if not requests:
+            return None, []
+        return await self._generate_next_token(batch_ids, requests)
+
+    def _step_token_budget(self, running_requests: List[InferenceRequest]) -> int:
+        """Prompt tokens to prefill in a step of the running batch."""
+        return max(self._max_step_tokens - len(running_requests), 1)
+
+    def _should_chunk_prefill(
+        self,
+        new_requests: List[InferenceRequest],
+        running_requests: List[InferenceRequest],
+    ) -> bool:
+        """Whether the prefill of new requests would stall the running ones
+        for longer than a step. Counts the padding of a padded batch."""
+        if not (self._max_step_tokens and new_requests and running_requests):
+            return False
+        prefill_tokens = len(new_requests) * max(r.input_length for r in new_requests)
+        return prefill_tokens > self._step_token_budget(running_requests)
+
+    async def _prefill_chunk(
+        self,
+        prefill: _ChunkedPrefill,
+        running_requests: List[InferenceRequest],
+    ) -> Tuple[Optional[_ChunkedPrefill], Optional[int], List[InferenceRequest]]:
+        """Prefill the next chunk of a batch, or the rest of it once a chunk
+        is all that's left or no request is running anymore.
+
+        Returns the prefill, if it isn't finished, and else the id of the
+        new batch and its unfinished requests, as _process_new_requests.
+        """
+        if running_requests:
+            start = time.monotonic()
+            try:
+                tokens_left = await self._inference_worker.prefill_chunk_async(
+                    None
+                    if prefill.started
+                    else [r.generation_request for r in prefill.requests],
+                    prefill.batch_id,
+                    self._step_token_budget(running_requests),
+                )
+            except StepFailedError as e:
+                requests = self._recover_failed_prefill(e, prefill.requests)
+                if not requests:
+                    return None, None, []
+                return _ChunkedPrefill(get_batch_id(), requests), None, []
+            if tokens_left:
+                self._stats.prefill_step_finished(time.monotonic() - start)
+                return prefill._replace(started=True), None, []
+        return (
+            None,
+            *await self._process_new_requests(prefill.requests, prefill.batch_id),
+        )
+
     async def _process_new_requests(
-        self, requests: List[InferenceRequest]
+        self, requests: List[InferenceRequest], batch_id: Optional[int] = None
     ) -> Tuple[int, List[InferenceRequest]]:
         if len(requests) == 0:
             return None, []
-        generations, batch_id = await self._inference_worker.process_new_batch_async(
-            [r.request for r in requests], batch_id=get_batch_id()
-        )
+        start = time.monotonic()
+        try:
+            (
+                generations,
+                batch_id,
+            ) = await self._inference_worker.process_new_batch_async(
+                [r.generation_request for r in requests],
+                batch_id=get_batch_id() if batch_id is None else batch_id,
+            )
+        except StepFailedError as e:
+            return await self._process_new_requests(
+                self._recover_failed_prefill(e, requests)
+            )
+        self._stats.prefill_step_finished(time.monotonic() - start)
         requests, need_filter = self._process_generation_result(generations, requests)
 
-        if need_filter and batch_id:
+        if need_filter and batch_id is not None:
             batch_id = await self._inference_worker.filter_requests_async(
                 batch_id, [r.id for r in requests]
             )
@@ -447,13 +1208,25 @@ class AsyncInferenceScheduler(InferenceScheduler):
     async def _generate_next_token(
         self, batch_ids: List[int], requests: List[InferenceRequest]
     ) -> Tuple[Optional[int], List[InferenceRequest]]:
-        generations, batch_id = await self._inference_worker.generate_next_token_async(
-            batch_ids,
-        )
+        num_steps = self._get_num_decode_steps()
+        if num_steps > 1:
+            return await self._generate_next_tokens(batch_ids, requests, num_steps)
+
+        start = time.monotonic()
+        try:
+            (
+                generations,
+                batch_id,
+            ) = await self._inference_worker.generate_next_token_async(
+                batch_ids,
+            )
+        except StepFailedError as e:
+            return await self._recover_failed_step(e, requests)
 
         # handle ooms
         if generations is None:
             return self._handle_ooms(batch_id, requests)
+        self._stats.decode_steps_finished(time.monotonic() - start)
 
         requests, need_filter = self._process_generation_result(generations, requests)
 
@@ -465,3 +1238,225 @@ class AsyncInferenceScheduler(InferenceScheduler):
         else:
             assert len(requests) == 0, "expect no requests left"
         return batch_id, requests
+
+    async def _generate_next_tokens(
+        self, batch_ids: List[int], requests: List[InferenceRequest], num_steps: int
+    ) -> Tuple[Optional[int], List[InferenceRequest]]:
+        start = time.monotonic()
+        try:
+            (
+                steps,
+                batch_id,
+            ) = await self._inference_worker.generate_next_tokens_async(
+                batch_ids, num_steps
+            )
+        except StepFailedError as e:
+            return await self._recover_failed_step(e, requests)
+
+        # handle ooms
+        if steps is None:
+            return self._handle_ooms(batch_id, requests)
+        self._stats.decode_steps_finished(time.monotonic() - start, len(steps))
+
+        # Finished requests were filtered out by the worker, but requests
+        # cancelled in the meantime are still in the batch.
+        unfinished_requests = self._process_decode_steps(steps, requests)
+        if batch_id is not None:
+            if any(r.cancelled for r in requests):
+                batch_id = await self._inference_worker.filter_requests_async(
+                    batch_id, [r.id for r in unfinished_requests]
+                )
+        else:
+            assert len(unfinished_requests) == 0, "expect no requests left"
+        return batch_id, unfinished_requests
+
+
+class PipelinedAsyncInferenceScheduler(AsyncInferenceScheduler):
+    """Same as AsyncInferenceScheduler, but overlaps host work with decoding.
+
+    As soon as a decode step returns, finished requests are filtered out and
+    the next decode step is sent to the inference worker. Only then are the
+    tokens of the returned step put into the output streams, new requests
+    selected and their prefill sent to the worker, to run right after the
+    in-flight decode step. This hides the scheduler overhead behind GPU
+    compute.
+
+    The inference worker has to execute calls in the order they were
+    submitted. Ray guarantees this for calls from the same caller to the
+    same (non-async) actor.
+    """
+
+    async def _run_scheduling_loop(self):
+        """Schedule requests to be processed by the inference worker."""
+        try:
+            # start work the in the scheduling loop to avoid GPU memory leak.
+            self._inference_worker: "AsyncInferenceWorker" = (
+                self._inference_worker_loader()
+            )
+            self._stats.start()
+
+            # The main schedule loop:
+            #
+            # 1. wait for the in-flight decode step and prefill of new requests.
+            #
+            # 2. filter out finished requests, and send the next decode step
+            # for the in-process and new requests.
+            #
+            # 3. while the decode step is running, put the tokens from step 1
+            # into the output streams.
+            #
+            # 4. select new requests and send their prefill.
+            #
+            # 5. goto step 1.
+            batch_id = None
+            in_process_requests: List[InferenceRequest] = []
+            new_requests: List[InferenceRequest] = []
+            decode_step: Optional[asyncio.Future] = None
+            prefill_step: Optional[asyncio.Future] = None
+            filter_steps: List[asyncio.Future] = []
+            decode_start = prefill_start = 0.0
+            while not self.is_stopped():
+                # 1. wait for the in-flight steps.
+                generations = []
+                step_error = None
+                # The requests whose tokens are processed in step 3.
+                decoded_requests, prefilled_requests = in_process_requests, new_requests
+                if decode_step is not None:
+                    try:
+                        generations, batch_id = await decode_step
+                    except StepFailedError as e:
+                        generations, step_error = None, e
+                    decode_end = time.monotonic()
+                    if generations is not None:
+                        self._stats.decode_steps_finished(decode_end - decode_start)
+                    # The prefill only starts once the decode step is done.
+                    prefill_start = max(prefill_start, decode_end)
+                new_generations, new_batch_id = [], None
+                if prefill_step is not None:
+                    try:
+                        new_generations, new_batch_id = await prefill_step
+                        self._stats.prefill_step_finished(
+                            time.monotonic() - prefill_start
+                        )
+                    except StepFailedError as e:
+                        # Retried right away, with its tokens processed.
+                        new_batch_id, new_requests = await self._process_new_requests(
+                            self._recover_failed_prefill(e, new_requests)
+                        )
+                        prefilled_requests = []
+                await asyncio.gather(*filter_steps)
+                decode_step = prefill_step = None
+
+                if step_error is not None:
+                    # Retried right away, with its tokens processed.
+                    batch_id, in_process_requests = await self._recover_failed_step(
+                        step_error, in_process_requests
+                    )
+                    generations, decoded_requests = [], []
+                elif generations is None:
+                    batch_id, in_process_requests = self._handle_ooms(
+                        batch_id, in_process_requests
+                    )
+                    generations, decoded_requests = [], []
+
+                # 2. send the next decode step.
+                (
+                    batch_id,
+                    kept_requests,
+                    cancelled,
+                    filter_steps,
+                ) = self._send_filter_requests(
+                    batch_id, in_process_requests, generations
+                )
+                (
+                    new_batch_id,
+                    kept_new_requests,
+                    new_cancelled,
+                    new_filter_steps,
+                ) = self._send_filter_requests(
+                    new_batch_id, new_requests, new_generations
+                )
+                filter_steps += new_filter_steps
+                if batch_id is not None or new_batch_id is not None:
+                    decode_start = time.monotonic()
+                    decode_step = asyncio.ensure_future(
+                        self._inference_worker.generate_next_token_async(
+                            [batch_id, new_batch_id]
+                        )
+                    )
+                # Let the steps above actually be sent to the worker before
+                # doing the host work.
+                await asyncio.sleep(0)
+
+                # 3. process the results while the decode step is running.
+                # The tokens of cancelled requests are dropped. Requests
+                # cancelled since they were filtered are still in the batch,
+                # they are filtered out after the next decode step.
+                requests = decoded_requests + prefilled_requests
+                in_process_requests = kept_requests + kept_new_requests
+                cancelled_ids = {r.id for r in cancelled + new_cancelled}
+                cancelled_ids.update(r.id for r in in_process_requests if r.cancelled)
+                self._process_generation_result(
+                    [
+                        g
+                        for g in generations + new_generations
+                        if g.request_id not in cancelled_ids
+                    ],
+                    [r for r in requests if r.id not in cancelled_ids],
+                )
+
+                # 4. select new requests. Their prefill runs after the
+                # in-flight decode step.
+                new_requests = await self._select_new_requests(in_process_requests)
+                if new_requests:
+                    prefill_start = time.monotonic()
+                    prefill_step = asyncio.ensure_future(
+                        self._inference_worker.process_new_batch_async(
+                            [r.generation_request for r in new_requests],
+                            batch_id=get_batch_id(),
+                        )
+                    )
+
+                self._stats.iteration_finished()
+                self._report_stats()
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            await asyncio.sleep(0.000001)
+
+    def _send_filter_requests(
+        self,
+        batch_id: Optional[int],
+        requests: List[InferenceRequest],
+        generations: List["Generation"],
+    ) -> Tuple[
+        Optional[int],
+        List[InferenceRequest],
+        List[InferenceRequest],
+        List[asyncio.Future],
+    ]:
+        """Send a filter of the finished and cancelled requests out of the
+        batch, without waiting for it. The cancelled requests are released
+        like in _split_cancelled_requests.
+
+        Returns the batch id after the filter, the requests left in the batch,
+        the cancelled requests and the in-flight filter step, if any."""
+        requests, cancelled = self._split_cancelled_requests(requests)
+        finished_ids = {
+            g.request_id for g in generations if g.generated_text is not None
+        }
+        kept_requests = [r for r in requests if r.id not in finished_ids]
+        if batch_id is None or (not cancelled and len(kept_requests) == len(requests)):
+            return batch_id, kept_requests, cancelled, []
+        filter_step = asyncio.ensure_future(
+            self._inference_worker.filter_requests_async(
+                batch_id, [r.id for r in kept_requests]
+            )
+        )
+        # Filtering keeps the batch id, unless the batch is empty.
+        return (
+            (batch_id if kept_requests else None),
+            kept_requests,
+            cancelled,
+            [filter_step],
+        )
@@ -0,0 +1,625 @@
+"""Offline simulator of the continuous batching scheduler.
+
+Drives a scheduler with a SimulatedInferenceWorker, which doesn't run a model
+but advances a virtual clock by the modelled cost of every call. Arrival
+traces are replayed against that clock, so a trace of hours of traffic is
+simulated in seconds on a CPU.
+
+Usage:
+    python -m aviary.backend.llm.continuous.simulator \\
+        --model-yaml models/continuous_batching/amazon--LightGPT.yaml \\
+        --set selection_mode=sjf --num-requests 1000 --rate 5
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+from dataclasses import asdict, dataclass
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Type
+
+import yaml
+
+from aviary.backend.llm.continuous.estimator import OutputLengthEstimator
+from aviary.backend.llm.continuous.kv_cache import KVCacheLayout
+from aviary.backend.llm.continuous.policy import (
+    FairShareRequestSelectionPolicy,
+    QuotaBasedRequestSelectionPolicy,
+)
+from aviary.backend.llm.continuous.queue import PriorityRequestQueue
+from aviary.backend.llm.continuous.scheduler import (
+    AsyncInferenceScheduler,
+    InferenceScheduler,
+    NaiveTokenizer,
+    PipelinedAsyncInferenceScheduler,
+)
+from aviary.backend.llm.continuous.types import Request
+from aviary.backend.llm.continuous.worker import AsyncInferenceWorker
+
+if TYPE_CHECKING:
+    from aviary.backend.server.models import ContinuousBatchingGenerationConfig
+
+SCHEDULERS = {
+    "sync": InferenceScheduler,
+    "async": AsyncInferenceScheduler,
+    "pipelined": PipelinedAsyncInferenceScheduler,
+}
+
+
+@dataclass
+class CostModel:
+    """Cost of the inference worker calls, in seconds.
+
+    The defaults are rough numbers for a 7B model on a single A10G, fit them
+    to profiles of the model to simulate.
+    """
+
+    # Prefill cost: prefill_base_s + prefill_per_token_s * prompt tokens.
+    prefill_base_s: float = 0.01
+    prefill_per_token_s: float = 0.0002
+    # Decode cost: decode_base_s + decode_per_request_s * batch size
+    # + decode_per_kv_token_s * tokens in the KV cache of the batch.
+    decode_base_s: float = 0.015
+    decode_per_request_s: float = 0.0001
+    decode_per_kv_token_s: float = 0.000001
+    # Added to every call to the worker.
+    rpc_latency_s: float = 0.002
+    # A decode step OOMs when the KV cache would hold more tokens than this.
+    kv_capacity_tokens: int = 40960
+
+    def prefill_cost_s(self, num_tokens: int) -> float:
+        return self.prefill_base_s + self.prefill_per_token_s * num_tokens
+
+    def decode_cost_s(self, batch_size: int, num_kv_tokens: int) -> float:
+        return (
+            self.decode_base_s
+            + self.decode_per_request_s * batch_size
+            + self.decode_per_kv_token_s * num_kv_tokens
+        )
+
+
+@dataclass
+class SimulatedGeneratedText:
+    text: str
+    # 0 if the request reached max_new_tokens, 1 if it generated EOS.
+    finish_reason: int
+
+
+@dataclass
+class SimulatedGeneration:
+    request_id: int
+    token_text: str
+    token_is_special: bool = False
+    generated_text: Optional[SimulatedGeneratedText] = None
+
+
+@dataclass
+class _SimulatedRequest:
+    id: int
+    max_new_tokens: int
+    # Tokens of the request in the KV cache.
+    num_kv_tokens: int
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+
+class SimulatedInferenceWorker(AsyncInferenceWorker):
+    """Inference worker advancing a virtual clock instead of running a model.
+
+    Every request generates output_lengths[request_id] tokens, ending with
+    EOS, or stops at max_new_tokens. Like the TGI worker, on OOM all batches
+    are dropped and (None, None) is returned. Prefills never OOM.
+
+    Args:
+        cost_model (CostModel): Cost of the calls.
+        clock (SimulatedClock): Clock to advance.
+    """
+
+    def __init__(self, cost_model: CostModel, clock: SimulatedClock):
+        self.cost_model = cost_model
+        self.clock = clock
+        self.output_lengths: Dict[int, int] = {}
+        self._batches: Dict[int, List[_SimulatedRequest]] = {}
+        # Tokens returned to the scheduler, kept when requests are preempted.
+        self._num_generated: Dict[int, int] = {}
+        self.first_token_time_s: Dict[int, float] = {}
+        self.last_token_time_s: Dict[int, float] = {}
+        self.num_ooms = 0
+        self.peak_kv_tokens = 0
+        # Integral of the tokens in the KV cache over time.
+        self.kv_token_seconds = 0.0
+
+    @property
+    def num_kv_tokens(self) -> int:
+        return sum(r.num_kv_tokens for batch in self._batches.values() for r in batch)
+
+    def get_kv_cache_layout(self) -> KVCacheLayout:
+        # Only the tokens of the requests are counted, without padding.
+        return KVCacheLayout(kind="paged", block_size=1)
+
+    def _advance(self, duration_s: float):
+        num_kv_tokens = self.num_kv_tokens
+        self.peak_kv_tokens = max(self.peak_kv_tokens, num_kv_tokens)
+        self.kv_token_seconds += num_kv_tokens * duration_s
+        self.clock.now += duration_s
+
+    def _generate(self, requests: List[_SimulatedRequest]) -> List[SimulatedGeneration]:
+        generations = []
+        for request in requests:
+            num_generated = self._num_generated.get(request.id, 0) + 1
+            self._num_generated[request.id] = num_generated
+            request.num_kv_tokens += 1
+            generated_text = None
+            if num_generated >= self.output_lengths.get(request.id, 1):
+                generated_text = SimulatedGeneratedText(text="", finish_reason=1)
+            elif num_generated >= request.max_new_tokens:
+                generated_text = SimulatedGeneratedText(text="", finish_reason=0)
+            # Every token is a word, as counted by NaiveTokenizer.
+            generations.append(
+                SimulatedGeneration(
+                    request_id=request.id,
+                    token_text=" x",
+                    generated_text=generated_text,
+                )
+            )
+        return generations
+
+    def _record_tokens(self, generations: List[SimulatedGeneration]):
+        for generation in generations:
+            self.first_token_time_s.setdefault(generation.request_id, self.clock.now)
+            self.last_token_time_s[generation.request_id] = self.clock.now
+
+    def _all_finished(self, requests: List[_SimulatedRequest]) -> bool:
+        return all(
+            self._num_generated[r.id] >= self.output_lengths.get(r.id, 1)
+            or self._num_generated[r.id] >= r.max_new_tokens
+            for r in requests
+        )
+
+    def _decode(
+        self, batch_ids: List[int]
+    ) -> Tuple[Optional[List[SimulatedGeneration]], Optional[int]]:
+        batch_ids = [batch_id for batch_id in batch_ids if batch_id is not None]
+        if not batch_ids:
+            return [], None
+        requests = []
+        for batch_id in batch_ids:
+            requests += self._batches.pop(batch_id)
+        batch_id = batch_ids[0]
+        self._batches[batch_id] = requests
+
+        if self.num_kv_tokens + len(requests) > self.cost_model.kv_capacity_tokens:
+            self._batches.clear()
+            self.num_ooms += 1
+            return None, None
+
+        self._advance(
+            self.cost_model.decode_cost_s(
+                len(requests), sum(r.num_kv_tokens for r in requests)
+            )
+        )
+        generations = self._generate(requests)
+        if self._all_finished(requests):
+            del self._batches[batch_id]
+            batch_id = None
+        return generations, batch_id
+
+    def process_new_batch(
+        self, requests: List[Request], batch_id: int
+    ) -> Tuple[List[SimulatedGeneration], Optional[int]]:
+        # Same as NaiveTokenizer.
+        prompt_lengths = [min(r.inputs.count(" ") + 1, r.truncate) for r in requests]
+        self._advance(
+            self.cost_model.rpc_latency_s
+            + self.cost_model.prefill_cost_s(sum(prompt_lengths))
+        )
+        batch = [
+            _SimulatedRequest(
+                id=r.id, max_new_tokens=r.max_new_tokens, num_kv_tokens=length
+            )
+            for r, length in zip(requests, prompt_lengths)
+        ]
+        # Resumed requests have their max_new_tokens reduced by the tokens
+        # they already generated, which _num_generated includes.
+        for r in batch:
+            r.max_new_tokens += self._num_generated.get(r.id, 0)
+        generations = self._generate(batch)
+        self._record_tokens(generations)
+        if self._all_finished(batch):
+            return generations, None
+        self._batches[batch_id] = batch
+        return generations, batch_id
+
+    def generate_next_token(
+        self, batch_ids: List[int]
+    ) -> Tuple[Optional[List[SimulatedGeneration]], Optional[int]]:
+        self._advance(self.cost_model.rpc_latency_s)
+        generations, batch_id = self._decode(batch_ids)
+        if generations is not None:
+            self._record_tokens(generations)
+        return generations, batch_id
+
+    def generate_next_tokens(
+        self, batch_ids: List[int], max_steps: int
+    ) -> Tuple[Optional[List[List[SimulatedGeneration]]], Optional[int]]:
+        # A single round-trip for all the steps.
+        self._advance(self.cost_model.rpc_latency_s)
+        steps = []
+        for _ in range(max_steps):
+            generations, batch_id = self._decode(batch_ids)
+            if generations is None:
+                # The tokens of the previous steps are lost.
+                for generation in itertools.chain.from_iterable(steps):
+                    self._num_generated[generation.request_id] -= 1
+                return None, None
+            steps.append(generations)
+            if batch_id is None:
+                break
+            batch_ids = [batch_id]
+            unfinished_ids = [
+                g.request_id for g in generations if g.generated_text is None
+            ]
+            if len(unfinished_ids) < len(generations):
+                batch_id = self._filter(batch_id, unfinished_ids)
+                break
+        for generations in steps:
+            self._record_tokens(generations)
+        return steps, batch_id
+
+    def _filter(self, batch_id: Optional[int], request_ids: List[int]) -> Optional[int]:
+        if batch_id is None:
+            return None
+        batch = self._batches.pop(batch_id)
+        request_ids = set(request_ids)
+        batch = [r for r in batch if r.id in request_ids]
+        if not batch:
+            return None
+        self._batches[batch_id] = batch
+        return batch_id
+
+    def filter_requests(
+        self, batch_id: int, request_ids: List[int], compact: bool = False
+    ) -> Optional[int]:
+        self._advance(self.cost_model.rpc_latency_s)
+        return self._filter(batch_id, request_ids)
+
+    # The async versions yield to the event loop, to let new requests arrive.
+
+    async def process_new_batch_async(
+        self, requests: List[Request], batch_id: int
+    ) -> Tuple[List[SimulatedGeneration], Optional[int]]:
+        await asyncio.sleep(0)
+        return self.process_new_batch(requests, batch_id)
+
+    async def generate_next_token_async(
+        self, batch_ids: List[int]
+    ) -> Tuple[Optional[List[SimulatedGeneration]], Optional[int]]:
+        await asyncio.sleep(0)
+        return self.generate_next_token(batch_ids)
+
+    async def generate_next_tokens_async(
+        self, batch_ids: List[int], max_steps: int
+    ) -> Tuple[Optional[List[List[SimulatedGeneration]]], Optional[int]]:
+        await asyncio.sleep(0)
+        return self.generate_next_tokens(batch_ids, max_steps)
+
+    async def filter_requests_async(
+        self, batch_id: int, request_ids: List[int], compact: bool = False
+    ) -> Optional[int]:
+        await asyncio.sleep(0)
+        return self.filter_requests(batch_id, request_ids, compact)
+
+
+@dataclass
+class TraceRequest:
+    arrival_time_s: float
+    input_tokens: int
+    # Number of tokens generated before EOS.
+    output_tokens: int
+    # Defaults to max_new_tokens of the generation config.
+    max_new_tokens: Optional[int] = None
+    # Lower value = higher priority (see QueuePriority).
+    priority: int = 0
+    tenant: str = ""
+
+
+def load_trace(path: str) -> List[TraceRequest]:
+    """Load a trace from a JSON lines file, one TraceRequest per line."""
+    with open(path) as f:
+        return [TraceRequest(**json.loads(line)) for line in f if line.strip()]
+
+
+def synthetic_trace(
+    num_requests: int,
+    rate: float,
+    mean_input_tokens: int = 256,
+    mean_output_tokens: int = 128,
+    max_input_tokens: int = 1024,
+    max_output_tokens: int = 512,
+    seed: int = 0,
+) -> List[TraceRequest]:
+    """Poisson arrivals at rate requests/s, with exponentially distributed
+    input and output lengths."""
+    rng = random.Random(seed)
+    trace = []
+    arrival_time_s = 0.0
+    for _ in range(num_requests):
+        arrival_time_s += rng.expovariate(rate)
+        trace.append(
+            TraceRequest(
+                arrival_time_s=arrival_time_s,
+                input_tokens=min(
+                    max(1, int(rng.expovariate(1 / mean_input_tokens))),
+                    max_input_tokens,
+                ),
+                output_tokens=min(
+                    max(1, int(rng.expovariate(1 / mean_output_tokens))),
+                    max_output_tokens,
+                ),
+            )
+        )
+    return trace
+
+
+@dataclass
+class SimulationResult:
+    duration_s: float
+    num_requests: int
+    num_ooms: int
+    num_preemptions: int
+    # Generated tokens per second.
+    throughput_tokens_per_s: float
+    # Requests per second finishing within the TTFT and ITL SLOs.
+    goodput_requests_per_s: float
+    ttft_p50_s: float
+    ttft_p90_s: float
+    ttft_p99_s: float
+    itl_p50_s: float
+    itl_p90_s: float
+    itl_p99_s: float
+    # Mean and peak tokens in the KV cache, as a fraction of its capacity.
+    kv_utilization: float
+    peak_kv_utilization: float
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def simulate(
+    trace: List[TraceRequest],
+    generation_config: "ContinuousBatchingGenerationConfig",
+    cost_model: Optional[CostModel] = None,
+    scheduler_cls: Optional[Type[InferenceScheduler]] = None,
+    ttft_slo_s: float = 2.0,
+    itl_slo_s: float = 0.1,
+) -> SimulationResult:
+    """Replay a trace against a scheduler configured like a deployment.
+
+    The selection policy and the request queue still use wall-clock time for
+    max_queue_wait_s and priority_aging_s.
+
+    Args:
+        trace: The requests to replay.
+        generation_config: Configuration of the scheduler and its policy.
+        cost_model: Cost of the inference worker calls.
+        scheduler_cls: The scheduler to simulate. Defaults to the one used
+            by ContinuousBatchingPredictor for generation_config.
+        ttft_slo_s: Max time to first token of a request counted in goodput.
+        itl_slo_s: Max mean inter-token latency of a request counted in
+            goodput.
+    """
+    if not trace:
+        raise ValueError("The trace is empty")
+    cost_model = cost_model or CostModel()
+    default_max_new_tokens = generation_config.generate_kwargs.get(
+        "max_new_tokens", 256
+    )
+    trace = sorted(trace, key=lambda r: r.arrival_time_s)
+    # Requests that can never be scheduled would make the simulation hang.
+    for request in trace:
+        max_new_tokens = request.max_new_tokens or default_max_new_tokens
+        input_tokens = min(request.input_tokens, generation_config.max_input_length)
+        if input_tokens + max_new_tokens > generation_config.max_batch_total_tokens:
+            raise ValueError(
+                f"A request of {input_tokens} input tokens and {max_new_tokens} "
+                "max new tokens doesn't fit in max_batch_total_tokens "
+                f"({generation_config.max_batch_total_tokens})"
+            )
+        if input_tokens + max_new_tokens > cost_model.kv_capacity_tokens:
+            raise ValueError(
+                f"A request of {input_tokens} input tokens and {max_new_tokens} "
+                "max new tokens doesn't fit in kv_capacity_tokens "
+                f"({cost_model.kv_capacity_tokens})"
+            )
+    if scheduler_cls is None:
+        scheduler_cls = (
+            PipelinedAsyncInferenceScheduler
+            if generation_config.pipelined_scheduling
+            else AsyncInferenceScheduler
+        )
+
+    clock = SimulatedClock()
+    worker = SimulatedInferenceWorker(cost_model, clock)
+    policy_kwargs = dict(
+        max_batch_total_tokens=generation_config.max_batch_total_tokens,
+        max_waiting_tokens=generation_config.max_waiting_tokens,
+        max_batch_prefill_tokens=generation_config.max_batch_prefill_tokens,
+        waiting_served_ratio=generation_config.waiting_served_ratio,
+        selection_mode=generation_config.selection_mode,
+        selection_lookahead=generation_config.selection_lookahead,
+        max_queue_wait_s=generation_config.max_queue_wait_s,
+        budget_calculator=worker.get_kv_cache_layout().budget_calculator(),
+    )
+    if generation_config.output_length_quantile is not None:
+        policy_kwargs["output_length_estimator"] = OutputLengthEstimator(
+            quantile=generation_config.output_length_quantile,
+            window=generation_config.output_length_window,
+            min_samples=generation_config.output_length_min_samples,
+        )
+    if generation_config.fair_share:
+        request_selection_policy = FairShareRequestSelectionPolicy(
+            tenant_weights=generation_config.tenant_weights,
+            tenant_max_tokens_per_s=generation_config.tenant_max_tokens_per_s,
+            **policy_kwargs,
+        )
+    else:
+        request_selection_policy = QuotaBasedRequestSelectionPolicy(**policy_kwargs)
+    scheduler = scheduler_cls(
+        tokenizer=NaiveTokenizer(),
+        inference_worker_loader=lambda: worker,
+        request_selection_policy=request_selection_policy,
+        request_queue=PriorityRequestQueue(
+            priority_aging_s=generation_config.priority_aging_s
+        ),
+        max_decode_steps=generation_config.max_decode_steps,
+    )
+
+    async def drain(stream):
+        async for _ in stream:
+            pass
+
+    def is_idle() -> bool:
+        return (
+            scheduler._stats.num_active_requests == 0
+            and scheduler._request_queue.empty()
+        )
+
+    arrival_time_s: Dict[int, float] = {}
+    drains = []
+    for request in trace:
+        while clock.now < request.arrival_time_s:
+            if is_idle():
+                clock.now = request.arrival_time_s
+            else:
+                await asyncio.sleep(0)
+        stream = scheduler.process_request(
+            " ".join(["x"] * request.input_tokens),
+            {},
+            max_new_tokens=request.max_new_tokens or default_max_new_tokens,
+            max_length=generation_config.max_input_length,
+            priority=request.priority,
+            tenant=request.tenant,
+        )
+        arrival_time_s[stream.id] = clock.now
+        worker.output_lengths[stream.id] = request.output_tokens
+        drains.append(asyncio.ensure_future(drain(stream)))
+    await asyncio.gather(*drains)
+    scheduler.stop()
+    scheduler._queue_put_event.set()
+
+    duration_s = clock.now
+    ttfts = []
+    itls = []
+    num_good = 0
+    for request_id, arrived_s in arrival_time_s.items():
+        first_s = worker.first_token_time_s[request_id]
+        ttft = first_s - arrived_s
+        num_tokens = worker._num_generated[request_id]
+        itl = (worker.last_token_time_s[request_id] - first_s) / max(1, num_tokens - 1)
+        ttfts.append(ttft)
+        itls.append(itl)
+        num_good += ttft <= ttft_slo_s and itl <= itl_slo_s
+    capacity = cost_model.kv_capacity_tokens
+    return SimulationResult(
+        duration_s=duration_s,
+        num_requests=len(trace),
+        num_ooms=worker.num_ooms,
+        num_preemptions=scheduler._stats.num_requests_preempted,
+        throughput_tokens_per_s=sum(worker._num_generated.values()) / duration_s,
+        goodput_requests_per_s=num_good / duration_s,
+        ttft_p50_s=_percentile(ttfts, 0.5),
+        ttft_p90_s=_percentile(ttfts, 0.9),
+        ttft_p99_s=_percentile(ttfts, 0.99),
+        itl_p50_s=_percentile(itls, 0.5),
+        itl_p90_s=_percentile(itls, 0.9),
+        itl_p99_s=_percentile(itls, 0.99),
+        kv_utilization=worker.kv_token_seconds / (capacity * duration_s),
+        peak_kv_utilization=worker.peak_kv_tokens / capacity,
+    )
+
+
+def _parse_overrides(overrides: List[str]) -> dict:
+    parsed = {}
+    for override in overrides:
+        key, _, value = override.partition("=")
+        parsed[key] = yaml.safe_load(value)
+    return parsed
+
+
+def main():
+    from aviary.backend.server.models import ContinuousBatchingGenerationConfig
+
+    parser = argparse.ArgumentParser(
+        description="Simulate the continuous batching scheduler."
+    )
+    parser.add_argument(
+        "--model-yaml",
+        help="Model YAML to take model_config.generation from.",
+    )
+    parser.add_argument(
+        "--set",
+        nargs="*",
+        default=[],
+        help="Generation config overrides, e.g. selection_mode=sjf.",
+    )
+    parser.add_argument(
+        "--cost",
+        nargs="*",
+        default=[],
+        help="Cost model overrides, e.g. kv_capacity_tokens=20000.",
+    )
+    parser.add_argument("--scheduler", choices=list(SCHEDULERS))
+    parser.add_argument("--trace", help="JSON lines file of TraceRequest.")
+    parser.add_argument("--num-requests", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=5.0, help="Requests/s.")
+    parser.add_argument("--mean-input-tokens", type=int, default=256)
+    parser.add_argument("--mean-output-tokens", type=int, default=128)
+    parser.add_argument("--ttft-slo-s", type=float, default=2.0)
+    parser.add_argument("--itl-slo-s", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generation = {}
+    if args.model_yaml:
+        with open(args.model_yaml) as f:
+            generation = yaml.safe_load(f)["model_config"]["generation"]
+    generation.update(_parse_overrides(args.set))
+    generation_config = ContinuousBatchingGenerationConfig.parse_obj(generation)
+
+    cost_model = CostModel(**_parse_overrides(args.cost))
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = synthetic_trace(
+            args.num_requests,
+            args.rate,
+            mean_input_tokens=args.mean_input_tokens,
+            mean_output_tokens=args.mean_output_tokens,
+            max_input_tokens=generation_config.max_input_length,
+            seed=args.seed,
+        )
+
+    result = asyncio.run(
+        simulate(
+            trace,
+            generation_config,
+            cost_model,
+            scheduler_cls=SCHEDULERS[args.scheduler] if args.scheduler else None,
+            ttft_slo_s=args.ttft_slo_s,
+            itl_slo_s=args.itl_slo_s,
+        )
+    )
+    for key, value in asdict(result).items():
+        print(f"{key:>28}: {value:.4g}")
+
+
+if __name__ == "__main__":
+    main()
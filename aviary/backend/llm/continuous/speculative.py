@@ -0,0 +1,246 @@
+from typing import TYPE_CHECKING, Dict, List, Sequence, Tuple
+
+import torch
+
+if TYPE_CHECKING:
+    from text_generation_server.models.causal_lm import CausalLMBatch
+
+
+class PromptLookupDrafter:
+    """Proposes the next tokens of a sequence by looking up its last tokens
+    earlier in it, in the prompt or in what was generated, and copying
+    what followed them there. Summaries, code edits and extraction repeat
+    whole spans of their prompt, so the proposals are often right.
+
+    The index maps every n-gram of the sequence to where it last ended, so
+    a lookup costs a few dict accesses however long the sequence. The
+    longest n-gram that matches wins.
+
+    How many tokens to propose follows the acceptance rate of the
+    sequence: an exponential moving average of the fraction of proposed
+    tokens that were accepted, scaled to max_draft_tokens. It stays at
+    least 1, so that a sequence that starts repeating itself is noticed.
+
+    Args:
+        token_ids (Sequence[int]): The sequence so far.
+        max_draft_tokens (int): Most tokens to propose per step.
+        min_ngram (int): Shortest n-gram to look up.
+        max_ngram (int): Longest n-gram to look up.
+        decay (float): Weight of the past in the acceptance rate.
+    """
+
+    def __init__(
+        self,
+        token_ids: Sequence[int],
+        max_draft_tokens: int,
+        min_ngram: int = 1,
+        max_ngram: int = 3,
+        decay: float = 0.7,
+    ):
+        self.max_draft_tokens = max_draft_tokens
+        self.min_ngram = min_ngram
+        self.max_ngram = max_ngram
+        self.decay = decay
+        self.acceptance_rate = 1.0
+        self.token_ids: List[int] = []
+        # Position after the last occurrence of each n-gram that is followed
+        # by a token.
+        self._index: Dict[Tuple[int, ...], int] = {}
+        self.extend(token_ids)
+
+    def __len__(self) -> int:
+        return len(self.token_ids)
+
+    @property
+    def draft_length(self) -> int:
+        return max(1, round(self.acceptance_rate * self.max_draft_tokens))
+
+    def extend(self, token_ids: Sequence[int]):
+        """Append tokens to the sequence."""
+        tokens = self.token_ids
+        start = len(tokens)
+        tokens.extend(token_ids)
+        # The n-grams ending before the new last token are now followed by
+        # one.
+        for end in range(max(start, 1), len(tokens)):
+            for n in range(self.min_ngram, min(self.max_ngram, end) + 1):
+                self._index[tuple(tokens[end - n : end])] = end
+
+    def propose(self, max_tokens: int) -> List[int]:
+        """The tokens that followed the longest earlier occurrence of the
+        end of the sequence, up to max_tokens and draft_length of them."""
+        max_tokens = min(max_tokens, self.draft_length)
+        tokens = self.token_ids
+        if max_tokens <= 0:
+            return []
+        for n in range(min(self.max_ngram, len(tokens)), self.min_ngram - 1, -1):
+            end = self._index.get(tuple(tokens[len(tokens) - n :]))
+            if end is not None:
+                return tokens[end : end + max_tokens]
+        return []
+
+    def accepted(self, num_proposed: int, num_accepted: int):
+        """Update the acceptance rate with the outcome of a proposal."""
+        if num_proposed:
+            self.acceptance_rate = (
+                self.decay * self.acceptance_rate
+                + (1 - self.decay) * num_accepted / num_proposed
+            )
+
+
+def _widen(attention_mask: torch.Tensor, width: int) -> torch.Tensor:
+    """The attention mask, with zero columns on the right up to width."""
+    if attention_mask.shape[1] >= width:
+        return attention_mask
+    return torch.cat(
+        [
+            attention_mask,
+            attention_mask.new_zeros(
+                attention_mask.shape[0], width - attention_mask.shape[1]
+            ),
+        ],
+        dim=1,
+    )
+
+
+def speculate(
+    batch: "CausalLMBatch", drafts: List[List[int]]
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """The inputs of a forward pass of a decoding batch that verifies the
+    draft tokens of each row, after its next input token.
+
+    The drafts are right padded to the longest and take the columns after
+    the input token. The batch is left as it is, so that it can go on
+    without speculating if the forward pass fails.
+
+    Returns:
+        The input ids, attention mask and position ids, [batch, 1 +
+        longest draft] but for the mask, which covers the past too. The
+        logits of column j are those of the token after draft token j.
+    """
+    num_drafts = max(len(draft) for draft in drafts)
+    width = batch.max_input_length
+    device = batch.input_ids.device
+    draft_ids = torch.tensor(
+        [draft + [0] * (num_drafts - len(draft)) for draft in drafts],
+        dtype=batch.input_ids.dtype,
+    ).to(device)
+    input_ids = torch.cat([batch.input_ids[:, -1:], draft_ids], dim=1)
+    attention_mask = batch.attention_mask[:, :width]
+    attention_mask = torch.cat(
+        [attention_mask, attention_mask.new_ones(len(drafts), num_drafts)], dim=1
+    )
+    position_ids = batch.position_ids[:, -1:] + torch.arange(
+        num_drafts + 1, device=device
+    )
+    return input_ids, attention_mask, position_ids
+
+
+def accept_speculation(
+    batch: "CausalLMBatch",
+    past_key_values,
+    num_drafts: int,
+    num_accepted: List[int],
+    next_token_ids: List[int],
+    min_padding_right_offset: int,
+):
+    """Move a batch past a forward pass given by speculate.
+
+    Every row takes the 1 + num_drafts columns of the pass. The input
+    token and the accepted drafts of a row stay attended to, the rejected
+    drafts become holes, masked out. The positions of the rows only count
+    the tokens they kept.
+
+    Everything is computed before the batch is updated, so that a failure
+    leaves it as it was.
+
+    Args:
+        past_key_values: The KV cache returned by the forward pass.
+        num_drafts (int): The longest draft of the pass.
+        num_accepted (List[int]): For each row, how many of its tokens of
+            the pass to keep, 1 + its accepted drafts.
+        next_token_ids (List[int]): The next input token of each row.
+        min_padding_right_offset (int): Columns to keep free on the right
+            of the attention mask, for the tokens still to be generated.
+    """
+    width = batch.max_input_length
+    device = batch.input_ids.device
+    accepted = torch.tensor(num_accepted, device=device)
+    new_width = width + num_drafts + 1
+    attention_mask = _widen(batch.attention_mask, new_width + min_padding_right_offset)
+    # The input token is already attended to.
+    columns = torch.arange(1, num_drafts + 1, device=device)
+    kept = (columns < accepted[:, None]).to(attention_mask.dtype)
+    input_ids = torch.tensor(
+        next_token_ids, dtype=batch.input_ids.dtype, device=device
+    ).view(-1, 1)
+    position_ids = batch.position_ids[:, -1:] + accepted.view(-1, 1).to(
+        batch.position_ids.dtype
+    )
+
+    attention_mask[:, width : new_width - 1] = kept
+    attention_mask[:, new_width - 1] = 1
+    batch.attention_mask = attention_mask
+    batch.max_input_length = new_width
+    batch.padding_right_offset = attention_mask.shape[1] - new_width
+    batch.input_ids = input_ids
+    batch.position_ids = position_ids
+    batch.past_key_values = past_key_values
+    # The filters of TGI keep the last input_length columns of each row,
+    # holes included.
+    batch.input_lengths = [
+        input_length + num_drafts + 1 for input_length in batch.input_lengths
+    ]
+
+
+def num_hole_columns(batch: "CausalLMBatch") -> int:
+    """How many columns compact_holes would free."""
+    past_width = batch.max_input_length - 1
+    num_kept = batch.attention_mask[:, :past_width].sum(dim=1).max()
+    return past_width - int(num_kept)
+
+
+def compact_holes(batch: "CausalLMBatch"):
+    """Squeeze the masked out columns out of the KV cache of a batch, so
+    that each row is its kept tokens, left padded to the longest.
+
+    It copies the whole KV cache, like a filter, so it is worth it only
+    once the holes take a good part of it.
+    """
+    past_width = batch.max_input_length - 1
+    kept = batch.attention_mask[:, :past_width] > 0
+    num_kept = kept.sum(dim=1)
+    new_past_width = int(num_kept.max())
+    # A stable sort puts the columns of each row that are masked out first
+    # and the kept ones last, in order.
+    columns = torch.sort(kept.to(torch.uint8), dim=1, stable=True).indices
+    columns = columns[:, past_width - new_past_width :]
+
+    key_seq_dim = 2 if batch.keys_head_dim_last else 3
+    new_past_key_values = []
+    for keys, values in batch.past_key_values:
+        key_index = (
+            columns[:, None, :, None] if key_seq_dim == 2 else columns[:, None, None, :]
+        )
+        key_index = key_index.expand(
+            *keys.shape[:key_seq_dim], new_past_width, *keys.shape[key_seq_dim + 1 :]
+        )
+        value_index = columns[:, None, :, None].expand(
+            *values.shape[:2], new_past_width, values.shape[3]
+        )
+        new_past_key_values.append(
+            (
+                torch.gather(keys, key_seq_dim, key_index),
+                torch.gather(values, 2, value_index),
+            )
+        )
+    batch.past_key_values = new_past_key_values
+
+    attention_mask = batch.attention_mask.new_zeros(
+        len(num_kept), new_past_width + 1 + batch.padding_right_offset
+    )
+    attention_mask[:, :new_past_width] = torch.gather(kept, 1, columns)
+    attention_mask[:, new_past_width] = 1
+    batch.attention_mask = attention_mask
+    batch.max_input_length = new_past_width + 1
+    batch.input_lengths = [n + 1 for n in num_kept.tolist()]
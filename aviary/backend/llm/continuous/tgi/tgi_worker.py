@@ -1,18 +1,28 @@
-import asyncio
 import gc
+import math
 import os
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Type
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Set, Tuple, Type
 from unittest.mock import patch
 
-import ray
 import torch
 from filelock import FileLock
 
 from aviary.backend.logger import get_logger
 
-from ..types import Request
-from ..worker import AsyncInferenceWorker
+from ..kv_cache import KVCacheLayout
+from ..metrics import WorkerMetrics
+from ..padded_batch import can_merge_in_place, merge_in_place
+from ..prefix_cache import PrefixKVCache, PrefixReuse, has_split_kv_cache
+from ..ray_worker import LocalInferenceWorker, RayInferenceWorker
+from ..speculative import (
+    PromptLookupDrafter,
+    accept_speculation,
+    compact_holes,
+    num_hole_columns,
+    speculate,
+)
+from ..worker import StepFailedError, is_oom
 
 if TYPE_CHECKING:
     from text_generation_server.models.causal_lm import CausalLMBatch
@@ -20,11 +30,9 @@ if TYPE_CHECKING:
     from text_generation_server.models.types import (
         Generation,
     )
-
-
-from text_generation_server.pb.generate_pb2 import (
-    Request as GenerationRequest,
-)
+    from text_generation_server.pb.generate_pb2 import (
+        Request as GenerationRequest,
+    )
 
 from ..worker import AbstractInferenceWorker
 from .logits_processors import MinNewTokensLogitsProcessor
@@ -117,7 +125,7 @@ def concatenate_batches(
 
 @dataclass
 class FakePB2:
-    requests: List[GenerationRequest]
+    requests: List["GenerationRequest"]
     id: Optional[int] = None
     request_ids: Optional[List[int]] = None
     max_tokens: Optional[int] = None
@@ -127,109 +135,277 @@ class FakePB2:
         return len(self.requests) if self.requests else 0
 
 
-def _flatten_list(lst: list) -> list:
-    return [item for sublist in lst for item in sublist]
+# The drivers used to be TGI specific.
+TGIRayInferenceWorker = RayInferenceWorker
+TGILocalInferenceWorker = LocalInferenceWorker
 
 
-# TODO: Add error handling.
-# We need to catch the exception and propagate it to the user.
-class TGIRayInferenceWorker(AsyncInferenceWorker):
-    def __init__(self, worker_group: List[ray.ObjectRef]):
-        self.worker_group = worker_group
+def _kv_cache_bytes(batch: "CausalLMBatch") -> int:
+    """Size of the KV cache held by a batch. Paged batches don't hold their
+    KV cache, their blocks are never copied."""
+    past_key_values = getattr(batch, "past_key_values", None)
+    if not past_key_values:
+        return 0
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for layer in past_key_values
+        for tensor in layer
+    )
 
-    def process_new_batch(
-        self, requests: List["Request"], batch_id: int
-    ) -> Tuple[List["Generation"], int]:
-        ret = ray.get(
-            [
-                worker.process_new_batch.remote(requests, batch_id)
-                for worker in self.worker_group
-            ]
-        )
-        return (
-            _flatten_list([x[0] for x in ret]) if ret[0][0] is not None else ret[0][0],
-            ret[0][1],
-        )
 
-    def generate_next_token(
-        self, batch_ids: List[int]
-    ) -> Tuple[List["Generation"], Optional[int]]:
-        ret = ray.get(
-            [
-                worker.generate_next_token.remote(batch_ids)
-                for worker in self.worker_group
-            ]
-        )
-        return (
-            _flatten_list([x[0] for x in ret]) if ret[0][0] is not None else ret[0][0],
-            ret[0][1],
-        )
+def _is_intact(batch: "CausalLMBatch") -> bool:
+    """Whether a batch can still be used after a step failed on it. TGI
+    drops the KV cache of the padded batches it concatenates, and the block
+    tables of the paged ones."""
+    if getattr(batch, "block_tables", True) is None:
+        return False
+    past_key_values = getattr(batch, "past_key_values", None)
+    return not past_key_values or all(
+        tensor is not None for layer in past_key_values for tensor in layer
+    )
 
-    def filter_requests(self, batch_id: int, request_ids: List[int]) -> Optional[int]:
-        return ray.get(
-            [
-                worker.filter_requests.remote(batch_id, request_ids)
-                for worker in self.worker_group
-            ]
-        )[0]
 
-    async def process_new_batch_async(
-        self, requests: List["Request"], batch_id: int
-    ) -> Tuple[List["Generation"], int]:
-        ret = await asyncio.gather(
-            *[
-                worker.process_new_batch.remote(requests, batch_id)
-                for worker in self.worker_group
-            ]
-        )
-        logger.debug(f"process_new_batch_async returns {ret}")
-        return (
-            _flatten_list([x[0] for x in ret]) if ret[0][0] is not None else ret[0][0],
-            ret[0][1],
-        )
+class _StepSnapshot:
+    """What a decode step updates in a batch, taken before the step, to put
+    the batch back as it was if the step fails.
 
-    async def generate_next_token_async(
-        self, batch_ids: List[int]
-    ) -> Tuple[List["Generation"], Optional[int]]:
-        ret = await asyncio.gather(
-            *[
-                worker.generate_next_token.remote(batch_ids)
-                for worker in self.worker_group
-            ]
-        )
-        logger.debug(f"generate_next_token_async returns {ret}")
+    The steps run the forward pass first, then update the rows one by one,
+    and the KV cache last, so a step failing half way leaves a batch with
+    the next token of some rows only. The lists of the rows and the
+    stopping criteria are copied, and so are the tensors a padded step
+    writes in place: the input ids and the columns of the attention mask
+    after the inputs. The other tensors are replaced, not written to, and
+    are only referenced. The random generators of the requests that sample
+    are rewound, so that the step picks the same tokens when it runs
+    again. A paged batch, whose step updates its tensors in place, can only
+    be kept if the step failed before updating anything.
+    """
+
+    def __init__(self, batch: "CausalLMBatch"):
+        self.batch = batch
+        self.padded = hasattr(batch, "padding_right_offset")
+        self.fields = {
+            field: getattr(batch, field)
+            for field in (
+                "input_ids",
+                "attention_mask",
+                "position_ids",
+                "past_key_values",
+                "max_input_length",
+                "padding_right_offset",
+            )
+            if hasattr(batch, field)
+        }
+        self.rows = {
+            field: list(getattr(batch, field))
+            for field in (
+                "all_input_ids",
+                "input_lengths",
+                "prefix_offsets",
+                "read_offsets",
+            )
+        }
+        self.stopping_criterias = [
+            (
+                stopping_criteria.current_tokens,
+                getattr(stopping_criteria, "current_output", None),
+            )
+            for stopping_criteria in batch.stopping_criterias
+        ]
+        self.generators = [
+            (generator, generator.get_state())
+            for generator in (
+                getattr(getattr(chooser, "choice", None), "generator", None)
+                for chooser in batch.next_token_choosers
+            )
+            if generator is not None
+        ]
+        if self.padded:
+            self.input_ids = batch.input_ids.clone()
+            self.free_columns = batch.attention_mask[
+                :, batch.max_input_length :
+            ].clone()
+
+    def _updated(self) -> bool:
+        # A paged step replaces the input ids before updating anything else.
+        batch = self.batch
         return (
-            _flatten_list([x[0] for x in ret]) if ret[0][0] is not None else ret[0][0],
-            ret[0][1],
+            any(
+                getattr(batch, field) is not value
+                for field, value in self.fields.items()
+            )
+            or any(
+                len(getattr(batch, field)) != len(values)
+                or any(a is not b for a, b in zip(getattr(batch, field), values))
+                for field, values in self.rows.items()
+            )
+            or any(
+                stopping_criteria.current_tokens != current_tokens
+                for stopping_criteria, (current_tokens, _) in zip(
+                    batch.stopping_criterias, self.stopping_criterias
+                )
+            )
         )
 
-    async def filter_requests_async(
-        self, batch_id: int, request_ids: List[int]
-    ) -> Optional[int]:
-        ret = await asyncio.gather(
-            *[
-                worker.filter_requests.remote(batch_id, request_ids)
-                for worker in self.worker_group
-            ]
-        )
-        logger.debug(f"filter_requests_async returns {ret}")
-        return ret[0]
+    def restore(self) -> bool:
+        """Put the batch back as it was before the step.
+
+        Returns whether it could."""
+        if not self.padded:
+            return not self._updated()
+        for generator, state in self.generators:
+            generator.set_state(state)
+        batch = self.batch
+        for field, value in self.fields.items():
+            setattr(batch, field, value)
+        batch.input_ids.copy_(self.input_ids)
+        batch.attention_mask[:, batch.max_input_length :] = self.free_columns
+        for field, values in self.rows.items():
+            setattr(batch, field, values)
+        for stopping_criteria, (current_tokens, current_output) in zip(
+            batch.stopping_criterias, self.stopping_criterias
+        ):
+            stopping_criteria.current_tokens = current_tokens
+            if current_output is not None:
+                stopping_criteria.current_output = current_output
+        return True
 
 
 class InferenceWorker(AbstractInferenceWorker):
-    def __init__(self, model_loader: Callable[[], "Model"]):
+    """Runs the batches of a TGI model.
+
+    Filtering or concatenating a padded batch copies its whole KV cache. So
+    the requests filtered out of a padded batch are only masked: they stay in
+    the batch and their generations are dropped, until more than
+    max_masked_fraction of the batch is masked, or the requests left are
+    filtered anyway, and the batch is compacted with a real filter. The
+    compaction keeps up to half of max_masked_fraction of the rows masked,
+    as spare rows. The masked rows are spare capacity: a new batch that fits
+    in them is merged into them in place, copying only its own KV cache,
+    see merge_in_place. The other batches are concatenated by TGI. The
+    masked rows still take memory and compute, so the KV cache layout
+    tells the scheduler to budget for them.
+
+    When a step fails, the batches it was given are put back as they were
+    before the step if TGI left them usable, and StepFailedError is raised
+    so that the scheduler takes requests out of them and goes on. This is
+    best effort: a batch consumed by a concatenation, or a paged batch
+    partly updated by the failed step, can't be recovered, and the whole
+    cache is dropped. A padded batch partly updated by the step is put back
+    from a snapshot taken before it, see _StepSnapshot. The shards of a
+    model agree on the outcome of each step: if it failed on any of them,
+    it fails on all of them, and the batches are put back on all of them
+    or dropped on all of them.
+
+    The prompts of a new padded batch can be prefilled in chunks of columns,
+    see prefill_chunk. Each chunk runs the model on the next columns of the
+    batch with the KV cache of the previous ones as its past, the way
+    decode steps do, so the result is the same as a single prefill.
+    Paged batches are always prefilled at once.
+
+    Decode steps of padded models with position ids can speculate: each
+    request proposes the tokens that followed the last occurrence of its
+    last tokens in its prompt or output, see PromptLookupDrafter, and a
+    single forward pass checks them all. A request keeps the drafts that
+    match the tokens its NextTokenChooser picks from the logits of the
+    pass, in order, plus the token picked after the last one, so its
+    output is the one it would get without speculating. A step can thus
+    return several generations per request. Every row of the batch takes
+    the columns of the longest draft, the rejected drafts become masked
+    out holes, and the batch is compacted once they take more than
+    max_masked_fraction of its columns.
+
+    Args:
+        model_loader (Callable[[], Model]): Loads the TGI model.
+        max_masked_fraction (float): Compact a padded batch once more than
+            this fraction of its rows are masked. 0 to always compact.
+        metrics (Optional[WorkerMetrics]): Metrics to export the batch
+            operations to.
+        recover_failed_steps (bool): Keep the batches of a failed step and
+            raise StepFailedError. If False, a failed decode step drops the
+            whole cache, and a failed prefill raises the original error.
+        prefix_cache_max_bytes (int): Keep up to this many bytes of the KV
+            cache of the prompts prefilled, so that the prefill of a batch
+            whose prompts start with a cached prefix, like their
+            prompt_format, skips it. See PrefixKVCache. Only padded models
+            are supported, and the KV cache layout tells the scheduler to
+            budget for it. It is cleared when a step runs out of memory.
+            0 to disable.
+        speculative_tokens (int): Most draft tokens per request and decode
+            step. Only padded models with position ids are supported, and
+            the KV cache layout tells the scheduler to budget for the
+            columns of the drafts. 0 to disable.
+    """
+
+    def __init__(
+        self,
+        model_loader: Callable[[], "Model"],
+        max_masked_fraction: float = 0.2,
+        metrics: Optional[WorkerMetrics] = None,
+        recover_failed_steps: bool = True,
+        prefix_cache_max_bytes: int = 0,
+        speculative_tokens: int = 0,
+    ):
         self._model = model_loader()
         self._batch_state_cache: Dict[int, "CausalLMBatch"] = dict()
+        # Batches being prefilled in chunks, and their prefix cache reuse,
+        # by batch id.
+        self._partial_batches: Dict[
+            int, Tuple["CausalLMBatch", Optional[PrefixReuse]]
+        ] = dict()
+        # Requests masked out of each batch, by batch id.
+        self._masked_requests: Dict[int, Set[int]] = dict()
+        self._max_masked_fraction = max_masked_fraction
+        self._prefix_cache: Optional[PrefixKVCache] = None
+        self._speculative_tokens = 0
+        self._padded = self.get_kv_cache_layout().kind == "padded"
+        self._lazy_filter = max_masked_fraction > 0 and self._padded
+        self._metrics = metrics
+        self._recover_failed_steps = recover_failed_steps
+        self._prefix_cache = (
+            PrefixKVCache(prefix_cache_max_bytes)
+            if prefix_cache_max_bytes > 0 and self._padded
+            else None
+        )
+        # Whether the prefix cache has to be cleared, after an OOM or a
+        # failed update. It is cleared on every shard before the next lookup,
+        # see _sync_prefix_cache.
+        self._prefix_cache_stale = False
+        self._speculative_tokens = (
+            speculative_tokens
+            if self._padded and getattr(self._model, "has_position_ids", False)
+            else 0
+        )
+        # Drafters of the requests of the last decode step, by request id.
+        self._drafters: Dict[int, PromptLookupDrafter] = dict()
+        # Draft tokens proposed and accepted since the worker started.
+        self._num_draft_tokens = 0
+        self._num_accepted_tokens = 0
         if self._model.device.type == "cuda":
             self._inference_mode_raii_guard = torch._C._InferenceMode(True)
 
     def process_new_batch(
         self, requests: List["GenerationRequest"], batch_id: int
     ) -> Tuple[List["Generation"], int]:
-        # TGI expects sorted requests
-        requests = sorted(requests, key=lambda x: x.id)
-        batch_state = create_batch(self._model, requests, batch_id)
-        generations, batch_state = self._model.generate_token(batch_state)
+        partial = self._partial_batches.pop(batch_id, None)
+        error = None
+        try:
+            if partial is None:
+                batch_state, prefix_reuse = self._create_batch(requests, batch_id)
+            else:
+                batch_state, prefix_reuse = partial
+            generations, batch_state = self._model.generate_token(batch_state)
+        except Exception as e:
+            logger.error(f"process_new_batch error happened: {repr(e)}")
+            error = e
+        error = self._shard_error(error)
+        if error is not None:
+            self._prefill_failed(error)
+            if not self._recover_failed_steps:
+                raise error
+            raise StepFailedError(repr(error), oom=is_oom(error)) from error
+        if prefix_reuse is not None:
+            self._cache_prefixes(batch_state, prefix_reuse)
         try:
             logger.debug(f"Batch state ID: { batch_state.batch_id}")
         except Exception as e:
@@ -243,6 +419,118 @@ class InferenceWorker(AbstractInferenceWorker):
         else:
             return generations, None
 
+    def prefill_chunk(
+        self,
+        requests: Optional[List["GenerationRequest"]],
+        batch_id: int,
+        max_tokens: int,
+    ) -> int:
+        if not self._padded:
+            return 0
+        partial = self._partial_batches.pop(batch_id, None)
+        error = None
+        try:
+            if partial is None:
+                partial = self._create_batch(requests, batch_id)
+            batch_state = partial[0]
+            # A chunk takes as many columns as fit in max_tokens, padding
+            # included. If the columns left fit, they are left to
+            # process_new_batch.
+            chunk_columns = max(max_tokens // len(batch_state), 1)
+            if batch_state.input_ids.shape[1] > chunk_columns:
+                self._prefill_columns(batch_state, chunk_columns)
+            else:
+                chunk_columns = 0
+        except Exception as e:
+            logger.error(f"prefill_chunk error happened: {repr(e)}")
+            error = e
+        error = self._shard_error(error)
+        if error is not None:
+            self._prefill_failed(error)
+            raise StepFailedError(repr(error), oom=is_oom(error)) from error
+        self._partial_batches[batch_id] = partial
+        if not chunk_columns:
+            return 0
+        return batch_state.input_ids.shape[1] * len(batch_state)
+
+    def _create_batch(
+        self, requests: List["GenerationRequest"], batch_id: int
+    ) -> Tuple["CausalLMBatch", Optional[PrefixReuse]]:
+        # TGI expects sorted requests
+        requests = sorted(requests, key=lambda x: x.id)
+        if self._prefix_cache:
+            self._sync_prefix_cache()
+        batch_state = create_batch(self._model, requests, batch_id)
+        prefix_reuse = None
+        if self._prefix_cache:
+            prefix_reuse = self._prefix_cache.prepare(
+                batch_state, getattr(self._model, "has_position_ids", False)
+            )
+        return batch_state, prefix_reuse
+
+    def _prefill_columns(self, batch_state: "CausalLMBatch", num_columns: int):
+        """Run the model on the next num_columns columns of the prompts of a
+        padded batch, and make their KV cache the past of the rest."""
+        past_length = batch_state.max_input_length - batch_state.input_ids.shape[1]
+        _, batch_state.past_key_values = self._model.forward(
+            batch_state.input_ids[:, :num_columns],
+            batch_state.attention_mask[:, : past_length + num_columns],
+            batch_state.position_ids[:, :num_columns],
+            batch_state.past_key_values,
+        )
+        batch_state.input_ids = batch_state.input_ids[:, num_columns:]
+        batch_state.position_ids = batch_state.position_ids[:, num_columns:]
+        # TGI computes the logprobs of the prompt from the logits of all of
+        # its tokens, which the last chunk doesn't have.
+        for request in batch_state.requests:
+            request.prefill_logprobs = False
+
+    def _prefill_failed(self, error: Exception):
+        if is_oom(error):
+            self._prefix_cache_stale = True
+
+    def _sync_prefix_cache(self):
+        """Clear the prefix cache if it has to be, on every shard.
+
+        The shards of a model must reuse the same prefixes, or their batches
+        would not match. So they decide together, before each lookup: if any
+        of them has to clear its cache, all of them do."""
+        (clear,) = self._on_any_shard(self._prefix_cache_stale)
+        if clear:
+            self._prefix_cache.tree.clear()
+            if self._metrics:
+                self._metrics.prefix_cache_bytes.set(0)
+        self._prefix_cache_stale = False
+
+    def _on_any_shard(self, *flags: bool) -> Tuple[bool, ...]:
+        """Whether each flag is set on any shard of the model.
+
+        Every shard has to call it at the same point, with as many flags."""
+        process_group = getattr(self._model, "process_group", None)
+        if process_group is None or process_group.size() == 1:
+            return flags
+        tensor = torch.tensor(flags, dtype=torch.uint8, device=self._model.device)
+        torch.distributed.all_reduce(
+            tensor, op=torch.distributed.ReduceOp.MAX, group=process_group
+        )
+        return tuple(bool(flag) for flag in tensor.tolist())
+
+    def _shard_error(self, error: Optional[Exception]) -> Optional[Exception]:
+        """The error of a step, if it failed on any shard of the model.
+
+        The shards have to take the same batches into the next step, so a
+        shard whose step went through fails it too when another one failed,
+        with an OOM if any of them ran out of memory. The error of this
+        shard is kept if it has one."""
+        failed, oom = self._on_any_shard(
+            error is not None, error is not None and is_oom(error)
+        )
+        if not failed or error is not None:
+            return error
+        if oom:
+            return torch.cuda.OutOfMemoryError("Out of memory on another shard")
+        return RuntimeError("The step failed on another shard")
+
     def generate_next_token(
         self, batch_ids: List[int]
     ) -> Tuple[List["Generation"], Optional[int]]:
@@ -260,20 +548,82 @@ class InferenceWorker(AbstractInferenceWorker):
         if len(batch_states) == 0:
             return [], None
 
+        masked_by_batch: Dict[int, Set[int]] = {}
+        merged = None
+        snapshot = None
+        error = None
         try:
+            for i, batch_state in enumerate(batch_states):
+                masked = self._masked_requests.pop(batch_state.batch_id, set())
+                if any(
+                    request_id in other.requests_idx_mapping
+                    for other in batch_states
+                    if other is not batch_state
+                    for request_id in masked
+                ):
+                    # A request masked out of this batch was preempted and is
+                    # back in another batch, drop it before they are merged.
+                    batch_states[i] = self._compact(batch_state, masked)
+                elif masked:
+                    masked_by_batch[batch_state.batch_id] = masked
+            if len(batch_states) > 1 and masked_by_batch:
+                batch_states = self._merge_in_place(batch_states, masked_by_batch)
+            masked_requests = set().union(*masked_by_batch.values())
             if len(batch_states) > 1:
-                batch_state = concatenate_batches(self._model, batch_states)
+                batch_state = merged = concatenate_batches(self._model, batch_states)
+                if self._metrics:
+                    self._metrics.batch_concatenations.inc()
+                    self._kv_cache_copied(batch_state)
             else:
                 batch_state = batch_states[0]
             # stats = batch_state.stats()
             # logger.info(f"generate_next_token batch_state { batch_state}")
-            generations, batch_state = self._model.generate_token(batch_state)
+            if self._recover_failed_steps:
+                snapshot = _StepSnapshot(batch_state)
+            generations, batch_state = self._generate_token(
+                batch_state, masked_requests
+            )
         except Exception as e:
             logger.error(f"generate_next_token error happened: {repr(e)}")
+            error = e
+        error = self._shard_error(error)
+        if error is not None:
+            if is_oom(error):
+                self._prefix_cache_stale = True
+            # The drafters of a shard whose step went through took its
+            # tokens, and all the shards have to propose the same drafts.
+            self._drafters.clear()
+            if self._recover_failed_steps:
+                request_ids_by_batch = self._restore_batches(
+                    batch_states,
+                    merged,
+                    set().union(*masked_by_batch.values()),
+                    snapshot,
+                )
+                # The batches are kept only if every shard could put them
+                # back.
+                (lost,) = self._on_any_shard(not request_ids_by_batch)
+                if not lost:
+                    raise StepFailedError(
+                        repr(error),
+                        oom=is_oom(error),
+                        request_ids_by_batch=request_ids_by_batch,
+                    ) from error
             #  Error happens when populate the new batch, we have to restart
             self._batch_state_cache.clear()
+            self._masked_requests.clear()
+            self._report_masked_requests()
             return None, None
 
+        if masked_requests:
+            generations = [
+                g for g in generations if g.request_id not in masked_requests
+            ]
+            if batch_state:
+                self._masked_requests[batch_state.batch_id] = masked_requests
+            else:
+                self._report_masked_requests()
+
         logger.debug(
             f"generate_next_token returns {(generations, batch_state.batch_id if batch_state else None)}"
         )
@@ -283,27 +633,347 @@ class InferenceWorker(AbstractInferenceWorker):
             return generations, batch_state.batch_id
         return generations, None
 
-    def filter_requests(self, batch_id: int, request_ids: List[int]) -> Optional[int]:
+    def _merge_in_place(
+        self,
+        batch_states: List["CausalLMBatch"],
+        masked_by_batch: Dict[int, Set[int]],
+    ) -> List["CausalLMBatch"]:
+        """Merge the batches that fit into the masked rows of the batch with
+        the most of them, in place. The masked requests of the batches
+        merged move to it.
+
+        Returns the batches left, including the one merged into.
+        """
+        batch = max(
+            batch_states, key=lambda b: len(masked_by_batch.get(b.batch_id, ()))
+        )
+        masked = masked_by_batch[batch.batch_id]
+        left = []
+        for other in batch_states:
+            if other is batch or not can_merge_in_place(batch, other, len(masked)):
+                left.append(other)
+                continue
+            replaced = sorted(masked)[: len(other)]
+            num_bytes = _kv_cache_bytes(other)
+            merge_in_place(
+                batch,
+                other,
+                [batch.requests_idx_mapping[request_id] for request_id in replaced],
+            )
+            masked.difference_update(replaced)
+            masked |= masked_by_batch.pop(other.batch_id, set())
+            if self._metrics:
+                self._metrics.in_place_batch_concatenations.inc()
+                self._metrics.inc(self._metrics.kv_cache_bytes_copied, num_bytes)
+        if not masked:
+            del masked_by_batch[batch.batch_id]
+        return left
+
+    def _generate_token(
+        self, batch_state: "CausalLMBatch", masked_requests: Set[int]
+    ) -> Tuple[List["Generation"], Optional["CausalLMBatch"]]:
+        """Run a decode step, speculative if enabled and some request has a
+        draft."""
+        if not self._speculative_tokens or not has_split_kv_cache(batch_state):
+            return self._model.generate_token(batch_state)
+        drafts = self._propose_drafts(batch_state, masked_requests)
+        if not any(drafts):
+            return self._model.generate_token(batch_state)
+        return self._speculative_step(batch_state, drafts)
+
+    def _propose_drafts(
+        self, batch_state: "CausalLMBatch", masked_requests: Set[int]
+    ) -> List[List[int]]:
+        """The draft of each request of a batch, never past its
+        max_new_tokens. Masked requests don't get any."""
+        # The scheduler decodes all of its batches together, so the drafters
+        # of the requests that are not in this one can go.
+        drafters = {}
+        drafts = []
+        for request, all_input_ids, stopping_criteria in zip(
+            batch_state.requests,
+            batch_state.all_input_ids,
+            batch_state.stopping_criterias,
+        ):
+            drafter = self._drafters.get(request.id)
+            token_ids = all_input_ids.view(-1)
+            if drafter is None:
+                drafter = PromptLookupDrafter(
+                    token_ids.tolist(), self._speculative_tokens
+                )
+            elif len(drafter) < len(token_ids):
+                drafter.extend(token_ids[len(drafter) :].tolist())
+            drafters[request.id] = drafter
+            if request.id in masked_requests:
+                drafts.append([])
+                continue
+            num_tokens_left = (
+                stopping_criteria.max_new_tokens - stopping_criteria.current_tokens
+            )
+            drafts.append(drafter.propose(num_tokens_left - 1))
+        self._drafters = drafters
+        return drafts
+
+    def _speculative_step(
+        self, batch: "CausalLMBatch", drafts: List[List[int]]
+    ) -> Tuple[List["Generation"], Optional["CausalLMBatch"]]:
+        """CausalLM.generate_token, checking the drafts of the requests of
+        a padded batch in the same forward pass.
+
+        The outcome of every row is computed before the batch and the
+        drafters are updated, so that a failure leaves them as they were,
+        but for the stopping criteria, which _StepSnapshot puts back."""
+        from text_generation_server.models.types import GeneratedText, Generation
+
+        input_ids, attention_mask, position_ids = speculate(batch, drafts)
+        logits, past_key_values = self._model.forward(
+            input_ids, attention_mask, position_ids, batch.past_key_values
+        )
+
+        generations: List[Generation] = []
+        num_accepted = []
+        next_token_ids = []
+        # The all_input_ids, prefix_offset and read_offset of each row.
+        rows = []
+        # Columns the unfinished requests may still need.
+        min_padding_right_offset = 0
+        stopped = True
+        iterator = zip(
+            batch.requests,
+            drafts,
+            logits,
+            batch.next_token_choosers,
+            batch.stopping_criterias,
+        )
+        for i, (
+            request,
+            draft,
+            request_logits,
+            next_token_chooser,
+            stopping_criteria,
+        ) in enumerate(iterator):
+            all_input_ids = batch.all_input_ids[i]
+            prefix_offset = batch.prefix_offsets[i]
+            read_offset = batch.read_offsets[i]
+            # The logits of column j are those of the token after draft
+            # token j, which is kept if it's the token picked from them.
+            for j in range(len(draft) + 1):
+                next_token_id, logprobs = next_token_chooser(
+                    all_input_ids.view(1, -1), request_logits[j : j + 1, :]
+                )
+                all_input_ids = torch.cat([all_input_ids, next_token_id])
+                next_token_id_squeezed = next_token_id.squeeze()
+                next_token_text, prefix_offset, read_offset = self._model.decode_token(
+                    all_input_ids[:, 0], prefix_offset, read_offset
+                )
+                stop, reason = stopping_criteria(
+                    next_token_id_squeezed, next_token_text
+                )
+                generated_text = None
+                if stop:
+                    generated_text = GeneratedText(
+                        self._model.decode(
+                            all_input_ids[-stopping_criteria.current_tokens :, 0]
+                        ),
+                        stopping_criteria.current_tokens,
+                        reason,
+                        getattr(next_token_chooser.choice, "seed", None),
+                    )
+                token_id = next_token_id_squeezed.item()
+                generations.append(
+                    Generation(
+                        request.id,
+                        None,
+                        next_token_id_squeezed,
+                        logprobs[-1, next_token_id],
+                        next_token_text,
+                        token_id in self._model.all_special_ids,
+                        generated_text,
+                    )
+                )
+                if stop or j == len(draft) or token_id != draft[j]:
+                    break
+
+            num_accepted.append(j + 1)
+            next_token_ids.append(token_id)
+            rows.append((all_input_ids, prefix_offset, read_offset))
+            if not stop:
+                stopped = False
+                min_padding_right_offset = max(
+                    min_padding_right_offset,
+                    stopping_criteria.max_new_tokens - stopping_criteria.current_tokens,
+                )
+
+        if not stopped:
+            accept_speculation(
+                batch,
+                past_key_values,
+                max(map(len, drafts)),
+                num_accepted,
+                next_token_ids,
+                min_padding_right_offset,
+            )
+        for i, (
+            request,
+            draft,
+            (all_input_ids, prefix_offset, read_offset),
+        ) in enumerate(zip(batch.requests, drafts, rows)):
+            self._drafters[request.id].accepted(len(draft), num_accepted[i] - 1)
+            batch.all_input_ids[i] = all_input_ids
+            batch.prefix_offsets[i] = prefix_offset
+            batch.read_offsets[i] = read_offset
+        self._num_draft_tokens += sum(map(len, drafts))
+        self._num_accepted_tokens += sum(num_accepted) - len(num_accepted)
+        if self._metrics:
+            self._metrics.inc(
+                self._metrics.speculative_draft_tokens, sum(map(len, drafts))
+            )
+            self._metrics.inc(
+                self._metrics.speculative_accepted_tokens,
+                sum(num_accepted) - len(num_accepted),
+            )
+        if stopped:
+            return generations, None
+
+        if num_hole_columns(batch) > self._max_masked_fraction * batch.max_input_length:
+            compact_holes(batch)
+            if self._metrics:
+                self._kv_cache_copied(batch)
+        return generations, batch
+
+    def filter_requests(
+        self, batch_id: int, request_ids: List[int], compact: bool = False
+    ) -> Optional[int]:
         if batch_id is None:
             return None
 
         batch_state = self._batch_state_cache.pop(batch_id)
+        self._masked_requests.pop(batch_id, None)
 
         if len(request_ids) == 0:
+            self._report_masked_requests()
             return None
 
-        # TGI expects sorted request_ids
-        request_ids = sorted(request_ids)
-        filtered = batch_state.filter(request_ids)
-        logger.debug(
-            f"Filtered batch {_print_batch(batch_state)} into {_print_batch(filtered)}"
-        )
+        if self._lazy_filter and not compact:
+            masked_requests = set(batch_state.requests_idx_mapping).difference(
+                request_ids
+            )
+            if len(masked_requests) <= self._max_masked_fraction * len(batch_state):
+                self._masked_requests[batch_id] = masked_requests
+                self._batch_state_cache[batch_id] = batch_state
+                if self._metrics:
+                    self._metrics.lazy_batch_filters.inc()
+                self._report_masked_requests()
+                return batch_id
+            # Keep some of the masked rows as spare rows to merge new batches
+            # into.
+            num_spare_rows = int(self._max_masked_fraction / 2 * len(request_ids))
+            spare_requests = sorted(masked_requests)[:num_spare_rows]
+        else:
+            spare_requests = []
+
+        filtered = self._filter(batch_state, list(request_ids) + spare_requests)
+        if spare_requests:
+            self._masked_requests[filtered.batch_id] = set(spare_requests)
+        self._report_masked_requests()
         if len(filtered):
             self._batch_state_cache[filtered.batch_id] = filtered
             return filtered.batch_id
 
         return None
 
+    def _filter(
+        self, batch_state: "CausalLMBatch", request_ids: List[int]
+    ) -> "CausalLMBatch":
+        # TGI expects sorted request_ids
+        request_ids = sorted(request_ids)
+        description = _print_batch(batch_state)
+        num_rows = len(batch_state)
+        filtered = batch_state.filter(request_ids)
+        # TGI filters batches in place, and copies nothing if no request is
+        # filtered out.
+        if self._metrics and len(filtered) < num_rows:
+            self._metrics.batch_filters.inc()
+            self._kv_cache_copied(filtered)
+        logger.debug(f"Filtered batch {description} into {_print_batch(filtered)}")
+        return filtered
+
+    def _compact(
+        self, batch_state: "CausalLMBatch", masked_requests: Set[int]
+    ) -> "CausalLMBatch":
+        """Filter the masked requests out of a batch."""
+        return self._filter(
+            batch_state,
+            [r for r in batch_state.requests_idx_mapping if r not in masked_requests],
+        )
+
+    def _restore_batches(
+        self,
+        batch_states: List["CausalLMBatch"],
+        merged: Optional["CausalLMBatch"],
+        masked_requests: Set[int],
+        snapshot: Optional[_StepSnapshot] = None,
+    ) -> Dict[int, List[int]]:
+        """Put the batches of a failed step back into the cache, or the batch
+        they were merged into, if they are intact.
+
+        Returns the ids of the requests left in each batch put back, masked
+        requests excluded, or nothing if the batches are lost."""
+        if snapshot is not None and not snapshot.restore():
+            return {}
+        if merged is not None and _is_intact(merged):
+            batch_states = [merged]
+        elif not all(_is_intact(batch_state) for batch_state in batch_states):
+            return {}
+        request_ids_by_batch = {}
+        for batch_state in batch_states:
+            request_ids = list(batch_state.requests_idx_mapping)
+            masked = masked_requests.intersection(request_ids)
+            if masked:
+                self._masked_requests[batch_state.batch_id] = masked
+            self._batch_state_cache[batch_state.batch_id] = batch_state
+            request_ids_by_batch[batch_state.batch_id] = [
+                request_id for request_id in request_ids if request_id not in masked
+            ]
+        self._report_masked_requests()
+        return request_ids_by_batch
+
+    def _cache_prefixes(
+        self, batch_state: Optional["CausalLMBatch"], prefix_reuse: PrefixReuse
+    ):
+        """Cache the prompts of a batch just prefilled, and count what its
+        prefill reused."""
+        if self._metrics:
+            num_rows = len(prefix_reuse.prompts)
+            self._metrics.inc(self._metrics.prefix_cache_lookups, num_rows)
+            if prefix_reuse.prefix_length:
+                self._metrics.inc(self._metrics.prefix_cache_hits, num_rows)
+                self._metrics.inc(
+                    self._metrics.prefix_cache_saved_tokens,
+                    prefix_reuse.prefix_length * num_rows,
+                )
+        # A batch whose requests all finished in the prefill has no KV cache.
+        if batch_state is not None:
+            try:
+                self._prefix_cache.update(batch_state, prefix_reuse)
+            except Exception as e:
+                # The prompts are only copied into the cache, the batch is
+                # fine. The cache may be half updated though.
+                logger.warning(f"Failed to cache the prompts of a batch: {repr(e)}")
+                self._prefix_cache_stale = True
+        if self._metrics:
+            self._metrics.prefix_cache_bytes.set(self._prefix_cache.tree.num_bytes)
+
+    def _kv_cache_copied(self, batch: "CausalLMBatch"):
+        """Count the KV cache of a batch built by a filter or concatenation."""
+        self._metrics.inc(self._metrics.kv_cache_bytes_copied, _kv_cache_bytes(batch))
+
+    def _report_masked_requests(self):
+        if self._metrics:
+            self._metrics.masked_requests.set(
+                sum(len(masked) for masked in self._masked_requests.values())
+            )
+
     def warmup(
         self, requests: List["GenerationRequest"], batch_id: int, max_total_tokens: int
     ) -> Optional[int]:
@@ -316,6 +986,45 @@ class InferenceWorker(AbstractInferenceWorker):
         self._model.warmup(batch_state, max_total_tokens)
         return True
 
+    def get_kv_cache_layout(self) -> KVCacheLayout:
+        try:
+            from text_generation_server.models import flash_causal_lm
+        except ImportError:
+            # Flash attention isn't installed, so no model is paged.
+            flash_causal_lm = None
+        if flash_causal_lm is None or not isinstance(
+            self._model, flash_causal_lm.FlashCausalLM
+        ):
+            return KVCacheLayout(
+                masked_fraction=self._max_masked_fraction,
+                reserved_tokens=self._prefix_cache_tokens(),
+                speculative_tokens=self._speculative_tokens,
+            )
+        return KVCacheLayout(
+            kind="paged",
+            block_size=getattr(flash_causal_lm, "BLOCK_SIZE", 16),
+            sliding_window=getattr(self._model, "sliding_window", None),
+        )
+
+    def _prefix_cache_tokens(self) -> int:
+        """Tokens of KV cache the prefix cache can hold, on this shard."""
+        if not self._prefix_cache:
+            return 0
+        config = self._model.model.config
+        num_kv_heads = (
+            getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        )
+        num_bytes = (
+            2
+            * config.num_hidden_layers
+            * config.hidden_size
+            * num_kv_heads
+            // config.num_attention_heads
+            // getattr(self._model, "world_size", 1)
+            * (torch.finfo(self._model.model.dtype).bits // 8)
+        )
+        return math.ceil(self._prefix_cache.tree.max_bytes / num_bytes)
+
     def check_cuda_objects(self):
         from collections import defaultdict
 
@@ -349,6 +1058,18 @@ class InferenceWorker(AbstractInferenceWorker):
 
     def report_stats(self):
         # print(f"worker stats: {[(id, cache.stats()) for id, cache in self._batch_state_cache.items()]}")
+        if self._prefix_cache:
+            prefix_cache = self._prefix_cache
+            logger.info(
+                f"prefix cache: {prefix_cache.tree.num_bytes / 2 ** 30} GiB, "
+                f"hit rate {prefix_cache.num_hits / max(prefix_cache.num_lookups, 1)}, "
+                f"saved {prefix_cache.num_saved_tokens} prefill tokens"
+            )
+        if self._speculative_tokens:
+            logger.info(
+                f"speculation: {self._num_accepted_tokens} of "
+                f"{self._num_draft_tokens} draft tokens accepted"
+            )
         if self._model.device.type == "cuda":
             # gc.collect()
             logger.info(
@@ -371,6 +1092,8 @@ class TGIInferenceWorker(InferenceWorker):
         quantize: Optional[str] = None,
         dtype: Optional[str] = None,
         trust_remote_code: bool = False,
+        prefix_cache_max_bytes: int = 0,
+        speculative_tokens: int = 0,
     ):
         from text_generation_server.cli import download_weights
         from text_generation_server.models import get_model
@@ -408,7 +1131,7 @@ class TGIInferenceWorker(InferenceWorker):
             hf_hub_download,
         ):
             super().__init__(
-                lambda: get_model(
+                model_loader=lambda: get_model(
                     model_id=model_id,
                     revision=revision,
                     sharded=int(os.getenv("WORLD_SIZE", "1")) > 1
@@ -417,5 +1140,8 @@ class TGIInferenceWorker(InferenceWorker):
                     quantize=quantize,
                     dtype=dtype,
                     trust_remote_code=trust_remote_code,
-                )
+                ),
+                metrics=WorkerMetrics(model_id, rank=int(os.getenv("RANK", "0"))),
+                prefix_cache_max_bytes=prefix_cache_max_bytes,
+                speculative_tokens=speculative_tokens,
             )
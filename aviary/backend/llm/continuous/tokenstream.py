@@ -1,32 +1,149 @@
 import asyncio
+import time
+from typing import AsyncIterator, List, Optional, Tuple
+
+
+class SlowReaderError(Exception):
+    """Raised to the reader of a stream that fell too far behind."""
 
 
 class TokenStream:
-    """A stream of tokens that can be iterated over asynchronously."""
+    """A stream of tokens that can be iterated over asynchronously.
+
+    Tokens are buffered, and the reader is only woken up once
+    chunk_tokens tokens are buffered or chunk_interval_s has passed since
+    the last chunk was read, so that it reads several tokens at once when
+    the tokens come in faster than that. The first token is always
+    delivered right away, and the rest of the buffer once the stream ends.
+
+    The buffer is the tail of the generated text. Every token text is kept
+    for generated_text anyway, so max_pending_tokens doesn't bound the
+    memory of a stream: it fails a reader that fell more than that many
+    tokens behind with a SlowReaderError, and overflowed() then tells the
+    writer to stop generating for it.
 
-    def __init__(self, id: int):
+    Args:
+        id (int): Id of the request.
+        chunk_tokens (int): Wake up the reader once this many tokens are
+            buffered.
+        chunk_interval_s (float): Wake up the reader if this much time has
+            passed since the last chunk was read.
+        max_pending_tokens (Optional[int]): Fail the stream once more than
+            this many tokens are unread. Never if None.
+    """
+
+    def __init__(
+        self,
+        id: int,
+        chunk_tokens: int = 1,
+        chunk_interval_s: float = 0,
+        max_pending_tokens: Optional[int] = None,
+    ):
         self.id = id
         self.num_input_tokens = None
-        self._queue = asyncio.Queue()
+        self.chunk_tokens = chunk_tokens
+        self.chunk_interval_s = chunk_interval_s
+        self.max_pending_tokens = max_pending_tokens
+        self._event = asyncio.Event()
+        # Index in _token_texts of the first unread token text.
+        self._read_index = 0
+        self._num_pending_tokens = 0
+        self._num_tokens_read = 0
+        self._last_read_time = 0.0
+        self._ended = False
+        self._overflowed = False
         self._num_tokens = 0
         self._generated_text = None
+        self._error: Optional[Exception] = None
+        self._token_texts: List[str] = []
 
     def end(self, generated_text=None):
         self._generated_text = generated_text
-        self._queue.put_nowait(StopIteration)
+        self._ended = True
+        self._event.set()
+
+    def fail(self, error: Exception):
+        """End the stream with an error, raised to the reader once it read
+        the tokens put so far."""
+        self._error = error
+        self.end()
+
+    def put(self, item, num_tokens: int = 1):
+        """Put the text of num_tokens tokens into the stream."""
+        if self._overflowed:
+            return
+        self._token_texts.append(item)
+        self._num_pending_tokens += num_tokens
+        self._num_tokens += num_tokens
+        if (
+            self.max_pending_tokens is not None
+            and self._num_pending_tokens > self.max_pending_tokens
+        ):
+            self._overflowed = True
+            self.fail(
+                SlowReaderError(
+                    f"Stream {self.id} has more than {self.max_pending_tokens} "
+                    "unread tokens"
+                )
+            )
+        elif self._is_chunk_ready():
+            self._event.set()
 
-    def put(self, item):
-        self._queue.put_nowait(item)
-        self._num_tokens += 1
+    def overflowed(self) -> bool:
+        """Whether the stream was failed because the reader fell behind."""
+        return self._overflowed
 
     def num_tokens(self):
         return self._num_tokens
 
+    def generated_text(self) -> str:
+        """Text of all the tokens put into the stream so far."""
+        return "".join(self._token_texts)
+
+    def _time_to_chunk_s(self) -> float:
+        """Time until the buffered tokens are due, 0 if they are already."""
+        if self._num_tokens_read == 0 or self._num_pending_tokens >= self.chunk_tokens:
+            return 0.0
+        return max(0.0, self._last_read_time + self.chunk_interval_s - time.monotonic())
+
+    def _is_chunk_ready(self) -> bool:
+        return bool(self._num_pending_tokens) and self._time_to_chunk_s() == 0
+
+    async def _next_chunk(self) -> Tuple[str, int]:
+        while not (self._ended or self._is_chunk_ready()):
+            self._event.clear()
+            if not self._num_pending_tokens:
+                await self._event.wait()
+                continue
+            # Flush a partial chunk once the interval passed, even if no
+            # other token comes in until then.
+            try:
+                await asyncio.wait_for(self._event.wait(), self._time_to_chunk_s())
+            except asyncio.TimeoutError:
+                pass
+        if not self._num_pending_tokens:
+            if self._error is not None:
+                raise self._error
+            raise StopAsyncIteration
+        text = "".join(self._token_texts[self._read_index :])
+        num_tokens = self._num_pending_tokens
+        self._read_index = len(self._token_texts)
+        self._num_pending_tokens = 0
+        self._num_tokens_read += num_tokens
+        self._last_read_time = time.monotonic()
+        return text, num_tokens
+
+    async def chunks(self) -> AsyncIterator[Tuple[str, int]]:
+        """Iterate over the chunks of text, with their number of tokens."""
+        while True:
+            try:
+                yield await self._next_chunk()
+            except StopAsyncIteration:
+                return
+
     def __aiter__(self):
         return self
 
-    async def __anext__(self):
-        result = await self._queue.get()
-        if result == StopIteration:
-            raise StopAsyncIteration
-        return result
+    async def __anext__(self) -> str:
+        text, _ = await self._next_chunk()
+        return text
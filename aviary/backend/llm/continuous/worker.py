@@ -1,6 +1,9 @@
 from abc import ABC, abstractmethod
-from typing import TYPE_CHECKING, List, Optional, Tuple
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
 
+import torch
+
+from .kv_cache import KVCacheLayout
 from .types import Request as GenerationRequest
 
 if TYPE_CHECKING:
@@ -9,6 +12,56 @@ if TYPE_CHECKING:
     )
 
 
+def _split_finished(generations: List["Generation"]) -> Tuple[Set[int], List[int]]:
+    """The ids of the requests of a step that finished, and of the others.
+    A speculative step has several generations for some requests."""
+    finished_ids = {g.request_id for g in generations if g.generated_text is not None}
+    unfinished_ids = list(
+        dict.fromkeys(
+            g.request_id for g in generations if g.request_id not in finished_ids
+        )
+    )
+    return finished_ids, unfinished_ids
+
+
+def is_oom(error: Exception) -> bool:
+    """Whether a step failed because it ran out of memory."""
+    return isinstance(error, torch.cuda.OutOfMemoryError) or (
+        "out of memory" in str(error).lower()
+    )
+
+
+class StepFailedError(Exception):
+    """Raised by an inference worker when a step failed, but left the
+    batches it was given as they were before the step, so that the
+    scheduler can take requests out of them and go on.
+
+    A failed prefill leaves nothing behind, so request_ids_by_batch is
+    empty.
+
+    Args:
+        message (str): Description of the original error.
+        oom (bool): Whether the step ran out of memory, rather than failed
+            because of one of its requests.
+        request_ids_by_batch (Dict[int, List[int]]): Ids of the requests of
+            each batch kept by the worker, in the order the batches were
+            given. The batches may have been merged into one.
+    """
+
+    def __init__(
+        self,
+        message: str,
+        oom: bool = False,
+        request_ids_by_batch: Optional[Dict[int, List[int]]] = None,
+    ):
+        super().__init__(message, oom, request_ids_by_batch)
+        self.oom = oom
+        self.request_ids_by_batch = request_ids_by_batch or {}
+
+    def __str__(self) -> str:
+        return self.args[0]
+
+
 class AbstractInferenceWorker(ABC):
     @abstractmethod
     def process_new_batch(
@@ -23,12 +76,86 @@ class AbstractInferenceWorker(ABC):
         pass
 
     @abstractmethod
-    def filter_requests(self, batch_id: int, request_ids: List[int]) -> Optional[int]:
+    def filter_requests(
+        self, batch_id: int, request_ids: List[int], compact: bool = False
+    ) -> Optional[int]:
+        """Keep only the given requests in a batch.
+
+        Args:
+            compact (bool): Free the memory of the requests filtered out
+                right away, even if the worker would only mask them out.
+        """
         pass
 
+    def generate_next_tokens(
+        self, batch_ids: List[int], max_steps: int
+    ) -> Tuple[Optional[List[List["Generation"]]], Optional[int]]:
+        """Run up to max_steps decode steps on the batches.
+
+        Stops early after a step in which a request finished, and filters the
+        finished requests out of the batch before returning.
+
+        Returns:
+            The generations of each step (None on OOM) and the id of the
+            batch, or None if all its requests finished.
+
+        Raises:
+            StepFailedError: If the first step failed. A later step that
+                fails ends the call early instead, it fails again on the
+                next call.
+        """
+        steps = []
+        for _ in range(max_steps):
+            try:
+                generations, batch_id = self.generate_next_token(batch_ids)
+            except StepFailedError:
+                if not steps:
+                    raise
+                return steps, batch_ids[0]
+            if generations is None:
+                return None, batch_id
+            steps.append(generations)
+            if batch_id is None:
+                break
+            batch_ids = [batch_id]
+            finished_ids, unfinished_ids = _split_finished(generations)
+            if finished_ids:
+                batch_id = self.filter_requests(batch_id, unfinished_ids)
+                break
+        return steps, batch_id
+
+    def prefill_chunk(
+        self,
+        requests: Optional[List["GenerationRequest"]],
+        batch_id: int,
+        max_tokens: int,
+    ) -> int:
+        """Prefill part of the prompts of a new batch, without generating.
+
+        The batch is created from requests on the first call, and requests
+        are None on the next ones. Each call prefills a chunk of up to
+        max_tokens tokens, leaving at least one token of every prompt, and
+        process_new_batch then prefills the rest of the batch and generates
+        its first tokens. The default implementation prefills nothing.
+
+        Returns:
+            The number of prompt tokens left to prefill, or 0 if the call
+            prefilled nothing, in which case process_new_batch has to be
+            called next.
+
+        Raises:
+            StepFailedError: If the chunk failed. The batch is dropped.
+        """
+        return 0
+
     def report_stats(self):  # noqa: B027
         pass
 
+    def get_kv_cache_layout(self) -> KVCacheLayout:
+        """How the worker lays out the KV cache of a batch, so that the
+        scheduler counts the tokens of a batch the same way."""
+        return KVCacheLayout()
+
 
 class AsyncInferenceWorker(AbstractInferenceWorker):
     @abstractmethod
@@ -45,6 +172,37 @@ class AsyncInferenceWorker(AbstractInferenceWorker):
 
     @abstractmethod
     async def filter_requests_async(
-        self, batch_id: int, request_ids: List[int]
+        self, batch_id: int, request_ids: List[int], compact: bool = False
     ) -> Optional[int]:
         pass
+
+    async def prefill_chunk_async(
+        self,
+        requests: Optional[List["GenerationRequest"]],
+        batch_id: int,
+        max_tokens: int,
+    ) -> int:
+        return self.prefill_chunk(requests, batch_id, max_tokens)
+
+    async def generate_next_tokens_async(
+        self, batch_ids: List[int], max_steps: int
+    ) -> Tuple[Optional[List[List["Generation"]]], Optional[int]]:
+        steps = []
+        for _ in range(max_steps):
+            try:
+                generations, batch_id = await self.generate_next_token_async(batch_ids)
+            except StepFailedError:
+                if not steps:
+                    raise
+                return steps, batch_ids[0]
+            if generations is None:
+                return None, batch_id
+            steps.append(generations)
+            if batch_id is None:
+                break
+            batch_ids = [batch_id]
+            finished_ids, unfinished_ids = _split_finished(generations)
+            if finished_ids:
+                batch_id = await self.filter_requests_async(batch_id, unfinished_ids)
+                break
+        return steps, batch_id
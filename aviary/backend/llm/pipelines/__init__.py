@@ -1,6 +1,7 @@
 from typing import Type
 
 from ._base import BasePipeline
+from .continuous_transformers import ContinuousTransformersPipeline
 from .llamacpp import LlamaCppPipeline
 from .tgi import TextGenerationInferencePipeline
 from .transformers import TransformersPipeline
@@ -20,4 +21,5 @@ __all__ = [
     "TransformersPipeline",
     "LlamaCppPipeline",
     "TextGenerationInferencePipeline",
+    "ContinuousTransformersPipeline",
 ]
@@ -0,0 +1,104 @@
+import os
+from abc import abstractmethod
+from typing import Any, List, Optional, Sequence, Tuple, Union
+
+import torch
+
+from aviary.backend.llm.continuous.generations import GenerationColumns
+from aviary.backend.llm.continuous.scheduler import Request
+from aviary.backend.server.models import Prompt, Response
+
+from ._base import AsyncStreamingPipeline
+
+
+class ContinuousBatchingPipeline(AsyncStreamingPipeline):
+    """Base of the pipelines driven by a continuous batching scheduler.
+
+    The model is an inference worker, which the pipeline passes the
+    requests of the scheduler to, once parsed by _parse_requests. The
+    generations are returned as GenerationColumns, and only by rank 0. The
+    other ranks compute the same ones, they return None instead.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        prompt_format: Union[str, None] = None,
+        device: Union[str, int, torch.device, None] = None,
+    ) -> None:
+        if tokenizer.pad_token_id is None:
+            if tokenizer.eos_token_id is not None:
+                tokenizer.pad_token_id = tokenizer.eos_token_id
+            else:
+                tokenizer.add_special_tokens({"pad_token": "[PAD]"})
+
+        super().__init__(model, tokenizer, prompt_format, device)
+        self._rank = int(os.getenv("RANK", "0"))
+
+    def get_input_length(self, input_text: str, max_length: int) -> int:
+        return self.tokenizer(
+            text=input_text,
+            return_tensors="np",
+            padding=True,
+            return_token_type_ids=False,
+            truncation=True,
+            max_length=max_length,
+        )["input_ids"].shape[1]
+
+    # TODO Fix this
+    def __call__(self, inputs: List[str | Prompt], **kwargs) -> List[Response]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _parse_requests(
+        self, requests: List["Request"], *, verbose: bool = True
+    ) -> List[Any]:
+        """Turn the requests of the scheduler into those of the model."""
+        raise NotImplementedError
+
+    def _encode(
+        self, generations: Optional[Sequence[Any]]
+    ) -> Optional[GenerationColumns]:
+        if generations is None or self._rank != 0:
+            return None
+        return GenerationColumns.from_generations(generations)
+
+    def process_new_batch(
+        self, requests: List["Request"], batch_id: int
+    ) -> Tuple[Optional[GenerationColumns], int]:
+        parsed_requests = self._parse_requests(requests)
+        generations, id = self.model.process_new_batch(parsed_requests, batch_id)
+        return self._encode(generations), id
+
+    def generate_next_token(
+        self, batch_ids: List[int]
+    ) -> Tuple[Optional[GenerationColumns], Optional[int]]:
+        generations, id = self.model.generate_next_token(batch_ids)
+        return self._encode(generations), id
+
+    def generate_next_tokens(
+        self, batch_ids: List[int], max_steps: int
+    ) -> Tuple[Optional[List[Optional[GenerationColumns]]], Optional[int]]:
+        steps, id = self.model.generate_next_tokens(batch_ids, max_steps)
+        if steps is None:
+            return None, id
+        return [self._encode(generations) for generations in steps], id
+
+    def prefill_chunk(
+        self, requests: Optional[List["Request"]], batch_id: int, max_tokens: int
+    ) -> int:
+        if requests is not None:
+            requests = self._parse_requests(requests)
+        return self.model.prefill_chunk(requests, batch_id, max_tokens)
+
+    def filter_requests(
+        self, batch_id: int, request_ids: List[int], compact: bool = False
+    ) -> Optional[int]:
+        return self.model.filter_requests(batch_id, request_ids, compact)
+
+    def warmup(
+        self, requests: List["Request"], batch_id: int, max_total_tokens: int
+    ) -> Optional[int]:
+        parsed_requests = self._parse_requests(requests, verbose=False)
+        return self.model.warmup(parsed_requests, batch_id, max_total_tokens)
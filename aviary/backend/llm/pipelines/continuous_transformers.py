@@ -0,0 +1,89 @@
+import os
+from typing import TYPE_CHECKING, List, Optional, Union
+
+import torch
+
+from aviary.backend.llm.continuous.hf_transformers.transformers_worker import (
+    TransformersInferenceWorker,
+    TransformersRequest,
+)
+from aviary.backend.llm.continuous.metrics import WorkerMetrics
+from aviary.backend.llm.continuous.scheduler import Request
+from aviary.backend.logger import get_logger
+
+from .continuous import ContinuousBatchingPipeline
+from .utils import decode_stopping_sequences_where_needed
+
+if TYPE_CHECKING:
+    from ..initializers._base import LLMInitializer
+
+logger = get_logger(__name__)
+
+
+class ContinuousTransformersPipeline(ContinuousBatchingPipeline):
+    """Text generation pipeline using Continuous Batching, on a Hugging Face
+    model run by a TransformersInferenceWorker. Unlike
+    TextGenerationInferencePipeline, it doesn't need TGI, and runs on CPU.
+
+    The sampling parameters of the requests are those of
+    TextGenerationInferencePipeline, with the same defaults. The watermark
+    isn't supported.
+
+    With a kv_cache_block_size, the worker pages the KV cache, see
+    TransformersInferenceWorker.
+    """
+
+    @classmethod
+    def from_initializer(
+        cls,
+        initializer: "LLMInitializer",
+        model_id: str,
+        prompt_format: Optional[str] = None,
+        device: Optional[Union[str, int, torch.device]] = None,
+        kv_cache_block_size: int = 0,
+        **kwargs,
+    ) -> "ContinuousTransformersPipeline":
+        model, tokenizer = initializer.load(model_id)
+        logger.info(f"Model: {model}")
+        worker = TransformersInferenceWorker(
+            model,
+            tokenizer,
+            metrics=WorkerMetrics(model_id, rank=int(os.getenv("RANK", "0"))),
+            kv_cache_block_size=kv_cache_block_size,
+        )
+        return cls(
+            worker,
+            tokenizer,
+            prompt_format=prompt_format,
+            device=device,
+            **kwargs,
+        )
+
+    def _parse_requests(
+        self, requests: List["Request"], *, verbose: bool = True
+    ) -> List[TransformersRequest]:
+        parsed_requests = []
+        for r in requests:
+            params = r.params
+            parsed_request = TransformersRequest(
+                id=r.id,
+                inputs=r.inputs,
+                truncate=r.truncate,
+                max_new_tokens=r.max_new_tokens,
+                temperature=params.get("temperature", 1.0),
+                repetition_penalty=params.get("repetition_penalty", 1.1),
+                top_k=params.get("top_k", 0),
+                top_p=params.get("top_p", 1.0),
+                typical_p=params.get("typical_p", 1.0),
+                do_sample=params.get("do_sample", False),
+                seed=params.get("seed", r.id),
+                stop_sequences=decode_stopping_sequences_where_needed(
+                    self.tokenizer, params.get("stopping_sequences", [])
+                )
+                or [],
+                ignore_eos_token=params.get("ignore_eos_token", False),
+            )
+            if verbose:
+                logger.info(f"Parsed request {parsed_request}")
+            parsed_requests.append(parsed_request)
+        return parsed_requests
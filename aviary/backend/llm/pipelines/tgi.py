@@ -1,16 +1,12 @@
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Any, Dict, List, Union
 
 import torch
 
 from aviary.backend.llm.continuous.scheduler import Request
 from aviary.backend.logger import get_logger
-from aviary.backend.server.models import Prompt, Response
 
-from ._base import AsyncStreamingPipeline
-from .utils import (
-    decode_stopping_sequences_where_needed,
-    pythonize_tensors,
-)
+from .continuous import ContinuousBatchingPipeline
+from .utils import decode_stopping_sequences_where_needed
 
 try:
     from text_generation_server.pb.generate_pb2 import (
@@ -28,15 +24,11 @@ except ImportError as e:
 logger = get_logger(__name__)
 
 if TYPE_CHECKING:
-    from text_generation_server.models.types import (
-        Generation,
-    )
-
     from aviary.backend.llm.continuous.tgi.tgi_worker import TGIInferenceWorker
 
 
-class TextGenerationInferencePipeline(AsyncStreamingPipeline):
-    """Text generation pipeline using Continuous Batching."""
+class TextGenerationInferencePipeline(ContinuousBatchingPipeline):
+    """Text generation pipeline using Continuous Batching, on a TGI model."""
 
     def __init__(
         self,
@@ -53,24 +45,8 @@ class TextGenerationInferencePipeline(AsyncStreamingPipeline):
         # TODO don't use private APIs here
         tokenizer = model._model.tokenizer
 
-        if tokenizer.pad_token_id is None:
-            if tokenizer.eos_token_id is not None:
-                tokenizer.pad_token_id = tokenizer.eos_token_id
-            else:
-                tokenizer.add_special_tokens({"pad_token": "[PAD]"})
-
         super().__init__(model, tokenizer, prompt_format, device)
 
-    def get_input_length(self, input_text: str, max_length: int) -> int:
-        return self.tokenizer(
-            text=input_text,
-            return_tensors="np",
-            padding=True,
-            return_token_type_ids=False,
-            truncation=True,
-            max_length=max_length,
-        )["input_ids"].shape[1]
-
     def _parse_sampling_args(
         self, generate_kwargs: Dict[str, Any], model_inputs=None
     ) -> Dict[str, Any]:
@@ -108,10 +84,6 @@ class TextGenerationInferencePipeline(AsyncStreamingPipeline):
 
         return parameters, stopping_parameters
 
-    # TODO Fix this
-    def __call__(self, inputs: List[str | Prompt], **kwargs) -> List[Response]:
-        raise NotImplementedError
-
     def _parse_requests(
         self, requests: List["Request"], *, verbose: bool = True
     ) -> List["GenerationRequest"]:
@@ -135,29 +107,3 @@ class TextGenerationInferencePipeline(AsyncStreamingPipeline):
             )
             parsed_requests.append(parsed_request)
         return parsed_requests
-
-    def process_new_batch(
-        self, requests: List["Request"], batch_id: int
-    ) -> Tuple[List["Generation"], int]:
-        parsed_requests = self._parse_requests(requests)
-        generations, id = self.model.process_new_batch(parsed_requests, batch_id)
-        if generations:
-            generations = [pythonize_tensors(g) for g in generations]
-        return generations, id
-
-    def generate_next_token(
-        self, batch_ids: List[int]
-    ) -> Tuple[List["Generation"], Optional[int]]:
-        generations, id = self.model.generate_next_token(batch_ids)
-        if generations:
-            generations = [pythonize_tensors(g) for g in generations]
-        return generations, id
-
-    def filter_requests(self, batch_id: int, request_ids: List[int]) -> Optional[int]:
-        return self.model.filter_requests(batch_id, request_ids)
-
-    def warmup(
-        self, requests: List["Request"], batch_id: int, max_total_tokens: int
-    ) -> Optional[int]:
-        parsed_requests = self._parse_requests(requests, verbose=False)
-        return self.model.warmup(parsed_requests, batch_id, max_total_tokens)
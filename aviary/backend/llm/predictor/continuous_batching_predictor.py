@@ -2,7 +2,7 @@ import asyncio
 import gc
 import time
 import traceback
-from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Type
 
 import ray
 import ray.exceptions
@@ -11,10 +11,31 @@ import torch
 import torch.distributed
 from ray.air import ScalingConfig
 
-from aviary.backend.llm.continuous.policy import QuotaBasedRequestSelectionPolicy
+from aviary.backend.llm.continuous.estimator import OutputLengthEstimator
+from aviary.backend.llm.continuous.generations import GenerationColumns
+from aviary.backend.llm.continuous.kv_cache import KVCacheLayout
+from aviary.backend.llm.continuous.metrics import SchedulerMetrics
+from aviary.backend.llm.continuous.policy import (
+    FairShareRequestSelectionPolicy,
+    QuotaBasedRequestSelectionPolicy,
+)
+from aviary.backend.llm.continuous.queue import PriorityRequestQueue
+from aviary.backend.llm.continuous.ray_worker import (
+    LocalInferenceWorker,
+    RayInferenceWorker,
+)
+from aviary.backend.llm.continuous.resident import (
+    ResidentScheduler,
+    ResidentSchedulerClient,
+    SchedulerUpdate,
+    ThreadTokenizer,
+)
 from aviary.backend.llm.continuous.scheduler import (
     AsyncInferenceScheduler,
+    PipelinedAsyncInferenceScheduler,
     RayTokenizer,
+    RayTokenizerPool,
+    Request,
 )
 from aviary.backend.llm.pipelines.utils import (
     construct_prompts,
@@ -23,28 +44,19 @@ from aviary.backend.llm.utils import (
     _init_torch_distributed_env_vars_only,
     init_torch_dist_process_group_async,
 )
+from aviary.backend.server.batch import QueuePriority
 from aviary.backend.server.models import ContinuousBatchingModel, Prompt, Response
 
 from ..utils import get_logger
 from .predictor import LLMPredictor, PredictionWorker
 
-try:
-    from aviary.backend.llm.continuous.tgi.tgi_worker import TGIRayInferenceWorker
-except ImportError as e:
-    TGIRayInferenceWorker = e
-
-if TYPE_CHECKING:
-    from text_generation_server.models.types import (
-        Generation,
-    )
-    from text_generation_server.pb.generate_pb2 import Request as GenerationRequest
-
-from aviary.backend.llm.continuous.scheduler import Request
-
 logger = get_logger(__name__)
 
 
 class ContinuousBatchingPredictionWorker(PredictionWorker):
+    # The replica talks to a resident scheduler while it runs steps.
+    concurrency_groups = {"scheduler": 4}
+
     def warmup(self):
         max_batch_prefill_tokens = self.llm_config.generation.max_batch_prefill_tokens
         max_input_length = self.llm_config.generation.max_input_length
@@ -83,40 +95,109 @@ class ContinuousBatchingPredictionWorker(PredictionWorker):
         return ret
 
     def process_new_batch(
-        self, requests: List["GenerationRequest"], batch_id: int
-    ) -> Tuple[List["Generation"], int]:
+        self, requests: List["Request"], batch_id: int
+    ) -> Tuple[Optional[GenerationColumns], int]:
         if self.current_device:
             torch.cuda.set_device(self.current_device)
         return self.generator.process_new_batch(requests, batch_id)
 
     def generate_next_token(
         self, batch_ids: List[int]
-    ) -> Tuple[List["Generation"], Optional[int]]:
+    ) -> Tuple[Optional[GenerationColumns], Optional[int]]:
         if self.current_device:
             torch.cuda.set_device(self.current_device)
         return self.generator.generate_next_token(batch_ids)
 
-    def filter_requests(self, batch_id: int, request_ids: List[int]) -> Optional[int]:
+    def filter_requests(
+        self, batch_id: int, request_ids: List[int], compact: bool = False
+    ) -> Optional[int]:
         if self.current_device:
             torch.cuda.set_device(self.current_device)
-        return self.generator.filter_requests(batch_id, request_ids)
+        return self.generator.filter_requests(batch_id, request_ids, compact)
+
+    def generate_next_tokens(
+        self, batch_ids: List[int], max_steps: int
+    ) -> Tuple[Optional[List[Optional[GenerationColumns]]], Optional[int]]:
+        if self.current_device:
+            torch.cuda.set_device(self.current_device)
+        return self.generator.generate_next_tokens(batch_ids, max_steps)
+
+    def prefill_chunk(
+        self, requests: Optional[List["Request"]], batch_id: int, max_tokens: int
+    ) -> int:
+        if self.current_device:
+            torch.cuda.set_device(self.current_device)
+        return self.generator.prefill_chunk(requests, batch_id, max_tokens)
 
     def get_input_length(self, input_text: str, max_length: int) -> int:
         if self.current_device:
             torch.cuda.set_device(self.current_device)
         return self.generator.get_input_length(input_text, max_length)
 
+    def get_tokenizer(self):
+        return self.generator.tokenizer
+
+    def get_kv_cache_layout(self) -> KVCacheLayout:
+        return self.generator.model.get_kv_cache_layout()
+
+    def start_scheduler(
+        self,
+        worker_group: List[ray.ObjectRef],
+        scheduler_cls: Type[AsyncInferenceScheduler],
+        num_tokenizer_workers: int = 0,
+        **scheduler_kwargs,
+    ):
+        """Run the scheduler in this worker, see worker_resident_scheduling.
+
+        Args:
+            worker_group (List[ray.ObjectRef]): The other ranks.
+            scheduler_cls (Type[AsyncInferenceScheduler]): Scheduler to run.
+            num_tokenizer_workers (int): Number of tokenizer actors. If 0,
+                prompts are tokenized in a thread of this worker.
+            **scheduler_kwargs: Passed to the scheduler.
+        """
+        if num_tokenizer_workers > 0:
+            tokenizer = RayTokenizerPool(
+                ray.put(self.get_tokenizer()), num_workers=num_tokenizer_workers
+            )
+        else:
+            tokenizer = ThreadTokenizer(self.generator.get_input_length)
+        self.resident_scheduler = ResidentScheduler(
+            scheduler_cls,
+            tokenizer=tokenizer,
+            inference_worker_loader=lambda: LocalInferenceWorker(
+                local_worker=self, worker_group=worker_group
+            ),
+            metrics=SchedulerMetrics(self.llm_config.model_id),
+            **scheduler_kwargs,
+        )
+
+    @ray.method(concurrency_group="scheduler")
+    def submit_request(self, *args, **kwargs) -> int:
+        return self.resident_scheduler.submit_request(*args, **kwargs)
+
+    @ray.method(concurrency_group="scheduler")
+    def cancel_request(self, request_id: int):
+        self.resident_scheduler.cancel_request(request_id)
+
+    @ray.method(concurrency_group="scheduler")
+    def request_shed(self):
+        self.resident_scheduler.request_shed()
+
+    @ray.method(concurrency_group="scheduler")
+    def pull(self, timeout_s: float, priorities: List[int]) -> SchedulerUpdate:
+        return self.resident_scheduler.pull(timeout_s, priorities)
+
+    @ray.method(concurrency_group="scheduler")
+    def estimate_queue_wait_s(self, priorities: List[int]) -> Dict[int, float]:
+        return self.resident_scheduler.estimate_queue_wait_s(priorities)
+
 
-# TODO make this non-TGI specific
 class ContinuousBatchingPredictor(LLMPredictor):
     def __init__(
         self,
         model_config: Optional[ContinuousBatchingModel],
     ) -> None:
-        if isinstance(TGIRayInferenceWorker, Exception):
-            raise RuntimeError(
-                "ContinuousBatchingPredictor requires text-generation-inference to be installed."
-            ) from TGIRayInferenceWorker
         super().__init__(model_config=model_config)
         self.scheduler = None
 
@@ -254,32 +335,112 @@ class ContinuousBatchingPredictor(LLMPredictor):
             scaling_config, pg_timeout_s, prediction_worker_cls=prediction_worker_cls
         )
 
-        self.scheduler = AsyncInferenceScheduler(
-            tokenizer=RayTokenizer(worker_group=worker_group),
-            inference_worker_loader=lambda: TGIRayInferenceWorker(
-                worker_group=worker_group
+        kv_cache_layout: KVCacheLayout = await worker_group[
+            0
+        ].get_kv_cache_layout.remote()
+        logger.info(f"KV cache layout of the model: {kv_cache_layout}")
+
+        generation = self.model_config.generation
+        policy_kwargs = dict(
+            max_batch_total_tokens=self.max_batch_total_tokens,
+            max_waiting_tokens=self.max_waiting_tokens,
+            max_batch_prefill_tokens=self.max_batch_prefill_tokens,
+            waiting_served_ratio=self.waiting_served_ratio,
+            selection_mode=generation.selection_mode,
+            selection_lookahead=generation.selection_lookahead,
+            max_queue_wait_s=generation.max_queue_wait_s,
+            budget_calculator=kv_cache_layout.budget_calculator(),
+        )
+        if generation.output_length_quantile is not None:
+            policy_kwargs["output_length_estimator"] = OutputLengthEstimator(
+                quantile=generation.output_length_quantile,
+                window=generation.output_length_window,
+                min_samples=generation.output_length_min_samples,
+            )
+        if generation.fair_share:
+            request_selection_policy = FairShareRequestSelectionPolicy(
+                tenant_weights=generation.tenant_weights,
+                tenant_max_tokens_per_s=generation.tenant_max_tokens_per_s,
+                **policy_kwargs,
+            )
+        else:
+            request_selection_policy = QuotaBasedRequestSelectionPolicy(**policy_kwargs)
+
+        if generation.pipelined_scheduling:
+            scheduler_cls = PipelinedAsyncInferenceScheduler
+        else:
+            scheduler_cls = AsyncInferenceScheduler
+        scheduler_kwargs = dict(
+            request_selection_policy=request_selection_policy,
+            request_queue=PriorityRequestQueue(
+                priority_aging_s=generation.priority_aging_s
             ),
-            request_selection_policy=QuotaBasedRequestSelectionPolicy(
-                max_batch_total_tokens=self.max_batch_total_tokens,
-                max_waiting_tokens=self.max_waiting_tokens,
-                max_batch_prefill_tokens=self.max_batch_prefill_tokens,
-                waiting_served_ratio=self.waiting_served_ratio,
+            max_decode_steps=generation.max_decode_steps,
+            max_step_tokens=generation.max_step_tokens,
+            stream_chunk_tokens=generation.stream_chunk_tokens,
+            stream_chunk_interval_s=generation.stream_chunk_interval_s,
+            max_stream_pending_tokens=generation.max_stream_pending_tokens,
+            prior_tokens_released_per_s=generation.queue_wait_prior_tokens_per_s,
+        )
+        num_tokenizer_workers = self.model_config.initialization.num_tokenizer_workers
+        if generation.worker_resident_scheduling:
+            await worker_group[0].start_scheduler.remote(
+                worker_group[1:],
+                scheduler_cls,
+                num_tokenizer_workers=num_tokenizer_workers,
+                **scheduler_kwargs,
+            )
+            self.scheduler = ResidentSchedulerClient(
+                worker_group[0],
+                stream_chunk_tokens=generation.stream_chunk_tokens,
+                stream_chunk_interval_s=generation.stream_chunk_interval_s,
+                max_stream_pending_tokens=generation.max_stream_pending_tokens,
+            )
+            return worker_group
+
+        if num_tokenizer_workers > 0:
+            tokenizer = RayTokenizerPool(
+                worker_group[0].get_tokenizer.remote(),
+                num_workers=num_tokenizer_workers,
+            )
+        else:
+            tokenizer = RayTokenizer(worker_group=worker_group)
+        self.scheduler = scheduler_cls(
+            tokenizer=tokenizer,
+            inference_worker_loader=lambda: RayInferenceWorker(
+                worker_group=worker_group
             ),
-            request_queue=asyncio.Queue(),
+            metrics=SchedulerMetrics(self.model_config.model_id),
+            **scheduler_kwargs,
         )
 
         return worker_group
 
-    def process_request(
-        self, prompt: str, max_new_tokens: int, sampling_params: Dict[str, Any]
+    def estimate_queue_wait_s(
+        self, priority: QueuePriority = QueuePriority.GENERATE_TEXT
+    ) -> float:
+        return self.scheduler.estimate_queue_wait_s(priority)
+
+    def request_shed(self):
+        self.scheduler.request_shed()
+
+    async def process_request(
+        self,
+        prompt: str,
+        max_new_tokens: int,
+        sampling_params: Dict[str, Any],
+        priority: QueuePriority = QueuePriority.GENERATE_TEXT,
+        tenant: str = "",
     ):
         # TODO improve error message
         assert max_new_tokens + self.max_input_length <= self.max_total_tokens
-        return self.scheduler.process_request(
+        return await self.scheduler.process_request_async(
             prompt,
             sampling_params,
             max_new_tokens=max_new_tokens,
             max_length=self.max_input_length,
+            priority=priority,
+            tenant=tenant,
         )
 
     async def _stream_async(
@@ -288,6 +449,8 @@ class ContinuousBatchingPredictor(LLMPredictor):
         *,
         timeout_s: float = 60,
         start_timestamp: Optional[float] = None,
+        priority: QueuePriority = QueuePriority.GENERATE_TEXT,
+        tenant: str = "",
         **kwargs,
     ) -> Iterator[List[Response]]:
         """Generate text for a list of prompts.
@@ -299,6 +462,10 @@ class ContinuousBatchingPredictor(LLMPredictor):
             start_timestamp (Optional[float], optional): Timestamp of when the
                 batch was created. Defaults to None. If set, will early stop
                 the generation.
+            priority (QueuePriority, optional): Priority of the request in
+                the scheduler queue. Defaults to GENERATE_TEXT.
+            tenant (str, optional): Who sent the request, for fair share
+                scheduling. Defaults to "".
 
         Returns:
             A list of generated texts.
@@ -324,9 +491,11 @@ class ContinuousBatchingPredictor(LLMPredictor):
         )
         max_new_tokens = max(generate_kwargs.get("max_new_tokens", 512), 512)
 
-        result = self.process_request(
+        result = await self.process_request(
             prompt_text,
             max_new_tokens=max_new_tokens,
+            priority=priority,
+            tenant=tenant,
             sampling_params={
                 **generate_kwargs,
                 "use_prompt_format": prompt.use_prompt_format,
@@ -338,14 +507,16 @@ class ContinuousBatchingPredictor(LLMPredictor):
         generated_text = []
         try:
             start_time = time.monotonic()
-            async for text in result:
+            # The tokens come in chunks, so that the Response creation and
+            # serialization costs are paid once per chunk instead of per token.
+            async for text, num_tokens in result.chunks():
                 # TODO maybe make the Scheduler/TokenStream return a Response directly
                 generated_text.append(text)
                 yield [
                     Response(
                         generated_text=text,
-                        num_generated_tokens=1,
-                        num_generated_tokens_batch=1,
+                        num_generated_tokens=num_tokens,
+                        num_generated_tokens_batch=num_tokens,
                         num_input_tokens=result.num_input_tokens,
                         num_input_tokens_batch=result.num_input_tokens,
                         preprocessing_time=0,
@@ -354,7 +525,7 @@ class ContinuousBatchingPredictor(LLMPredictor):
                 ]
                 start_time = time.monotonic()
             yield [StopIteration]
-        except (Exception, asyncio.CancelledError):
+        except (Exception, asyncio.CancelledError, GeneratorExit):
             logger.info(f"Stream cancelled for {request_id}")
             self.scheduler.cancel_request(request_id)
             raise
@@ -2,7 +2,7 @@ import asyncio
 import gc
 import os
 import traceback
-from typing import Iterator, List, Optional, Type
+from typing import Dict, Iterator, List, Optional, Type
 
 import ray
 import ray.util
@@ -73,6 +73,7 @@ def init_model(
         initializer,
         llm_config.actual_hf_model_id,
         prompt_format=llm_config.generation.prompt_format,
+        **llm_config.initialization.get_pipeline_kwargs(),
     )
 
     return pipeline
@@ -89,6 +90,10 @@ class PredictionWorker(TorchDistributedWorker):
         world_size (int): Number of GPUs.
     """
 
+    # Concurrency groups of the actor, for methods that must not wait behind
+    # the others (see ray.method).
+    concurrency_groups: Optional[Dict[str, int]] = None
+
     def __init__(self, llm_config: LLMConfig, world_size: int):
         self.llm_config = llm_config
         self.world_size = world_size
@@ -433,7 +438,13 @@ class LLMPredictor:
             ),
         )
         runtime_env = llm_config.initialization.runtime_env or {}
-        remote_prediction_worker_cls = ray.remote(prediction_worker_cls).options(
+        if prediction_worker_cls.concurrency_groups:
+            actor_cls = ray.remote(
+                concurrency_groups=prediction_worker_cls.concurrency_groups
+            )(prediction_worker_cls)
+        else:
+            actor_cls = ray.remote(prediction_worker_cls)
+        remote_prediction_worker_cls = actor_cls.options(
             **scaling_options, runtime_env=runtime_env
         )
         initialize_node_remote_pg = initialize_node_remote.options(
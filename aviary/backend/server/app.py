@@ -1,4 +1,6 @@
 import asyncio
+import hashlib
+import math
 import traceback
 from abc import ABC, abstractmethod
 from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple, Type, Union
@@ -13,7 +15,10 @@ from starlette.responses import StreamingResponse
 from aviary.backend.llm.predictor import ContinuousBatchingPredictor, LLMPredictor
 from aviary.backend.logger import get_logger
 from aviary.backend.server.batch import QueuePriority, _PriorityBatchQueue
-from aviary.backend.server.exceptions import PromptTooLongError
+from aviary.backend.server.exceptions import (
+    PromptTooLongError,
+    ServerOverloadedError,
+)
 from aviary.backend.server.models import (
     Args,
     DeepSpeed,
@@ -36,6 +41,20 @@ async def _until_disconnected(request: Request):
         await asyncio.sleep(1)
 
 
+def _get_tenant(request: Request, tenant_header: Optional[str] = None) -> str:
+    """Return who sent a request, for fair share scheduling.
+
+    That's the value of tenant_header if it's set, or else a digest of the
+    bearer token, so that the token itself is never logged or kept around.
+    Anonymous requests all share the "" tenant."""
+    if tenant_header and request.headers.get(tenant_header):
+        return request.headers[tenant_header]
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return ""
+    return hashlib.sha256(token.strip().encode()).hexdigest()[:16]
+
+
 @serve.ingress(app)
 class LLMDeployment(ABC):
     _predictor_cls: Type[LLMPredictor] = LLMPredictor
@@ -83,6 +102,11 @@ class LLMDeployment(ABC):
                 "Please make the prompt shorter."
             )
 
+    async def check_admission(self, priority: QueuePriority) -> None:  # noqa: B027
+        """Reject a request before it's queued if it can't be served in
+        time."""
+        pass
+
     @app.get("/metadata")
     async def metadata(self) -> dict:
         return {
@@ -105,6 +129,7 @@ class LLMDeployment(ABC):
         self, prompt: Prompt, request: Request, *, priority: QueuePriority
     ) -> Response:
         await self.validate_prompt(prompt)
+        await self.check_admission(priority)
         with async_timeout.timeout(GATEWAY_TIMEOUT_S):
             responses = []
             async for t in self.generate_text_batch(
@@ -125,6 +150,8 @@ class LLMDeployment(ABC):
         self, prompt: Prompt, request: Request
     ) -> StreamingResponse:
         await self.validate_prompt(prompt)
+        # Before the response starts, so that a rejection gets its own status.
+        await self.check_admission(QueuePriority.GENERATE_TEXT)
 
         async def wrapper():
             """Wrapper to always yield json-formatted strings"""
@@ -213,6 +240,7 @@ class LLMDeployment(ABC):
                 prompts,
                 timeout_s=timeout_s,
                 start_timestamp=start_timestamp,
+                **kwargs,
             ):
                 yield [
                     v if v is not None or self.requests_ids[id] else StopIteration
@@ -428,6 +456,26 @@ class ContinuousBatchingLLMDeployment(LLMDeployment):
 
         return False
 
+    async def check_admission(self, priority: QueuePriority) -> None:
+        """Shed the request if its estimated queue wait is over
+        max_estimated_queue_wait_s.
+
+        Failing fast under overload keeps the batch full of requests that
+        will finish in time, instead of ones whose client gives up."""
+        max_wait_s = self.args.model_config.generation.max_estimated_queue_wait_s
+        if max_wait_s is None or not self.predictor.is_initialized():
+            return
+        wait_s = self.predictor.estimate_queue_wait_s(priority)
+        if wait_s > max_wait_s:
+            self.predictor.request_shed()
+            # The wait is unknown before the throughput is measured.
+            retry_after_s = wait_s - max_wait_s if math.isfinite(wait_s) else max_wait_s
+            raise ServerOverloadedError(
+                f"The estimated queue wait ({wait_s:.1f}s) exceeds "
+                f"{max_wait_s}s. Please try again later.",
+                retry_after_s=retry_after_s,
+            )
+
     async def generate_text_batch(
         self,
         prompt: Prompt,
@@ -456,10 +504,37 @@ class ContinuousBatchingLLMDeployment(LLMDeployment):
             [(prompt, curr_request_id)],
             start_timestamp=start_timestamp,
             timeout_s=timeout_s,
+            tenant=_get_tenant(
+                request, self.args.model_config.generation.tenant_header
+            ),
             **kwargs,
         )
+        # Unlike static batching, nothing needs to consume the rest of the
+        # generator after the client disconnects. Instead, the pending step is
+        # cancelled, which cancels the request in the scheduler so that it
+        # stops occupying a slot in the batch.
+        disconnected = asyncio.ensure_future(_until_disconnected(request))
         try:
-            async for result in async_generator:
+            while True:
+                future = asyncio.ensure_future(async_generator.__anext__())
+                await asyncio.wait(
+                    (future, disconnected), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not future.done():
+                    logger.info(f"Request {curr_request_id} disconnected.")
+                    self.requests_ids[curr_request_id] = True
+                    future.cancel()
+                    try:
+                        await future
+                    except (asyncio.CancelledError, StopAsyncIteration):
+                        pass
+                    break
+                try:
+                    result = future.result()
+                except StopAsyncIteration:
+                    break
                 yield result
         finally:
+            disconnected.cancel()
+            await async_generator.aclose()
             del self.requests_ids[curr_request_id]
@@ -1,2 +1,18 @@
+import math
+
+from fastapi import HTTPException
+
+
 class PromptTooLongError(ValueError):
     pass
+
+
+class ServerOverloadedError(HTTPException):
+    """Raised when a request is rejected because the replica is overloaded."""
+
+    def __init__(self, detail: str, retry_after_s: float):
+        super().__init__(
+            status_code=503,
+            detail=detail,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after_s)))},
+        )
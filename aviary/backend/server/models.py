@@ -296,7 +296,7 @@ class Transformers(Initializer, extra=Extra.forbid):
 
     @property
     def allowed_pipelines(self) -> Set[str]:
-        return {"transformers"}
+        return {"transformers", "ContinuousTransformers"}
 
 
 class DeepSpeed(Transformers):
@@ -323,6 +323,10 @@ class DeepSpeed(Transformers):
             raise ValueError("'use_meta_tensor=True' needs 'use_kernel=True'.")
         return values
 
+    @property
+    def allowed_pipelines(self) -> Set[str]:
+        return {"transformers"}
+
 
 class DeviceMap(Transformers):
     type: Literal["DeviceMap"]
@@ -356,6 +360,19 @@ class Continuous(Initializer):
 class TextGenerationInference(Continuous):
     type: Literal["TextGenerationInference"]
     model_init_kwargs: Dict[str, Any] = {}
+    # Bytes of GPU memory, on each worker, used to keep the KV cache of
+    # prompts, so that prompts starting the same way, like their
+    # prompt_format, are only prefilled once. Has to fit in what
+    # max_batch_total_tokens leaves free. Only used by padded models.
+    # 0 to disable.
+    prefix_cache_max_bytes: int = 0
+    # Most tokens to guess per request and decode step, by looking up the
+    # last tokens of the request in its prompt and output, all checked by
+    # the same forward pass. Outputs that copy their prompt, like summaries
+    # or code edits, then take fewer steps. The rejected guesses take KV
+    # cache memory until their batch is compacted. Only used by padded
+    # models with position ids. 0 to disable.
+    speculative_tokens: int = 0
 
     def get_initializer_kwargs(self) -> dict:
         return {
@@ -381,6 +398,13 @@ class InitializationConfig(BaseModelExtended):
     hf_model_id: Optional[str] = None
     full_warmup: bool = False  # For debugging purposes
 
+    def get_pipeline_kwargs(self) -> dict:
+        """
+        Get kwargs that will be passed to the pipeline's from_initializer,
+        on top of the initializer and model id.
+        """
+        return {}
+
     @root_validator
     def initializer_pipeline(cls, values):
         pipeline = values.get("pipeline")
@@ -423,8 +447,40 @@ class StaticBatchingInitializationConfig(InitializationConfig):
 
 
 class ContinuousBatchingInitializationConfig(InitializationConfig):
-    initializer: TextGenerationInference
-    pipeline: Literal["TextGenerationInference"] = "TextGenerationInference"
+    # DeviceMap and SingleDevice models are run without TGI by the
+    # ContinuousTransformers pipeline, on CPU too.
+    initializer: Annotated[
+        Union[TextGenerationInference, DeviceMap, SingleDevice],
+        Field(discriminator="type"),
+    ]
+    pipeline: Union[
+        Literal["TextGenerationInference"], Literal["ContinuousTransformers"]
+    ] = "TextGenerationInference"
+    # Number of CPU actors used to tokenize incoming prompts. If 0, the
+    # default, the prompts are tokenized on the GPU prediction workers, as
+    # before the pool was added; deployments opt into the pool by setting it.
+    num_tokenizer_workers: int = 0
+    # Number of tokens per block of the paged KV cache of the
+    # ContinuousTransformers pipeline, which then sizes it for
+    # max_batch_total_tokens. If 0, the KV cache is kept in the batches.
+    kv_cache_block_size: int = 0
+
+    @root_validator
+    def kv_cache_block_size_pipeline(cls, values):
+        if (
+            values.get("kv_cache_block_size")
+            and values.get("pipeline") != "ContinuousTransformers"
+        ):
+            raise ValueError(
+                "kv_cache_block_size can only be set with the "
+                "'ContinuousTransformers' pipeline."
+            )
+        return values
+
+    def get_pipeline_kwargs(self) -> dict:
+        if self.pipeline == "ContinuousTransformers":
+            return {"kv_cache_block_size": self.kv_cache_block_size}
+        return {}
 
 
 class GenerationConfig(BaseModelExtended):
@@ -486,6 +542,85 @@ class ContinuousBatchingGenerationConfig(GenerationConfig):
     # you want to start considering pausing the running queries to include the waiting
     # ones into the same batch.
     waiting_served_ratio: float = 1.2
+    # How new requests are picked from the queue. "fifo" admits them in arrival
+    # order and stops at the first request that doesn't fit in the budget.
+    # "sjf" (shortest job first) and "best_fit" (largest fitting request first)
+    # look at the first selection_lookahead queued requests and admit every
+    # request that fits, so that one long prompt doesn't block the short ones
+    # behind it.
+    selection_mode: Literal["fifo", "sjf", "best_fit"] = "fifo"
+    selection_lookahead: int = 32
+    # Requests that have been queued for longer than this can no longer be
+    # overtaken by other requests in "sjf" and "best_fit" modes.
+    max_queue_wait_s: float = 10.0
+    # If True, the next decode step is sent to the model before the tokens of
+    # the current one are streamed back and new requests are selected, hiding
+    # that work behind GPU compute.
+    pipelined_scheduling: bool = False
+    # If True, the scheduling loop runs in the rank 0 model worker, which
+    # drives the other ranks itself, instead of in the Serve replica. The
+    # replica only submits and cancels requests, and pulls the generated
+    # tokens of all the requests at once, so it is no longer involved in
+    # every step.
+    worker_resident_scheduling: bool = False
+    # Max number of tokens generated per call to the model workers. Up to this
+    # many are generated when no request is waiting, saving a round-trip per
+    # token. Fewer are generated as the queue fills up. Not used with
+    # pipelined_scheduling.
+    max_decode_steps: int = 1
+    # Token budget of a step while requests are running. New requests whose
+    # prefill would take more, padding included, are prefilled in chunks of
+    # this many tokens minus one per running request, each followed by a
+    # decode step of the running requests, which bounds how long a long
+    # prompt stalls them. Only padded models prefill in chunks. Not used
+    # with pipelined_scheduling. Disabled if None.
+    max_step_tokens: Optional[int] = None
+    # Requests are scheduled earliest deadline first. Requests are due as soon
+    # as they are queued, plus this delay per priority level (see
+    # QueuePriority), so /batch requests only use the capacity left over by
+    # /query and /stream ones, but are not overtaken by requests arriving more
+    # than this many seconds after them.
+    priority_aging_s: float = 30.0
+    # If True, the token budget is shared fairly between tenants instead of
+    # going to the requests in queue order. The tenant of a request is the
+    # value of tenant_header if set (e.g. by a trusted gateway), or else
+    # the first 16 hex digits of the SHA-256 of its bearer token.
+    fair_share: bool = False
+    tenant_header: Optional[str] = None
+    # Share of the token budget of each tenant, relative to the others.
+    # Tenants that aren't listed have a weight of 1.
+    tenant_weights: Dict[str, float] = {}
+    # Max input + new tokens per second admitted for each tenant, even if the
+    # budget is unused. Tenants that aren't listed are unlimited.
+    tenant_max_tokens_per_s: Dict[str, float] = {}
+    # Requests expected to wait longer than this in the queue are rejected
+    # right away with a 503 and a Retry-After header, instead of waiting
+    # until the gateway timeout. The wait is estimated from the tokens queued
+    # ahead and the recent throughput. Disabled if None.
+    max_estimated_queue_wait_s: Optional[float] = None
+    # Tokens per second the queue wait is estimated with until the actual
+    # throughput is measured, after a few requests finish. If None, requests
+    # arriving while others are queued are shed until then.
+    queue_wait_prior_tokens_per_s: Optional[float] = None
+    # Generated tokens are streamed in chunks of up to stream_chunk_tokens
+    # tokens, or whatever was generated in the last stream_chunk_interval_s
+    # if that's fewer. The first token is always sent on its own, right away.
+    # By default, every token is sent on its own.
+    stream_chunk_tokens: int = 1
+    stream_chunk_interval_s: float = 0
+    # A request whose reader falls more than this many tokens behind fails
+    # with a SlowReaderError, and stops generating. Never if None.
+    max_stream_pending_tokens: Optional[int] = None
+    # If set, requests only reserve the tokens they are estimated to generate
+    # in the token budget instead of max_new_tokens, so that more of them fit
+    # in a batch. The estimate is this quantile of the output lengths of the
+    # last output_length_window finished requests that were longer than what
+    # the request generated so far, once output_length_min_samples requests
+    # finished. A batch generating more than estimated can run out of memory,
+    # its last requests are then preempted and resumed later. Disabled if None.
+    output_length_quantile: Optional[float] = None
+    output_length_window: int = 1000
+    output_length_min_samples: int = 100
 
     @root_validator
     def validate_values(cls, values):
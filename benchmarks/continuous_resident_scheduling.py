@@ -0,0 +1,275 @@
+"""Benchmark of worker_resident_scheduling against scheduling in the replica.
+
+Runs a continuous batch of streaming requests on stand-in model ranks, Ray
+actors that sleep for each step and return GenerationColumns from rank 0,
+like the TGI prediction workers. Either the scheduler runs in the driver,
+standing in for the Serve replica, and calls every rank for every step, or
+it runs in rank 0, and the driver only submits the requests and pulls
+their tokens. The event loop of the driver is kept busy, like a replica
+serving HTTP requests, for busy_ms out of every 10 ms.
+
+Reports the generated tokens per second and the median and p99 of the
+time between two tokens of a request, as seen by the driver.
+
+TGI doesn't have to be installed.
+
+Usage:
+    python benchmarks/continuous_resident_scheduling.py --batch-sizes 64 256
+"""
+import argparse
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import numpy as np
+import ray
+
+from aviary.backend.llm.continuous.generations import GenerationColumns
+from aviary.backend.llm.continuous.policy import QuotaBasedRequestSelectionPolicy
+from aviary.backend.llm.continuous.queue import PriorityRequestQueue
+from aviary.backend.llm.continuous.resident import (
+    ResidentScheduler,
+    ResidentSchedulerClient,
+)
+from aviary.backend.llm.continuous.scheduler import (
+    AsyncInferenceScheduler,
+    NaiveTokenizer,
+)
+from aviary.backend.llm.continuous.worker import AsyncInferenceWorker
+
+
+class Generation:
+    def __init__(self, request_id: int, finished: bool, num_tokens: int):
+        self.request_id = request_id
+        self.token_id = 1
+        self.token_logprob = 0.0
+        self.token_text = " x"
+        self.token_is_special = False
+        self.generated_text = None
+        if finished:
+            self.generated_text = type(
+                "GeneratedText",
+                (),
+                {"text": " x" * num_tokens, "generated_tokens": num_tokens},
+            )()
+            self.generated_text.finish_reason = 0
+
+
+class FakeRank:
+    """Stands in for a ContinuousBatchingPredictionWorker."""
+
+    def __init__(self, rank: int, step_s: float):
+        self.rank = rank
+        self.step_s = step_s
+        self.batches: Dict[int, list] = {}
+        self.num_generated: Dict[int, int] = {}
+
+    def _generate(self, requests) -> GenerationColumns:
+        time.sleep(self.step_s)
+        if self.rank != 0:
+            return None
+        generations = []
+        for request in requests:
+            n = self.num_generated.get(request.id, 0) + 1
+            self.num_generated[request.id] = n
+            generations.append(Generation(request.id, n == request.max_new_tokens, n))
+        return GenerationColumns.from_generations(generations)
+
+    def process_new_batch(self, requests, batch_id):
+        self.batches[batch_id] = requests
+        return self._generate(requests), batch_id
+
+    def generate_next_token(self, batch_ids):
+        batch_ids = [batch_id for batch_id in batch_ids if batch_id is not None]
+        if not batch_ids:
+            return None, None
+        requests = [r for batch_id in batch_ids for r in self.batches.pop(batch_id)]
+        self.batches[batch_ids[0]] = requests
+        return self._generate(requests), batch_ids[0]
+
+    def filter_requests(self, batch_id, request_ids, compact=False):
+        requests = self.batches.pop(batch_id)
+        if not request_ids:
+            return None
+        request_ids = set(request_ids)
+        self.batches[batch_id] = [r for r in requests if r.id in request_ids]
+        return batch_id
+
+    def start_scheduler(self, worker_group, batch_size: int):
+        self.resident_scheduler = ResidentScheduler(
+            AsyncInferenceScheduler,
+            **scheduler_kwargs(LocalRanks(self, worker_group), batch_size),
+        )
+
+    @ray.method(concurrency_group="scheduler")
+    def submit_request(self, *args, **kwargs):
+        return self.resident_scheduler.submit_request(*args, **kwargs)
+
+    @ray.method(concurrency_group="scheduler")
+    def pull(self, timeout_s, priorities):
+        return self.resident_scheduler.pull(timeout_s, priorities)
+
+
+class RayRanks(AsyncInferenceWorker):
+    """Stands in for RayInferenceWorker."""
+
+    def __init__(self, worker_group):
+        self.worker_group = worker_group
+
+    def process_new_batch(self, requests, batch_id):
+        raise NotImplementedError
+
+    def generate_next_token(self, batch_ids):
+        raise NotImplementedError
+
+    def filter_requests(self, batch_id, request_ids, compact=False):
+        raise NotImplementedError
+
+    async def _call_async(self, method: str, *args) -> List[Any]:
+        return await asyncio.gather(
+            *[getattr(worker, method).remote(*args) for worker in self.worker_group]
+        )
+
+    @staticmethod
+    def _decode(ret):
+        columns, batch_id = ret[0]
+        return (columns.to_generations() if columns else []), batch_id
+
+    async def process_new_batch_async(self, requests, batch_id):
+        return self._decode(
+            await self._call_async("process_new_batch", ray.put(requests), batch_id)
+        )
+
+    async def generate_next_token_async(self, batch_ids):
+        return self._decode(await self._call_async("generate_next_token", batch_ids))
+
+    async def filter_requests_async(self, batch_id, request_ids, compact=False):
+        return (
+            await self._call_async("filter_requests", batch_id, request_ids, compact)
+        )[0]
+
+
+class LocalRanks(RayRanks):
+    """Stands in for LocalInferenceWorker."""
+
+    def __init__(self, local_worker, worker_group):
+        super().__init__(worker_group)
+        self.local_worker = local_worker
+        self._executor = ThreadPoolExecutor(1)
+
+    async def _call_async(self, method: str, *args) -> List[Any]:
+        refs = [getattr(worker, method).remote(*args) for worker in self.worker_group]
+        local_args = [ray.get(a) if isinstance(a, ray.ObjectRef) else a for a in args]
+        ret = await asyncio.get_running_loop().run_in_executor(
+            self._executor,
+            functools.partial(getattr(self.local_worker, method), *local_args),
+        )
+        return [ret] + await asyncio.gather(*refs)
+
+
+def scheduler_kwargs(worker, batch_size: int) -> Dict[str, Any]:
+    return dict(
+        tokenizer=NaiveTokenizer(),
+        inference_worker_loader=lambda: worker,
+        request_selection_policy=QuotaBasedRequestSelectionPolicy(
+            max_batch_total_tokens=batch_size * 1024,
+            max_batch_prefill_tokens=batch_size * 64,
+        ),
+        request_queue=PriorityRequestQueue(),
+    )
+
+
+async def keep_busy(busy_ms: float):
+    """Hog the event loop, like serving HTTP requests would."""
+    while True:
+        end = time.perf_counter() + busy_ms / 1000
+        while time.perf_counter() < end:
+            pass
+        await asyncio.sleep((10 - busy_ms) / 1000)
+
+
+async def run_requests(scheduler, batch_size: int, max_new_tokens: int):
+    streams = await asyncio.gather(
+        *[
+            scheduler.process_request_async(
+                "hello " * 32, {}, max_new_tokens=max_new_tokens, max_length=64
+            )
+            for _ in range(batch_size)
+        ]
+    )
+    gaps = []
+
+    async def read(stream):
+        last = None
+        num_tokens = 0
+        async for _, n in stream.chunks():
+            now = time.perf_counter()
+            if last is not None:
+                # The gap is shared by the tokens of a chunk.
+                gaps.extend([(now - last) / n] * n)
+            last = now
+            num_tokens += n
+        return num_tokens
+
+    start = time.perf_counter()
+    num_tokens = sum(await asyncio.gather(*[read(s) for s in streams]))
+    return num_tokens / (time.perf_counter() - start), gaps
+
+
+def run_benchmark(
+    batch_size: int, world_size: int, step_ms: float, busy_ms: float, resident: bool
+) -> Dict[str, float]:
+    remote_cls = ray.remote(num_cpus=0, concurrency_groups={"scheduler": 4})(FakeRank)
+    worker_group = [remote_cls.remote(i, step_ms / 1000) for i in range(world_size)]
+
+    async def run():
+        busy = asyncio.ensure_future(keep_busy(busy_ms))
+        if resident:
+            await worker_group[0].start_scheduler.remote(worker_group[1:], batch_size)
+            scheduler = ResidentSchedulerClient(worker_group[0], poll_timeout_s=0.1)
+        else:
+            scheduler = AsyncInferenceScheduler(
+                **scheduler_kwargs(RayRanks(worker_group), batch_size)
+            )
+        # Warm up.
+        await run_requests(scheduler, 1, 4)
+        tokens_per_s, gaps = await run_requests(scheduler, batch_size, 128)
+        busy.cancel()
+        if not resident:
+            scheduler.stop()
+        return tokens_per_s, gaps
+
+    tokens_per_s, gaps = asyncio.run(run())
+    for worker in worker_group:
+        ray.kill(worker)
+    return {
+        "tokens_per_s": tokens_per_s,
+        "itl_p50_ms": float(np.percentile(gaps, 50)) * 1000,
+        "itl_p99_ms": float(np.percentile(gaps, 99)) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[64, 256])
+    parser.add_argument("--world-size", type=int, default=4)
+    parser.add_argument("--step-ms", type=float, default=20)
+    parser.add_argument("--busy-ms", type=float, default=3)
+    args = parser.parse_args()
+
+    ray.init()
+    for batch_size in args.batch_sizes:
+        for resident in (False, True):
+            results = run_benchmark(
+                batch_size, args.world_size, args.step_ms, args.busy_ms, resident
+            )
+            print(
+                f"batch={batch_size:<5} resident={resident!s:<5}: "
+                + ", ".join(f"{k}={v:.1f}" for k, v in results.items())
+            )
+
+
+if __name__ == "__main__":
+    main()
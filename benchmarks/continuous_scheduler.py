@@ -0,0 +1,278 @@
+"""Benchmark of the continuous batching scheduler overhead.
+
+Runs the scheduler against a fake inference worker that sleeps instead of
+running a model, and reports how long the (fake) GPU sits idle between
+two consecutive decode steps, not counting the time spent on prefills in
+between. That gap is the scheduler and RPC overhead.
+
+Usage:
+    python benchmarks/continuous_scheduler.py --num-requests 256
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from aviary.backend.llm.continuous.policy import QuotaBasedRequestSelectionPolicy
+from aviary.backend.llm.continuous.queue import PriorityRequestQueue
+from aviary.backend.llm.continuous.scheduler import (
+    AsyncInferenceScheduler,
+    NaiveTokenizer,
+    PipelinedAsyncInferenceScheduler,
+)
+from aviary.backend.llm.continuous.types import Request
+from aviary.backend.llm.continuous.worker import AsyncInferenceWorker
+
+SCHEDULERS = {
+    "sequential": AsyncInferenceScheduler,
+    "pipelined": PipelinedAsyncInferenceScheduler,
+}
+
+
+@dataclass
+class FakeGeneratedText:
+    text: str
+    finish_reason: int = 0
+
+
+@dataclass
+class FakeGeneration:
+    request_id: int
+    token_text: str
+    token_is_special: bool = False
+    generated_text: Optional[FakeGeneratedText] = None
+
+
+class FakeInferenceWorker(AsyncInferenceWorker):
+    """Inference worker that sleeps instead of running a model.
+
+    Calls are executed on a single fake device in the order they were made,
+    like calls to a Ray actor. Every call also pays rpc_latency_s, half on the
+    way to the device and half on the way back.
+    """
+
+    def __init__(
+        self,
+        prefill_time_s: float = 0.02,
+        decode_time_s: float = 0.02,
+        rpc_latency_s: float = 0.002,
+    ):
+        self.prefill_time_s = prefill_time_s
+        self.decode_time_s = decode_time_s
+        self.rpc_latency_s = rpc_latency_s
+        self.device_free_at = 0.0
+        # (kind, start, end) of all the steps run on the device
+        self.timeline: List[Tuple[str, float, float]] = []
+        self._batches: Dict[int, List[Request]] = {}
+        self._num_generated: Dict[int, int] = {}
+        self.num_calls = 0
+
+    def _schedule(self, kind: str, duration_s: float) -> float:
+        start = max(time.monotonic() + self.rpc_latency_s / 2, self.device_free_at)
+        self.device_free_at = start + duration_s
+        self.timeline.append((kind, start, self.device_free_at))
+        return self.device_free_at
+
+    def decode_gaps(self) -> List[float]:
+        """Device idle time before each decode step but the first one."""
+        gaps = []
+        idle = None
+        last_end = None
+        for kind, start, end in self.timeline:
+            if idle is not None:
+                idle += start - last_end
+            last_end = end
+            if kind == "decode":
+                if idle is not None:
+                    gaps.append(idle)
+                idle = 0.0
+        return gaps
+
+    async def _return_at(self, end: float, result):
+        return_at = end + self.rpc_latency_s / 2
+        # The event loop only wakes up with a millisecond resolution, spin for
+        # the last millisecond to not count that as scheduler overhead.
+        await asyncio.sleep(max(0, return_at - time.monotonic() - 0.001))
+        while time.monotonic() < return_at:
+            await asyncio.sleep(0)
+        return result
+
+    def _generate(self, requests: List[Request]) -> List[FakeGeneration]:
+        generations = []
+        for request in requests:
+            self._num_generated[request.id] = self._num_generated.get(request.id, 0) + 1
+            generated_text = None
+            if self._num_generated[request.id] >= request.max_new_tokens:
+                generated_text = FakeGeneratedText(text="x" * request.max_new_tokens)
+            generations.append(
+                FakeGeneration(
+                    request_id=request.id,
+                    token_text="x",
+                    generated_text=generated_text,
+                )
+            )
+        return generations
+
+    def _all_finished(self, requests: List[Request]) -> bool:
+        return all(self._num_generated[r.id] >= r.max_new_tokens for r in requests)
+
+    def process_new_batch(self, requests, batch_id):
+        raise NotImplementedError
+
+    def generate_next_token(self, batch_ids):
+        raise NotImplementedError
+
+    def filter_requests(self, batch_id, request_ids, compact=False):
+        raise NotImplementedError
+
+    async def process_new_batch_async(
+        self, requests: List[Request], batch_id: int
+    ) -> Tuple[List[FakeGeneration], Optional[int]]:
+        self.num_calls += 1
+        end = self._schedule("prefill", self.prefill_time_s)
+        generations = self._generate(requests)
+        if self._all_finished(requests):
+            batch_id = None
+        else:
+            self._batches[batch_id] = list(requests)
+        return await self._return_at(end, (generations, batch_id))
+
+    async def generate_next_token_async(
+        self, batch_ids: List[Optional[int]]
+    ) -> Tuple[List[FakeGeneration], Optional[int]]:
+        self.num_calls += 1
+        batch_ids = [batch_id for batch_id in batch_ids if batch_id is not None]
+        if not batch_ids:
+            return [], None
+        requests = []
+        for batch_id in batch_ids:
+            requests += self._batches.pop(batch_id)
+        end = self._schedule("decode", self.decode_time_s)
+        generations = self._generate(requests)
+        batch_id = batch_ids[0]
+        if self._all_finished(requests):
+            batch_id = None
+        else:
+            self._batches[batch_id] = requests
+        return await self._return_at(end, (generations, batch_id))
+
+    async def generate_next_tokens_async(
+        self, batch_ids: List[Optional[int]], max_steps: int
+    ) -> Tuple[List[List[FakeGeneration]], Optional[int]]:
+        self.num_calls += 1
+        batch_ids = [batch_id for batch_id in batch_ids if batch_id is not None]
+        if not batch_ids:
+            return [], None
+        requests = []
+        for batch_id in batch_ids:
+            requests += self._batches.pop(batch_id)
+        steps = []
+        for _ in range(max_steps):
+            end = self._schedule("decode", self.decode_time_s)
+            steps.append(self._generate(requests))
+            if any(g.generated_text is not None for g in steps[-1]):
+                break
+        requests = [r for r in requests if self._num_generated[r.id] < r.max_new_tokens]
+        batch_id = batch_ids[0]
+        if requests:
+            self._batches[batch_id] = requests
+        else:
+            batch_id = None
+        return await self._return_at(end, (steps, batch_id))
+
+    async def filter_requests_async(
+        self, batch_id: int, request_ids: List[int], compact: bool = False
+    ) -> Optional[int]:
+        self.num_calls += 1
+        end = self._schedule("filter", 0)
+        request_ids = set(request_ids)
+        requests = [r for r in self._batches.pop(batch_id) if r.id in request_ids]
+        if requests:
+            self._batches[batch_id] = requests
+        else:
+            batch_id = None
+        return await self._return_at(end, batch_id)
+
+
+async def run_benchmark(args: argparse.Namespace, mode: str) -> Dict[str, float]:
+    random.seed(args.seed)
+    worker = FakeInferenceWorker(
+        prefill_time_s=args.prefill_time_ms / 1000,
+        decode_time_s=args.decode_time_ms / 1000,
+        rpc_latency_s=args.rpc_latency_ms / 1000,
+    )
+    scheduler = SCHEDULERS[mode](
+        tokenizer=NaiveTokenizer(),
+        inference_worker_loader=lambda: worker,
+        request_selection_policy=QuotaBasedRequestSelectionPolicy(
+            max_batch_total_tokens=args.max_batch_total_tokens,
+            max_batch_prefill_tokens=args.max_batch_total_tokens,
+        ),
+        request_queue=PriorityRequestQueue(),
+        max_decode_steps=args.max_decode_steps,
+    )
+
+    async def consume(stream) -> int:
+        return sum([num_tokens async for _, num_tokens in stream.chunks()])
+
+    start = time.monotonic()
+    streams = [
+        scheduler.process_request(
+            "hello " * random.randint(16, 256),
+            {},
+            max_new_tokens=random.randint(16, args.max_new_tokens),
+            max_length=256,
+        )
+        for _ in range(args.num_requests)
+    ]
+    num_tokens = sum(await asyncio.gather(*[consume(s) for s in streams]))
+    elapsed = time.monotonic() - start
+    scheduler.stop()
+
+    gaps = [gap * 1000 for gap in worker.decode_gaps()]
+    return {
+        "decode_steps": len(gaps) + 1,
+        "worker_calls": worker.num_calls,
+        "mean_gap_ms": statistics.mean(gaps),
+        "p50_gap_ms": statistics.median(gaps),
+        "p99_gap_ms": statistics.quantiles(gaps, n=100)[98],
+        "tokens_per_s": num_tokens / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--num-requests", type=int, default=256)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--max-batch-total-tokens", type=int, default=16000)
+    parser.add_argument("--prefill-time-ms", type=float, default=20)
+    parser.add_argument("--decode-time-ms", type=float, default=20)
+    parser.add_argument("--rpc-latency-ms", type=float, default=2)
+    parser.add_argument(
+        "--max-decode-steps",
+        type=int,
+        default=1,
+        help="Max tokens generated per worker call (sequential mode only).",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--modes", nargs="+", choices=list(SCHEDULERS), default=list(SCHEDULERS)
+    )
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        results = asyncio.run(run_benchmark(args, mode))
+        print(
+            f"{mode:>12}: "
+            + ", ".join(
+                f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}"
+                for k, v in results.items()
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
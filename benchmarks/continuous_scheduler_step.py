@@ -0,0 +1,116 @@
+"""Micro-benchmark of the host work of the continuous batching scheduler.
+
+Measures, without any inference worker, the time the scheduler spends per
+decode step on matching the generations to the running requests and on
+trying to admit the queued requests, at large batch sizes. The queued
+requests never fit in the token budget, so every step evaluates the whole
+look-ahead window without admitting anything, which is the steady state
+of a saturated server. Also measures the time to admit a full batch into
+an empty scheduler.
+
+Usage:
+    python benchmarks/continuous_scheduler_step.py --batch-sizes 256 1024
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from aviary.backend.llm.continuous.policy import (
+    SELECTION_MODES,
+    QuotaBasedRequestSelectionPolicy,
+)
+from aviary.backend.llm.continuous.queue import PriorityRequestQueue
+from aviary.backend.llm.continuous.scheduler import InferenceScheduler, NaiveTokenizer
+
+
+@dataclass
+class FakeGeneration:
+    request_id: int
+    token_text: str
+    token_is_special: bool = False
+    generated_text: Optional[object] = None
+
+
+async def run_benchmark(
+    batch_size: int, selection_mode: str, num_steps: int, num_queued: int
+) -> Dict[str, float]:
+    max_new_tokens = num_steps + 16
+    token_budget = batch_size * (max_new_tokens + 64)
+    scheduler = InferenceScheduler(
+        tokenizer=NaiveTokenizer(),
+        inference_worker_loader=lambda: None,
+        request_selection_policy=QuotaBasedRequestSelectionPolicy(
+            max_batch_total_tokens=token_budget,
+            max_batch_prefill_tokens=token_budget,
+            waiting_served_ratio=0,
+            selection_mode=selection_mode,
+        ),
+        request_queue=PriorityRequestQueue(),
+        inline=True,
+    )
+    for _ in range(batch_size):
+        scheduler.process_request(
+            "hello " * 32, {}, max_new_tokens=max_new_tokens, max_length=64
+        )
+    # sjf and best_fit admit up to the look-ahead per round.
+    requests = []
+    start = time.perf_counter()
+    while len(requests) < batch_size:
+        requests += await scheduler._select_new_requests(requests)
+    admission_s = time.perf_counter() - start
+    assert len(requests) == batch_size
+
+    # Requests that never fit in what is left of the budget.
+    for _ in range(num_queued):
+        scheduler.process_request(
+            "hello " * 32, {}, max_new_tokens=token_budget, max_length=64
+        )
+
+    step_times = []
+    for _ in range(num_steps):
+        # The worker doesn't return the generations in the request order.
+        generations = [FakeGeneration(r.id, "x") for r in reversed(requests)]
+        start = time.perf_counter()
+        requests, _ = scheduler._process_generation_result(generations, requests)
+        assert not await scheduler._select_new_requests(requests)
+        step_times.append(time.perf_counter() - start)
+    scheduler.stop()
+
+    return {
+        "admission_ms": admission_s * 1000,
+        "mean_step_us": statistics.mean(step_times) * 1e6,
+        "p50_step_us": statistics.median(step_times) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[256, 1024])
+    parser.add_argument(
+        "--selection-modes",
+        nargs="+",
+        choices=SELECTION_MODES,
+        default=["fifo", "sjf"],
+    )
+    parser.add_argument("--num-steps", type=int, default=200)
+    parser.add_argument("--num-queued", type=int, default=64)
+    args = parser.parse_args()
+
+    for selection_mode in args.selection_modes:
+        for batch_size in args.batch_sizes:
+            results = asyncio.run(
+                run_benchmark(
+                    batch_size, selection_mode, args.num_steps, args.num_queued
+                )
+            )
+            print(
+                f"{selection_mode:>8} batch={batch_size:<5}: "
+                + ", ".join(f"{k}={v:.1f}" for k, v in results.items())
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Micro-benchmark of the serialization of a continuous batching step.
+
+Compares, per decode step, the generations a rank sends back to the
+scheduler as TGI Generation objects run through pythonize_tensors, as
+before, against GenerationColumns: the time to encode them on the worker,
+pickle and unpickle them, and decode them on the scheduler, and the
+number of bytes sent. Only rank 0 sends its generations now, so the old
+format is counted once per rank. Also compares the bytes of the requests
+of a prefill, pickled once per rank before and put once in the object
+store now.
+
+TGI doesn't have to be installed, stand-ins with the same fields as its
+Generation types are used.
+
+Usage:
+    python benchmarks/continuous_wire_format.py --batch-sizes 64 256 1024
+"""
+import argparse
+import pickle
+import statistics
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+
+from aviary.backend.llm.continuous.generations import GenerationColumns
+from aviary.backend.llm.continuous.types import Request
+from aviary.backend.llm.pipelines.utils import pythonize_tensors
+
+
+@dataclass
+class GeneratedText:
+    text: str
+    generated_tokens: int
+    finish_reason: int
+    seed: Optional[int]
+
+
+@dataclass
+class Generation:
+    request_id: int
+    prefill_tokens: Optional[object]
+    token_id: int
+    token_logprob: float
+    token_text: str
+    token_is_special: bool
+    generated_text: Optional[GeneratedText]
+
+
+def make_generations(batch_size: int, rng: np.random.Generator) -> List[Generation]:
+    vocab = [f" tok{i}" for i in range(512)]
+    generations = []
+    for request_id in range(batch_size):
+        token_id = int(rng.integers(len(vocab)))
+        finished = rng.random() < 0.01
+        generations.append(
+            Generation(
+                request_id=request_id,
+                prefill_tokens=None,
+                token_id=token_id,
+                # The padded TGI models return the logprob as a tensor.
+                token_logprob=torch.tensor(rng.normal()),
+                token_text=vocab[token_id],
+                token_is_special=False,
+                generated_text=GeneratedText(" tok" * 200, 200, 1, None)
+                if finished
+                else None,
+            )
+        )
+    return generations
+
+
+def time_step(
+    step: Callable[[List[Generation]], object], batch_size: int, repeat: int
+) -> float:
+    # pythonize_tensors converts the generations in place, so each call
+    # gets its own.
+    inputs = [
+        make_generations(batch_size, np.random.default_rng(i)) for i in range(repeat)
+    ]
+    times = []
+    for generations in inputs:
+        start = time.perf_counter()
+        step(generations)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def old_step(generations: List[Generation]) -> List[Generation]:
+    payload = pickle.dumps([pythonize_tensors(g) for g in generations], 5)
+    return pickle.loads(payload)
+
+
+def new_step(generations: List[Generation]) -> List[object]:
+    payload = pickle.dumps(GenerationColumns.from_generations(generations), 5)
+    return pickle.loads(payload).to_generations()
+
+
+def run_benchmark(batch_size: int, world_size: int, repeat: int) -> Dict[str, float]:
+    generations = make_generations(batch_size, np.random.default_rng(0))
+    new_bytes = len(pickle.dumps(GenerationColumns.from_generations(generations), 5))
+    old_bytes = len(pickle.dumps([pythonize_tensors(g) for g in generations], 5))
+
+    requests = [
+        Request(
+            id=i,
+            inputs="hello " * 256,
+            truncate=512,
+            max_new_tokens=256,
+            params={"temperature": 0.7, "top_p": 0.9, "stopping_sequences": []},
+        )
+        for i in range(batch_size)
+    ]
+    request_bytes = len(pickle.dumps(requests, 5))
+
+    return {
+        "old_step_us": time_step(old_step, batch_size, repeat) * 1e6,
+        "new_step_us": time_step(new_step, batch_size, repeat) * 1e6,
+        "old_step_kb": old_bytes * world_size / 1024,
+        "new_step_kb": new_bytes / 1024,
+        "old_prefill_kb": request_bytes * world_size / 1024,
+        "new_prefill_kb": request_bytes / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[64, 256, 1024])
+    parser.add_argument("--world-size", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    for batch_size in args.batch_sizes:
+        results = run_benchmark(batch_size, args.world_size, args.repeat)
+        print(
+            f"batch={batch_size:<5} world_size={args.world_size}: "
+            + ", ".join(f"{k}={v:.1f}" for k, v in results.items())
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import asyncio
+from types import SimpleNamespace
+from typing import Dict, List
+
+import torch
+
+from aviary.backend.llm.continuous.generations import GeneratedText, TokenGeneration
+from aviary.backend.llm.continuous.worker import AsyncInferenceWorker
+
+
+class FakeCausalLMBatch(SimpleNamespace):
+    """A TGI CausalLMBatch, with the fields the continuous batching code
+    uses and the filter of TGI, which updates the batch in place."""
+
+    def __len__(self):
+        return len(self.input_lengths)
+
+    def filter(self, request_ids: List[int]) -> "FakeCausalLMBatch":
+        if len(request_ids) == len(self):
+            return self
+        keep = [self.requests_idx_mapping[request_id] for request_id in request_ids]
+        max_input_length = max(self.input_lengths[i] for i in keep)
+        padding_right_offset = max(
+            self.stopping_criterias[i].max_new_tokens
+            - self.stopping_criterias[i].current_tokens
+            for i in keep
+        )
+        end = self.attention_mask.shape[1] - self.padding_right_offset
+        self.attention_mask = self.attention_mask[
+            keep, end - max_input_length : end + padding_right_offset
+        ]
+        self.past_key_values = [
+            [tensor[keep, :, -(max_input_length - 1) :] for tensor in layer]
+            for layer in self.past_key_values
+        ]
+        self.input_ids = self.input_ids[keep]
+        self.position_ids = self.position_ids[keep]
+        for field in (
+            "requests",
+            "all_input_ids",
+            "input_lengths",
+            "prefix_offsets",
+            "read_offsets",
+            "next_token_choosers",
+            "stopping_criterias",
+        ):
+            values = getattr(self, field)
+            setattr(self, field, [values[i] for i in keep])
+        self.requests_idx_mapping = {
+            request_id: i for i, request_id in enumerate(request_ids)
+        }
+        self.max_input_length = max_input_length
+        self.padding_right_offset = padding_right_offset
+        return self
+
+
+def make_causal_lm_batch(
+    prompts: Dict[int, List[int]], max_new_tokens: int, batch_id: int = 0
+) -> FakeCausalLMBatch:
+    """A batch of prompts by request id, about to be prefilled, the way
+    CausalLMBatch.from_pb makes it."""
+    width = max(len(prompt) for prompt in prompts.values())
+    num_rows = len(prompts)
+    input_ids = torch.zeros(num_rows, width, dtype=torch.long)
+    attention_mask = torch.zeros(num_rows, width + max_new_tokens, dtype=torch.long)
+    for i, prompt in enumerate(prompts.values()):
+        input_ids[i, width - len(prompt) :] = torch.tensor(prompt)
+        attention_mask[i, width - len(prompt) : width] = 1
+    position_ids = attention_mask[:, :width].cumsum(-1) - 1
+    position_ids.masked_fill_(attention_mask[:, :width] == 0, 1)
+    return FakeCausalLMBatch(
+        batch_id=batch_id,
+        requests=[
+            SimpleNamespace(id=request_id, prefill_logprobs=True)
+            for request_id in prompts
+        ],
+        requests_idx_mapping={request_id: i for i, request_id in enumerate(prompts)},
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        position_ids=position_ids,
+        past_key_values=None,
+        all_input_ids=[torch.tensor(prompt).view(-1, 1) for prompt in prompts.values()],
+        input_lengths=[len(prompt) for prompt in prompts.values()],
+        prefix_offsets=[0] * num_rows,
+        read_offsets=[0] * num_rows,
+        next_token_choosers=[None] * num_rows,
+        stopping_criterias=[
+            SimpleNamespace(max_new_tokens=max_new_tokens, current_tokens=0)
+            for _ in prompts
+        ],
+        max_input_length=width,
+        padding_right_offset=max_new_tokens,
+        keys_head_dim_last=True,
+    )
+
+
+def token_generation(
+    request_id: int, num_generated: int, finished: bool
+) -> TokenGeneration:
+    """The num_generated-th "x" generated for a request."""
+    return TokenGeneration(
+        request_id,
+        0,
+        0.0,
+        "x",
+        False,
+        GeneratedText("x" * num_generated, num_generated, 0) if finished else None,
+    )
+
+
+class FakeAsyncWorker(AsyncInferenceWorker):
+    """Generates one "x" per request per step, checking that finished
+    requests are filtered out before the next step.
+
+    Each step lets the other tasks of the loop run, like a real step would.
+    """
+
+    def __init__(self):
+        self.batches = {}
+        self.num_generated = {}
+        self.num_decode_calls = 0
+
+    def process_new_batch(self, requests, batch_id):
+        raise NotImplementedError
+
+    def generate_next_token(self, batch_ids):
+        raise NotImplementedError
+
+    def filter_requests(self, batch_id, request_ids, compact=False):
+        raise NotImplementedError
+
+    def _generate(self, requests) -> List[TokenGeneration]:
+        generations = []
+        for request in requests:
+            num_generated = self.num_generated.get(request.id, 0)
+            assert num_generated < request.max_new_tokens
+            self.num_generated[request.id] = num_generated + 1
+            generations.append(
+                token_generation(
+                    request.id,
+                    num_generated + 1,
+                    num_generated + 1 == request.max_new_tokens,
+                )
+            )
+        return generations
+
+    async def process_new_batch_async(self, requests, batch_id):
+        self.batches[batch_id] = requests
+        await asyncio.sleep(0.001)
+        return self._generate(requests), batch_id
+
+    async def generate_next_token_async(self, batch_ids):
+        self.num_decode_calls += 1
+        batch_ids = [batch_id for batch_id in batch_ids if batch_id is not None]
+        if not batch_ids:
+            return [], None
+        requests = [r for batch_id in batch_ids for r in self.batches.pop(batch_id)]
+        self.batches[batch_ids[0]] = requests
+        await asyncio.sleep(0.001)
+        return self._generate(requests), batch_ids[0]
+
+    async def filter_requests_async(self, batch_id, request_ids, compact=False):
+        requests = self.batches.pop(batch_id)
+        if not request_ids:
+            return None
+        self.batches[batch_id] = [r for r in requests if r.id in request_ids]
+        return batch_id
+
+    async def generate_next_tokens_async(self, batch_ids, max_steps):
+        num_decode_calls = self.num_decode_calls
+        ret = await super().generate_next_tokens_async(batch_ids, max_steps)
+        # Counts as a single call.
+        self.num_decode_calls = num_decode_calls + 1
+        return ret
@@ -0,0 +1,25 @@
+import pytest
+
+from aviary.backend.llm.continuous.estimator import OutputLengthEstimator
+
+
+def test_output_length_estimator():
+    estimator = OutputLengthEstimator(quantile=0.9, window=100, min_samples=10)
+    for i in range(9):
+        estimator.observe(i + 1)
+    # Not enough samples yet.
+    assert estimator.estimate(0, 512) == 512
+
+    for i in range(9, 200):
+        estimator.observe(i % 100 + 1)
+    # Only the last 100 samples, 1 to 100, are kept.
+    assert len(estimator) == 100
+    assert estimator.estimate(0, 512) == 91
+    assert estimator.estimate(0, 50) == 50
+    # Requests that already generated 80 tokens are estimated from the
+    # samples longer than that.
+    assert estimator.estimate(80, 512) == 99
+    assert estimator.estimate(100, 512) == 512
+
+    with pytest.raises(ValueError):
+        OutputLengthEstimator(quantile=0)
@@ -0,0 +1,54 @@
+import pickle
+from dataclasses import dataclass
+from typing import Optional
+
+from aviary.backend.llm.continuous.generations import (
+    GeneratedText,
+    GenerationColumns,
+    TokenGeneration,
+)
+
+
+@dataclass
+class _TGIGeneratedText:
+    text: str
+    generated_tokens: int
+    finish_reason: int
+    seed: Optional[int] = None
+
+
+@dataclass
+class _TGIGeneration:
+    request_id: int
+    prefill_tokens: Optional[object]
+    token_id: int
+    token_logprob: float
+    token_text: str
+    token_is_special: bool
+    generated_text: Optional[_TGIGeneratedText]
+
+
+def test_generation_columns_round_trip():
+    generations = [
+        _TGIGeneration(3, None, 11, -0.5, " the", False, None),
+        _TGIGeneration(1, None, 2, -1.0, "</s>", True, _TGIGeneratedText("a b", 2, 1)),
+        _TGIGeneration(7, None, 11, -0.25, " the", False, None),
+        _TGIGeneration(5, None, 12, 0.0, " end", False, _TGIGeneratedText("c", 4, 0)),
+    ]
+    columns = pickle.loads(
+        pickle.dumps(GenerationColumns.from_generations(generations))
+    )
+
+    assert len(columns) == 4
+    # Each token text is stored once.
+    assert columns.texts == [" the", "</s>", " end"]
+    assert columns.to_generations() == [
+        TokenGeneration(3, 11, -0.5, " the", False, None),
+        TokenGeneration(1, 2, -1.0, "</s>", True, GeneratedText("a b", 2, 1)),
+        TokenGeneration(7, 11, -0.25, " the", False, None),
+        TokenGeneration(5, 12, 0.0, " end", False, GeneratedText("c", 4, 0)),
+    ]
+
+    empty = GenerationColumns.from_generations([])
+    assert len(empty) == 0
+    assert empty.to_generations() == []
@@ -0,0 +1,49 @@
+import pytest
+
+from aviary.backend.llm.continuous.inflight import BatchLengths, InFlightTable
+from aviary.backend.llm.continuous.queue import InferenceRequest
+from aviary.backend.llm.continuous.types import Request
+
+
+def _make_request(id: int, input_length: int, max_new_tokens: int):
+    return InferenceRequest.from_request(
+        Request(
+            id=id,
+            inputs="test",
+            truncate=input_length,
+            max_new_tokens=max_new_tokens,
+            params={},
+        ),
+        request_input_length=input_length,
+    )
+
+
+def test_in_flight_table_lengths():
+    table = InFlightTable()
+    requests = [_make_request(i, 10 + i, 3) for i in range(10)]
+    table.add(requests)
+    assert table.lengths() == BatchLengths.of(requests) == (10, 19, 145, 30)
+    with pytest.raises(ValueError):
+        table.add(requests[:1])
+
+    for _ in range(2):
+        for request in reversed(requests):
+            assert table.token_generated(request.id) is request
+            request.output_stream.put("x")
+    assert table.lengths() == BatchLengths.of(requests) == (10, 21, 165, 10)
+
+    # The longest request leaves, then its slot is reused.
+    assert table.remove(9) is requests[9]
+    assert table.remove(9) is None
+    assert 9 not in table and table.get(9) is None
+    assert table.lengths() == BatchLengths.of(requests[:9]) == (9, 20, 144, 9)
+    new_request = _make_request(10, 5, 100)
+    table.add([new_request])
+    assert table.get(10) is new_request
+    assert len(table) == 10
+    assert table.lengths() == (10, 20, 149, 109)
+
+    # Requests generating past max_new_tokens don't go negative.
+    for _ in range(2):
+        table.token_generated(0)
+    assert table.lengths() == (10, 20, 151, 108)
@@ -0,0 +1,73 @@
+from aviary.backend.llm.continuous.inflight import BatchLengths
+from aviary.backend.llm.continuous.kv_cache import (
+    KVCacheLayout,
+    PaddedBudgetCalculator,
+    PagedBudgetCalculator,
+    SlidingWindowBudgetCalculator,
+)
+from aviary.backend.llm.continuous.policy import QuotaBasedRequestSelectionPolicy
+from aviary.backend.llm.continuous.queue import InferenceRequest, PriorityRequestQueue
+from aviary.backend.llm.continuous.types import Request
+
+
+def _make_request(id: int, input_length: int, max_new_tokens: int = 10):
+    return InferenceRequest.from_request(
+        Request(
+            id=id,
+            inputs="test",
+            truncate=input_length,
+            max_new_tokens=max_new_tokens,
+            params={},
+        ),
+        request_input_length=input_length,
+    )
+
+
+def test_budget_calculators():
+    lengths = BatchLengths.of([_make_request(0, 100), _make_request(1, 10)])
+    assert PaddedBudgetCalculator().num_tokens(lengths) == 2 * 100 + 20
+    # Masked rows can take a fifth of the rows, a quarter of the rows left.
+    assert PaddedBudgetCalculator(0.2).num_tokens(lengths) == 275
+    # A prefix cache of 50 tokens takes them from every batch.
+    assert PaddedBudgetCalculator(0.2, 50).num_tokens(lengths) == 325
+    # 4 more columns per row, and a fifth of the columns can be holes.
+    assert PaddedBudgetCalculator(0.2, 0, 4).num_tokens(lengths) == 357
+    assert PagedBudgetCalculator(block_size=1).num_tokens(lengths) == 130
+    assert PagedBudgetCalculator(block_size=16).num_tokens(lengths) == 130 + 30
+    assert SlidingWindowBudgetCalculator(32, block_size=1).num_tokens(lengths) == 64
+    assert (
+        SlidingWindowBudgetCalculator(1000, block_size=16).num_tokens(lengths)
+        == 130 + 30
+    )
+
+    assert isinstance(KVCacheLayout().budget_calculator(), PaddedBudgetCalculator)
+    assert KVCacheLayout(masked_fraction=0.2).budget_calculator().masked_fraction == 0.2
+    assert KVCacheLayout(reserved_tokens=50).budget_calculator().reserved_tokens == 50
+    calculator = KVCacheLayout(speculative_tokens=4).budget_calculator()
+    assert calculator.speculative_tokens == 4
+    calculator = KVCacheLayout(kind="paged", block_size=16).budget_calculator()
+    assert type(calculator) is PagedBudgetCalculator
+    assert calculator.block_size == 16
+    calculator = KVCacheLayout(
+        kind="paged", block_size=16, sliding_window=4096
+    ).budget_calculator()
+    assert isinstance(calculator, SlidingWindowBudgetCalculator)
+
+
+def test_quota_policy_paged_budget():
+    def select(layout: KVCacheLayout):
+        policy = QuotaBasedRequestSelectionPolicy(
+            max_batch_total_tokens=1000,
+            max_batch_prefill_tokens=1000,
+            budget_calculator=layout.budget_calculator(),
+        )
+        queue = PriorityRequestQueue()
+        queue.put_nowait(_make_request(0, 400))
+        for i in range(1, 20):
+            queue.put_nowait(_make_request(i, 20))
+        return [r.id for r in policy.select_new_requests([], queue)]
+
+    # Padded, every request counts as long as the longest one.
+    assert select(KVCacheLayout()) == [0, 1]
+    # 410 + 19 * 30 tokens.
+    assert select(KVCacheLayout(kind="paged", block_size=1)) == list(range(20))
@@ -0,0 +1,207 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from aviary.backend.llm.continuous.hf_transformers.paged_kv_cache import (
+    BlockManager,
+    KVCacheFullError,
+    PagedAttention,
+    PagedAttentionInputs,
+    PagedKVCache,
+    paged_attention,
+)
+from aviary.backend.llm.continuous.worker import is_oom
+
+
+def test_block_manager_allocates_and_frees_blocks():
+    block_manager = BlockManager(num_blocks=4, block_size=4)
+    block_table = block_manager.allocate(list(range(6)))
+    assert block_table == [0, 1]
+    assert block_manager.num_used_blocks == 2
+
+    slot, copy = block_manager.append_slot(block_table, 6)
+    assert (slot, copy) == (6, None)
+    slot, copy = block_manager.append_slot(block_table, 8)
+    assert (slot, copy) == (8, None)
+    assert block_table == [0, 1, 2]
+
+    block_manager.free(block_table)
+    assert block_table == []
+    assert block_manager.num_free_blocks == 4
+
+
+def test_block_manager_appends_the_same_slot_again():
+    block_manager = BlockManager(num_blocks=4, block_size=2)
+    block_table = block_manager.allocate([1, 2])
+    assert block_manager.append_slot(block_table, 2) == (2, None)
+    # Like a step that failed after appending, and is run again.
+    assert block_manager.num_blocks_to_append(block_table, 2) == 0
+    assert block_manager.append_slot(block_table, 2) == (2, None)
+    assert block_table == [0, 1]
+    assert block_manager.num_used_blocks == 2
+
+
+def test_block_manager_shares_full_prompt_blocks():
+    block_manager = BlockManager(num_blocks=8, block_size=2)
+    first = block_manager.allocate([1, 2, 3, 4, 5])
+    assert block_manager.num_new_blocks([1, 2, 3, 4, 6]) == 1
+    assert block_manager.num_new_blocks([1, 9, 3, 4]) == 2
+    second = block_manager.allocate([1, 2, 3, 4, 6])
+    # The full blocks are shared, the last partial one isn't.
+    assert first[:2] == second[:2]
+    assert first[2] != second[2]
+    assert block_manager.ref_count(first[0]) == 2
+    # The same tokens after another block don't match.
+    third = block_manager.allocate([9, 9, 3, 4])
+    assert not set(third) & set(first)
+
+    block_manager.free(first)
+    block_manager.free(second)
+    assert block_manager.num_used_blocks == 2
+    # The freed blocks are no longer shared.
+    assert block_manager.num_new_blocks([1, 2]) == 1
+
+
+def test_block_manager_copies_shared_blocks_on_write():
+    block_manager = BlockManager(num_blocks=4, block_size=4)
+    block_table = block_manager.allocate([1, 2, 3])
+    fork = block_manager.fork(block_table)
+    assert block_manager.num_blocks_to_append(fork, 3) == 1
+    slot, copy = block_manager.append_slot(fork, 3)
+    assert copy == (block_table[0], fork[0])
+    assert slot == fork[0] * 4 + 3
+    assert block_manager.ref_count(block_table[0]) == 1
+    # The original is no longer shared, so it is written in place.
+    assert block_manager.append_slot(block_table, 3) == (block_table[0] * 4 + 3, None)
+
+
+def test_block_manager_raises_when_full():
+    block_manager = BlockManager(num_blocks=2, block_size=2)
+    block_manager.allocate([1, 2, 3])
+    with pytest.raises(KVCacheFullError) as exc_info:
+        block_manager.allocate([4, 5])
+    assert is_oom(exc_info.value)
+    assert block_manager.num_free_blocks == 0
+
+
+def test_paged_kv_cache_gathers_padded_past():
+    cache = PagedKVCache(
+        num_blocks=4,
+        block_size=2,
+        num_layers=1,
+        num_heads=1,
+        head_dim=1,
+        dtype=torch.float32,
+        device=torch.device("cpu"),
+    )
+    # A padded past of two rows of 3 and 2 tokens, numbered by position.
+    keys = torch.tensor([[0.0, 1.0, 2.0], [-1.0, 10.0, 11.0]]).view(2, 1, 3, 1)
+    tables = [[3, 0], [1]]
+    slots, valid = cache.slot_table(tables, [3, 2], 3)
+    assert valid.tolist() == [[True, True, True], [False, True, True]]
+    cache.write(slots[valid], [(keys, keys)], *torch.nonzero(valid, as_tuple=True))
+    ((gathered, _),) = cache.gather(slots)
+    assert gathered[valid[:, None]].tolist() == keys[valid[:, None]].tolist()
+
+    cache.copy_blocks([(1, 2)])
+    assert cache.key_cache[0][4:6].view(-1).tolist() == [10.0, 11.0]
+
+
+def test_paged_attention_matches_dense_attention():
+    torch.manual_seed(0)
+    block_size, heads, kv_heads, head_dim = 4, 4, 2, 8
+    context_lens = [7, 3]
+    query_len = 2
+    cache = PagedKVCache(
+        num_blocks=6,
+        block_size=block_size,
+        num_layers=1,
+        num_heads=kv_heads,
+        head_dim=head_dim,
+        dtype=torch.float32,
+        device=torch.device("cpu"),
+    )
+    cache.key_cache[0].normal_()
+    cache.value_cache[0].normal_()
+    block_tables = [[4, 1], [2]]
+    query = torch.randn(len(context_lens), heads, query_len, head_dim)
+
+    output = paged_attention(
+        query,
+        cache.key_cache[0],
+        cache.value_cache[0],
+        torch.tensor([[4, 1], [2, 0]]),
+        torch.tensor(context_lens),
+        block_size,
+    )
+
+    for i, (block_table, context_len) in enumerate(zip(block_tables, context_lens)):
+        slots = torch.tensor(
+            [
+                block_table[p // block_size] * block_size + p % block_size
+                for p in range(context_len)
+            ]
+        )
+        keys = cache.key_cache[0][slots].transpose(0, 1).repeat_interleave(2, dim=0)
+        values = cache.value_cache[0][slots].transpose(0, 1).repeat_interleave(2, dim=0)
+        mask = torch.ones(query_len, context_len, dtype=torch.bool).tril(
+            context_len - query_len
+        )
+        expected = F.scaled_dot_product_attention(
+            query[i], keys, values, attn_mask=mask
+        )
+        torch.testing.assert_close(output[i], expected)
+
+
+@torch.inference_mode()
+def test_paged_attention_decodes_like_gpt2():
+    torch.manual_seed(0)
+    config = GPT2Config(vocab_size=16, n_positions=32, n_embd=16, n_layer=2, n_head=2)
+    config.scale_attn_by_inverse_layer_idx = True
+    model = GPT2LMHeadModel(config).eval()
+    block_size = 2
+    cache = PagedKVCache(
+        num_blocks=8,
+        block_size=block_size,
+        num_layers=2,
+        num_heads=2,
+        head_dim=8,
+        dtype=torch.float32,
+        device=torch.device("cpu"),
+    )
+    assert PagedAttention.supports(model)
+    attention = PagedAttention(model, cache)
+    prompts = [[3, 4, 5], [6, 7]]
+    block_tables = [[5, 1], [2]]
+    # The KV cache of the prompts, as a prefill outside of decode leaves it.
+    for prompt, block_table in zip(prompts, block_tables):
+        past = model(torch.tensor([prompt])).past_key_values
+        slots = [
+            block_table[p // block_size] * block_size + p % block_size
+            for p in range(len(prompt))
+        ]
+        cache.write(
+            torch.tensor(slots),
+            past,
+            torch.zeros(len(slots), dtype=torch.long),
+            torch.arange(len(slots)),
+        )
+    block_tables[1].append(3)
+
+    new_tokens = [8, 9]
+    inputs = PagedAttentionInputs(
+        slots=torch.tensor([1 * block_size + 1, 3 * block_size]),
+        block_tables=cache.block_table_tensor(block_tables),
+        context_lens=torch.tensor([4, 3]),
+    )
+    with attention.decode(inputs):
+        logits = model(
+            torch.tensor(new_tokens)[:, None],
+            position_ids=torch.tensor([[3], [2]]),
+            use_cache=False,
+        ).logits
+
+    for i, (prompt, token) in enumerate(zip(prompts, new_tokens)):
+        expected = model(torch.tensor([prompt + [token]])).logits[0, -1]
+        torch.testing.assert_close(logits[i, -1], expected)
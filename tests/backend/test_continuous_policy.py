@@ -0,0 +1,195 @@
+from aviary.backend.llm.continuous.estimator import OutputLengthEstimator
+from aviary.backend.llm.continuous.policy import (
+    FairShareRequestSelectionPolicy,
+    QuotaBasedRequestSelectionPolicy,
+)
+from aviary.backend.llm.continuous.queue import (
+    InferenceRequest,
+    PriorityRequestQueue,
+)
+from aviary.backend.llm.continuous.types import Request
+
+
+def _make_request(
+    id: int, input_length: int = 10, max_new_tokens: int = 10, tenant: str = ""
+):
+    return InferenceRequest.from_request(
+        Request(
+            id=id,
+            inputs="test",
+            truncate=input_length,
+            max_new_tokens=max_new_tokens,
+            params={},
+        ),
+        request_input_length=input_length,
+        tenant=tenant,
+    )
+
+
+def _make_queue(*requests: InferenceRequest) -> PriorityRequestQueue:
+    queue = PriorityRequestQueue()
+    for request in requests:
+        queue.put_nowait(request)
+    return queue
+
+
+def test_quota_policy_admits_everything_that_fits_when_idle():
+    policy = QuotaBasedRequestSelectionPolicy(
+        max_batch_total_tokens=60, max_batch_prefill_tokens=60
+    )
+    queue = _make_queue(*[_make_request(i) for i in range(4)])
+    selected = policy.select_new_requests([], queue)
+    # 3 requests * (10 input + 10 new tokens) fit into 60 tokens
+    assert [r.id for r in selected] == [0, 1, 2]
+    assert queue.qsize() == 1
+    assert policy.stats.num_admissions == 1
+
+
+def test_quota_policy_honours_waiting_served_ratio():
+    """New requests are only admitted once enough of them are waiting, or
+    max_waiting_tokens decode steps have passed."""
+    policy = QuotaBasedRequestSelectionPolicy(
+        max_batch_total_tokens=1000,
+        max_batch_prefill_tokens=1000,
+        waiting_served_ratio=1.0,
+        max_waiting_tokens=3,
+    )
+    in_process = [_make_request(i) for i in range(2)]
+    queue = _make_queue(_make_request(2))
+
+    for _ in range(3):
+        assert policy.select_new_requests(in_process, queue) == []
+    assert policy.stats.num_deferred_by_ratio == 3
+    assert policy.waiting_tokens == 3
+
+    selected = policy.select_new_requests(in_process, queue)
+    assert [r.id for r in selected] == [2]
+    assert policy.waiting_tokens == 0
+    assert policy.stats.num_forced_admissions == 1
+
+    queue = _make_queue(_make_request(3), _make_request(4))
+    selected = policy.select_new_requests(in_process, queue)
+    assert [r.id for r in selected] == [3, 4]
+    assert policy.stats.num_forced_admissions == 1
+
+
+def test_quota_policy_accounts_for_running_requests():
+    policy = QuotaBasedRequestSelectionPolicy(
+        max_batch_total_tokens=50,
+        max_batch_prefill_tokens=50,
+        max_waiting_tokens=0,
+    )
+    in_process = [_make_request(0)]
+    queue = _make_queue(_make_request(1), _make_request(2))
+    # Padded accounting: 10 * 2 input tokens + 10 * 2 new tokens
+    selected = policy.select_new_requests(in_process, queue)
+    assert [r.id for r in selected] == [1]
+
+    selected = policy.select_new_requests(in_process + selected, queue)
+    assert selected == []
+    assert policy.stats.num_deferred_by_budget == 1
+
+
+def test_quota_policy_lookahead_skips_oversized_head():
+    """In sjf/best_fit mode a long request at the head of the queue doesn't
+    block shorter requests behind it, unless it has waited for too long."""
+    requests = [
+        _make_request(0, input_length=40, max_new_tokens=40),
+        _make_request(1),
+        _make_request(2),
+    ]
+
+    policy = QuotaBasedRequestSelectionPolicy(
+        max_batch_total_tokens=50, max_batch_prefill_tokens=50
+    )
+    assert policy.select_new_requests([], _make_queue(*requests)) == []
+
+    policy = QuotaBasedRequestSelectionPolicy(
+        max_batch_total_tokens=50, max_batch_prefill_tokens=50, selection_mode="sjf"
+    )
+    queue = _make_queue(*requests)
+    selected = policy.select_new_requests([], queue)
+    assert [r.id for r in selected] == [1, 2]
+    assert [r.id for r in queue] == [0]
+    assert policy.stats.num_bypassed_requests == 1
+
+    policy = QuotaBasedRequestSelectionPolicy(
+        max_batch_total_tokens=50,
+        max_batch_prefill_tokens=50,
+        selection_mode="best_fit",
+        max_queue_wait_s=0,
+    )
+    queue = _make_queue(*requests)
+    assert policy.select_new_requests([], queue) == []
+    assert queue.qsize() == 3
+
+
+def test_fair_share_policy_shares_budget_by_weight():
+    # Every request reserves 20 tokens, so 8 of them fit in the budget.
+    policy = FairShareRequestSelectionPolicy(
+        tenant_weights={"a": 3},
+        max_batch_total_tokens=160,
+        max_batch_prefill_tokens=160,
+        selection_lookahead=64,
+    )
+    queue = _make_queue(
+        *[_make_request(i, tenant="a") for i in range(20)],
+        *[_make_request(i, tenant="b") for i in range(20, 40)],
+    )
+    selected = policy.select_new_requests([], queue)
+    assert [r.tenant for r in selected] == ["a", "b", "a", "a", "a", "b", "a", "a"]
+    assert queue.qsize() == 32
+
+    # Nothing was generated, all the reserved new tokens are refunded.
+    for request in selected:
+        policy.request_finished(request)
+    assert policy._tenants == {}
+
+
+def test_fair_share_policy_rate_limit():
+    policy = FairShareRequestSelectionPolicy(
+        tenant_max_tokens_per_s={"capped": 10},
+        max_batch_total_tokens=1000,
+        max_batch_prefill_tokens=1000,
+    )
+    queue = _make_queue(
+        *[_make_request(i, tenant="capped") for i in range(3)],
+        *[_make_request(i, tenant="free") for i in range(3, 5)],
+    )
+    # The capped tenant gets a single request in, the unused budget goes to
+    # the other tenant.
+    selected = policy.select_new_requests([], queue)
+    assert [r.id for r in selected] == [0, 3, 4]
+    assert policy.select_new_requests([], queue) == []
+    assert queue.qsize() == 2
+
+
+def test_quota_policy_output_length_estimator():
+    estimator = OutputLengthEstimator(quantile=0.9, min_samples=10)
+    policy = QuotaBasedRequestSelectionPolicy(
+        max_batch_total_tokens=200,
+        max_batch_prefill_tokens=200,
+        output_length_estimator=estimator,
+    )
+    # 2 requests * (10 input + 90 new tokens) fit into 200 tokens.
+    queue = _make_queue(*[_make_request(i, max_new_tokens=90) for i in range(10)])
+    selected = policy.select_new_requests([], queue)
+    assert [r.id for r in selected] == [0, 1]
+
+    # Requests that finished after 10 tokens, cancelled ones aren't counted.
+    for request in selected:
+        for _ in range(10):
+            request.output_stream.put("x")
+        request.cancelled = request.id == 0
+        policy.request_finished(request)
+    for i in range(10):
+        request = _make_request(100 + i)
+        for _ in range(10):
+            request.output_stream.put("x")
+        policy.request_finished(request)
+    assert len(estimator) == 11
+
+    # The 8 others fit, with 10 input + 10 estimated new tokens each.
+    selected = policy.select_new_requests([], queue)
+    assert [r.id for r in selected] == list(range(2, 10))
+    assert policy.reserved_gen_length(selected[0]) == 10
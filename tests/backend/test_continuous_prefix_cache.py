@@ -0,0 +1,135 @@
+from typing import List
+
+import torch
+from continuous_fakes import make_causal_lm_batch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from aviary.backend.llm.continuous.prefix_cache import (
+    KVSegment,
+    PrefixKVCache,
+    RadixPrefixCache,
+)
+
+
+def _segment(token_ids: List[int]) -> KVSegment:
+    """A KV cache of one layer whose entries are the token ids."""
+    tensor = torch.tensor(token_ids, dtype=torch.float32).view(1, 1, -1, 1)
+    return KVSegment([(tensor, tensor.clone())])
+
+
+def _loader(token_ids: List[int], loaded: list):
+    def load(start, end):
+        loaded.append((start, end))
+        return _segment(token_ids[start:end])
+
+    return load
+
+
+def _tokens(segments: List[KVSegment], num_tokens: int) -> List[int]:
+    return KVSegment.concat(segments, num_tokens)[0][1].view(-1).int().tolist()
+
+
+def test_radix_prefix_cache_match_and_insert():
+    cache = RadixPrefixCache(max_bytes=1 << 20)
+    loaded = []
+    assert cache.insert([1, 2, 3, 4], _loader([1, 2, 3, 4], loaded)) == 4
+    assert cache.match([9, 1]) == (0, [])
+
+    # Stopping partway through an edge still matches.
+    length, segments = cache.match([1, 2, 7])
+    assert length == 2
+    assert _tokens(segments, length) == [1, 2]
+
+    # Only the new tokens are loaded, and the edge is split where they start.
+    assert cache.insert([1, 2, 5, 6], _loader([1, 2, 5, 6], loaded)) == 2
+    assert loaded == [(0, 4), (2, 4)]
+    assert cache.num_bytes == 2 * 6 * 4
+    length, segments = cache.match([1, 2, 5, 6, 8])
+    assert length == 4
+    assert _tokens(segments, length) == [1, 2, 5, 6]
+    length, segments = cache.match([1, 2, 3, 4])
+    assert _tokens(segments, length) == [1, 2, 3, 4]
+
+    assert cache.insert([1, 2, 3], _loader([1, 2, 3], loaded)) == 0
+
+
+def test_radix_prefix_cache_evicts_least_recently_used_leaves():
+    # Room for 5 tokens.
+    cache = RadixPrefixCache(max_bytes=5 * 2 * 4)
+    cache.insert([1, 2, 3], _loader([1, 2, 3], []))
+    cache.insert([1, 2, 4], _loader([1, 2, 4], []))
+    cache.insert([1, 5, 6], _loader([1, 5, 6], []))
+    # [1, 2, 3] was used the longest ago.
+    assert cache.num_bytes == 5 * 2 * 4
+    assert cache.match([1, 2, 3])[0] == 2
+    assert cache.match([1, 2, 4])[0] == 3
+    assert cache.match([1, 5, 6])[0] == 3
+
+    # A parent left without children can go too, until there is room.
+    cache.insert([7, 8, 9, 10], _loader([7, 8, 9, 10], []))
+    assert cache.match([1, 2, 4])[0] == 1
+    assert cache.match([1, 5, 6])[0] == 1
+    assert cache.match([7, 8, 9, 10])[0] == 4
+    assert cache.num_bytes == 5 * 2 * 4
+
+
+def _make_batch(prompts: List[List[int]]):
+    return make_causal_lm_batch(dict(enumerate(prompts)), max_new_tokens=4)
+
+
+def _prefill(model, batch) -> torch.Tensor:
+    """Run a prefill like TGI's CausalLM, and return the next token logits."""
+    outputs = model(
+        input_ids=batch.input_ids,
+        attention_mask=batch.attention_mask[:, : -batch.padding_right_offset],
+        position_ids=batch.position_ids,
+        past_key_values=batch.past_key_values,
+        use_cache=True,
+    )
+    batch.past_key_values = [tuple(layer) for layer in outputs.past_key_values]
+    batch.max_input_length += 1
+    return outputs.logits[:, -1]
+
+
+@torch.inference_mode()
+def test_prefix_kv_cache_prefill_matches_full_prefill():
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(
+        GPT2Config(vocab_size=64, n_positions=64, n_embd=32, n_layer=2, n_head=2)
+    ).eval()
+    cache = PrefixKVCache(max_bytes=1 << 20, min_prefix_tokens=4)
+    system = [5, 6, 7, 8, 9, 10, 11, 12]
+
+    first = _make_batch([system + [20, 21], system + [30]])
+    reuse = cache.prepare(first, use_position_ids=True)
+    assert reuse.prefix_length == 0
+    _prefill(model, first)
+    cache.update(first, reuse)
+
+    prompts = [system + [20, 40, 41, 42], system + [50], system + [20, 21, 60]]
+    batch = _make_batch(prompts)
+    expected = _prefill(model, _make_batch(prompts))
+    reuse = cache.prepare(batch, use_position_ids=True)
+    assert reuse.prefix_length == len(system)
+    assert batch.input_ids.shape[1] == 4
+    assert not any(request.prefill_logprobs for request in batch.requests)
+    torch.testing.assert_close(_prefill(model, batch), expected)
+    cache.update(batch, reuse)
+
+    # The prompts of the batch are cached, from the right columns.
+    for prompt in prompts:
+        full = _make_batch([prompt])
+        _prefill(model, full)
+        length, segments = cache.tree.match(prompt)
+        assert length == len(prompt)
+        for (keys, values), (cached_keys, cached_values) in zip(
+            full.past_key_values, KVSegment.concat(segments, length)
+        ):
+            torch.testing.assert_close(cached_keys, keys)
+            torch.testing.assert_close(cached_values, values)
+
+    # Models without position ids only reuse prefixes of unpadded batches.
+    batch = _make_batch([system + [1], system + [2, 3]])
+    assert cache.prepare(batch, use_position_ids=False).prefix_length == 0
+    batch = _make_batch([system + [1], system + [2]])
+    assert cache.prepare(batch, use_position_ids=False).prefix_length == len(system)
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from aviary.backend.llm.continuous.queue import (
+    InferenceRequest,
+    PriorityRequestQueue,
+)
+from aviary.backend.llm.continuous.types import Request
+from aviary.backend.server.batch import QueuePriority
+
+
+def _make_request(
+    id: int,
+    submit_time_s: float,
+    priority: int = 0,
+    deadline_s: float = None,
+    tenant: str = "",
+):
+    request = InferenceRequest.from_request(
+        Request(id=id, inputs="test", truncate=10, max_new_tokens=10, params={}),
+        request_input_length=10,
+        priority=priority,
+        tenant=tenant,
+    )
+    request.submit_time_ns = int(submit_time_s * 1e9)
+    if deadline_s is not None:
+        request.deadline_ns = int(deadline_s * 1e9)
+    return request
+
+
+def _drain(queue: PriorityRequestQueue):
+    ids = []
+    while not queue.empty():
+        ids.append(queue.get_nowait().id)
+    return ids
+
+
+def test_priority_queue_orders_by_priority_with_aging():
+    queue = PriorityRequestQueue(priority_aging_s=10)
+    queue.put_nowait(_make_request(0, 0, QueuePriority.BATCH_GENERATE_TEXT))
+    queue.put_nowait(_make_request(1, 1))
+    queue.put_nowait(_make_request(2, 5, QueuePriority.BATCH_GENERATE_TEXT))
+    queue.put_nowait(_make_request(3, 9))
+    # Queued more than priority_aging_s after request 0.
+    queue.put_nowait(_make_request(4, 11))
+
+    assert [r.id for r in queue] == [1, 3, 0, 4, 2]
+    assert queue.peek(2) == list(queue)[:2]
+    assert _drain(queue) == [1, 3, 0, 4, 2]
+    with pytest.raises(asyncio.QueueEmpty):
+        queue.get_nowait()
+
+
+def test_priority_queue_deadlines():
+    queue = PriorityRequestQueue(priority_aging_s=10)
+    queue.put_nowait(_make_request(0, 0))
+    queue.put_nowait(
+        _make_request(1, 1, QueuePriority.BATCH_GENERATE_TEXT, deadline_s=2)
+    )
+    queue.put_nowait(_make_request(2, 3))
+    # A deadline can only make a request due earlier.
+    queue.put_nowait(_make_request(3, 0.5, deadline_s=100))
+    assert _drain(queue) == [0, 3, 1, 2]
+
+
+def test_priority_queue_put_front_and_remove():
+    queue = PriorityRequestQueue()
+    requests = [_make_request(i, i) for i in range(100)]
+    for request in requests:
+        queue.put_nowait(request)
+
+    for request in requests[:90:2]:
+        assert queue.remove(request.id) is request
+    assert queue.remove(0) is None
+    assert 0 not in queue and 1 in queue
+    assert queue.qsize() == len(queue) == 55
+
+    queue.put_front(queue.remove(99))
+    queue.put_front(queue.remove(95))
+    with pytest.raises(ValueError):
+        queue.put_nowait(requests[95])
+
+    expected = [95, 99] + list(range(1, 90, 2)) + [90, 91, 92, 93, 94, 96, 97, 98]
+    assert [r.id for r in queue] == expected
+    assert _drain(queue) == expected
+
+
+def test_priority_queue_tenants():
+    queue = PriorityRequestQueue()
+    for i in range(300):
+        queue.put_nowait(_make_request(i, i, tenant="a" if i % 3 else "b"))
+    assert sorted(queue.tenants()) == ["a", "b"]
+
+    queue.remove(0)
+    for _ in range(150):
+        queue.get_nowait()
+    assert [r.id for r in queue.peek(3, tenant="b")] == [153, 156, 159]
+    assert [r.id for r in queue.peek(3, tenant="a")] == [151, 152, 154]
+
+    while queue.peek(1, tenant="b"):
+        queue.remove(queue.peek(1, tenant="b")[0].id)
+    assert queue.tenants() == ["a"]
+    assert [r.id for r in queue] == [r.id for r in queue.peek(1000, tenant="a")]
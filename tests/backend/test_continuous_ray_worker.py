@@ -0,0 +1,25 @@
+import asyncio
+
+import torch
+
+from aviary.backend.llm.continuous.ray_worker import LocalInferenceWorker
+
+
+class _InferenceModeRecordingWorker:
+    def __init__(self):
+        self.inference_mode = []
+
+    def filter_requests(self, batch_id, request_ids, compact=False):
+        self.inference_mode.append(torch.is_inference_mode_enabled())
+        return batch_id
+
+
+def test_local_steps_run_in_inference_mode():
+    local_worker = _InferenceModeRecordingWorker()
+    worker = LocalInferenceWorker(local_worker, [])
+
+    assert worker.filter_requests(0, [1]) == 0
+    assert asyncio.run(worker.filter_requests_async(0, [1])) == 0
+    # The async steps run in the thread of the executor.
+    assert local_worker.inference_mode == [True, True]
+    assert not torch.is_inference_mode_enabled()
@@ -0,0 +1,144 @@
+import asyncio
+import math
+
+from continuous_fakes import FakeAsyncWorker
+
+from aviary.backend.llm.continuous.policy import QuotaBasedRequestSelectionPolicy
+from aviary.backend.llm.continuous.queue import PriorityRequestQueue
+from aviary.backend.llm.continuous.resident import (
+    Outbox,
+    OutboxTokenStream,
+    ResidentScheduler,
+    ResidentSchedulerClient,
+    StreamChunk,
+)
+from aviary.backend.llm.continuous.scheduler import (
+    AsyncInferenceScheduler,
+    NaiveTokenizer,
+)
+
+
+class _FakeActorMethod:
+    def __init__(self, method):
+        self._method = method
+
+    def remote(self, *args, **kwargs):
+        return asyncio.ensure_future(asyncio.to_thread(self._method, *args, **kwargs))
+
+
+class _FakeActorHandle:
+    """Calls the methods of an object in threads, like a threaded actor."""
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        return _FakeActorMethod(getattr(self._target, name))
+
+
+def _make_resident_scheduler(worker) -> ResidentScheduler:
+    return ResidentScheduler(
+        AsyncInferenceScheduler,
+        tokenizer=NaiveTokenizer(),
+        inference_worker_loader=lambda: worker,
+        request_selection_policy=QuotaBasedRequestSelectionPolicy(),
+        request_queue=PriorityRequestQueue(),
+    )
+
+
+def test_resident_scheduler_streams_to_client():
+    worker = FakeAsyncWorker()
+    resident = _make_resident_scheduler(worker)
+
+    async def run():
+        client = ResidentSchedulerClient(_FakeActorHandle(resident), poll_timeout_s=0.1)
+        streams = [
+            await client.process_request_async(
+                "hello world", {}, max_new_tokens=n, max_length=20
+            )
+            for n in (1, 5, 30)
+        ]
+
+        async def read(stream):
+            return [c async for c in stream.chunks()]
+
+        chunks = await asyncio.gather(*[read(stream) for stream in streams])
+        assert [stream.num_input_tokens for stream in streams] == [2, 2, 2]
+        assert [sum(n for _, n in c) for c in chunks] == [1, 5, 30]
+        assert ["".join(t for t, _ in c) for c in chunks] == ["x", "x" * 5, "x" * 30]
+        assert client._streams == {}
+
+    try:
+        asyncio.run(run())
+    finally:
+        resident.stop()
+    assert worker.batches == {}
+
+
+def test_outbox_coalesces_tokens_between_pulls():
+    outbox = Outbox()
+    stream = OutboxTokenStream(1, outbox)
+    stream.num_input_tokens = 4
+    assert outbox.pull(0) == {}
+
+    stream.put("a")
+    stream.put("bc", num_tokens=2)
+    OutboxTokenStream(2, outbox).put("d")
+    assert outbox.pull(0) == {
+        1: StreamChunk("abc", 3, 4),
+        2: StreamChunk("d", 1, None),
+    }
+
+    stream.put("e")
+    error = RuntimeError("step failed")
+    stream.fail(error)
+    assert outbox.pull(0) == {1: StreamChunk("e", 1, 4, ended=True, error=error)}
+    assert stream.num_tokens() == 4
+    assert stream.generated_text() == "abce"
+
+
+def test_resident_scheduler_cancel():
+    worker = FakeAsyncWorker()
+    resident = _make_resident_scheduler(worker)
+
+    async def run():
+        client = ResidentSchedulerClient(_FakeActorHandle(resident), poll_timeout_s=0.1)
+        cancelled = await client.process_request_async(
+            "cancel me", {}, max_new_tokens=1000
+        )
+        kept = await client.process_request_async("keep me", {}, max_new_tokens=10)
+        assert client.cancel_request(cancelled.id)
+        assert not client.cancel_request(cancelled.id)
+        assert [t async for t in cancelled] == []
+        assert "".join([t async for t in kept]) == "x" * 10
+        # The worker drops the cancelled request.
+        while worker.batches:
+            await asyncio.sleep(0.01)
+        assert client.estimate_queue_wait_s(0) == 0.0
+
+    try:
+        asyncio.run(run())
+    finally:
+        resident.stop()
+
+
+def test_client_queue_wait_is_unknown_until_estimated():
+    worker = FakeAsyncWorker()
+    resident = _make_resident_scheduler(worker)
+
+    async def run():
+        client = ResidentSchedulerClient(_FakeActorHandle(resident), poll_timeout_s=0.1)
+        # Not fetched yet, so load shedding doesn't let the request in.
+        assert client.estimate_queue_wait_s(1) == math.inf
+        # The estimate is fetched without waiting for a request or a pull.
+        for _ in range(100):
+            if math.isfinite(client.estimate_queue_wait_s(1)):
+                break
+            await asyncio.sleep(0.01)
+        assert client.estimate_queue_wait_s(1) == 0.0
+        assert client._poll_task is None
+
+    try:
+        asyncio.run(run())
+    finally:
+        resident.stop()
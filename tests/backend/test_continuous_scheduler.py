@@ -0,0 +1,501 @@
+import asyncio
+import math
+
+from continuous_fakes import FakeAsyncWorker, token_generation
+
+from aviary.backend.llm.continuous.metrics import SchedulerMetrics
+from aviary.backend.llm.continuous.policy import QuotaBasedRequestSelectionPolicy
+from aviary.backend.llm.continuous.queue import PriorityRequestQueue
+from aviary.backend.llm.continuous.scheduler import (
+    AsyncInferenceScheduler,
+    InferenceScheduler,
+    NaiveTokenizer,
+    PipelinedAsyncInferenceScheduler,
+    _reset_batch_id,
+)
+from aviary.backend.llm.continuous.worker import StepFailedError
+
+
+def _make_scheduler(**kwargs) -> InferenceScheduler:
+    return InferenceScheduler(
+        tokenizer=NaiveTokenizer(),
+        inference_worker_loader=lambda: None,
+        request_selection_policy=QuotaBasedRequestSelectionPolicy(),
+        request_queue=PriorityRequestQueue(),
+        inline=True,
+        **kwargs,
+    )
+
+
+def test_preempted_requests_resume_at_head_of_queue():
+    scheduler = _make_scheduler()
+    first_stream = scheduler.process_request(
+        "hello world", {}, max_new_tokens=10, max_length=20
+    )
+    scheduler.process_request("queued", {}, max_new_tokens=10, max_length=20)
+
+    first = scheduler._request_queue.get_nowait()
+    first_stream.put(" foo")
+    first_stream.put(" bar")
+
+    assert scheduler._handle_ooms(None, [first]) == (None, [])
+    assert scheduler._request_queue.peek(1) == [first]
+    assert scheduler._stats.num_requests_preempted == 1
+    assert scheduler._stats.num_preempted_tokens_kept == 2
+
+    # The generated tokens are kept and folded into the prompt.
+    request = first.generation_request
+    assert request.inputs == "hello world foo bar"
+    assert request.truncate == 22
+    assert request.max_new_tokens == 8
+    assert first.prefill_length == first.request_input_length + 2
+    assert first.input_length == first.request_input_length + 2
+    assert first.gen_length == 8
+
+
+def test_process_request_async_resolves_input_length():
+    async def run():
+        scheduler = _make_scheduler()
+        stream = await scheduler.process_request_async(
+            "hello world", {}, max_new_tokens=10, max_length=20
+        )
+        request = scheduler._request_queue.get_nowait()
+        assert request.output_stream is stream
+        assert request._request_input_length == 2
+
+    asyncio.run(run())
+
+
+def test_cancel_queued_request():
+    async def run():
+        scheduler = _make_scheduler()
+        stream = scheduler.process_request("cancel me", {}, max_new_tokens=10)
+        scheduler.process_request("keep me", {}, max_new_tokens=10)
+
+        assert scheduler.cancel_request(stream.id)
+        assert not scheduler.cancel_request(stream.id)
+        # The stream ends right away.
+        assert [t async for t in stream] == []
+
+        selected = await scheduler._select_new_requests([])
+        assert [r.request.inputs for r in selected] == ["keep me"]
+        assert scheduler._stats.num_requests_cancelled == 1
+
+    asyncio.run(run())
+
+
+class _FilterRecordingWorker:
+    def __init__(self):
+        self.filter_calls = []
+
+    def filter_requests(self, batch_id, request_ids, compact=False):
+        self.filter_calls.append((batch_id, request_ids))
+        return batch_id if request_ids else None
+
+
+def test_cancel_running_request_is_filtered_out():
+    scheduler = _make_scheduler()
+    scheduler._inference_worker = _FilterRecordingWorker()
+    scheduler.process_request("cancel me", {}, max_new_tokens=10)
+    scheduler.process_request("keep me", {}, max_new_tokens=10)
+    running = [scheduler._request_queue.get_nowait() for _ in range(2)]
+
+    assert scheduler._remove_cancelled_requests(0, running) == (0, running)
+    assert scheduler._inference_worker.filter_calls == []
+
+    scheduler.cancel_request(running[0].id)
+    batch_id, requests = scheduler._remove_cancelled_requests(0, running)
+    assert batch_id == 0
+    assert requests == [running[1]]
+    assert scheduler._inference_worker.filter_calls == [(0, [running[1].id])]
+
+
+def test_request_of_slow_reader_is_cancelled():
+    scheduler = _make_scheduler(max_stream_pending_tokens=2)
+    stream = scheduler.process_request("read me slowly", {}, max_new_tokens=10)
+    requests = [scheduler._request_queue.get_nowait()]
+    scheduler._in_flight.add(requests)
+
+    for _ in range(2):
+        requests, _ = scheduler._process_generation_result(
+            [token_generation(stream.id, 1, False)], requests
+        )
+    assert not requests[0].cancelled
+    requests, _ = scheduler._process_generation_result(
+        [token_generation(stream.id, 1, False)], requests
+    )
+    assert requests[0].cancelled
+    assert stream.overflowed()
+    assert not scheduler.cancel_request(stream.id)
+
+
+def test_pipelined_scheduler_generates_all_tokens():
+    async def run():
+        worker = FakeAsyncWorker()
+        scheduler = PipelinedAsyncInferenceScheduler(
+            tokenizer=NaiveTokenizer(),
+            inference_worker_loader=lambda: worker,
+            request_selection_policy=QuotaBasedRequestSelectionPolicy(),
+            request_queue=PriorityRequestQueue(),
+        )
+        streams = [
+            scheduler.process_request("hello", {}, max_new_tokens=i + 1)
+            for i in range(8)
+        ]
+        num_tokens = [sum([n async for _, n in stream.chunks()]) for stream in streams]
+        scheduler.stop()
+
+        assert num_tokens == [i + 1 for i in range(8)]
+        assert worker.batches == {}
+        assert scheduler._stats.num_active_requests == 0
+        assert scheduler._stats.num_tokens_in_flight == 0
+
+    asyncio.run(run())
+
+
+class _CallbackAsyncWorker(FakeAsyncWorker):
+    """Calls on_decode with the number of decode steps run so far, at the
+    start of each decode step."""
+
+    def __init__(self, on_decode):
+        super().__init__()
+        self.on_decode = on_decode
+
+    async def generate_next_token_async(self, batch_ids):
+        self.on_decode(self.num_decode_calls)
+        return await super().generate_next_token_async(batch_ids)
+
+
+def test_pipelined_scheduler_releases_requests_cancelled_mid_decode():
+    async def run():
+        in_flight_after_cancel = []
+
+        def on_decode(num_decode_calls):
+            if num_decode_calls == 2:
+                scheduler.cancel_request(cancelled.id)
+            elif num_decode_calls == 3:
+                in_flight_after_cancel.append(cancelled.id in scheduler._in_flight)
+
+        worker = _CallbackAsyncWorker(on_decode)
+        scheduler = PipelinedAsyncInferenceScheduler(
+            tokenizer=NaiveTokenizer(),
+            inference_worker_loader=lambda: worker,
+            request_selection_policy=QuotaBasedRequestSelectionPolicy(),
+            request_queue=PriorityRequestQueue(),
+        )
+        cancelled = scheduler.process_request("cancel me", {}, max_new_tokens=100)
+        kept = scheduler.process_request("keep me", {}, max_new_tokens=10)
+        assert sum([n async for _, n in kept.chunks()]) == 10
+        assert sum([n async for _, n in cancelled.chunks()]) < 10
+        scheduler.stop()
+
+        # Released when filtered out, before the next decode step.
+        assert in_flight_after_cancel == [False]
+        assert worker.batches == {}
+        assert len(scheduler._in_flight) == 0
+        assert scheduler._stats.num_requests_cancelled == 1
+        assert scheduler._stats.num_active_requests == 0
+        assert scheduler._stats.num_tokens_in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_multi_step_decode_when_queue_is_empty():
+    async def run():
+        worker = FakeAsyncWorker()
+        scheduler = AsyncInferenceScheduler(
+            tokenizer=NaiveTokenizer(),
+            inference_worker_loader=lambda: worker,
+            request_selection_policy=QuotaBasedRequestSelectionPolicy(),
+            request_queue=PriorityRequestQueue(),
+            max_decode_steps=8,
+            metrics=SchedulerMetrics("test-model"),
+        )
+        streams = [
+            scheduler.process_request("hello", {}, max_new_tokens=n)
+            for n in (5, 10, 30)
+        ]
+        num_tokens = [sum([n async for _, n in stream.chunks()]) for stream in streams]
+        scheduler.stop()
+
+        assert num_tokens == [5, 10, 30]
+        assert worker.batches == {}
+        # 29 decode steps, stopping early when the first two requests finish.
+        assert worker.num_decode_calls == 5
+        assert scheduler._stats.num_finished_requests == 3
+        assert scheduler._stats.num_active_requests == 0
+        assert scheduler._stats.num_tokens_in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_requests_finished_in_prefill_of_batch_0_are_filtered_out():
+    async def run():
+        _reset_batch_id()
+        worker = FakeAsyncWorker()
+        scheduler = AsyncInferenceScheduler(
+            tokenizer=NaiveTokenizer(),
+            inference_worker_loader=lambda: worker,
+            request_selection_policy=QuotaBasedRequestSelectionPolicy(),
+            request_queue=PriorityRequestQueue(),
+        )
+        # The first request finishes in the prefill of batch 0, and the
+        # fake worker fails if it is still in the batch in the next step.
+        streams = [
+            scheduler.process_request("hello", {}, max_new_tokens=n) for n in (1, 3)
+        ]
+        num_tokens = [
+            await asyncio.wait_for(read(stream), timeout=10) for stream in streams
+        ]
+        scheduler.stop()
+
+        assert num_tokens == [1, 3]
+        assert worker.batches == {}
+
+    async def read(stream):
+        return sum([n async for _, n in stream.chunks()])
+
+    asyncio.run(run())
+
+
+def test_oom_in_batch_0_is_recoverable():
+    scheduler = _make_scheduler()
+    scheduler._inference_worker = _FilterRecordingWorker()
+    for _ in range(2):
+        scheduler.process_request("hello", {}, max_new_tokens=10, max_length=20)
+    running = [scheduler._request_queue.get_nowait() for _ in range(2)]
+    scheduler._in_flight.add(running)
+
+    # Only the last request is preempted, batch 0 keeps the first one.
+    assert scheduler._handle_ooms(0, list(running)) == (0, running[:1])
+    assert scheduler._inference_worker.filter_calls == [(0, [running[0].id])]
+    assert scheduler._request_queue.peek(1) == [running[1]]
+
+
+class _SpeculativeAsyncWorker(FakeAsyncWorker):
+    """Generates up to 3 "x" per request per decode step, like speculative
+    steps whose drafts are all accepted."""
+
+    async def generate_next_token_async(self, batch_ids):
+        self.num_decode_calls += 1
+        batch_ids = [batch_id for batch_id in batch_ids if batch_id is not None]
+        requests = [r for batch_id in batch_ids for r in self.batches.pop(batch_id)]
+        self.batches[batch_ids[0]] = requests
+        generations = []
+        for _ in range(3):
+            generations += self._generate(
+                [r for r in requests if self.num_generated[r.id] < r.max_new_tokens]
+            )
+        return generations, batch_ids[0]
+
+
+def test_speculative_steps_generate_several_tokens_per_request():
+    async def run(scheduler_cls, max_decode_steps):
+        worker = _SpeculativeAsyncWorker()
+        scheduler = scheduler_cls(
+            tokenizer=NaiveTokenizer(),
+            inference_worker_loader=lambda: worker,
+            request_selection_policy=QuotaBasedRequestSelectionPolicy(),
+            request_queue=PriorityRequestQueue(),
+            max_decode_steps=max_decode_steps,
+        )
+        streams = [
+            scheduler.process_request("hello", {}, max_new_tokens=n)
+            for n in (1, 5, 10, 30)
+        ]
+        num_tokens = [sum([n async for _, n in stream.chunks()]) for stream in streams]
+        scheduler.stop()
+
+        assert num_tokens == [1, 5, 10, 30]
+        assert worker.batches == {}
+        assert worker.num_decode_calls < 29
+        assert scheduler._stats.num_tokens_generated == 46
+        assert scheduler._stats.num_active_requests == 0
+        assert scheduler._stats.num_tokens_in_flight == 0
+
+    asyncio.run(run(AsyncInferenceScheduler, 1))
+    asyncio.run(run(AsyncInferenceScheduler, 8))
+    asyncio.run(run(PipelinedAsyncInferenceScheduler, 1))
+
+
+class _FailingAsyncWorker(FakeAsyncWorker):
+    """Fails the prefills and decode steps with a request whose input starts
+    with "prefill error" or "decode error", and runs out of memory the first
+    time batches are merged, leaving the batches as they were."""
+
+    def __init__(self):
+        super().__init__()
+        self.num_ooms = 0
+        self.num_compact_filters = 0
+
+    async def process_new_batch_async(self, requests, batch_id):
+        if any(r.inputs.startswith("prefill error") for r in requests):
+            raise StepFailedError("prefill error")
+        # Preempted requests resume with the tokens they have left.
+        for request in requests:
+            self.num_generated.pop(request.id, None)
+        return await super().process_new_batch_async(requests, batch_id)
+
+    async def generate_next_token_async(self, batch_ids):
+        batch_ids = [batch_id for batch_id in batch_ids if batch_id is not None]
+        requests = [r for batch_id in batch_ids for r in self.batches[batch_id]]
+        oom = len(batch_ids) > 1 and not self.num_ooms
+        if oom or any(r.inputs.startswith("decode error") for r in requests):
+            self.num_ooms += oom
+            raise StepFailedError(
+                "decode error",
+                oom=oom,
+                request_ids_by_batch={
+                    batch_id: [r.id for r in self.batches[batch_id]]
+                    for batch_id in batch_ids
+                },
+            )
+        return await super().generate_next_token_async(batch_ids)
+
+    async def filter_requests_async(self, batch_id, request_ids, compact=False):
+        self.num_compact_filters += compact
+        return await super().filter_requests_async(batch_id, request_ids)
+
+
+def test_failed_steps_only_fail_the_requests_to_blame():
+    async def read(stream):
+        num_tokens = 0
+        try:
+            async for _, n in stream.chunks():
+                num_tokens += n
+        except StepFailedError:
+            return -num_tokens
+        return num_tokens
+
+    async def run():
+        worker = _FailingAsyncWorker()
+        scheduler = AsyncInferenceScheduler(
+            tokenizer=NaiveTokenizer(),
+            inference_worker_loader=lambda: worker,
+            request_selection_policy=QuotaBasedRequestSelectionPolicy(),
+            request_queue=PriorityRequestQueue(),
+        )
+        inputs = ["hello"] * 3 + ["prefill error", "decode error"] + ["hello"] * 3
+        streams = [
+            scheduler.process_request(text, {}, max_new_tokens=5) for text in inputs
+        ]
+        num_tokens = [await read(stream) for stream in streams]
+        scheduler.stop()
+
+        # The failed requests end with an error, after the tokens they
+        # generated before failing.
+        assert num_tokens == [5, 5, 5, 0, -1, 5, 5, 5]
+        assert worker.num_ooms == 1
+        # The batch split off on OOM is freed right away.
+        assert worker.num_compact_filters == 1
+        assert worker.batches == {}
+        assert scheduler._stats.num_ooms == 1
+        assert scheduler._stats.num_requests_failed == 2
+        assert scheduler._stats.num_active_requests == 0
+        assert scheduler._stats.num_tokens_in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_estimate_queue_wait():
+    scheduler = _make_scheduler()
+    # 2 input tokens + 8 new tokens, and 3 + 7.
+    scheduler.process_request("a b", {}, max_new_tokens=8, max_length=20)
+    scheduler.process_request("a b c", {}, max_new_tokens=7, max_length=20, priority=1)
+    # The throughput isn't known yet.
+    assert scheduler.estimate_queue_wait_s() == math.inf
+    scheduler._prior_tokens_released_per_s = 2
+    assert scheduler.estimate_queue_wait_s(priority=0) == 5
+
+    scheduler._stats.tokens_released_per_s = 5
+    assert scheduler.estimate_queue_wait_s(priority=0) == 2
+    assert scheduler.estimate_queue_wait_s(priority=1) == 4
+    scheduler._request_queue.get_nowait()
+    assert scheduler.estimate_queue_wait_s(priority=1) == 2
+
+    # No request left the batch lately, the best measured rate is used.
+    scheduler._stats.max_tokens_released_per_s = 10
+    scheduler._stats.tokens_released_per_s = 0
+    assert scheduler.estimate_queue_wait_s(priority=1) == 1
+
+    scheduler._request_queue.get_nowait()
+    assert scheduler.estimate_queue_wait_s(priority=1) == 0
+
+
+class _ChunkingAsyncWorker(FakeAsyncWorker):
+    """Prefills in chunks, a token per word of the longest prompt per
+    request, logging the steps."""
+
+    def __init__(self):
+        super().__init__()
+        self.steps = []
+        # Requests and tokens left to prefill, by batch id.
+        self.partial_batches = {}
+
+    async def prefill_chunk_async(self, requests, batch_id, max_tokens):
+        if requests is not None:
+            num_tokens = len(requests) * max(len(r.inputs.split()) for r in requests)
+            self.partial_batches[batch_id] = (requests, num_tokens)
+        requests, num_tokens = self.partial_batches[batch_id]
+        if num_tokens <= max_tokens:
+            return 0
+        self.partial_batches[batch_id] = (requests, num_tokens - max_tokens)
+        self.steps.append("chunk")
+        return num_tokens - max_tokens
+
+    async def process_new_batch_async(self, requests, batch_id):
+        partial = self.partial_batches.pop(batch_id, None)
+        if partial is not None:
+            assert [r.id for r in partial[0]] == [r.id for r in requests]
+        self.steps.append("prefill")
+        return await super().process_new_batch_async(requests, batch_id)
+
+    async def generate_next_token_async(self, batch_ids):
+        self.steps.append("decode")
+        return await super().generate_next_token_async(batch_ids)
+
+
+def test_long_prompts_are_prefilled_in_chunks_between_decode_steps():
+    async def run():
+        worker = _ChunkingAsyncWorker()
+        scheduler = AsyncInferenceScheduler(
+            tokenizer=NaiveTokenizer(),
+            inference_worker_loader=lambda: worker,
+            request_selection_policy=QuotaBasedRequestSelectionPolicy(),
+            request_queue=PriorityRequestQueue(),
+            max_step_tokens=11,
+        )
+        running = scheduler.process_request("hello", {}, max_new_tokens=30)
+        tokens = running.chunks()
+        await tokens.__anext__()
+        long = scheduler.process_request("word " * 45, {}, max_new_tokens=5)
+        while "chunk" not in worker.steps:
+            await asyncio.sleep(0.001)
+        short = scheduler.process_request("hi", {}, max_new_tokens=5)
+        num_tokens = [
+            1 + sum([n async for _, n in tokens]),
+            sum([n async for _, n in long.chunks()]),
+            sum([n async for _, n in short.chunks()]),
+        ]
+        scheduler.stop()
+
+        assert num_tokens == [30, 5, 5]
+        assert worker.batches == {}
+        assert worker.partial_batches == {}
+        # Chunks of 10 tokens, 11 minus one for the running request, each
+        # followed by a decode step, until the last 5 are prefilled with the
+        # first token. The short request waits for the long one to be
+        # prefilled.
+        first_chunk = worker.steps.index("chunk")
+        assert worker.steps[first_chunk : first_chunk + 10] == [
+            "chunk",
+            "decode",
+        ] * 4 + [
+            "prefill",
+            "decode",
+        ]
+        assert worker.steps.count("prefill") == 3
+        assert scheduler._stats.num_active_requests == 0
+        assert scheduler._stats.num_tokens_in_flight == 0
+
+    asyncio.run(run())
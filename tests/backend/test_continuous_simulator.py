@@ -0,0 +1,53 @@
+import asyncio
+
+from aviary.backend.llm.continuous.simulator import (
+    CostModel,
+    TraceRequest,
+    simulate,
+    synthetic_trace,
+)
+from aviary.backend.server.models import ContinuousBatchingGenerationConfig
+
+
+def _simulate(trace, cost_model=None, **generation_config):
+    return asyncio.run(
+        simulate(
+            trace,
+            ContinuousBatchingGenerationConfig(**generation_config),
+            cost_model,
+        )
+    )
+
+
+def test_simulate_single_request():
+    cost_model = CostModel(
+        prefill_base_s=0.1,
+        prefill_per_token_s=0,
+        decode_base_s=0.01,
+        decode_per_request_s=0,
+        decode_per_kv_token_s=0,
+        rpc_latency_s=0,
+    )
+    result = _simulate(
+        [TraceRequest(arrival_time_s=1.0, input_tokens=10, output_tokens=5)],
+        cost_model,
+    )
+    # The first token comes out of the prefill, the 4 others out of decode
+    # steps.
+    assert abs(result.duration_s - 1.14) < 1e-9
+    assert abs(result.ttft_p50_s - 0.1) < 1e-9
+    assert abs(result.itl_p50_s - 0.01) < 1e-9
+    assert result.num_ooms == 0
+
+
+def test_simulate_preempts_requests_on_oom():
+    trace = synthetic_trace(200, rate=50, seed=1)
+    result = _simulate(trace, CostModel(kv_capacity_tokens=6000))
+    assert result.num_ooms > 0
+    assert result.num_preemptions > 0
+    assert result.num_requests == 200
+
+    result = _simulate(trace, CostModel())
+    assert result.num_ooms == 0
+    assert result.num_preemptions == 0
+    assert 0 < result.kv_utilization <= result.peak_kv_utilization <= 1
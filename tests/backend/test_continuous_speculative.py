@@ -0,0 +1,170 @@
+from typing import List
+
+import pytest
+import torch
+from continuous_fakes import make_causal_lm_batch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from aviary.backend.llm.continuous.speculative import (
+    PromptLookupDrafter,
+    accept_speculation,
+    compact_holes,
+    num_hole_columns,
+    speculate,
+)
+
+
+def test_prompt_lookup_drafter_proposes_what_followed_the_longest_match():
+    drafter = PromptLookupDrafter([1, 2, 3, 4, 9, 2, 3, 5, 6], max_draft_tokens=3)
+    assert drafter.propose(8) == []
+
+    # [2, 3] was last followed by 5, [7, 2, 3] never occurred.
+    drafter.extend([7, 2, 3])
+    assert drafter.propose(8) == [5, 6, 7]
+    assert drafter.propose(2) == [5, 6]
+
+    # Only 1-grams match.
+    drafter.extend([4])
+    assert drafter.propose(8) == [9, 2, 3]
+
+
+def test_prompt_lookup_drafter_adapts_draft_length():
+    drafter = PromptLookupDrafter([1, 2, 3, 1, 2, 3, 1], max_draft_tokens=4)
+    # The proposal stops at the end of the sequence.
+    assert drafter.propose(8) == [2, 3, 1]
+    for _ in range(5):
+        drafter.accepted(4, 0)
+    assert drafter.draft_length == 1
+    assert drafter.propose(8) == [2]
+    for _ in range(10):
+        drafter.accepted(1, 1)
+    assert drafter.draft_length == 4
+
+
+def _start_decoding(model, prompts: List[List[int]], max_new_tokens: int):
+    """Prefill a batch like TGI's CausalLM, returning it and the first
+    generated token of each prompt."""
+    batch = make_causal_lm_batch(dict(enumerate(prompts)), max_new_tokens)
+    width = batch.max_input_length
+    outputs = model(
+        input_ids=batch.input_ids,
+        attention_mask=batch.attention_mask[:, :width],
+        position_ids=batch.position_ids,
+        use_cache=True,
+    )
+    next_token_ids = outputs.logits[:, -1].argmax(-1)
+    batch.attention_mask[:, width] = 1
+    batch.input_ids = next_token_ids.view(-1, 1)
+    batch.position_ids = batch.position_ids[:, -1:] + 1
+    batch.past_key_values = outputs.past_key_values
+    batch.input_lengths = [len(prompt) + 1 for prompt in prompts]
+    batch.max_input_length = width + 1
+    batch.padding_right_offset = max_new_tokens - 1
+    return batch, next_token_ids.tolist()
+
+
+def _speculative_greedy_decode(model, prompts, max_new_tokens, compact_after):
+    batch, first_token_ids = _start_decoding(model, prompts, max_new_tokens)
+    outputs = [[token_id] for token_id in first_token_ids]
+    drafters = [
+        PromptLookupDrafter(prompt + output, max_draft_tokens=4)
+        for prompt, output in zip(prompts, outputs)
+    ]
+    num_passes = 0
+    while min(len(output) for output in outputs) < max_new_tokens:
+        drafts = [
+            drafter.propose(max_new_tokens - len(output) - 1)
+            for drafter, output in zip(drafters, outputs)
+        ]
+        input_ids, attention_mask, position_ids = speculate(batch, drafts)
+        result = model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=batch.past_key_values,
+            use_cache=True,
+        )
+        num_passes += 1
+        predicted = result.logits.argmax(-1).tolist()
+        num_accepted = []
+        for draft, tokens, output, drafter in zip(drafts, predicted, outputs, drafters):
+            n = 1
+            while n <= len(draft) and tokens[n - 1] == draft[n - 1]:
+                n += 1
+            drafter.accepted(len(draft), n - 1)
+            drafter.extend(tokens[:n])
+            output.extend(tokens[:n])
+            num_accepted.append(n)
+        accept_speculation(
+            batch,
+            result.past_key_values,
+            max(len(draft) for draft in drafts),
+            num_accepted,
+            [output[-1] for output in outputs],
+            max(max_new_tokens - min(len(output) for output in outputs), 0),
+        )
+        if num_passes == compact_after:
+            assert num_hole_columns(batch) > 0
+            compact_holes(batch)
+            assert num_hole_columns(batch) == 0
+            assert batch.attention_mask.shape[1] == (
+                batch.max_input_length + batch.padding_right_offset
+            )
+    return [output[:max_new_tokens] for output in outputs], num_passes
+
+
+@torch.inference_mode()
+def test_speculative_decoding_matches_greedy_decoding():
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(
+        GPT2Config(vocab_size=32, n_positions=128, n_embd=32, n_layer=2, n_head=2)
+    ).eval()
+    prompts = [
+        [3, 4, 5, 6, 7, 3, 4, 5, 6, 7, 3, 4],
+        [9, 1, 9, 2, 9, 1],
+        [8, 8, 2, 10, 11, 12, 13, 14, 15, 2, 10, 11, 12],
+    ]
+    max_new_tokens = 24
+    expected = [
+        model.generate(
+            torch.tensor([prompt]),
+            attention_mask=torch.ones(1, len(prompt)),
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=0,
+        )[0, len(prompt) :].tolist()
+        for prompt in prompts
+    ]
+
+    for compact_after in (0, 3):
+        outputs, num_passes = _speculative_greedy_decode(
+            model, prompts, max_new_tokens, compact_after
+        )
+        assert outputs == expected
+        # The repetitions were guessed.
+        assert num_passes < max_new_tokens - 1
+
+
+@torch.inference_mode()
+def test_failed_acceptance_leaves_the_batch_as_it_was():
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(
+        GPT2Config(vocab_size=32, n_positions=64, n_embd=32, n_layer=2, n_head=2)
+    ).eval()
+    batch, next_token_ids = _start_decoding(model, [[1, 2, 3], [4, 5]], 6)
+    input_ids, attention_mask, position_ids = speculate(batch, [[7, 8], [9]])
+    result = model(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        position_ids=position_ids,
+        past_key_values=batch.past_key_values,
+        use_cache=True,
+    )
+    fields = dict(vars(batch))
+    mask = batch.attention_mask.clone()
+
+    # An accepted count too many for the rows of the batch.
+    with pytest.raises(RuntimeError):
+        accept_speculation(batch, result.past_key_values, 2, [1, 2, 1], [5, 6], 0)
+    assert vars(batch) == fields
+    assert torch.equal(batch.attention_mask, mask)
@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+from typing import List
+
+from aviary.backend.llm.continuous.generations import GeneratedText, TokenGeneration
+from aviary.backend.llm.continuous.worker import AbstractInferenceWorker
+from aviary.backend.llm.pipelines.tgi import TextGenerationInferencePipeline
+from aviary.backend.llm.predictor.continuous_batching_predictor import (
+    ContinuousBatchingPredictionWorker,
+)
+
+
+class _FakeModel(AbstractInferenceWorker):
+    """A TGI model generating token i at step i, and finishing each request
+    after its own number of steps."""
+
+    def __init__(self, lengths):
+        self.lengths = dict(lengths)
+        self.step = 0
+        self.filtered = []
+
+    def process_new_batch(self, requests, batch_id):
+        raise NotImplementedError
+
+    def generate_next_token(self, batch_ids: List[int]):
+        self.step += 1
+        generations = [
+            TokenGeneration(
+                id,
+                self.step,
+                -0.5,
+                f" t{self.step}",
+                False,
+                GeneratedText("done", self.step, 0) if self.step == length else None,
+            )
+            for id, length in self.lengths.items()
+        ]
+        return generations, batch_ids[0]
+
+    def filter_requests(self, batch_id, request_ids, compact=False):
+        self.filtered.append(request_ids)
+        self.lengths = {id: self.lengths[id] for id in request_ids}
+        return batch_id
+
+
+def _make_prediction_worker(model):
+    # TextGenerationInferencePipeline.__init__ takes the tokenizer of a TGI
+    # model, which needs text-generation-inference.
+    pipeline = TextGenerationInferencePipeline.__new__(TextGenerationInferencePipeline)
+    pipeline.model = model
+    pipeline._rank = 0
+    return SimpleNamespace(generator=pipeline, current_device=None)
+
+
+def test_prediction_worker_generates_next_tokens_through_pipeline():
+    model = _FakeModel({0: 2, 1: 5})
+    worker = _make_prediction_worker(model)
+
+    steps, batch_id = ContinuousBatchingPredictionWorker.generate_next_tokens(
+        worker, [7], 4
+    )
+
+    # The steps stop once request 0 finishes, and it is filtered out.
+    steps = [columns.to_generations() for columns in steps]
+    assert [[g.token_id for g in generations] for generations in steps] == [
+        [1, 1],
+        [2, 2],
+    ]
+    assert steps[1][0].generated_text.text == "done"
+    assert steps[1][1].generated_text is None
+    assert batch_id == 7
+    assert model.filtered == [[1]]
@@ -0,0 +1,437 @@
+import threading
+from collections import Counter
+from datetime import timedelta
+from types import SimpleNamespace
+from typing import Dict, List
+
+import pytest
+import torch
+from continuous_fakes import FakeCausalLMBatch, make_causal_lm_batch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from aviary.backend.llm.continuous.prefix_cache import KVSegment
+from aviary.backend.llm.continuous.tgi.tgi_worker import InferenceWorker, _StepSnapshot
+from aviary.backend.llm.continuous.worker import StepFailedError
+
+
+class _FakeModel:
+    """A TGI CausalLM around a GPT-2 model, that picks tokens greedily."""
+
+    device = torch.device("cpu")
+    has_position_ids = True
+
+    def __init__(self, model: GPT2LMHeadModel):
+        self.model = model
+        # Row of the next step to fail at, after updating the rows before.
+        self.fail_at_row = None
+        # Next token logits of the last step.
+        self.last_logits = None
+
+    def forward(self, input_ids, attention_mask, position_ids, past_key_values=None):
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        return outputs.logits, outputs.past_key_values
+
+    def generate_token(self, batch: FakeCausalLMBatch):
+        logits, past_key_values = self.forward(
+            batch.input_ids,
+            batch.attention_mask[:, : -batch.padding_right_offset],
+            batch.position_ids,
+            batch.past_key_values,
+        )
+        self.last_logits = logits[:, -1]
+        generations = []
+        stopped = True
+        for i, (request, stopping_criteria) in enumerate(
+            zip(batch.requests, batch.stopping_criterias)
+        ):
+            if i == self.fail_at_row:
+                self.fail_at_row = None
+                raise RuntimeError(f"Failed at row {i}")
+            token_id = logits[i, -1].argmax()
+            batch.all_input_ids[i] = torch.cat(
+                [batch.all_input_ids[i], token_id.view(1, 1)]
+            )
+            batch.input_lengths[i] += 1
+            batch.input_ids[i, 0] = token_id
+            batch.max_input_length = max(batch.max_input_length, batch.input_lengths[i])
+            stopping_criteria.current_tokens += 1
+            stop = stopping_criteria.current_tokens >= stopping_criteria.max_new_tokens
+            stopped = stopped and stop
+            generations.append(
+                SimpleNamespace(request_id=request.id, token_id=token_id)
+            )
+        if stopped:
+            return generations, None
+        batch.input_ids = batch.input_ids[:, :1]
+        batch.attention_mask[:, -batch.padding_right_offset] = 1
+        batch.padding_right_offset -= 1
+        batch.position_ids = batch.position_ids[:, -1:] + 1
+        batch.past_key_values = past_key_values
+        return generations, batch
+
+
+class _Metric:
+    def __init__(self, values: Counter, name: str):
+        self._values = values
+        self._name = name
+
+    def inc(self, value: float = 1):
+        self._values[self._name] += value
+
+    def set(self, value: float):
+        self._values[self._name] = value
+
+
+class _Metrics:
+    """Records what the worker exports to its WorkerMetrics."""
+
+    def __init__(self):
+        self.values = Counter()
+
+    def __getattr__(self, name: str) -> _Metric:
+        return _Metric(self.values, name)
+
+    def inc(self, metric: _Metric, value: float = 1):
+        metric.inc(value)
+
+
+def _make_model() -> GPT2LMHeadModel:
+    torch.manual_seed(0)
+    return GPT2LMHeadModel(
+        GPT2Config(vocab_size=32, n_positions=128, n_embd=32, n_layer=2, n_head=2)
+    ).eval()
+
+
+def _kv_cache_bytes(batch: FakeCausalLMBatch) -> int:
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for layer in batch.past_key_values
+        for tensor in layer
+    )
+
+
+@torch.inference_mode()
+def _greedy(model, token_ids: List[int], max_new_tokens: int) -> List[int]:
+    """Greedy decoding of a single prompt, without padding or KV cache."""
+    token_ids = list(token_ids)
+    output = []
+    for _ in range(max_new_tokens):
+        logits = model(torch.tensor([token_ids])).logits[0, -1]
+        output.append(int(logits.argmax()))
+        token_ids.append(output[-1])
+    return output
+
+
+class _Decoder:
+    """Drives a worker the way the scheduler does: prefills batches, decodes
+    them together, and filters out the requests that are done."""
+
+    def __init__(self, worker: InferenceWorker, max_new_tokens: int):
+        self.worker = worker
+        self.max_new_tokens = max_new_tokens
+        self.outputs: Dict[int, List[int]] = {}
+
+    def prefill(self, batch_id: int, prompts: Dict[int, List[int]]) -> int:
+        batch = make_causal_lm_batch(prompts, self.max_new_tokens, batch_id)
+        generations, batch = self.worker._model.generate_token(batch)
+        self.worker._batch_state_cache[batch_id] = batch
+        self._record(generations)
+        return batch_id
+
+    def step(self, batch_ids: List[int]) -> int:
+        generations, batch_id = self.worker.generate_next_token(batch_ids)
+        self._record(generations)
+        return batch_id
+
+    def filter(self, batch_id: int, request_ids: List[int]) -> int:
+        return self.worker.filter_requests(batch_id, request_ids)
+
+    def finish(self, batch_id: int):
+        """Decode until every request generated all of its tokens."""
+        while batch_id is not None:
+            running = [
+                request_id
+                for request_id in self._request_ids(batch_id)
+                if len(self.outputs[request_id]) < self.max_new_tokens
+            ]
+            batch_id = self.filter(batch_id, running)
+            if batch_id is not None:
+                batch_id = self.step([batch_id])
+
+    def _request_ids(self, batch_id: int) -> List[int]:
+        batch = self.worker._batch_state_cache[batch_id]
+        masked = self.worker._masked_requests.get(batch_id, set())
+        return [r for r in batch.requests_idx_mapping if r not in masked]
+
+    def _record(self, generations):
+        for generation in generations:
+            self.outputs.setdefault(generation.request_id, []).append(
+                int(generation.token_id)
+            )
+
+
+PROMPTS = {
+    0: [3, 4, 5, 6, 7, 3, 4, 5],
+    1: [9, 1, 9, 2],
+    2: [8, 8, 2, 10, 11, 12],
+    3: [20, 21],
+    4: [5, 6, 7, 8, 9, 10, 11],
+    5: [12, 13, 14],
+    6: [15, 16, 17, 18],
+}
+
+
+def test_new_batch_is_merged_into_masked_rows_in_place():
+    model = _make_model()
+    metrics = _Metrics()
+    worker = InferenceWorker(
+        lambda: _FakeModel(model), max_masked_fraction=0.5, metrics=metrics
+    )
+    assert worker.get_kv_cache_layout().masked_fraction == 0.5
+    decoder = _Decoder(worker, max_new_tokens=6)
+
+    with torch.inference_mode():
+        batch_id = decoder.prefill(0, {i: PROMPTS[i] for i in range(5)})
+        batch_id = decoder.step([batch_id])
+        # Requests 1 and 3 leave, their rows are only masked.
+        assert decoder.filter(batch_id, [0, 2, 4]) == batch_id
+        assert metrics.values["lazy_batch_filters"] == 1
+        assert metrics.values["masked_requests"] == 2
+        host = worker._batch_state_cache[batch_id]
+
+        new_batch_id = decoder.prefill(1, {5: PROMPTS[5], 6: PROMPTS[6]})
+        new_bytes = _kv_cache_bytes(worker._batch_state_cache[new_batch_id])
+        # The new requests take the masked rows, and the KV cache of the
+        # running batch is not copied.
+        merged_id = decoder.step([batch_id, new_batch_id])
+        assert merged_id == batch_id
+        assert metrics.values["in_place_batch_concatenations"] == 1
+        assert metrics.values["batch_concatenations"] == 0
+        assert metrics.values["kv_cache_bytes_copied"] == new_bytes
+        assert worker._masked_requests.get(batch_id) is None
+        assert sorted(host.requests_idx_mapping) == [0, 2, 4, 5, 6]
+        assert len(host) == 5
+
+        decoder.finish(merged_id)
+
+    for request_id in (0, 2, 4, 5, 6):
+        assert decoder.outputs[request_id] == _greedy(model, PROMPTS[request_id], 6)
+
+
+def test_compaction_keeps_spare_rows():
+    model = _make_model()
+    metrics = _Metrics()
+    worker = InferenceWorker(
+        lambda: _FakeModel(model), max_masked_fraction=0.5, metrics=metrics
+    )
+    decoder = _Decoder(worker, max_new_tokens=4)
+
+    with torch.inference_mode():
+        batch_id = decoder.prefill(0, {i: PROMPTS[i % 7] for i in range(10)})
+        batch_id = decoder.step([batch_id])
+        # 6 of 10 rows masked is too many, the batch is compacted, but a
+        # quarter of the requests left are kept masked, as spare rows.
+        batch_id = decoder.filter(batch_id, [0, 1, 2, 3])
+        batch = worker._batch_state_cache[batch_id]
+        assert len(batch) == 5
+        assert worker._masked_requests[batch_id] == {4}
+        assert metrics.values["batch_filters"] == 1
+        assert metrics.values["kv_cache_bytes_copied"] == _kv_cache_bytes(batch)
+
+        # Filtering out nothing copies nothing.
+        worker._compact(batch, set())
+        assert metrics.values["batch_filters"] == 1
+
+
+def test_compact_filter_frees_the_rows():
+    model = _make_model()
+    metrics = _Metrics()
+    worker = InferenceWorker(
+        lambda: _FakeModel(model), max_masked_fraction=0.5, metrics=metrics
+    )
+    decoder = _Decoder(worker, max_new_tokens=4)
+
+    with torch.inference_mode():
+        batch_id = decoder.prefill(0, {i: PROMPTS[i] for i in range(4)})
+        batch_id = decoder.step([batch_id])
+        # Filtering out a request to recover from an OOM frees its row,
+        # without keeping spare rows.
+        batch_id = worker.filter_requests(batch_id, [0, 1, 2], compact=True)
+        assert len(worker._batch_state_cache[batch_id]) == 3
+        assert worker._masked_requests.get(batch_id) is None
+        assert metrics.values["lazy_batch_filters"] == 0
+        assert metrics.values["batch_filters"] == 1
+
+        decoder.finish(batch_id)
+
+    for request_id in range(3):
+        assert decoder.outputs[request_id] == _greedy(model, PROMPTS[request_id], 4)
+
+
+def test_batch_partly_updated_by_a_failed_step_is_restored():
+    model = _make_model()
+    fake_model = _FakeModel(model)
+    worker = InferenceWorker(lambda: fake_model, metrics=_Metrics())
+    decoder = _Decoder(worker, max_new_tokens=4)
+
+    with torch.inference_mode():
+        batch_id = decoder.prefill(0, {i: PROMPTS[i] for i in range(3)})
+        batch_id = decoder.step([batch_id])
+        # The step fails after the next token of the first two rows.
+        fake_model.fail_at_row = 2
+        with pytest.raises(StepFailedError) as excinfo:
+            decoder.step([batch_id])
+        assert excinfo.value.request_ids_by_batch == {batch_id: [0, 1, 2]}
+        batch = worker._batch_state_cache[batch_id]
+        assert batch.input_lengths == [len(PROMPTS[i]) + 2 for i in range(3)]
+        assert [s.current_tokens for s in batch.stopping_criterias] == [2, 2, 2]
+
+        decoder.finish(batch_id)
+
+    for request_id in range(3):
+        assert decoder.outputs[request_id] == _greedy(model, PROMPTS[request_id], 4)
+
+
+def test_snapshot_rewinds_the_generators_of_sampling_requests():
+    batch = make_causal_lm_batch({0: [1, 2]}, 4)
+    generator = torch.Generator().manual_seed(0)
+    batch.next_token_choosers = [
+        SimpleNamespace(choice=SimpleNamespace(generator=generator))
+    ]
+    snapshot = _StepSnapshot(batch)
+    sample = torch.rand(1, generator=generator)
+    assert snapshot.restore()
+    assert torch.rand(1, generator=generator) == sample
+
+
+def test_prefix_cache_is_budgeted():
+    model = _make_model()
+    # 2 layers of keys and values of 32 floats per token.
+    worker = InferenceWorker(lambda: _FakeModel(model), prefix_cache_max_bytes=5000)
+    assert worker.get_kv_cache_layout().reserved_tokens == 10
+    worker = InferenceWorker(lambda: _FakeModel(model))
+    assert worker.get_kv_cache_layout().reserved_tokens == 0
+
+
+def test_speculation_is_budgeted():
+    model = _make_model()
+    worker = InferenceWorker(lambda: _FakeModel(model), speculative_tokens=4)
+    assert worker.get_kv_cache_layout().speculative_tokens == 4
+
+
+def test_prefix_cache_is_cleared_on_every_shard():
+    model = _make_model()
+    store = torch.distributed.HashStore()
+    num_bytes = {}
+
+    def run(rank: int):
+        fake_model = _FakeModel(model)
+        fake_model.process_group = torch.distributed.ProcessGroupGloo(
+            store, rank, 2, timedelta(seconds=30)
+        )
+        worker = InferenceWorker(lambda: fake_model, prefix_cache_max_bytes=1 << 20)
+        tree = worker._prefix_cache.tree
+        segment = KVSegment([(torch.zeros(1, 2, 4, 16), torch.zeros(1, 2, 4, 16))])
+        tree.insert([1, 2, 3, 4], lambda start, end: segment)
+        # Only rank 1 ran out of memory, both shards clear their cache.
+        worker._prefix_cache_stale = rank == 1
+        worker._sync_prefix_cache()
+        num_bytes[rank] = tree.num_bytes
+        # Nothing to clear.
+        tree.insert([1, 2, 3, 4], lambda start, end: segment)
+        worker._sync_prefix_cache()
+        num_bytes[rank] += tree.num_bytes
+
+    threads = [threading.Thread(target=run, args=(rank,)) for rank in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert num_bytes == {0: 1024, 1: 1024}
+
+
+def test_chunked_prefill_matches_prefill():
+    model = _make_model()
+    fake_model = _FakeModel(model)
+    worker = InferenceWorker(lambda: fake_model)
+    decoder = _Decoder(worker, max_new_tokens=4)
+    prompts = {i: PROMPTS[i] for i in range(3)}
+
+    with torch.inference_mode():
+        fake_model.generate_token(make_causal_lm_batch(prompts, 4))
+        expected = fake_model.last_logits
+        worker._partial_batches[1] = (
+            make_causal_lm_batch(prompts, 4, batch_id=1),
+            None,
+        )
+        # 3 columns of the 8 per chunk, the last 2 are left to the prefill.
+        assert worker.prefill_chunk(None, 1, 9) == 3 * 5
+        assert worker.prefill_chunk(None, 1, 9) == 3 * 2
+        assert worker.prefill_chunk(None, 1, 9) == 0
+        generations, batch_id = worker.process_new_batch(None, 1)
+        torch.testing.assert_close(fake_model.last_logits, expected)
+
+        decoder._record(generations)
+        decoder.finish(batch_id)
+
+    for request_id in prompts:
+        assert decoder.outputs[request_id] == _greedy(model, PROMPTS[request_id], 4)
+
+
+def test_step_failed_on_one_shard_is_undone_on_every_shard():
+    model = _make_model()
+    store = torch.distributed.HashStore()
+    errors = {}
+    batches = {}
+    outputs = {}
+
+    def run(rank: int):
+        fake_model = _FakeModel(model)
+        fake_model.process_group = torch.distributed.ProcessGroupGloo(
+            store, rank, 2, timedelta(seconds=30)
+        )
+        worker = InferenceWorker(lambda: fake_model)
+        decoder = _Decoder(worker, max_new_tokens=4)
+        with torch.inference_mode():
+            batch_id = decoder.prefill(0, {i: PROMPTS[i] for i in range(3)})
+            batch_id = decoder.step([batch_id])
+            # Only rank 1 fails, after the next token of its first two rows.
+            fake_model.fail_at_row = 2 if rank == 1 else None
+            try:
+                decoder.step([batch_id])
+            except StepFailedError as e:
+                errors[rank] = e
+            batch = worker._batch_state_cache[batch_id]
+            batches[rank] = (
+                list(batch.input_lengths),
+                [s.current_tokens for s in batch.stopping_criterias],
+            )
+            decoder.finish(batch_id)
+        outputs[rank] = decoder.outputs
+
+    threads = [threading.Thread(target=run, args=(rank,)) for rank in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [errors[rank].request_ids_by_batch for rank in range(2)] == [
+        {0: [0, 1, 2]}
+    ] * 2
+    assert (
+        batches[0]
+        == batches[1]
+        == (
+            [len(PROMPTS[i]) + 2 for i in range(3)],
+            [2, 2, 2],
+        )
+    )
+    for rank in range(2):
+        for request_id in range(3):
+            expected = _greedy(model, PROMPTS[request_id], 4)
+            assert outputs[rank][request_id] == expected
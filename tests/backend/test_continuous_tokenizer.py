@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+import ray
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+from transformers import PreTrainedTokenizerFast
+
+from aviary.backend.llm.continuous import scheduler as scheduler_module
+from aviary.backend.llm.continuous.scheduler import RayTokenizerPool, TokenizerWorker
+
+
+@pytest.fixture(scope="module")
+def ray_cluster():
+    ray.init(num_cpus=1, include_dashboard=False)
+    yield
+    ray.shutdown()
+
+
+def _make_tokenizer():
+    vocab = {"<unk>": 0}
+    vocab.update({f"w{i}": i + 1 for i in range(10)})
+    backend = Tokenizer(WordLevel(vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = Whitespace()
+    return PreTrainedTokenizerFast(tokenizer_object=backend, unk_token="<unk>")
+
+
+class _RemoteMethod:
+    def __init__(self, method):
+        self._method = method
+
+    def remote(self, *args):
+        return ray.put(self._method(*args))
+
+
+class _LocalTokenizerWorker:
+    """Runs a TokenizerWorker in the driver, returning ObjectRefs like its
+    actor would, and counts the calls made to it."""
+
+    def __init__(self, tokenizer):
+        self.worker = TokenizerWorker(tokenizer)
+        self.calls = []
+        self.get_input_lengths = _RemoteMethod(self._get_input_lengths)
+
+    def _get_input_lengths(self, input_texts, max_length):
+        self.calls.append(input_texts)
+        return self.worker.get_input_lengths(input_texts, max_length)
+
+
+def _make_pool(**kwargs) -> RayTokenizerPool:
+    pool = RayTokenizerPool(_make_tokenizer(), num_workers=0, **kwargs)
+    pool._workers = [_LocalTokenizerWorker(_make_tokenizer())]
+    return pool
+
+
+def _num_calls(pool: RayTokenizerPool) -> int:
+    return len(pool._workers[0].calls)
+
+
+def test_tokenizer_pool_batches_and_dedupes_calls(ray_cluster):
+    async def run(pool):
+        return await asyncio.gather(
+            *[
+                pool.get_input_length_async(text, 8)
+                for text in ["w1 w2", "w3", "w1 w2", "w4 w5 w6"]
+            ]
+        )
+
+    pool = _make_pool()
+    assert asyncio.run(run(pool)) == [2, 1, 2, 3]
+    # One batch, with each distinct prompt once.
+    assert pool._workers[0].calls == [["w1 w2", "w3", "w4 w5 w6"]]
+    assert pool._in_flight == {}
+
+    pool = _make_pool(max_batch_size=2)
+    assert asyncio.run(run(pool)) == [2, 1, 2, 3]
+    assert _num_calls(pool) == 2
+
+
+def test_tokenizer_pool_caches_input_lengths(ray_cluster):
+    pool = _make_pool(cache_size=2)
+    assert pool.get_input_length("w1 w2 w3", 8) == 3
+    assert pool.get_input_length("w1 w2 w3", 2) == 2
+    assert _num_calls(pool) == 2
+    assert pool.get_input_length("w1 w2 w3", 8) == 3
+    assert asyncio.run(pool.get_input_length_async("w1 w2 w3", 8)) == 3
+    assert _num_calls(pool) == 2
+
+    # The least recently used count is evicted.
+    assert pool.get_input_length("w4", 8) == 1
+    assert pool.get_input_length("w1 w2 w3", 8) == 3
+    assert _num_calls(pool) == 3
+    assert pool.get_input_length("w1 w2 w3", 2) == 2
+    assert _num_calls(pool) == 4
+
+
+def test_tokenizer_pool_does_not_share_counts_of_colliding_prompts(
+    ray_cluster, monkeypatch
+):
+    # Every prompt has the same hash.
+    monkeypatch.setattr(scheduler_module, "hash", lambda _: 0, raising=False)
+    pool = _make_pool()
+    assert pool.get_input_length("w1", 8) == 1
+    assert pool.get_input_length("w1 w2 w3", 8) == 3
+
+    async def run():
+        return await asyncio.gather(
+            pool.get_input_length_async("w4 w5", 8),
+            pool.get_input_length_async("w6 w7 w8 w9", 8),
+        )
+
+    assert asyncio.run(run()) == [2, 4]
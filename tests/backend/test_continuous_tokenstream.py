@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+import pytest
+
+from aviary.backend.llm.continuous.tokenstream import SlowReaderError, TokenStream
+
+
+def test_token_stream_coalesces_tokens():
+    async def run():
+        stream = TokenStream(0, chunk_tokens=3, chunk_interval_s=100)
+        chunks = stream.chunks()
+
+        # The first token is delivered right away.
+        stream.put("a")
+        assert await chunks.__anext__() == ("a", 1)
+
+        stream.put("b")
+        stream.put("c")
+        next_chunk = asyncio.ensure_future(chunks.__anext__())
+        await asyncio.sleep(0.01)
+        assert not next_chunk.done()
+        stream.put("d")
+        assert await next_chunk == ("bcd", 3)
+
+        # Everything left is delivered when the stream ends.
+        stream.put("e")
+        stream.end("abcde")
+        assert [chunk async for chunk in chunks] == [("e", 1)]
+        assert stream.num_tokens() == 5
+        assert stream.generated_text() == "abcde"
+
+    asyncio.run(run())
+
+
+def test_token_stream_defaults_to_one_token_per_chunk():
+    async def run():
+        stream = TokenStream(0)
+        stream.put("a")
+        stream.put("b")
+        assert await stream.__anext__() == "ab"
+        stream.put("c")
+        assert await stream.__anext__() == "c"
+
+    asyncio.run(run())
+
+
+def test_token_stream_chunk_interval():
+    async def run():
+        stream = TokenStream(0, chunk_tokens=100, chunk_interval_s=0.05)
+        stream.put("a")
+        assert await stream.__anext__() == "a"
+
+        stream.put("b")
+        start = time.monotonic()
+        # The partial chunk is flushed once the interval passed, without
+        # waiting for the next token.
+        assert await stream.__anext__() == "b"
+        assert time.monotonic() - start >= 0.04
+
+    asyncio.run(run())
+
+
+def test_token_stream_slow_reader():
+    async def run():
+        stream = TokenStream(0, max_pending_tokens=10)
+        stream.put("a")
+        assert await stream.__anext__() == "a"
+        for _ in range(10):
+            stream.put("b")
+        assert not stream.overflowed()
+        stream.put("c")
+        assert stream.overflowed()
+        # Tokens put after the overflow are dropped.
+        stream.put("d")
+        assert stream.num_tokens() == 12
+
+        chunks = stream.chunks()
+        assert await chunks.__anext__() == ("b" * 10 + "c", 11)
+        with pytest.raises(SlowReaderError):
+            await chunks.__anext__()
+
+        # Readers aren't failed unless a cap is set.
+        stream = TokenStream(1)
+        for _ in range(100_000):
+            stream.put("e")
+        assert not stream.overflowed()
+        assert await stream.__anext__() == "e" * 100_000
+
+    asyncio.run(run())
@@ -0,0 +1,230 @@
+import asyncio
+from typing import Dict, List
+
+import pytest
+import torch
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+from aviary.backend.llm.continuous.hf_transformers.paged_kv_cache import (
+    PagedAttention,
+)
+from aviary.backend.llm.continuous.hf_transformers.transformers_worker import (
+    FINISH_REASON_LENGTH,
+    FINISH_REASON_STOP_SEQUENCE,
+    TransformersInferenceWorker,
+    TransformersRequest,
+)
+from aviary.backend.llm.continuous.policy import QuotaBasedRequestSelectionPolicy
+from aviary.backend.llm.continuous.queue import PriorityRequestQueue
+from aviary.backend.llm.continuous.ray_worker import LocalInferenceWorker
+from aviary.backend.llm.continuous.resident import ThreadTokenizer
+from aviary.backend.llm.continuous.scheduler import AsyncInferenceScheduler
+from aviary.backend.llm.pipelines import ContinuousTransformersPipeline
+
+WORDS = [f"w{i}" for i in range(30)]
+
+
+def _make_model_and_tokenizer():
+    vocab = {"<pad>": 0, "<eos>": 1, "<unk>": 2}
+    vocab.update({word: i + 3 for i, word in enumerate(WORDS)})
+    backend = Tokenizer(WordLevel(vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = Whitespace()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        pad_token="<pad>",
+        eos_token="<eos>",
+        unk_token="<unk>",
+    )
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(
+        GPT2Config(
+            vocab_size=len(vocab),
+            n_positions=128,
+            n_embd=32,
+            n_layer=2,
+            n_head=2,
+            bos_token_id=1,
+            eos_token_id=1,
+        )
+    ).eval()
+    return model, tokenizer
+
+
+@torch.inference_mode()
+def _greedy(model, token_ids: List[int], max_new_tokens: int) -> List[int]:
+    """Greedy decoding of a single prompt, without padding or KV cache."""
+    token_ids = list(token_ids)
+    output = []
+    for _ in range(max_new_tokens):
+        logits = model(torch.tensor([token_ids])).logits[0, -1]
+        output.append(int(logits.argmax()))
+        token_ids.append(output[-1])
+    return output
+
+
+def _request(id: int, prompt: str, max_new_tokens: int, **kwargs):
+    return TransformersRequest(
+        id=id,
+        inputs=prompt,
+        truncate=64,
+        max_new_tokens=max_new_tokens,
+        ignore_eos_token=True,
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize(
+    "kv_cache_block_size,paged_attention", [(0, False), (4, True), (4, False)]
+)
+def test_transformers_worker_matches_greedy_decoding(
+    kv_cache_block_size, paged_attention, monkeypatch
+):
+    if not paged_attention:
+        monkeypatch.setattr(PagedAttention, "supports", lambda model: False)
+    model, tokenizer = _make_model_and_tokenizer()
+    worker = TransformersInferenceWorker(
+        model, tokenizer, kv_cache_block_size=kv_cache_block_size
+    )
+    if paged_attention:
+
+        def gather(batch):
+            raise AssertionError("The past was gathered from the blocks.")
+
+        worker._gather = gather
+    worker.warmup([_request(0, "w1", 1)], 0, 256)
+    prompts = {
+        0: "w1 w2 w3",
+        1: "w4 w5 w6 w7 w8 w9 w10",
+        2: "w11 w12 w13 w14 w15",
+    }
+    max_new_tokens = {0: 4, 1: 9, 2: 6}
+    expected = {
+        id: _greedy(model, tokenizer(prompt)["input_ids"], max_new_tokens[id])
+        for id, prompt in prompts.items()
+    }
+    # Stop request 3 at the first occurrence of the third token of request 2.
+    stop_word = tokenizer.decode(expected[2][2])
+    stop_length = expected[2].index(expected[2][2]) + 1
+    prompts[3] = prompts[2]
+    expected[3] = expected[2][:stop_length]
+
+    outputs: Dict[int, List[int]] = {id: [] for id in prompts}
+    finished = {}
+
+    def collect(generations):
+        for generation in generations:
+            outputs[generation.request_id].append(generation.token_id)
+            if generation.generated_text is not None:
+                finished[generation.request_id] = generation.generated_text
+        return [g.request_id for g in generations if g.generated_text is None]
+
+    generations, first = worker.process_new_batch(
+        [_request(0, prompts[0], 4), _request(1, prompts[1], 9)], 0
+    )
+    collect(generations)
+    generations, first = worker.generate_next_token([first])
+    collect(generations)
+    # A new, longer batch joins the first one.
+    generations, second = worker.process_new_batch(
+        [
+            _request(2, prompts[2], 6),
+            _request(3, prompts[3], 6, stop_sequences=[stop_word]),
+        ],
+        1,
+    )
+    unfinished = collect(generations)
+    batch_id = worker.filter_requests(second, unfinished)
+    batch_ids = [first, batch_id]
+    while batch_ids:
+        generations, batch_id = worker.generate_next_token(batch_ids)
+        unfinished = collect(generations)
+        if len(unfinished) < len(generations):
+            batch_id = worker.filter_requests(batch_id, unfinished)
+        batch_ids = [batch_id] if batch_id is not None else []
+
+    assert outputs == expected
+    assert worker._batches == {}
+    if kv_cache_block_size:
+        assert worker._kv_cache.block_manager.num_used_blocks == 0
+        assert (worker._paged_attention is not None) == paged_attention
+    for id, generated_text in finished.items():
+        assert generated_text.text == tokenizer.decode(expected[id])
+        assert generated_text.generated_tokens == len(expected[id])
+        assert generated_text.finish_reason == (
+            FINISH_REASON_STOP_SEQUENCE if id == 3 else FINISH_REASON_LENGTH
+        )
+
+
+@pytest.mark.parametrize("kv_cache_block_size", [0, 4])
+def test_continuous_transformers_pipeline_serves_requests_on_cpu(kv_cache_block_size):
+    model, tokenizer = _make_model_and_tokenizer()
+    pipeline = ContinuousTransformersPipeline(
+        TransformersInferenceWorker(
+            model, tokenizer, kv_cache_block_size=kv_cache_block_size
+        ),
+        tokenizer,
+    )
+    pipeline.model.warmup([_request(0, "w1", 1)], 0, 256)
+    prompts = ["w1 w2 w3", "w4 w5 w6 w7 w8 w9 w10", "w11", "w12 w13 w14 w15"]
+    max_new_tokens = [5, 12, 3, 8]
+    expected = [
+        tokenizer.decode(_greedy(model, tokenizer(prompt)["input_ids"], n))
+        for prompt, n in zip(prompts, max_new_tokens)
+    ]
+
+    async def run():
+        scheduler = AsyncInferenceScheduler(
+            tokenizer=ThreadTokenizer(pipeline.get_input_length),
+            inference_worker_loader=lambda: LocalInferenceWorker(pipeline, []),
+            request_selection_policy=QuotaBasedRequestSelectionPolicy(
+                max_batch_total_tokens=256, max_batch_prefill_tokens=64
+            ),
+            request_queue=PriorityRequestQueue(),
+            max_decode_steps=4,
+        )
+        params = {"repetition_penalty": 1.0, "ignore_eos_token": True}
+        streams = [
+            await scheduler.process_request_async(
+                prompt, params, max_new_tokens=n, max_length=64
+            )
+            for prompt, n in zip(prompts, max_new_tokens)
+        ]
+        texts = [
+            "".join([text async for text, _ in stream.chunks()]) for stream in streams
+        ]
+        scheduler.stop()
+        return texts
+
+    texts = asyncio.run(run())
+    assert [text.strip() for text in texts] == expected
+    assert pipeline.model._batches == {}
+
+
+def test_paged_transformers_worker_shares_prompt_blocks():
+    model, tokenizer = _make_model_and_tokenizer()
+    worker = TransformersInferenceWorker(model, tokenizer, kv_cache_block_size=4)
+    worker.warmup([_request(0, "w1", 1)], 0, 64)
+    block_manager = worker._kv_cache.block_manager
+    prompt = "w1 w2 w3 w4 w5 w6 w7 w8 w9 w10"
+    expected = _greedy(model, tokenizer(prompt)["input_ids"], 3)
+
+    _, batch_id = worker.process_new_batch(
+        [_request(0, prompt, 3), _request(1, prompt, 3)], 0
+    )
+    # Both prompts share their 2 full blocks and take a block each for
+    # their last 2 tokens and first generated one.
+    assert block_manager.num_used_blocks == 4
+    sequences = worker._batches[batch_id].sequences
+    assert sequences[0].block_table[:2] == sequences[1].block_table[:2]
+
+    batch_id = worker.filter_requests(batch_id, [1])
+    assert block_manager.num_used_blocks == 3
+    outputs = []
+    while batch_id is not None:
+        generations, batch_id = worker.generate_next_token([batch_id])
+        outputs.extend(generation.token_id for generation in generations)
+    assert outputs == expected[1:]
+    assert block_manager.num_used_blocks == 0
@@ -0,0 +1,75 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from fastapi.exception_handlers import http_exception_handler
+
+from aviary.backend.llm.continuous.policy import QuotaBasedRequestSelectionPolicy
+from aviary.backend.llm.continuous.queue import PriorityRequestQueue
+from aviary.backend.llm.continuous.scheduler import InferenceScheduler, NaiveTokenizer
+from aviary.backend.server.app import ContinuousBatchingLLMDeployment
+from aviary.backend.server.batch import QueuePriority
+from aviary.backend.server.exceptions import ServerOverloadedError
+
+check_admission = ContinuousBatchingLLMDeployment.func_or_class.check_admission
+
+
+def _make_deployment(scheduler: InferenceScheduler, max_estimated_queue_wait_s):
+    """The parts of a deployment check_admission uses, with a predictor
+    backed by a real scheduler."""
+    predictor = SimpleNamespace(
+        is_initialized=lambda: True,
+        estimate_queue_wait_s=scheduler.estimate_queue_wait_s,
+        request_shed=scheduler.request_shed,
+    )
+    generation = SimpleNamespace(max_estimated_queue_wait_s=max_estimated_queue_wait_s)
+    return SimpleNamespace(
+        args=SimpleNamespace(model_config=SimpleNamespace(generation=generation)),
+        predictor=predictor,
+    )
+
+
+def _rejection(deployment) -> ServerOverloadedError:
+    with pytest.raises(ServerOverloadedError) as exc_info:
+        asyncio.run(check_admission(deployment, QueuePriority.GENERATE_TEXT))
+    return exc_info.value
+
+
+def test_requests_are_shed_with_503_and_retry_after():
+    scheduler = InferenceScheduler(
+        tokenizer=NaiveTokenizer(),
+        inference_worker_loader=lambda: None,
+        request_selection_policy=QuotaBasedRequestSelectionPolicy(),
+        request_queue=PriorityRequestQueue(),
+        inline=True,
+    )
+    deployment = _make_deployment(scheduler, max_estimated_queue_wait_s=5)
+
+    # Nothing is queued.
+    asyncio.run(check_admission(deployment, QueuePriority.GENERATE_TEXT))
+
+    # 2 input tokens + 8 new tokens are queued before any throughput is
+    # measured, so the wait is unknown.
+    scheduler.process_request("a b", {}, max_new_tokens=8, max_length=20)
+    error = _rejection(deployment)
+    assert error.status_code == 503
+    assert error.headers == {"Retry-After": "5"}
+    assert scheduler._stats.num_requests_shed == 1
+
+    response = asyncio.run(http_exception_handler(None, error))
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    assert "queue wait" in json.loads(response.body)["detail"]
+
+    scheduler._stats.tokens_released_per_s = 5
+    asyncio.run(check_admission(deployment, QueuePriority.GENERATE_TEXT))
+
+    # 30 tokens queued at 5 tokens/s, 1 s over the max wait.
+    scheduler.process_request("a b c d", {}, max_new_tokens=16, max_length=20)
+    assert _rejection(deployment).headers == {"Retry-After": "1"}
+    assert scheduler._stats.num_requests_shed == 2
+
+    # Shedding is disabled.
+    deployment = _make_deployment(scheduler, max_estimated_queue_wait_s=None)
+    asyncio.run(check_admission(deployment, QueuePriority.GENERATE_TEXT))